@@ -0,0 +1,98 @@
+# benchmarks/bench_document_qa.py
+#
+# Compares what handle_document sends to Gemini before and after retrieval:
+#   * first analysis: the whole extracted text vs. the map-reduce prompts
+#   * follow-up question: the whole text again vs. the top-k BM25 chunks
+# and times the local work (chunking, index build, search).
+#
+# With --live (and GEMINI_API_KEY set) it also measures time-to-first-token of the
+# follow-up prompts against the real API; otherwise only sizes and local timings are
+# reported (tokens are estimated at ~4 characters per token).
+#
+# Usage (from the project root):
+#   python -m benchmarks.bench_document_qa
+#   python -m benchmarks.bench_document_qa --sizes 50000,300000 --live
+
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bot.document_index import (DocumentIndex, chunk_text, group_chunks,  # noqa: E402
+                                DOC_MAP_SECTION_CHARS, DOC_TOP_K)
+
+CHARS_PER_TOKEN = 4
+WORDS = ("cell membrane protein enzyme energy reaction molecule gene acid structure function "
+         "process system theory model equation force mass velocity field charge current "
+         "market price demand supply capital labour policy state law history empire treaty").split()
+
+
+def make_document(num_chars: int, seed: int = 7) -> str:
+    rng = random.Random(seed)
+    paragraphs = []
+    total = 0
+    while total < num_chars:
+        paragraph = " ".join(rng.choice(WORDS) for _ in range(rng.randint(40, 120))) + "."
+        paragraphs.append(paragraph)
+        total += len(paragraph) + 2
+    # One paragraph the follow-up question is about.
+    paragraphs.insert(len(paragraphs) * 2 // 3,
+                      "The Krebs cycle takes place in the mitochondrial matrix and yields NADH and FADH2.")
+    return "\n\n".join(paragraphs)
+
+
+def tokens(num_chars: int) -> int:
+    return num_chars // CHARS_PER_TOKEN
+
+
+async def time_to_first_token(prompt: str) -> float:
+    from bot.gemini_utils import ask_gemini_stream
+
+    start = time.perf_counter()
+    async for _ in ask_gemini_stream(prompt, [], "You are a helpful study assistant."):
+        return time.perf_counter() - start
+    return float("nan")
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark document Q&A prompt sizes.")
+    parser.add_argument("--sizes", default="10000,100000,300000", help="Comma-separated document sizes (chars).")
+    parser.add_argument("--live", action="store_true", help="Measure time-to-first-token against Gemini.")
+    args = parser.parse_args()
+    question = "Where does the Krebs cycle take place and what does it yield?"
+
+    print(f"{'doc chars':>10} | {'analysis before':>15} | {'largest map/reduce':>18} | "
+          f"{'follow-up before':>16} | {'follow-up after':>15} | {'index+search':>12}")
+    print("-" * 102)
+    for size in (int(s) for s in args.sizes.split(",")):
+        text = make_document(size)
+
+        start = time.perf_counter()
+        index = DocumentIndex.from_text("bench.pdf", text)
+        relevant_chunks = index.top_chunks(question)
+        local_ms = (time.perf_counter() - start) * 1000
+
+        sections = group_chunks(chunk_text(text)) if len(text) > DOC_MAP_SECTION_CHARS else [text]
+        # A section summary is roughly a tenth of the section; the reduce prompt holds all of them.
+        largest_prompt = max(max(len(section) for section in sections), sum(len(s) // 10 for s in sections))
+        follow_up_after = sum(len(chunk) for chunk in relevant_chunks)
+        assert any("Krebs" in chunk for chunk in relevant_chunks)
+
+        print(f"{len(text):>10} | {tokens(len(text)):>8} tokens | {tokens(largest_prompt):>11} tokens | "
+              f"{tokens(len(text)):>9} tokens | {tokens(follow_up_after):>8} tokens | {local_ms:>9.1f} ms")
+
+        if args.live:
+            before = await time_to_first_token(f"Question: {question}\n\n---\n{text}\n---")
+            after = await time_to_first_token(f"Question: {question}\n\n---\n" + "\n---\n".join(relevant_chunks))
+            print(f"{'':>10}   follow-up TTFT: before {before * 1000:.0f} ms, after {after * 1000:.0f} ms")
+
+    print(f"\nTop-k = {DOC_TOP_K} chunks; map sections of {DOC_MAP_SECTION_CHARS} chars run concurrently, "
+          f"so the first analysis is bounded by the largest single prompt rather than the document size.")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,113 @@
+# benchmarks/bench_markdown.py
+#
+# Times transform_markdown_fallback (the plain-text fallback used when Telegram rejects
+# a MarkdownV2 message) against the original uncompiled regex cascade, on synthetic
+# Gemini-style answers: headings, bullet lists, bold/italic, inline code, fenced code
+# blocks and links, plus a marker-free prose case. Both outputs are checked for equality.
+#
+# Usage (from the project root):
+#   python -m benchmarks.bench_markdown
+#   python -m benchmarks.bench_markdown --sizes 1000,100000 --repeat 50
+
+import os
+import re
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "benchmark")
+os.environ.setdefault("GEMINI_API_KEY", "benchmark")
+os.environ.setdefault("MAX_CONVERSATION_TURNS", "10")
+
+from bot.telegram_bot import transform_markdown_fallback  # noqa: E402
+
+WORDS = ("the cell membrane regulates transport of ions and molecules while enzymes lower the "
+         "activation energy of a reaction so that the process reaches equilibrium faster").split()
+
+
+def reference_transform(text: str) -> str:
+    """The original cascade: every pass runs unconditionally with uncompiled patterns."""
+    text = text.replace('\r\n', '\n')
+    text = re.sub(r'```(?:[a-zA-Z0-9_.-]*)?\n(.*?)\n```', r'\1', text, flags=re.DOTALL | re.MULTILINE)
+    text = re.sub(r'```(.*?)```', r'\1', text, flags=re.DOTALL)
+    text = re.sub(r'`(.*?)`', r'\1', text)
+    text = re.sub(r'^\s*#{1,6}\s*(.*?)\s*$', r'\1', text, flags=re.MULTILINE)
+    text = re.sub(r'\[(.*?)\]\((.*?)\)', r'\1 (\2)', text)
+    for pattern in (r'\*\*(.*?)\*\*', r'__(.*?)__', r'\*(.*?)\*', r'_(.*?)_', r'~(.*?)~', r'\|\|(.*?)\|\|'):
+        text = re.sub(pattern, r'\1', text)
+    lines = []
+    for line in text.split('\n'):
+        stripped_line = line.lstrip()
+        if stripped_line.startswith(('* ', '- ', '+ ')):
+            line = ' ' * (len(line) - len(stripped_line)) + '• ' + stripped_line[2:]
+        lines.append(line)
+    return re.sub(r'\n{3,}', '\n\n', "\n".join(lines)).strip()
+
+
+def sentence(rng: random.Random) -> str:
+    words = [rng.choice(WORDS) for _ in range(rng.randint(8, 20))]
+    position = rng.randrange(len(words))
+    words[position] = rng.choice(("**{}**", "*{}*", "`{}`", "[{}](https://example.com)", "{}")).format(words[position])
+    return " ".join(words).capitalize() + "."
+
+
+def make_answer(num_chars: int, seed: int = 11) -> str:
+    rng = random.Random(seed)
+    blocks = []
+    total = 0
+    while total < num_chars:
+        kind = rng.random()
+        if kind < 0.15:
+            block = f"## {sentence(rng)[:40]}"
+        elif kind < 0.45:
+            block = "\n".join(f"{rng.choice(('*', '-', '  *'))} {sentence(rng)}" for _ in range(rng.randint(2, 5)))
+        elif kind < 0.55:
+            block = "```python\n" + "\n".join(f"value_{i} = compute({i})" for i in range(rng.randint(2, 6))) + "\n```"
+        else:
+            block = " ".join(sentence(rng) for _ in range(rng.randint(2, 5)))
+        blocks.append(block)
+        total += len(block) + 2
+    return "\n\n".join(blocks)
+
+
+def make_prose(num_chars: int, seed: int = 11) -> str:
+    rng = random.Random(seed)
+    text = []
+    total = 0
+    while total < num_chars:
+        paragraph = " ".join(rng.choice(WORDS) for _ in range(60)) + "."
+        text.append(paragraph)
+        total += len(paragraph) + 2
+    return "\n\n".join(text)
+
+
+def best_time(func, text: str, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(text)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Markdown plain-text fallback transform.")
+    parser.add_argument("--sizes", default="1000,4000,10000,100000", help="Comma-separated answer sizes in characters")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    print(f"{'input':>16} {'chars':>8} {'reference':>11} {'current':>10} {'speedup':>8}")
+    for size in (int(value) for value in args.sizes.split(",")):
+        for label, text in (("gemini answer", make_answer(size)), ("plain prose", make_prose(size))):
+            assert transform_markdown_fallback(text) == reference_transform(text), f"output differs for {label} {size}"
+            reference = best_time(reference_transform, text, args.repeat)
+            current = best_time(transform_markdown_fallback, text, args.repeat)
+            print(f"{label:>16} {len(text):>8} {reference * 1000:>9.2f}ms {current * 1000:>8.2f}ms "
+                  f"{reference / current:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
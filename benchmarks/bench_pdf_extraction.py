@@ -0,0 +1,85 @@
+# benchmarks/bench_pdf_extraction.py
+#
+# Compares the old serial PDF loop (one process, `text += page.get_text()`) with the
+# parallel page-range extraction in bot.document_extraction, on generated 10, 100 and
+# 1000 page PDFs. Also reports how soon the first page is available when streaming.
+#
+# Usage (from the project root):
+#   python -m benchmarks.bench_pdf_extraction
+#   python -m benchmarks.bench_pdf_extraction --pages 10,100 --workers 4
+
+import os
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fitz  # noqa: E402
+
+from bot import document_extraction  # noqa: E402
+
+LINE = "The mitochondria is the powerhouse of the cell; ATP synthesis happens on the inner membrane."
+
+
+def make_pdf(path: str, num_pages: int) -> None:
+    pdf_doc = fitz.open()
+    for page_number in range(num_pages):
+        page = pdf_doc.new_page()
+        text = "\n".join(f"{page_number}.{line_number} {LINE}" for line_number in range(45))
+        page.insert_textbox(fitz.Rect(36, 36, 576, 806), text, fontsize=8)
+    pdf_doc.save(path)
+    pdf_doc.close()
+
+
+def serial_loop(path: str) -> str:
+    """The extraction loop the bot used before the process pool."""
+    text = ""
+    with fitz.open(path) as pdf_doc:
+        for page in pdf_doc:
+            text += page.get_text("text")
+    return text
+
+
+async def bench_parallel(path: str) -> tuple:
+    start = time.perf_counter()
+    first_page_seconds = None
+    async for page_number, _, _ in document_extraction.iter_pdf_pages(path, max_chars=10 ** 9):
+        if first_page_seconds is None:
+            first_page_seconds = time.perf_counter() - start
+    return time.perf_counter() - start, first_page_seconds
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark PDF text extraction.")
+    parser.add_argument("--pages", default="10,100,1000", help="Comma-separated page counts.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Extraction pool size.")
+    args = parser.parse_args()
+
+    document_extraction.DOCUMENT_WORKERS = args.workers
+    # Warm the pool up so process start-up is not counted against the first run.
+    document_extraction.get_extraction_pool().submit(int).result()
+
+    print(f"workers: {args.workers}")
+    print(f"{'pages':>6} | {'serial loop':>12} | {'parallel':>10} | {'first page':>10}")
+    print("-" * 50)
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            for num_pages in (int(p) for p in args.pages.split(",")):
+                path = os.path.join(directory, f"{num_pages}.pdf")
+                make_pdf(path, num_pages)
+
+                start = time.perf_counter()
+                serial_loop(path)
+                serial_seconds = time.perf_counter() - start
+                parallel_seconds, first_page_seconds = await bench_parallel(path)
+                print(f"{num_pages:>6} | {serial_seconds * 1000:>9.1f} ms | {parallel_seconds * 1000:>7.1f} ms | "
+                      f"{first_page_seconds * 1000:>7.1f} ms")
+    finally:
+        document_extraction.shutdown_extraction_pool()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,80 @@
+# benchmarks/bench_persistence.py
+#
+# Compares the time of one persistence run (the Application touching a few hundred
+# chats and then flushing) between PicklePersistence and SQLitePersistence, for stores
+# holding 10k, 100k and 1M chats.
+#
+# Usage (from the project root):
+#   python -m benchmarks.bench_persistence
+#   python -m benchmarks.bench_persistence --sizes 10000,100000 --dirty 500
+
+import os
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram.ext import PicklePersistence  # noqa: E402
+
+from bot.sqlite_persistence import SQLitePersistence, _dumps  # noqa: E402
+
+
+def make_chat_data(chat_id: int) -> dict:
+    """A chat_data entry shaped like the bot's real ones (a short conversation history)."""
+    return {
+        "conversation_history": [
+            {"role": "user", "parts": [{"text": f"Question {i} from chat {chat_id}"}]} for i in range(4)
+        ],
+        "mdv2_failed_for_msg_id": {},
+    }
+
+
+async def bench_pickle(directory: str, num_chats: int, num_dirty: int) -> float:
+    persistence = PicklePersistence(filepath=os.path.join(directory, "state.pkl"), on_flush=True)
+    await persistence.get_chat_data()
+    for chat_id in range(num_chats):
+        await persistence.update_chat_data(chat_id, make_chat_data(chat_id))
+    await persistence.flush()
+
+    start = time.perf_counter()
+    for chat_id in range(num_dirty):
+        await persistence.update_chat_data(chat_id, make_chat_data(chat_id + 1))
+    await persistence.flush()
+    return time.perf_counter() - start
+
+
+async def bench_sqlite(directory: str, num_chats: int, num_dirty: int) -> float:
+    persistence = SQLitePersistence(os.path.join(directory, "state.sqlite3"))
+    rows = {"user_data": {}, "bot_data": {},
+            "chat_data": {chat_id: _dumps(make_chat_data(chat_id)) for chat_id in range(num_chats)}}
+    persistence._write_batch(rows, {}, None)
+
+    start = time.perf_counter()
+    for chat_id in range(num_dirty):
+        await persistence.update_chat_data(chat_id, make_chat_data(chat_id + 1))
+    await persistence.flush()
+    elapsed = time.perf_counter() - start
+    persistence.close()
+    return elapsed
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark persistence flush time.")
+    parser.add_argument("--sizes", default="10000,100000,1000000", help="Comma-separated store sizes (chats).")
+    parser.add_argument("--dirty", type=int, default=200, help="Chats touched between two flushes.")
+    args = parser.parse_args()
+
+    print(f"{'chats':>10} | {'pickle flush':>13} | {'sqlite flush':>13}")
+    print("-" * 44)
+    for size in (int(s) for s in args.sizes.split(",")):
+        with tempfile.TemporaryDirectory() as directory:
+            pickle_seconds = await bench_pickle(directory, size, args.dirty)
+            sqlite_seconds = await bench_sqlite(directory, size, args.dirty)
+        print(f"{size:>10} | {pickle_seconds * 1000:>10.1f} ms | {sqlite_seconds * 1000:>10.1f} ms")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,155 @@
+# --- START OF FILE bot/cache_utils.py ---
+
+import sys
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Iterator, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class TTLCache:
+    """
+    A small LRU cache whose entries also expire after `ttl_seconds`.
+
+    The cache is bounded both by entry count and by an approximate memory budget
+    (`max_bytes`, measured with `size_func`, `sys.getsizeof` by default). When either
+    limit is exceeded, the least recently used entries are evicted first. Expiry uses
+    wall-clock time so entries can be saved to disk and restored after a restart.
+    """
+
+    def __init__(self, name: str, ttl_seconds: float, max_entries: int = 1024, max_bytes: int = 0,
+                 size_func: Callable[[Any], int] = sys.getsizeof):
+        self.name = name
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._size_func = size_func
+        # key -> (expires_at, size, value)
+        self._entries: "OrderedDict[Hashable, Tuple[float, int, Any]]" = OrderedDict()
+        self._total_bytes = 0
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        entry = self._entries.get(key)
+        return entry is not None and entry[0] > time.time()
+
+    @property
+    def total_bytes(self) -> int:
+        return self._total_bytes
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Returns the cached value (marking it recently used) or `default` when missing or expired."""
+        entry = self._entries.get(key)
+        if entry is None:
+            self.stats["misses"] += 1
+            return default
+        if entry[0] <= time.time():
+            self._remove(key)
+            self.stats["expirations"] += 1
+            self.stats["misses"] += 1
+            return default
+        self._entries.move_to_end(key)
+        self.stats["hits"] += 1
+        return entry[2]
+
+    def set(self, key: Hashable, value: Any, ttl_seconds: Optional[float] = None,
+            expires_at: Optional[float] = None) -> None:
+        """Stores a value; entries larger than the whole memory budget are not cached."""
+        size = self._size_func(value)
+        if self.max_bytes and size > self.max_bytes:
+            logger.debug(f"Cache '{self.name}': value of {size} bytes exceeds the budget, not cached.")
+            return
+        if key in self._entries:
+            self._remove(key)
+        if expires_at is None:
+            expires_at = time.time() + (self.ttl_seconds if ttl_seconds is None else ttl_seconds)
+        self._entries[key] = (expires_at, size, value)
+        self._total_bytes += size
+        self._evict()
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._entries.get(key)
+        if entry is None:
+            return default
+        self._remove(key)
+        return entry[2]
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._total_bytes = 0
+
+    def purge_expired(self) -> int:
+        """Drops all expired entries and returns how many were removed."""
+        now = time.time()
+        expired = [key for key, (expires_at, _, _) in self._entries.items() if expires_at <= now]
+        for key in expired:
+            self._remove(key)
+        self.stats["expirations"] += len(expired)
+        return len(expired)
+
+    def items(self) -> Iterator[Tuple[Hashable, float, Any]]:
+        """Yields (key, expires_at, value) for every live entry, oldest first."""
+        now = time.time()
+        for key, (expires_at, _, value) in list(self._entries.items()):
+            if expires_at > now:
+                yield key, expires_at, value
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Returns the counters plus current size, for /stats."""
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "entries": len(self._entries),
+            "bytes": self._total_bytes,
+            "hit_rate": (self.stats["hits"] / lookups * 100) if lookups else 0.0,
+        }
+
+    def _remove(self, key: Hashable) -> None:
+        _, size, _ = self._entries.pop(key)
+        self._total_bytes -= size
+
+    def _evict(self) -> None:
+        while self._entries and (len(self._entries) > self.max_entries or
+                                 (self.max_bytes and self._total_bytes > self.max_bytes)):
+            oldest_key = next(iter(self._entries))
+            self._remove(oldest_key)
+            self.stats["evictions"] += 1
+
+
+class SingleFlight:
+    """
+    Collapses concurrent calls for the same key into one in-flight coroutine.
+
+    The first caller starts `coro_factory()` as a task of its own; everyone who asks for the
+    same key while it is still running awaits the same result (or exception). Callers only
+    shield the task, so a caller that is cancelled leaves the work running for the others.
+    """
+
+    def __init__(self):
+        self._in_flight: Dict[Hashable, asyncio.Task] = {}
+        self.collapsed = 0
+
+    async def do(self, key: Hashable, coro_factory: Callable[[], Awaitable[Any]]) -> Any:
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.get_running_loop().create_task(coro_factory())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda finished: self._finished(key, finished))
+        else:
+            self.collapsed += 1
+        return await asyncio.shield(task)
+
+    def _finished(self, key: Hashable, task: asyncio.Task) -> None:
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+        if not task.cancelled():
+            # Mark retrieved so an exception nobody awaited any more is not logged as unhandled.
+            task.exception()
+
+# --- END OF FILE bot/cache_utils.py ---
@@ -0,0 +1,17 @@
+# --- START OF FILE bot/config_utils.py ---
+
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def env_number(name: str, default: float, cast=int):
+    """Reads a numeric setting from the environment, falling back to `default` if it is not valid."""
+    try:
+        return cast(os.getenv(name, default))
+    except ValueError:
+        logger.warning(f"{name} in .env is not valid. Using default {default}.")
+        return cast(default)
+
+# --- END OF FILE bot/config_utils.py ---
@@ -0,0 +1,253 @@
+# --- START OF FILE bot/context_cache.py ---
+
+import os
+import time
+import asyncio
+import itertools
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional, Set
+
+import google.generativeai as genai
+
+from .config_utils import env_number
+
+logger = logging.getLogger(__name__)
+
+
+# --- Context Cache Configuration ---
+# "gemini" creates server-side cached contents, "local" uses the offline stand-in below, "off" disables caching.
+GEMINI_CONTEXT_CACHE = os.getenv("GEMINI_CONTEXT_CACHE", "gemini").lower()
+GEMINI_CONTEXT_CACHE_TTL_SECONDS = env_number("GEMINI_CONTEXT_CACHE_TTL_SECONDS", 3600)
+GEMINI_DOCUMENT_CACHE_TTL_SECONDS = env_number("GEMINI_DOCUMENT_CACHE_TTL_SECONDS", 900)
+# Gemini refuses to cache less than this (the minimum for the 2.5 Flash models).
+GEMINI_CONTEXT_CACHE_MIN_TOKENS = env_number("GEMINI_CONTEXT_CACHE_MIN_TOKENS", 1024)
+# A document is sent inline until it is used this often; caching a one-off document only adds cost.
+# Uses are counted per document, across the different prompts and tools it is sent with
+# (e.g. a link's summary and the follow-up questions about it).
+GEMINI_DOCUMENT_CACHE_MIN_USES = env_number("GEMINI_DOCUMENT_CACHE_MIN_USES", 2)
+GEMINI_CONTEXT_CACHE_MAX_ENTRIES = env_number("GEMINI_CONTEXT_CACHE_MAX_ENTRIES", 128)
+
+CHARS_PER_TOKEN = 4
+# Used entries are extended back to their full TTL once less than this share of it is left.
+REFRESH_FRACTION = 0.5
+# Entries count as expired this long before the server drops them, so a request never races the expiry.
+EXPIRY_MARGIN_SECONDS = 30
+CREATE_FAILURE_BACKOFF_SECONDS = 300
+MAX_TRACKED_DOCUMENTS = 1024
+
+DOCUMENT_ACKNOWLEDGEMENT = "Understood. I will use this document to answer."
+
+
+def document_turns(document: str) -> List[Dict[str, Any]]:
+    """The turns a reference document is sent as, cached or not, ahead of the conversation history."""
+    return [
+        {'role': 'user', 'parts': [{'text': f"Reference document:\n\n{document}"}]},
+        {'role': 'model', 'parts': [{'text': DOCUMENT_ACKNOWLEDGEMENT}]},
+    ]
+
+
+def estimate_tokens(*texts: Optional[str]) -> int:
+    return sum(len(text) for text in texts if text) // CHARS_PER_TOKEN
+
+
+class LocalCachedContent:
+    """
+    Offline stand-in for `genai.caching.CachedContent` with the same create/update/delete
+    surface. Used by the tests and with GEMINI_CONTEXT_CACHE=local; nothing leaves the process.
+    """
+    store: Dict[str, "LocalCachedContent"] = {}
+    _ids = itertools.count(1)
+
+    def __init__(self, model: str, system_instruction: Optional[str], contents: Optional[list], ttl: int):
+        self.name = f"cachedContents/local-{next(self._ids)}"
+        self.model = model
+        self.system_instruction = system_instruction
+        self.contents = contents or []
+        text = "".join(part['text'] for turn in self.contents for part in turn['parts'])
+        self.usage_metadata = SimpleNamespace(total_token_count=estimate_tokens(system_instruction, text))
+        self.update(ttl=ttl)
+
+    @classmethod
+    def create(cls, model: str, *, system_instruction: Optional[str] = None, contents: Optional[list] = None,
+               tools: Any = None, tool_config: Any = None, ttl: int = 3600, **kwargs) -> "LocalCachedContent":
+        cached = cls(model, system_instruction, contents, ttl)
+        cls.store[cached.name] = cached
+        return cached
+
+    def update(self, *, ttl: int) -> None:
+        self.expire_time = datetime.now(timezone.utc) + timedelta(seconds=ttl)
+
+    def delete(self) -> None:
+        self.store.pop(self.name, None)
+
+
+@dataclass
+class _CacheEntry:
+    handle: Any
+    ttl: int
+    expires_at: float
+    tokens: int
+    is_document: bool
+    chat_ids: Set[int] = field(default_factory=set)
+
+
+class ContextCache:
+    """
+    Keeps server-side cached contents (system prompt, tools and optionally a reference
+    document) keyed by the caller's settings key.
+
+    `lookup` never waits on the network: a miss starts creating the cache in the background
+    and the current request goes out uncached, so caching never adds latency. Each use of an
+    entry close to expiry extends it in the background, so caches live as long as chats keep
+    using them and expire on the server otherwise.
+    """
+
+    def __init__(self, backend: Any = None):
+        self._backend = backend
+        self._entries: "OrderedDict[tuple, _CacheEntry]" = OrderedDict()
+        self._tasks: Dict[tuple, asyncio.Task] = {}
+        self._failed_until: Dict[tuple, float] = {}
+        self._document_uses: "OrderedDict[str, int]" = OrderedDict()
+        self._stats = {"hits": 0, "misses": 0, "created": 0, "refreshed": 0, "create_failures": 0,
+                       "skipped_small": 0, "cached_tokens_served": 0}
+
+    @property
+    def backend(self) -> Any:
+        if self._backend is None:
+            self._backend = LocalCachedContent if GEMINI_CONTEXT_CACHE == "local" else genai.caching.CachedContent
+        return self._backend
+
+    @property
+    def enabled(self) -> bool:
+        return GEMINI_CONTEXT_CACHE in ("gemini", "local")
+
+    def lookup(self, key: tuple, create_kwargs: Dict[str, Any], tokens: int,
+               document_id: Optional[str] = None, chat_id: Optional[int] = None) -> Optional[Any]:
+        """
+        Returns the cached content for `key`, or None if the request has to go out uncached.
+        `create_kwargs` (model, system_instruction, contents, tools, tool_config) describe
+        the cache to create on a miss; `tokens` is the estimated size of that content.
+        `document_id` identifies the reference document in the content, if any: it is only
+        cached once the document has been sent GEMINI_DOCUMENT_CACHE_MIN_USES times, whatever
+        the prompt and tools it was sent with.
+        """
+        is_document = document_id is not None
+        if not self.enabled:
+            return None
+        now = time.monotonic()
+        entry = self._entries.get(key)
+        if entry is not None and now < entry.expires_at - EXPIRY_MARGIN_SECONDS:
+            self._entries.move_to_end(key)
+            if chat_id is not None:
+                entry.chat_ids.add(chat_id)
+            self._stats["hits"] += 1
+            self._stats["cached_tokens_served"] += entry.tokens
+            if entry.expires_at - now < entry.ttl * REFRESH_FRACTION:
+                self._spawn(key, self._refresh(key, entry))
+            return entry.handle
+        if entry is not None:
+            del self._entries[key]  # Expired on the server by now.
+
+        if tokens < GEMINI_CONTEXT_CACHE_MIN_TOKENS:
+            self._stats["skipped_small"] += 1
+            return None
+        if is_document:
+            uses = self._document_uses.pop(document_id, 0) + 1
+            self._document_uses[document_id] = uses
+            while len(self._document_uses) > MAX_TRACKED_DOCUMENTS:
+                self._document_uses.popitem(last=False)
+            if uses < GEMINI_DOCUMENT_CACHE_MIN_USES:
+                return None
+        if key in self._tasks or now < self._failed_until.get(key, 0.0):
+            return None
+
+        self._stats["misses"] += 1
+        ttl = GEMINI_DOCUMENT_CACHE_TTL_SECONDS if is_document else GEMINI_CONTEXT_CACHE_TTL_SECONDS
+        self._spawn(key, self._create(key, create_kwargs, ttl, tokens, is_document, chat_id))
+        return None
+
+    def _spawn(self, key: tuple, coro) -> None:
+        if key in self._tasks:
+            coro.close()
+            return
+        task = asyncio.get_running_loop().create_task(coro)
+        self._tasks[key] = task
+        task.add_done_callback(lambda _: self._tasks.pop(key, None))
+
+    async def _create(self, key: tuple, create_kwargs: Dict[str, Any], ttl: int, tokens: int,
+                      is_document: bool, chat_id: Optional[int]) -> None:
+        try:
+            handle = await asyncio.to_thread(self.backend.create, ttl=ttl, **create_kwargs)
+        except Exception as e:
+            self._stats["create_failures"] += 1
+            self._failed_until[key] = time.monotonic() + CREATE_FAILURE_BACKOFF_SECONDS
+            logger.warning(f"Could not create Gemini context cache ({tokens} tokens est.): {e}")
+            return
+        usage = getattr(handle, "usage_metadata", None)
+        entry = _CacheEntry(handle, ttl, time.monotonic() + ttl, getattr(usage, "total_token_count", 0) or tokens,
+                            is_document)
+        if chat_id is not None:
+            entry.chat_ids.add(chat_id)
+        self._entries[key] = entry
+        self._stats["created"] += 1
+        logger.info(f"Created Gemini context cache {handle.name} ({entry.tokens} tokens, TTL {ttl}s).")
+        while len(self._entries) > max(GEMINI_CONTEXT_CACHE_MAX_ENTRIES, 1):
+            _, evicted = self._entries.popitem(last=False)
+            await self._delete(evicted)
+
+    async def _refresh(self, key: tuple, entry: _CacheEntry) -> None:
+        try:
+            await asyncio.to_thread(entry.handle.update, ttl=entry.ttl)
+        except Exception as e:
+            logger.warning(f"Could not extend Gemini context cache {entry.handle.name}: {e}")
+            self.invalidate(key)
+            return
+        entry.expires_at = time.monotonic() + entry.ttl
+        self._stats["refreshed"] += 1
+
+    @staticmethod
+    async def _delete(entry: _CacheEntry) -> None:
+        try:
+            await asyncio.to_thread(entry.handle.delete)
+        except Exception as e:
+            logger.debug(f"Could not delete Gemini context cache {entry.handle.name}: {e}")
+
+    def invalidate(self, key: tuple) -> None:
+        """Forgets an entry the server no longer has (Gemini answered that the cached content was not found)."""
+        self._entries.pop(key, None)
+
+    async def release_chat(self, chat_id: int) -> None:
+        """Drops the chat's claim on cached documents and deletes those no other chat is using."""
+        for key, entry in list(self._entries.items()):
+            if entry.is_document and chat_id in entry.chat_ids:
+                entry.chat_ids.discard(chat_id)
+                if not entry.chat_ids:
+                    del self._entries[key]
+                    await self._delete(entry)
+
+    async def close(self) -> None:
+        """Cancels pending work and deletes every cache this process created (called on shutdown)."""
+        for task in list(self._tasks.values()):
+            task.cancel()
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+        entries = list(self._entries.values())
+        self._entries.clear()
+        await asyncio.gather(*(self._delete(entry) for entry in entries))
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Returns process-local counters; `cached_tokens_served` is input that was not resent in full."""
+        return {**self._stats, "entries": len(self._entries),
+                "cached_tokens": sum(entry.tokens for entry in self._entries.values())}
+
+
+context_cache = ContextCache()
+
+
+def get_context_cache_stats() -> Dict[str, Any]:
+    return context_cache.get_stats()
+
+# --- END OF FILE bot/context_cache.py ---
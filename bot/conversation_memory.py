@@ -0,0 +1,175 @@
+# --- START OF FILE bot/conversation_memory.py ---
+
+import asyncio
+import logging
+from typing import Any, Dict, List, Optional
+
+from .config_utils import env_number
+from .gemini_utils import ask_gemini_non_stream
+from .gemini_admission import Priority
+
+logger = logging.getLogger(__name__)
+
+
+# --- History Budget Configuration ---
+# Tokens are estimated at ~4 characters each, which is close enough for Gemini on mixed text.
+CHARS_PER_TOKEN = 4
+HISTORY_TOKEN_BUDGET = env_number("HISTORY_TOKEN_BUDGET", 6000)
+HISTORY_SUMMARY_MAX_CHARS = env_number("HISTORY_SUMMARY_MAX_CHARS", 3000)
+# Each message of an oversized newest exchange (e.g. a document analysis) is stored
+# clipped to this share of the budget.
+HISTORY_MAX_TURN_SHARE = 0.45
+# Exchanges kept queued for the summary while Gemini is failing; older ones are dropped.
+HISTORY_MAX_UNSUMMARIZED_TURNS = 20
+
+HISTORY_KEY = "conversation_history"
+SUMMARY_KEY = "history_summary"
+UNSUMMARIZED_KEY = "history_unsummarized"  # Turns folded out of the history, not yet in the summary.
+# Bumped whenever the conversation is cleared, so a summary run started before /new never
+# writes into the new conversation.
+CONVERSATION_ID_KEY = "conversation_id"
+
+SUMMARY_SYSTEM_PROMPT = (
+    "You maintain the running memory of a conversation between a student and an AI study helper. "
+    "Merge the existing summary with the new turns into one concise summary in the conversation's "
+    "language: keep the topics, facts, definitions, decisions and open questions the assistant may "
+    "need later; drop greetings and filler."
+)
+
+_summary_tasks: Dict[int, asyncio.Task] = {}
+_memory_stats = {"turns_folded": 0, "summaries": 0, "summary_failures": 0, "turns_clipped": 0}
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def _turn_text(message: Dict[str, Any]) -> str:
+    return "".join(part.get('text', '') for part in message.get('parts', []) if isinstance(part, dict))
+
+
+def history_tokens(history: List[Dict[str, Any]]) -> int:
+    return sum(estimate_tokens(_turn_text(message)) for message in history)
+
+
+def get_history_for_prompt(chat_data: Dict[Any, Any]) -> List[Dict[str, Any]]:
+    """
+    Returns the history to send to Gemini: the running summary of folded turns (as a
+    leading user/model exchange, so roles still alternate) followed by the recent turns.
+    """
+    history = list(chat_data.get(HISTORY_KEY, []))
+    summary = chat_data.get(SUMMARY_KEY)
+    if summary:
+        history[:0] = [
+            {'role': 'user', 'parts': [{'text': f"Summary of our earlier conversation:\n{summary}"}]},
+            {'role': 'model', 'parts': [{'text': "Understood, I will keep that context in mind."}]},
+        ]
+    return history
+
+
+def _clip_turn(message: Dict[str, Any], max_chars: int) -> Dict[str, Any]:
+    text = _turn_text(message)
+    if len(text) <= max_chars:
+        return message
+    _memory_stats["turns_clipped"] += 1
+    return {'role': message['role'], 'parts': [{'text': text[:max_chars] + "\n[...]"}]}
+
+
+def append_turn(chat_data: Dict[Any, Any], user_text: str, model_text: str, max_turns: int,
+                chat_id: Optional[int] = None, application: Any = None) -> None:
+    """
+    Saves one user/model exchange and keeps the stored history within HISTORY_TOKEN_BUDGET
+    (and `max_turns` exchanges). Turns that no longer fit are moved, oldest first, to the
+    unsummarized queue, and a background task folds them into the running summary, so the
+    reply that was just delivered never waits for it. The newest exchange always stays; if
+    it alone exceeds the budget it is stored clipped (its full text goes to the summary).
+    """
+    user_turn = {'role': 'user', 'parts': [{'text': user_text}]}
+    model_turn = {'role': 'model', 'parts': [{'text': model_text}]}
+    history = chat_data.get(HISTORY_KEY, []) + [user_turn, model_turn]
+
+    folded = []
+    while len(history) > 2 and (len(history) > max_turns * 2 or history_tokens(history) > HISTORY_TOKEN_BUDGET):
+        folded.extend(history[:2])
+        history = history[2:]
+    max_turn_chars = int(HISTORY_TOKEN_BUDGET * HISTORY_MAX_TURN_SHARE * CHARS_PER_TOKEN)
+    if history_tokens(history) > HISTORY_TOKEN_BUDGET:
+        folded.extend(history)
+        history = [_clip_turn(message, max_turn_chars) for message in history]
+
+    chat_data[HISTORY_KEY] = history
+    if folded:
+        queue = chat_data.setdefault(UNSUMMARIZED_KEY, [])
+        queue.extend(folded)
+        del queue[:-HISTORY_MAX_UNSUMMARIZED_TURNS * 2]
+        _memory_stats["turns_folded"] += len(folded) // 2
+        schedule_summary(chat_data, chat_id, application)
+
+
+def schedule_summary(chat_data: Dict[Any, Any], chat_id: Optional[int] = None, application: Any = None) -> None:
+    """Starts folding the unsummarized turns into the summary, unless a run for this chat is already going."""
+    key = chat_id if chat_id is not None else id(chat_data)
+    if not chat_data.get(UNSUMMARIZED_KEY) or key in _summary_tasks:
+        return
+    task = asyncio.get_running_loop().create_task(_summarize(chat_data, chat_id, application))
+    _summary_tasks[key] = task
+
+    def on_done(finished: asyncio.Task) -> None:
+        if _summary_tasks.get(key) is finished:
+            del _summary_tasks[key]
+        # Turns folded while this run was in flight get their own run; after a failure
+        # they wait for the next fold instead of retrying in a loop.
+        if not finished.cancelled() and finished.exception() is None and finished.result():
+            schedule_summary(chat_data, chat_id, application)
+
+    task.add_done_callback(on_done)
+
+
+async def _summarize(chat_data: Dict[Any, Any], chat_id: Optional[int], application: Any) -> bool:
+    conversation_id = chat_data.get(CONVERSATION_ID_KEY, 0)
+    pending = list(chat_data.get(UNSUMMARIZED_KEY, []))
+    transcript = "\n\n".join(f"{message['role'].upper()}: {_turn_text(message)}" for message in pending)
+    prompt = (
+        f"Existing summary:\n{chat_data.get(SUMMARY_KEY) or '(none)'}\n\n"
+        f"New turns:\n{transcript[:HISTORY_TOKEN_BUDGET * CHARS_PER_TOKEN * 4]}\n\n"
+        f"Write the updated summary in at most {HISTORY_SUMMARY_MAX_CHARS // 6} words."
+    )
+    summary = await ask_gemini_non_stream(prompt=prompt, system_prompt=SUMMARY_SYSTEM_PROMPT, conversation_history=[],
+                                          priority=Priority.BACKGROUND)
+    if not summary or summary.startswith("[AI ERROR"):
+        # Keep the turns queued; the next fold retries them.
+        _memory_stats["summary_failures"] += 1
+        logger.warning(f"Chat {chat_id}: history summary failed; {len(pending)} turns stay queued.")
+        return False
+
+    if chat_data.get(CONVERSATION_ID_KEY, 0) != conversation_id or UNSUMMARIZED_KEY not in chat_data:
+        return False  # The history was cleared (/new) while the summary was being written.
+    chat_data[SUMMARY_KEY] = summary.strip()[:HISTORY_SUMMARY_MAX_CHARS]
+    del chat_data[UNSUMMARIZED_KEY][:len(pending)]
+    _memory_stats["summaries"] += 1
+    if application is not None and chat_id is not None:
+        application.mark_data_for_update_persistence(chat_ids=chat_id)
+    logger.info(f"Chat {chat_id}: folded {len(pending) // 2} turns into the history summary.")
+    return True
+
+
+def clear_conversation(chat_data: Dict[Any, Any], chat_id: Optional[int] = None) -> bool:
+    """
+    Removes the history, its summary and any queued turns, cancels the chat's summary run
+    and starts a new conversation id. Returns True if there was a history.
+    """
+    had_history = HISTORY_KEY in chat_data
+    for key in (HISTORY_KEY, SUMMARY_KEY, UNSUMMARIZED_KEY):
+        chat_data.pop(key, None)
+    chat_data[CONVERSATION_ID_KEY] = chat_data.get(CONVERSATION_ID_KEY, 0) + 1
+    task = _summary_tasks.pop(chat_id if chat_id is not None else id(chat_data), None)
+    if task is not None:
+        task.cancel()
+    return had_history
+
+
+def get_conversation_memory_stats() -> Dict[str, Any]:
+    """Returns process-local counters of folded/clipped turns and summary runs for /stats."""
+    return dict(_memory_stats)
+
+# --- END OF FILE bot/conversation_memory.py ---
@@ -0,0 +1,384 @@
+# --- START OF FILE bot/document_extraction.py ---
+
+import os
+import time
+import asyncio
+import logging
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import AsyncGenerator, Callable, List, Optional, Tuple, Union
+
+from .config_utils import env_number
+
+logger = logging.getLogger(__name__)
+
+# NOTE: This module is imported by the worker processes as well, so it must stay free
+# of side effects (no bot tokens, no Telegram or Gemini imports at module level).
+
+
+DOCUMENT_WORKERS = env_number("DOCUMENT_WORKERS", min(2, os.cpu_count() or 1))
+DOCUMENT_EXTRACTION_TIMEOUT = env_number("DOCUMENT_EXTRACTION_TIMEOUT", 60.0, cast=float)
+DOCUMENT_MAX_PAGES = env_number("DOCUMENT_MAX_PAGES", 1000)
+DOCUMENT_MAX_CHARS = env_number("DOCUMENT_MAX_CHARS", 300000)
+# Address-space limit per worker process in MB (0 = unlimited). Only enforced on Unix.
+DOCUMENT_WORKER_MEMORY_MB = env_number("DOCUMENT_WORKER_MEMORY_MB", 1024)
+# PDFs are split into page ranges of at least this many pages, spread across the workers.
+PDF_MIN_PAGES_PER_TASK = env_number("PDF_MIN_PAGES_PER_TASK", 8)
+# How long past its deadline a worker may take to return partial text before it is killed.
+WORKER_GRACE_SECONDS = 5.0
+
+TRUNCATION_NOTICE = "\n[...Content truncated due to length...]"
+
+PDF_MIME_TYPES = {"application/pdf"}
+DOCX_MIME_TYPES = {"application/vnd.openxmlformats-officedocument.wordprocessingml.document", "application/msword"}
+TEXT_MIME_TYPES = {"text/plain"}
+
+
+class DocumentExtractionError(Exception):
+    """Raised when a document cannot be extracted within the configured limits."""
+
+
+def detect_document_kind(mime_type: Optional[str], file_name: Optional[str]) -> Optional[str]:
+    """Returns 'pdf', 'docx' or 'txt' for supported documents, otherwise None."""
+    lower_name = (file_name or "").lower()
+    if mime_type in PDF_MIME_TYPES or lower_name.endswith(".pdf"):
+        return "pdf"
+    if mime_type in DOCX_MIME_TYPES or lower_name.endswith((".docx", ".doc")):
+        return "docx"
+    if mime_type in TEXT_MIME_TYPES or lower_name.endswith(".txt"):
+        return "txt"
+    return None
+
+
+# --- Worker-side functions (run inside the process pool) ---
+def _init_worker(memory_limit_mb: int) -> None:
+    """Applies the per-process memory limit in each worker."""
+    if memory_limit_mb <= 0:
+        return
+    try:
+        import resource
+        limit_bytes = memory_limit_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit_bytes, limit_bytes))
+    except (ImportError, ValueError, OSError):
+        # Windows has no 'resource' module; some platforms refuse RLIMIT_AS.
+        pass
+
+
+def _open_pdf(source: Union[str, bytes]):
+    import fitz
+
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return fitz.open(stream=source, filetype="pdf")
+    return fitz.open(source)
+
+
+def _count_pdf_pages(source: Union[str, bytes]) -> int:
+    with _open_pdf(source) as pdf_doc:
+        return pdf_doc.page_count
+
+
+def _extract_pdf_page_range(source: Union[str, bytes], start: int, stop: int, max_chars: int,
+                            deadline: float) -> Tuple[int, List[str], bool]:
+    """
+    Extracts pages [start, stop). Returns the start page, the page texts and whether the
+    range stopped early because it passed the char budget or the deadline.
+    """
+    page_texts = []
+    total_chars = 0
+    with _open_pdf(source) as pdf_doc:
+        for page_number in range(start, min(stop, pdf_doc.page_count)):
+            if total_chars > max_chars or time.time() > deadline:
+                return start, page_texts, True
+            page_text = pdf_doc[page_number].get_text("text")
+            page_texts.append(page_text)
+            total_chars += len(page_text)
+    return start, page_texts, False
+
+
+def _extract_pdf(source: Union[str, bytes], max_pages: int, max_chars: int, deadline: float) -> str:
+    """Serial PDF extraction within a single worker (used by `extract_text_sync`)."""
+    with _open_pdf(source) as pdf_doc:
+        page_count = pdf_doc.page_count
+    _, page_texts, stopped_early = _extract_pdf_page_range(source, 0, min(page_count, max_pages), max_chars,
+                                                           deadline)
+    return _join_pdf_pages(page_texts, max_chars, stopped_early or page_count > max_pages)
+
+
+def _join_pdf_pages(page_texts: List[str], max_chars: int, truncated: bool) -> str:
+    """Joins page texts once and applies the char budget."""
+    text = "".join(page_texts)
+    if len(text) > max_chars:
+        return text[:max_chars] + TRUNCATION_NOTICE
+    return text + TRUNCATION_NOTICE if truncated else text
+
+
+def _extract_docx(source: Union[str, bytes], max_chars: int, deadline: float) -> str:
+    import io
+    from docx import Document as DocxDocument
+
+    docx_doc = DocxDocument(io.BytesIO(bytes(source)) if not isinstance(source, str) else source)
+    paragraphs = []
+    total_chars = 0
+    for para in docx_doc.paragraphs:
+        if total_chars > max_chars or time.time() > deadline:
+            paragraphs.append(TRUNCATION_NOTICE)
+            break
+        paragraphs.append(para.text + "\n")
+        total_chars += len(para.text) + 1
+    return "".join(paragraphs)
+
+
+def _extract_txt(source: Union[str, bytes], max_chars: int) -> str:
+    if isinstance(source, str):
+        with open(source, 'r', encoding='utf-8', errors='ignore') as txt_file:
+            text = txt_file.read(max_chars + 1)
+    else:
+        text = bytes(source[:(max_chars + 1) * 4]).decode('utf-8', errors='ignore')
+    if len(text) > max_chars:
+        text = text[:max_chars] + TRUNCATION_NOTICE
+    return text
+
+
+def extract_text_sync(kind: str, source: Union[str, bytes], max_pages: int = DOCUMENT_MAX_PAGES,
+                      max_chars: int = DOCUMENT_MAX_CHARS, deadline: Optional[float] = None) -> str:
+    """
+    Extracts text from a file path or raw bytes, stopping at the page/char budgets or
+    the wall-clock deadline. This runs inside a pool worker.
+    """
+    deadline = deadline or float("inf")
+    if kind == "pdf":
+        return _extract_pdf(source, max_pages, max_chars, deadline)
+    if kind == "docx":
+        return _extract_docx(source, max_chars, deadline)
+    if kind == "txt":
+        return _extract_txt(source, max_chars)
+    raise DocumentExtractionError(f"Unsupported document kind: {kind}")
+
+
+# --- Event-loop side ---
+_pool: Optional[ProcessPoolExecutor] = None
+
+
+def get_extraction_pool() -> ProcessPoolExecutor:
+    """Returns the shared extraction pool, creating it on first use."""
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(
+            max_workers=max(DOCUMENT_WORKERS, 1),
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(DOCUMENT_WORKER_MEMORY_MB,),
+        )
+        logger.info(f"Document extraction pool started with {max(DOCUMENT_WORKERS, 1)} workers.")
+    return _pool
+
+
+def shutdown_extraction_pool(kill: bool = False) -> None:
+    """
+    Shuts the pool down. With `kill=True` the worker processes are terminated at once,
+    which is the only way to stop an extraction stuck inside a single page.
+    """
+    if _pool is not None:
+        _discard_pool(_pool, kill)
+
+
+def _discard_pool(pool: ProcessPoolExecutor, kill: bool = False) -> None:
+    """
+    Retires `pool` so the next job starts a fresh one. A killed pool fails the other jobs
+    still on it with BrokenProcessPool (rather than cancelling them), so they can be retried.
+    """
+    global _pool
+    if _pool is pool:
+        _pool = None
+    if kill:
+        for process in list(getattr(pool, "_processes", {}).values()):
+            process.terminate()
+        pool.shutdown(wait=False)
+    else:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+async def _run_in_pool(timeout: float, fn: Callable, *args):
+    """
+    Runs `fn(*args)` in the extraction pool. A worker that overruns `timeout` by the grace
+    period can only be stopped by killing the whole pool; the other jobs that were on it
+    are retried once on a fresh pool instead of failing along with it.
+    """
+    loop = asyncio.get_running_loop()
+    for attempt in range(2):
+        pool = get_extraction_pool()
+        try:
+            future = loop.run_in_executor(pool, fn, *args)
+            # Shielded so the timeout below decides how the job is stopped.
+            return await asyncio.wait_for(asyncio.shield(future), timeout=timeout + WORKER_GRACE_SECONDS)
+        except asyncio.CancelledError:
+            # The caller gave up: a job that is still queued never takes a worker.
+            future.cancel()
+            raise
+        except asyncio.TimeoutError:
+            logger.error(f"Document extraction exceeded {timeout:.0f}s; restarting the extraction pool.")
+            future.cancel()
+            _discard_pool(pool, kill=True)
+            raise DocumentExtractionError("Document extraction timed out.")
+        except BrokenProcessPool as e:
+            # Another job's overrun killed the pool, or a worker died, most likely after
+            # hitting the memory limit. A job that breaks a fresh pool too is the culprit.
+            _discard_pool(pool)
+            if attempt == 0:
+                logger.warning(f"Document extraction pool broke ({e}); retrying the job on a fresh pool.")
+                continue
+            logger.error(f"Document extraction worker crashed: {e}")
+            raise DocumentExtractionError("Document extraction worker crashed.") from e
+        except MemoryError as e:
+            raise DocumentExtractionError("Document needs more memory than the extraction limit allows.") from e
+
+
+def _write_temp_pdf(data: bytes) -> str:
+    with tempfile.NamedTemporaryFile(prefix="pdf_", suffix=".pdf", delete=False) as temp_file:
+        temp_file.write(data)
+        return temp_file.name
+
+
+async def iter_pdf_pages(source: Union[str, bytes],
+                         timeout: float = DOCUMENT_EXTRACTION_TIMEOUT,
+                         max_pages: int = DOCUMENT_MAX_PAGES,
+                         max_chars: int = DOCUMENT_MAX_CHARS) -> AsyncGenerator[Tuple[int, int, str], None]:
+    """
+    Extracts a PDF in parallel page ranges and yields `(page_number, page_count, text)`
+    in page order as soon as each leading page is ready, so callers can start working
+    on the first pages while later ones are still being parsed.
+
+    Stops (cancelling outstanding ranges) once the char budget is used up. Closing the
+    generator early, or cancelling the consuming task, cancels the remaining work.
+    PDF bytes are written to a temporary file once, and the workers open it by path, so
+    the document is not pickled into every page-range task.
+    """
+    deadline = time.time() + timeout
+    temp_path = None
+    if not isinstance(source, str):
+        temp_path = source = await asyncio.to_thread(_write_temp_pdf, source)
+    pages = _iter_pdf_page_ranges(source, deadline, timeout, max_pages, max_chars)
+    try:
+        async for page in pages:
+            yield page
+    finally:
+        await pages.aclose()  # Cancels the outstanding ranges before the file goes away.
+        if temp_path is not None:
+            try:
+                os.remove(temp_path)
+            except OSError as e:
+                # Windows refuses while a cancelled worker still has the file open.
+                logger.warning(f"Could not remove temporary PDF {temp_path}: {e}")
+
+
+async def _iter_pdf_page_ranges(source: str, deadline: float, timeout: float, max_pages: int,
+                                max_chars: int) -> AsyncGenerator[Tuple[int, int, str], None]:
+    loop = asyncio.get_running_loop()
+    page_count = await _run_in_pool(timeout, _count_pdf_pages, source)
+    pages_to_read = min(page_count, max_pages)
+    workers = max(DOCUMENT_WORKERS, 1)
+    # Several ranges per worker keep every worker busy; capping the range size keeps the
+    # first pages arriving early even on a single worker, without re-opening the file per page.
+    pages_per_task = min(max(PDF_MIN_PAGES_PER_TASK, -(-pages_to_read // (workers * 4))), 64)
+
+    def submit(start: int, attempt: int) -> None:
+        args = (source, start, min(start + pages_per_task, pages_to_read), max_chars, deadline)
+        pool = get_extraction_pool()
+        try:
+            future = loop.run_in_executor(pool, _extract_pdf_page_range, *args)
+        except BrokenProcessPool:
+            # The pool broke after its last job finished; nothing has run on it yet.
+            _discard_pool(pool)
+            pool = get_extraction_pool()
+            future = loop.run_in_executor(pool, _extract_pdf_page_range, *args)
+        pending[future] = (start, pool, attempt)
+
+    # future -> (start page, pool it runs on, attempt)
+    pending = {}
+    finished_ranges = {}
+    next_start = 0
+    total_chars = 0
+    try:
+        for start in range(0, pages_to_read, pages_per_task):
+            submit(start, 0)
+        while pending:
+            done, _ = await asyncio.wait(pending, timeout=max(deadline - time.time(), 0) + WORKER_GRACE_SECONDS,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                logger.error(f"Document extraction exceeded {timeout:.0f}s; restarting the extraction pool.")
+                for pool in {pool for _, pool, _ in pending.values()}:
+                    _discard_pool(pool, kill=True)
+                raise DocumentExtractionError("Document extraction timed out.")
+            for future in done:
+                start, pool, attempt = pending.pop(future)
+                try:
+                    start, page_texts, stopped_early = future.result()
+                except BrokenProcessPool as e:
+                    _discard_pool(pool)
+                    if attempt == 0:
+                        logger.warning(f"Document extraction pool broke ({e}); retrying pages from {start} "
+                                       f"on a fresh pool.")
+                        submit(start, 1)
+                        continue
+                    logger.error(f"Document extraction worker crashed: {e}")
+                    raise DocumentExtractionError("Document extraction worker crashed.") from e
+                except MemoryError as e:
+                    raise DocumentExtractionError("Document needs more memory than the extraction limit allows.") from e
+                finished_ranges[start] = (page_texts, stopped_early)
+
+            # Yield the contiguous prefix of finished ranges, in page order.
+            while next_start in finished_ranges:
+                page_texts, stopped_early = finished_ranges.pop(next_start)
+                for offset, page_text in enumerate(page_texts):
+                    yield next_start + offset, page_count, page_text
+                    total_chars += len(page_text)
+                    if total_chars > max_chars:
+                        return
+                if stopped_early:
+                    return
+                next_start += pages_per_task
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+async def extract_document_text(source: Union[str, bytes], kind: str,
+                                timeout: float = DOCUMENT_EXTRACTION_TIMEOUT,
+                                max_pages: int = DOCUMENT_MAX_PAGES,
+                                max_chars: int = DOCUMENT_MAX_CHARS,
+                                on_page: Optional[Callable[[str], None]] = None) -> str:
+    """
+    Extracts the text of a PDF, DOCX or TXT document in the process pool.
+
+    PDFs are split into page ranges that are parsed in parallel and joined once. The
+    workers stop on their own once they pass the page/char budget or `timeout`
+    (returning the text so far plus a truncation notice). If a worker overruns the
+    timeout by more than a grace period, e.g. on a pathological page, the pool is
+    restarted and `DocumentExtractionError` is raised; other documents that were being
+    extracted on that pool are retried once on the fresh one. Cancelling the awaiting task
+    (the user's request was abandoned) cancels jobs that have not started yet; running
+    jobs are bounded by the same budgets and their results are discarded.
+
+    `on_page` is called with each PDF page's text, in order, as soon as it is ready, so
+    the caller can start processing the first pages before the document is complete.
+    """
+    try:
+        if kind == "pdf":
+            page_texts = []
+            page_count = 0
+            async for _, page_count, page_text in iter_pdf_pages(source, timeout, max_pages, max_chars):
+                page_texts.append(page_text)
+                if on_page is not None:
+                    on_page(page_text)
+            truncated = len(page_texts) < page_count
+            return _join_pdf_pages(page_texts, max_chars, truncated)
+
+        return await _run_in_pool(timeout, extract_text_sync, kind, source, max_pages, max_chars,
+                                  time.time() + timeout)
+    except asyncio.CancelledError:
+        logger.info("Document extraction abandoned by the caller.")
+        raise
+
+# --- END OF FILE bot/document_extraction.py ---
@@ -0,0 +1,193 @@
+# --- START OF FILE bot/document_index.py ---
+
+import re
+import math
+import logging
+from collections import Counter
+from typing import Dict, List, Set, Tuple
+
+from .config_utils import env_number
+
+logger = logging.getLogger(__name__)
+
+
+# --- Chunking & Retrieval Configuration ---
+DOC_CHUNK_CHARS = env_number("DOC_CHUNK_CHARS", 1500)
+DOC_CHUNK_OVERLAP = env_number("DOC_CHUNK_OVERLAP", 200)
+DOC_TOP_K = env_number("DOC_TOP_K", 6)
+# Documents longer than one section are summarized section by section (map), then the
+# section summaries are combined into the final analysis (reduce).
+DOC_MAP_SECTION_CHARS = env_number("DOC_MAP_SECTION_CHARS", 12000)
+DOC_MAP_CONCURRENCY = env_number("DOC_MAP_CONCURRENCY", 4)
+
+# A reply to the bot is only treated as a question about the last document when its best
+# chunk scores at least this much per content word of the question (BM25; a rare word
+# found once in a chunk scores roughly 1-4).
+DOC_FOLLOW_UP_MIN_SCORE = env_number("DOC_FOLLOW_UP_MIN_SCORE", 0.75, cast=float)
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+# Function words are frequent in every document and question, and their IDF is still
+# positive, so they would make any question "match" any document. They are dropped from queries.
+STOPWORDS = frozenset("""
+a about above after again all also am an and any are as at be because been before being
+below between both but by can could did do does doing down during each few for from further
+had has have having he her here hers him his how if in into is it its itself just me more
+most my no nor not now of off on once only or other our out over own same she should so some
+such than that the their them then there these they this those through to too under until up
+very was we were what when where which while who whom why will with would you your yours
+please thanks thank tell explain know
+el la los las un una de del al en es que por para con como se lo le su sus mas pero este esta
+le les des du et est une dans pour avec sur qui ce cette pas ou au aux
+der die das ein eine und ist im zu den dem von mit auf nicht wie was
+il lo gli della di che per non una sono
+os as um uma do da dos das em no na que com por para se
+""".split())
+
+# Unicode-aware so Cyrillic, Greek, etc. are tokenized too; single characters carry no signal.
+_TOKEN_PATTERN = re.compile(r"\w\w+", re.UNICODE)
+_PARAGRAPH_SPLIT = re.compile(r"\n\s*\n")
+
+
+def tokenize(text: str) -> List[str]:
+    return _TOKEN_PATTERN.findall(text.lower())
+
+
+def query_terms(query: str) -> Set[str]:
+    """The distinct words of a query that can carry meaning (stopwords removed)."""
+    return set(tokenize(query)) - STOPWORDS
+
+
+def chunk_text(text: str, chunk_chars: int = DOC_CHUNK_CHARS, overlap: int = DOC_CHUNK_OVERLAP) -> List[str]:
+    """
+    Splits text into chunks of at most `chunk_chars`, packing whole paragraphs where
+    possible. Paragraphs longer than a chunk are cut with `overlap` characters carried
+    over, so a sentence on a boundary is still found in one piece.
+    """
+    chunks = []
+    current = []
+    current_len = 0
+    for paragraph in _PARAGRAPH_SPLIT.split(text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        if len(paragraph) > chunk_chars:
+            if current:
+                chunks.append("\n\n".join(current))
+                current, current_len = [], 0
+            step = max(chunk_chars - overlap, 1)
+            for start in range(0, len(paragraph), step):
+                chunks.append(paragraph[start:start + chunk_chars])
+                if start + chunk_chars >= len(paragraph):
+                    break
+            continue
+        if current and current_len + len(paragraph) + 2 > chunk_chars:
+            chunks.append("\n\n".join(current))
+            current, current_len = [], 0
+        current.append(paragraph)
+        current_len += len(paragraph) + 2
+    if current:
+        chunks.append("\n\n".join(current))
+    return chunks
+
+
+def group_chunks(chunks: List[str], max_chars: int = DOC_MAP_SECTION_CHARS) -> List[str]:
+    """Packs consecutive chunks into sections of at most `max_chars` (one chunk minimum)."""
+    sections = []
+    current = []
+    current_len = 0
+    for chunk in chunks:
+        if current and current_len + len(chunk) > max_chars:
+            sections.append("\n\n".join(current))
+            current, current_len = [], 0
+        current.append(chunk)
+        current_len += len(chunk) + 2
+    if current:
+        sections.append("\n\n".join(current))
+    return sections
+
+
+class DocumentIndex:
+    """
+    A BM25 index over the chunks of one uploaded document.
+
+    Only the document name and its chunks are pickled (it lives in chat_data); the term
+    statistics are rebuilt on first use after a restart, which takes a few milliseconds.
+    """
+
+    def __init__(self, name: str, chunks: List[str]):
+        self.name = name
+        self.chunks = chunks
+        self._term_freqs: List[Counter] = []
+        self._doc_freqs: Dict[str, int] = {}
+        self._lengths: List[int] = []
+        self._avg_length = 0.0
+        self._built = False
+
+    @classmethod
+    def from_text(cls, name: str, text: str) -> "DocumentIndex":
+        return cls(name, chunk_text(text))
+
+    def __len__(self) -> int:
+        return len(self.chunks)
+
+    def __getstate__(self):
+        return {"name": self.name, "chunks": self.chunks}
+
+    def __setstate__(self, state):
+        self.__init__(state["name"], state["chunks"])
+
+    @property
+    def total_chars(self) -> int:
+        return sum(len(chunk) for chunk in self.chunks)
+
+    def _build(self) -> None:
+        doc_freqs: Counter = Counter()
+        for chunk in self.chunks:
+            term_freqs = Counter(tokenize(chunk))
+            self._term_freqs.append(term_freqs)
+            self._lengths.append(sum(term_freqs.values()))
+            doc_freqs.update(term_freqs.keys())
+        self._doc_freqs = dict(doc_freqs)
+        self._avg_length = (sum(self._lengths) / len(self._lengths)) if self._lengths else 0.0
+        self._built = True
+
+    def search(self, query: str, k: int = DOC_TOP_K) -> List[Tuple[int, float]]:
+        """Returns up to `k` (chunk_index, score) pairs with a positive BM25 score, best first."""
+        if not self._built:
+            self._build()
+        terms = query_terms(query)
+        num_chunks = len(self.chunks)
+        scores = []
+        for chunk_index, term_freqs in enumerate(self._term_freqs):
+            length_norm = BM25_K1 * (1 - BM25_B + BM25_B * self._lengths[chunk_index] / (self._avg_length or 1))
+            score = 0.0
+            for term in terms:
+                term_freq = term_freqs.get(term)
+                if not term_freq:
+                    continue
+                doc_freq = self._doc_freqs[term]
+                idf = math.log(1 + (num_chunks - doc_freq + 0.5) / (doc_freq + 0.5))
+                score += idf * term_freq * (BM25_K1 + 1) / (term_freq + length_norm)
+            if score > 0:
+                scores.append((chunk_index, score))
+        scores.sort(key=lambda item: item[1], reverse=True)
+        return scores[:k]
+
+    def top_chunks(self, query: str, k: int = DOC_TOP_K, fallback_to_start: bool = True,
+                   min_score: float = 0.0) -> List[str]:
+        """
+        Returns the `k` most relevant chunks in document order, so the model reads them
+        in the same sequence as the original. When nothing in the query matches, or the
+        best chunk scores less than `min_score` per query term, returns the opening chunks,
+        or nothing if `fallback_to_start` is False.
+        """
+        hits = self.search(query, k)
+        if hits and hits[0][1] / len(query_terms(query)) < min_score:
+            hits = []
+        if not hits:
+            return self.chunks[:k] if fallback_to_start else []
+        return [self.chunks[chunk_index] for chunk_index in sorted(chunk_index for chunk_index, _ in hits)]
+
+# --- END OF FILE bot/document_index.py ---
@@ -0,0 +1,293 @@
+# --- START OF FILE bot/edit_scheduler.py ---
+
+import time
+import asyncio
+import logging
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+from telegram.error import BadRequest, NetworkError, RetryAfter
+
+from .config_utils import env_number
+from .markdown_v2 import check_markdown_v2, record_markdown_v2_rejection
+
+logger = logging.getLogger(__name__)
+
+
+# --- Telegram Rate Limits ---
+# Telegram allows roughly 30 requests/s per bot, about one message per second in a
+# private chat and 20 per minute in a group.
+TELEGRAM_GLOBAL_EDITS_PER_SECOND = env_number("TELEGRAM_GLOBAL_EDITS_PER_SECOND", 25.0, cast=float)
+TELEGRAM_CHAT_EDITS_PER_SECOND = env_number("TELEGRAM_CHAT_EDITS_PER_SECOND", 1.0, cast=float)
+TELEGRAM_GROUP_EDITS_PER_MINUTE = env_number("TELEGRAM_GROUP_EDITS_PER_MINUTE", 20.0, cast=float)
+# A new stream may make this many edits back to back before the rate applies.
+TELEGRAM_CHAT_EDIT_BURST = env_number("TELEGRAM_CHAT_EDIT_BURST", 2.0, cast=float)
+
+# Recent time-to-first-visible-text samples kept per stream kind (text, image).
+FIRST_VISIBLE_SAMPLES = 500
+
+PARSE_ERROR_MARKERS = ("can't parse entities", "unescaped", "can't find end of", "nested entities",
+                       "entity", "wrong http url")
+
+
+class TokenBucket:
+    """A token bucket refilled at `rate` tokens per second, holding at most `capacity`."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def time_until_available(self, now: float) -> float:
+        """Seconds until one token is available (0 if one is available now)."""
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self) -> None:
+        self.tokens -= 1
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+@dataclass
+class _PendingEdit:
+    bot: Any
+    text: str
+    parse_mode: Optional[str]
+    fallback: Optional[Callable[[], str]]
+    on_parse_error: Optional[Callable[[], None]]
+    entities: Optional[List[Any]] = None
+    on_sent: Optional[Callable[[], None]] = None
+    render: Optional[Callable[[], Tuple[str, List[Any]]]] = None
+
+    @property
+    def content(self) -> Tuple[str, tuple]:
+        return self.text, tuple(self.entities or ())
+
+
+class EditScheduler:
+    """
+    Central scheduler for streaming message edits.
+
+    Handlers hand over the latest text of a message with `schedule_edit` and move on;
+    only the newest text per message is kept, so a burst of Gemini chunks turns into
+    a single edit when the chat's next slot opens. Slots come from a per-chat token
+    bucket (private vs. group rate) and a global bucket for the whole bot. A RetryAfter
+    from Telegram pauses edits for every chat, since the flood limit is per bot.
+
+    One-off edits that must not be coalesced (e.g. the final formatted message) go
+    through `run`, which takes a slot and retries once after a RetryAfter.
+    """
+
+    def __init__(self, global_rate: float = TELEGRAM_GLOBAL_EDITS_PER_SECOND,
+                 chat_rate: float = TELEGRAM_CHAT_EDITS_PER_SECOND,
+                 group_rate_per_minute: float = TELEGRAM_GROUP_EDITS_PER_MINUTE,
+                 chat_burst: float = TELEGRAM_CHAT_EDIT_BURST):
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate_per_minute / 60
+        self.chat_burst = chat_burst
+        self._global_bucket = TokenBucket(global_rate, max(global_rate, 1))
+        self._chat_buckets: Dict[int, TokenBucket] = {}
+        self._paused_until = 0.0
+        self._pending: Dict[Tuple[int, int], _PendingEdit] = {}
+        self._last_sent: Dict[Tuple[int, int], Tuple[str, tuple]] = {}
+        self._workers: Dict[Tuple[int, int], asyncio.Task] = {}
+        self._first_visible: Dict[str, Deque[float]] = {}
+        self.stats = {"edits_sent": 0, "edits_coalesced": 0, "edits_skipped_unchanged": 0,
+                      "retry_after": 0, "parse_fallbacks": 0, "parse_failures_avoided": 0, "edit_errors": 0}
+
+    def schedule_edit(self, bot, chat_id: int, message_id: int, text: Optional[str] = None,
+                      parse_mode: Optional[str] = None,
+                      fallback: Optional[Callable[[], str]] = None,
+                      on_parse_error: Optional[Callable[[], None]] = None,
+                      entities: Optional[List[Any]] = None,
+                      on_sent: Optional[Callable[[], None]] = None,
+                      render: Optional[Callable[[], Tuple[str, List[Any]]]] = None) -> None:
+        """
+        Queues `text` (with `parse_mode` or explicit `entities`) as the next content of the
+        message, replacing any edit that has not been sent yet. If the edit's formatting is
+        rejected, `on_parse_error` is called and `fallback()` is sent as plain text instead.
+        `on_sent` is called each time an edit of this message reaches Telegram.
+        Instead of `text`, a stream can pass `render`, which returns (text, entities) and is
+        only called for the edits that are actually sent, not for each coalesced chunk.
+        """
+        key = (chat_id, message_id)
+        if key in self._pending:
+            self.stats["edits_coalesced"] += 1
+        self._pending[key] = _PendingEdit(bot, text, parse_mode, fallback, on_parse_error, entities, on_sent,
+                                          render)
+        if key not in self._workers:
+            self._workers[key] = asyncio.create_task(self._drain(key))
+
+    async def finish(self, chat_id: int, message_id: int) -> None:
+        """
+        Drops the message's unsent edit and waits for one already in flight, so the
+        caller's final edit is not overwritten by a stale stream update.
+        """
+        key = (chat_id, message_id)
+        self._pending.pop(key, None)
+        worker = self._workers.get(key)
+        if worker is not None:
+            await asyncio.gather(worker, return_exceptions=True)
+        self._last_sent.pop(key, None)
+
+    async def run(self, chat_id: int, call: Callable[[], Awaitable[Any]]) -> Any:
+        """Waits for a slot in the chat and runs `call`, retrying once if Telegram asks to slow down."""
+        for attempt in range(2):
+            await self._acquire(chat_id)
+            try:
+                return await call()
+            except RetryAfter as e:
+                self._note_retry_after(e)
+                if attempt:
+                    raise
+
+    async def shutdown(self) -> None:
+        """Cancels outstanding stream edits (called from the Application's post_shutdown)."""
+        self._pending.clear()
+        workers = list(self._workers.values())
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+    def record_first_visible(self, kind: str, seconds: float) -> None:
+        """Records how long a user waited for the first answer text of a `kind` stream to appear."""
+        self._first_visible.setdefault(kind, deque(maxlen=FIRST_VISIBLE_SAMPLES)).append(seconds)
+
+    def snapshot(self) -> Dict[str, Any]:
+        first_visible = {}
+        for kind, samples in self._first_visible.items():
+            ordered = sorted(samples)
+            first_visible[kind] = {"count": len(ordered), "p50": ordered[len(ordered) // 2],
+                                   "p95": ordered[min(int(len(ordered) * 0.95), len(ordered) - 1)]}
+        return {**self.stats, "pending": len(self._pending),
+                "paused_for": max(self._paused_until - time.monotonic(), 0.0),
+                "first_visible": first_visible}
+
+    # --- Internals ---
+    def _chat_bucket(self, chat_id: int, now: float) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) > 10000:
+                # Buckets that have refilled carry no state worth keeping.
+                for idle_chat_id in [cid for cid, b in self._chat_buckets.items() if b.is_full(now)]:
+                    del self._chat_buckets[idle_chat_id]
+            rate = self.group_rate if chat_id < 0 else self.chat_rate
+            bucket = self._chat_buckets[chat_id] = TokenBucket(rate, self.chat_burst)
+        return bucket
+
+    async def _acquire(self, chat_id: int) -> None:
+        """Waits until the chat may make a request, then takes its tokens."""
+        await self._wait_for_slot(chat_id)
+        self._take_slot(chat_id)
+
+    async def _wait_for_slot(self, chat_id: int, key: Optional[Tuple[int, int]] = None) -> bool:
+        """
+        Waits until the global pause is over and both buckets have a token, without taking
+        them. With `key`, gives up (returning False) once that message has nothing pending.
+        """
+        while True:
+            if key is not None and key not in self._pending:
+                return False
+            now = time.monotonic()
+            bucket = self._chat_bucket(chat_id, now)
+            wait = max(self._paused_until - now, 0.0) or bucket.time_until_available(now) \
+                or self._global_bucket.time_until_available(now)
+            if not wait:
+                return True
+            await asyncio.sleep(wait)
+
+    def _take_slot(self, chat_id: int) -> None:
+        self._chat_bucket(chat_id, time.monotonic()).consume()
+        self._global_bucket.consume()
+
+    def _note_retry_after(self, error: RetryAfter) -> None:
+        retry_after = error.retry_after
+        seconds = retry_after.total_seconds() if hasattr(retry_after, "total_seconds") else float(retry_after)
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self.stats["retry_after"] += 1
+        logger.warning(f"Telegram flood control: pausing all message edits for {seconds:.1f}s.")
+
+    async def _drain(self, key: Tuple[int, int]) -> None:
+        chat_id, message_id = key
+        try:
+            while await self._wait_for_slot(chat_id, key):
+                edit = self._pending.pop(key)
+                try:
+                    if edit.render is not None:
+                        edit.text, edit.entities = edit.render()
+                        edit.render = None
+                    if edit.content == self._last_sent.get(key):
+                        # Nothing is sent, so the chat keeps its token for the next edit.
+                        self.stats["edits_skipped_unchanged"] += 1
+                        continue
+                    self._take_slot(chat_id)
+                    await self._send(key, edit)
+                except Exception as e:
+                    # One broken edit must not stop the stream's later edits.
+                    self.stats["edit_errors"] += 1
+                    logger.error(f"Chat {chat_id}: could not prepare a stream edit: {e}", exc_info=True)
+        finally:
+            self._workers.pop(key, None)
+
+    async def _send(self, key: Tuple[int, int], edit: _PendingEdit) -> None:
+        chat_id, message_id = key
+        if edit.parse_mode == "MarkdownV2" and edit.fallback and check_markdown_v2(edit.text):
+            # Telegram would reject it: send the plain text now instead of paying for a failed edit.
+            self.stats["parse_failures_avoided"] += 1
+            if edit.on_parse_error:
+                edit.on_parse_error()
+            edit = _PendingEdit(edit.bot, edit.fallback(), None, None, None, on_sent=edit.on_sent)
+        try:
+            await edit.bot.edit_message_text(edit.text, chat_id, message_id, parse_mode=edit.parse_mode,
+                                             entities=edit.entities)
+            self._last_sent[key] = edit.content
+            self.stats["edits_sent"] += 1
+            if edit.on_sent:
+                edit.on_sent()
+        except RetryAfter as e:
+            self._note_retry_after(e)
+            # Resend after the pause unless newer text has been queued meanwhile.
+            self._pending.setdefault(key, edit)
+        except BadRequest as e:
+            error_text = str(e).lower()
+            if "message is not modified" in error_text:
+                self._last_sent[key] = edit.content
+            elif (edit.parse_mode or edit.entities) and edit.fallback and any(marker in error_text for marker in PARSE_ERROR_MARKERS):
+                logger.warning(f"Chat {chat_id}: stream edit failed to parse ({e}); falling back to plain text.")
+                self.stats["parse_fallbacks"] += 1
+                if edit.parse_mode == "MarkdownV2":
+                    record_markdown_v2_rejection()
+                if edit.on_parse_error:
+                    edit.on_parse_error()
+                self._pending.setdefault(key, _PendingEdit(edit.bot, edit.fallback(), None, None, None,
+                                                           on_sent=edit.on_sent))
+            else:
+                self.stats["edit_errors"] += 1
+                logger.error(f"Chat {chat_id}: unhandled BadRequest during stream edit: {e}")
+        except NetworkError as e:
+            self.stats["edit_errors"] += 1
+            logger.warning(f"Chat {chat_id}: network error during stream edit: {e}")
+        except Exception as e:
+            self.stats["edit_errors"] += 1
+            logger.error(f"Chat {chat_id}: unexpected error during stream edit: {e}", exc_info=True)
+
+
+edit_scheduler = EditScheduler()
+
+
+def get_edit_scheduler_stats() -> Dict[str, Any]:
+    """Returns the shared scheduler's counters for /stats."""
+    return edit_scheduler.snapshot()
+
+# --- END OF FILE bot/edit_scheduler.py ---
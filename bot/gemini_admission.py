@@ -0,0 +1,279 @@
+# --- START OF FILE bot/gemini_admission.py ---
+
+import time
+import heapq
+import asyncio
+import itertools
+import logging
+from collections import deque
+from dataclasses import dataclass, field
+from enum import IntEnum
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from .config_utils import env_number
+
+logger = logging.getLogger(__name__)
+
+
+# --- Gemini Quota Configuration (per model) ---
+GEMINI_RPM_LIMIT = env_number("GEMINI_RPM_LIMIT", 1000)
+GEMINI_TPM_LIMIT = env_number("GEMINI_TPM_LIMIT", 1_000_000)
+GEMINI_ADMISSION_MAX_QUEUE = env_number("GEMINI_ADMISSION_MAX_QUEUE", 200)
+# Output tokens count against TPM too; a request is budgeted for its input plus this much output.
+GEMINI_OUTPUT_TOKEN_ESTIMATE = env_number("GEMINI_OUTPUT_TOKEN_ESTIMATE", 1024)
+
+QUOTA_WINDOW_SECONDS = 60.0
+# How long a model is paused after ResourceExhausted when the caller has no better retry delay.
+DEFAULT_QUOTA_PAUSE_SECONDS = 5.0
+
+
+class Priority(IntEnum):
+    """Admission priority of a Gemini call; lower values are served first and shed last."""
+    INTERACTIVE = 0  # Text questions and voice messages a user is watching.
+    VISION = 1
+    DOCUMENT = 2
+    URL = 3  # URL summaries and their critic pass.
+    BACKGROUND = 4  # Work nobody is waiting on, e.g. history summaries.
+
+
+# Longest a request of each priority may wait in the queue before it is shed instead.
+MAX_QUEUE_WAIT_SECONDS = {
+    Priority.INTERACTIVE: env_number("GEMINI_MAX_WAIT_INTERACTIVE_SECONDS", 45, cast=float),
+    Priority.VISION: env_number("GEMINI_MAX_WAIT_VISION_SECONDS", 60, cast=float),
+    Priority.DOCUMENT: env_number("GEMINI_MAX_WAIT_DOCUMENT_SECONDS", 120, cast=float),
+    Priority.URL: env_number("GEMINI_MAX_WAIT_URL_SECONDS", 120, cast=float),
+    Priority.BACKGROUND: env_number("GEMINI_MAX_WAIT_BACKGROUND_SECONDS", 300, cast=float),
+}
+
+
+class GeminiOverloadedError(Exception):
+    """Raised when a request is shed because the model's quota is booked beyond its priority's max wait."""
+
+    def __init__(self, eta: float):
+        super().__init__(f"Gemini quota is exhausted for about {eta:.0f}s.")
+        self.eta = eta
+
+
+@dataclass(order=True)
+class _Waiter:
+    priority: int
+    seq: int
+    tokens: int = field(compare=False)
+    deadline: float = field(compare=False)
+    future: asyncio.Future = field(compare=False)
+
+
+class _ModelBudget:
+    """Sliding one-minute window of the requests and tokens admitted for one model."""
+
+    def __init__(self, rpm: int, tpm: int):
+        self.rpm = max(rpm, 1)
+        self.tpm = max(tpm, 1)
+        self.window: Deque[Tuple[float, int]] = deque()  # (admitted at, tokens)
+        self.window_tokens = 0
+        self.paused_until = 0.0
+        self.queue: List[_Waiter] = []
+        self.wakeup: Optional[asyncio.TimerHandle] = None
+
+    def _expire(self, now: float) -> None:
+        while self.window and self.window[0][0] <= now - QUOTA_WINDOW_SECONDS:
+            self.window_tokens -= self.window.popleft()[1]
+
+    def admit(self, now: float, tokens: int) -> None:
+        self.window.append((now, tokens))
+        self.window_tokens += tokens
+
+    def wait_time(self, now: float, tokens: int, requests_ahead: int = 0, tokens_ahead: int = 0) -> float:
+        """
+        Seconds until a request of `tokens` fits the budget, after the `requests_ahead`
+        queued requests (of `tokens_ahead` in total) have been admitted first.
+        """
+        self._expire(now)
+        wait = max(self.paused_until - now, 0.0)
+
+        excess_requests = len(self.window) + requests_ahead + 1 - self.rpm
+        if excess_requests > len(self.window):
+            # Even a fully drained window leaves requests waiting for later windows.
+            wait = max(wait, QUOTA_WINDOW_SECONDS * excess_requests / self.rpm)
+        elif excess_requests > 0:
+            wait = max(wait, self.window[excess_requests - 1][0] + QUOTA_WINDOW_SECONDS - now)
+
+        excess_tokens = self.window_tokens + tokens_ahead + tokens - self.tpm
+        if excess_tokens > self.window_tokens:
+            wait = max(wait, QUOTA_WINDOW_SECONDS * excess_tokens / self.tpm)
+        elif excess_tokens > 0:
+            freed = 0
+            for admitted_at, admitted_tokens in self.window:
+                freed += admitted_tokens
+                if freed >= excess_tokens:
+                    wait = max(wait, admitted_at + QUOTA_WINDOW_SECONDS - now)
+                    break
+        return wait
+
+
+class AdmissionTicket:
+    """A request's place in the admission queue. `eta` is 0 when it was admitted right away."""
+
+    def __init__(self, controller: "GeminiAdmissionController", budget: _ModelBudget,
+                 waiter: Optional[_Waiter], eta: float):
+        self._controller = controller
+        self._budget = budget
+        self._waiter = waiter
+        self.eta = eta
+
+    @property
+    def queued(self) -> bool:
+        return self._waiter is not None
+
+    async def wait(self) -> None:
+        """Waits until the request is admitted; raises GeminiOverloadedError if it is shed meanwhile."""
+        if self._waiter is None:
+            return
+        queued_at = time.monotonic()
+        try:
+            await self._waiter.future
+        finally:
+            self._controller.stats["wait_seconds"] += time.monotonic() - queued_at
+            self.cancel()
+
+    def cancel(self) -> None:
+        """Leaves the queue (e.g. the user's request was abandoned); a no-op once admitted."""
+        waiter, self._waiter = self._waiter, None
+        if waiter is None:
+            return
+        if not waiter.future.done():
+            waiter.future.cancel()
+        if waiter.future.cancelled():
+            self._controller._dispatch(self._budget)
+
+
+class GeminiAdmissionController:
+    """
+    Process-wide admission control for Gemini calls.
+
+    Every call takes a ticket for its model before it is sent. Each model has a budget of
+    requests and estimated tokens per sliding minute. Calls are admitted right away while
+    both fit and nothing is queued. Otherwise they wait in a priority queue, highest
+    priority first, and get an ETA. A request is shed with `GeminiOverloadedError` when its
+    ETA exceeds its priority's max wait. Newly queued urgent work sheds the low-priority
+    waiters it pushes past their deadline. A quota error from Gemini pauses the whole
+    model for the retry delay, so retries queue up instead of hitting the API together.
+    """
+
+    def __init__(self, rpm: int = GEMINI_RPM_LIMIT, tpm: int = GEMINI_TPM_LIMIT,
+                 max_queue: int = GEMINI_ADMISSION_MAX_QUEUE):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_queue = max_queue
+        self._budgets: Dict[str, _ModelBudget] = {}
+        self._seq = itertools.count()
+        self.stats = {"admitted": 0, "queued": 0, "shed": 0, "quota_pauses": 0, "wait_seconds": 0.0}
+
+    def _budget(self, model_name: str) -> _ModelBudget:
+        budget = self._budgets.get(model_name)
+        if budget is None:
+            budget = self._budgets[model_name] = _ModelBudget(self.rpm, self.tpm)
+        return budget
+
+    def request(self, model_name: str, priority: Priority, tokens: int) -> AdmissionTicket:
+        """
+        Books a call of about `tokens` (input + output) for `model_name`. Returns a ticket to
+        `wait()` on, or raises GeminiOverloadedError if the request would wait too long.
+        """
+        budget = self._budget(model_name)
+        tokens = min(max(tokens, 1), budget.tpm)
+        now = time.monotonic()
+        live = [waiter for waiter in budget.queue if not waiter.future.done()]
+        if not live and budget.wait_time(now, tokens) == 0:
+            budget.admit(now, tokens)
+            self.stats["admitted"] += 1
+            return AdmissionTicket(self, budget, None, 0.0)
+
+        ahead = [waiter for waiter in live if waiter.priority <= priority]
+        eta = budget.wait_time(now, tokens, len(ahead), sum(waiter.tokens for waiter in ahead))
+        if eta > MAX_QUEUE_WAIT_SECONDS[priority] or (len(live) >= self.max_queue and
+                                                      all(waiter.priority <= priority for waiter in live)):
+            self.stats["shed"] += 1
+            logger.warning(f"Shedding {priority.name} Gemini request for {model_name}: ETA {eta:.0f}s.")
+            raise GeminiOverloadedError(eta)
+
+        waiter = _Waiter(int(priority), next(self._seq), tokens, now + MAX_QUEUE_WAIT_SECONDS[priority],
+                         asyncio.get_running_loop().create_future())
+        heapq.heappush(budget.queue, waiter)
+        self.stats["queued"] += 1
+        self._shed_overdue(budget, now)
+        self._dispatch(budget)
+        return AdmissionTicket(self, budget, waiter, eta)
+
+    def try_admit(self, model_name: str, tokens: int) -> bool:
+        """
+        Admits a call only if it fits the budget right now and nobody is queued; never queues.
+        Used for optional extra calls such as hedged requests.
+        """
+        budget = self._budget(model_name)
+        tokens = min(max(tokens, 1), budget.tpm)
+        now = time.monotonic()
+        if any(not waiter.future.done() for waiter in budget.queue) or budget.wait_time(now, tokens) > 0:
+            return False
+        budget.admit(now, tokens)
+        self.stats["admitted"] += 1
+        return True
+
+    def _shed_overdue(self, budget: _ModelBudget, now: float) -> None:
+        """Sheds waiters that can no longer start before their deadline, lowest priority first."""
+        live = sorted(waiter for waiter in budget.queue if not waiter.future.done())
+        requests_ahead, tokens_ahead = 0, 0
+        for position, waiter in enumerate(live):
+            overflow = position >= self.max_queue
+            if overflow or now + budget.wait_time(now, waiter.tokens, requests_ahead, tokens_ahead) > waiter.deadline:
+                self.stats["shed"] += 1
+                waiter.future.set_exception(GeminiOverloadedError(max(waiter.deadline - now, 0.0)))
+                continue
+            requests_ahead += 1
+            tokens_ahead += waiter.tokens
+        budget.queue = [waiter for waiter in budget.queue if not waiter.future.done()]
+        heapq.heapify(budget.queue)
+
+    def _dispatch(self, budget: _ModelBudget) -> None:
+        """Admits queued requests in priority order while the budget allows, then sleeps until it frees up."""
+        if budget.wakeup is not None:
+            budget.wakeup.cancel()
+            budget.wakeup = None
+        now = time.monotonic()
+        while budget.queue:
+            head = budget.queue[0]
+            if head.future.done():
+                heapq.heappop(budget.queue)
+                continue
+            wait = budget.wait_time(now, head.tokens)
+            if wait > 0:
+                budget.wakeup = asyncio.get_running_loop().call_later(wait, self._dispatch, budget)
+                return
+            heapq.heappop(budget.queue)
+            budget.admit(now, head.tokens)
+            self.stats["admitted"] += 1
+            head.future.set_result(None)
+
+    def report_quota_exceeded(self, model_name: str, retry_after: float = DEFAULT_QUOTA_PAUSE_SECONDS) -> None:
+        """Pauses admissions for `model_name` after Gemini answered ResourceExhausted."""
+        budget = self._budget(model_name)
+        budget.paused_until = max(budget.paused_until, time.monotonic() + retry_after)
+        self.stats["quota_pauses"] += 1
+        if budget.queue:
+            self._dispatch(budget)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Returns process-local counters, current queue depth and the average queue wait."""
+        queued = self.stats["queued"]
+        return {**self.stats,
+                "queue_depth": sum(len(budget.queue) for budget in self._budgets.values()),
+                "avg_wait_seconds": self.stats["wait_seconds"] / queued if queued else 0.0}
+
+
+gemini_admission = GeminiAdmissionController()
+
+
+def get_gemini_admission_stats() -> Dict[str, Any]:
+    return gemini_admission.get_stats()
+
+# --- END OF FILE bot/gemini_admission.py ---
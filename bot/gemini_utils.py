@@ -1,15 +1,23 @@
 # --- START OF FINAL bot/gemini_utils.py ---
 
 import os
+import time
+import hashlib
 import logging
 import asyncio
-from typing import AsyncGenerator, List, Dict, Any, Union
+from collections import OrderedDict
+from typing import AsyncGenerator, List, Dict, Any, Union, Optional, Tuple
 
 import google.generativeai as genai
 # Use only the imports that are guaranteed to exist in your environment
 from google.generativeai.types import GenerationConfig, Tool, FunctionDeclaration, PartDict
 
 from .web_search import perform_web_search
+from .config_utils import env_number
+from .context_cache import context_cache, document_turns, estimate_tokens
+from .gemini_admission import gemini_admission, Priority, GeminiOverloadedError, GEMINI_OUTPUT_TOKEN_ESTIMATE
+from .model_router import model_router
+from .hedging import hedged_first_chunk
 
 logger = logging.getLogger(__name__)
 
@@ -43,49 +51,319 @@ web_search_tool = Tool(
 
 TOOL_REGISTRY = {"perform_web_search": perform_web_search}
 
+# --- GenerativeModel Registry ---
+# Building a GenerativeModel re-validates the tool declarations and copies the large
+# system instruction, so we keep the built models in a small LRU cache. There are only
+# a few dozen language variants of the system prompt, so almost every request is a hit.
+GEMINI_MODEL_CACHE_SIZE = env_number("GEMINI_MODEL_CACHE_SIZE", 64)
+
+_model_cache: "OrderedDict[tuple, genai.GenerativeModel]" = OrderedDict()
+_model_cache_stats = {"hits": 0, "misses": 0, "evictions": 0, "build_seconds": 0.0}
+
+
+def _freeze(value: Any) -> Any:
+    """Turns dicts/lists (e.g. tool and generation configs) into a hashable cache key part."""
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    return repr(value)
+
+
+def _tool_names(tools: Optional[List[Tool]]) -> tuple:
+    """Returns the sorted function names declared by a list of tools."""
+    if not tools:
+        return ()
+    names = []
+    for tool in tools:
+        for declaration in getattr(tool, "function_declarations", None) or []:
+            names.append(declaration.name)
+    return tuple(sorted(names))
+
+
+def get_cached_model(
+        model_name: str,
+        system_prompt: Optional[str] = None,
+        tools: Optional[List[Tool]] = None,
+        generation_config: Optional[Union[GenerationConfig, Dict[str, Any]]] = None,
+        tool_config: Optional[Dict[str, Any]] = None,
+) -> genai.GenerativeModel:
+    """
+    Returns a GenerativeModel for the given settings, building it only on a cache miss.
+
+    Models are keyed by (model name, system prompt hash, tool set, generation config,
+    tool config). The least recently used model is evicted once the cache holds
+    GEMINI_MODEL_CACHE_SIZE entries.
+    """
+    prompt_hash = hashlib.sha256(system_prompt.encode("utf-8")).hexdigest() if system_prompt else None
+    cache_key = (model_name, prompt_hash, _tool_names(tools), _freeze(generation_config), _freeze(tool_config))
+
+    model = _model_cache.get(cache_key)
+    if model is not None:
+        _model_cache.move_to_end(cache_key)
+        _model_cache_stats["hits"] += 1
+        return model
+
+    build_start = time.perf_counter()
+    model = genai.GenerativeModel(
+        model_name,
+        system_instruction=system_prompt,
+        generation_config=generation_config,
+        tools=tools,
+        tool_config=tool_config
+    )
+    _model_cache_stats["build_seconds"] += time.perf_counter() - build_start
+    _model_cache_stats["misses"] += 1
+
+    _model_cache[cache_key] = model
+    while len(_model_cache) > max(GEMINI_MODEL_CACHE_SIZE, 1):
+        _model_cache.popitem(last=False)
+        _model_cache_stats["evictions"] += 1
+    logger.debug(f"Built new GenerativeModel for '{model_name}'. Cache size: {len(_model_cache)}")
+    return model
+
+
+def get_model_cache_stats() -> Dict[str, Any]:
+    """
+    Returns a snapshot of the model registry counters, including an estimate of the
+    setup time saved (hits multiplied by the average build time of a miss).
+    """
+    misses = _model_cache_stats["misses"]
+    avg_build_seconds = _model_cache_stats["build_seconds"] / misses if misses else 0.0
+    return {
+        "size": len(_model_cache),
+        "hits": _model_cache_stats["hits"],
+        "misses": misses,
+        "evictions": _model_cache_stats["evictions"],
+        "avg_build_ms": avg_build_seconds * 1000,
+        "saved_seconds_estimate": avg_build_seconds * _model_cache_stats["hits"],
+    }
+
+
+def clear_model_cache() -> None:
+    """Drops all cached models and resets the counters."""
+    _model_cache.clear()
+    _model_cache_stats.update({"hits": 0, "misses": 0, "evictions": 0, "build_seconds": 0.0})
+
+
+def _model_for_cached_content(cached_content: Any,
+                              generation_config: Optional[Union[GenerationConfig, Dict[str, Any]]] = None
+                              ) -> genai.GenerativeModel:
+    """Returns a GenerativeModel bound to server-side cached content, kept in the same LRU registry."""
+    cache_key = (cached_content.name, None, (), _freeze(generation_config), None)
+    model = _model_cache.get(cache_key)
+    if model is None:
+        # Passing the CachedContent object (not its name) avoids a blocking fetch of the resource.
+        model = genai.GenerativeModel.from_cached_content(cached_content, generation_config=generation_config)
+        _model_cache[cache_key] = model
+        while len(_model_cache) > max(GEMINI_MODEL_CACHE_SIZE, 1):
+            _model_cache.popitem(last=False)
+            _model_cache_stats["evictions"] += 1
+    else:
+        _model_cache.move_to_end(cache_key)
+    return model
+
+
+def get_context_model(
+        model_name: str,
+        system_prompt: str,
+        conversation_history: List[Dict[str, Any]],
+        tools: Optional[List[Tool]] = None,
+        generation_config: Optional[Union[GenerationConfig, Dict[str, Any]]] = None,
+        tool_config: Optional[Dict[str, Any]] = None,
+        document: Optional[str] = None,
+        chat_id: Optional[int] = None,
+) -> Tuple[genai.GenerativeModel, List[Dict[str, Any]], Optional[tuple]]:
+    """
+    Returns (model, history, context cache key) for a request.
+
+    The system prompt, tools and the optional reference `document` go into a Gemini context
+    cache when one is ready, so only the history and the new message are sent in full.
+    Otherwise the uncached model is used and the document is sent as the first turns of the
+    history, so the model sees the same conversation either way. The key is None when the
+    request is uncached.
+    """
+    prompt_hash = hashlib.sha256(system_prompt.encode("utf-8")).hexdigest() if system_prompt else None
+    document_hash = hashlib.sha256(document.encode("utf-8")).hexdigest() if document else None
+    cache_key = (model_name, prompt_hash, _tool_names(tools), _freeze(tool_config), document_hash)
+    prefix = document_turns(document) if document else []
+
+    cached_content = context_cache.lookup(
+        cache_key,
+        create_kwargs={"model": model_name, "system_instruction": system_prompt, "contents": prefix or None,
+                       "tools": tools, "tool_config": tool_config},
+        tokens=estimate_tokens(system_prompt, document),
+        document_id=document_hash,
+        chat_id=chat_id,
+    )
+    if cached_content is not None:
+        return _model_for_cached_content(cached_content, generation_config), list(conversation_history), cache_key
+
+    model = get_cached_model(model_name, system_prompt=system_prompt, tools=tools,
+                             generation_config=generation_config, tool_config=tool_config)
+    return model, prefix + list(conversation_history), None
+
+
+def _request_tokens(*texts: Optional[str], history: List[Dict[str, Any]] = ()) -> int:
+    """Estimated tokens a request books against the TPM budget: its input plus the expected output."""
+    history_texts = [part.get('text') for message in history for part in message.get('parts', [])
+                     if isinstance(part, dict)]
+    return estimate_tokens(*texts, *history_texts) + GEMINI_OUTPUT_TOKEN_ESTIMATE
+
+
+async def _admission(model_name: str, priority: Priority, tokens: int) -> AsyncGenerator[Dict[str, Any], None]:
+    """
+    Waits until the admission controller lets the request through. When it has to queue,
+    first yields a {"queued": True, "eta": seconds} signal for the handler to show.
+    Raises GeminiOverloadedError when the request is shed.
+    """
+    ticket = gemini_admission.request(model_name, priority, tokens)
+    try:
+        if ticket.queued:
+            yield {"queued": True, "eta": ticket.eta}
+        await ticket.wait()
+    finally:
+        ticket.cancel()
+
+
+def _overloaded_message(e: GeminiOverloadedError) -> str:
+    return f"[AI ERROR: The AI service is very busy right now. Please try again in about {max(e.eta, 5):.0f} seconds.]"
+
+
+def _is_missing_cache_error(e: Exception) -> bool:
+    """True for the errors Gemini returns when a cached content expired or was deleted."""
+    from google.api_core import exceptions
+    return isinstance(e, (exceptions.NotFound, exceptions.PermissionDenied, exceptions.InvalidArgument)) \
+        and "cache" in str(e).lower()
+
+
+# --- Failure Handling ---
+RETRY_NOW, RETRY_LATER, RETRY_NEVER = "now", "later", "never"
+
+
+def _handle_failure(e: Exception, model_name: str, cache_key: Optional[tuple], delay: float) -> str:
+    """
+    Reports a failed call to the context cache, the admission controller and the model's
+    circuit breaker, and says whether the model may be retried: RETRY_NOW (only its context
+    cache was gone), RETRY_LATER (transient: quota or server trouble) or RETRY_NEVER.
+    Only transient failures count against the breaker; a client error such as a bad prompt
+    or an oversized upload says nothing about the model's health.
+    """
+    from google.api_core import exceptions
+    if cache_key is not None and _is_missing_cache_error(e):
+        logger.warning(f"Gemini context cache is gone ({e}). Retrying without it.")
+        context_cache.invalidate(cache_key)
+        return RETRY_NOW
+    if isinstance(e, exceptions.ResourceExhausted):
+        # Pause the model for every caller; the retry waits its turn in the admission queue.
+        logger.warning(f"Gemini quota exceeded: {e}. Pausing {model_name} for {delay:.1f} seconds...")
+        gemini_admission.report_quota_exceeded(model_name, delay)
+        model_router.record_failure(model_name)
+        return RETRY_LATER
+    if isinstance(e, (exceptions.ServiceUnavailable, exceptions.InternalServerError, exceptions.DeadlineExceeded,
+                      asyncio.TimeoutError)):
+        logger.warning(f"Temporary API error from {model_name}: {e}")
+        model_router.record_failure(model_name)
+        return RETRY_LATER
+    logger.error(f"Non-retryable error from {model_name}: {e}", exc_info=True)
+    return RETRY_NEVER
+
+
+async def _next_model(attempt: int, failed: set, exhausted: set, initial_delay: float) -> Optional[str]:
+    """
+    Picks the model for the next attempt, preferring tiers that have not failed this request.
+    Backs off before retrying a model that failed transiently; None when nothing is left to try.
+    """
+    model_name = model_router.select(avoid=failed | exhausted)
+    if model_name is None or model_name in exhausted:
+        return None
+    if model_name in failed:
+        delay = initial_delay * (2 ** max(attempt - 1, 0))
+        logger.warning(f"Retrying {model_name} in {delay:.1f} seconds...")
+        await asyncio.sleep(delay)
+    return model_name
+
+
+def _answer_cache_scope(chat_id: Optional[int], conversation_history: List[Dict[str, Any]],
+                        document: Optional[str]) -> str:
+    """
+    Scope of a cached answer: the chat, the exact history sent and the document. A short
+    follow-up like "tell me more" is only answered from cache in the conversation it was asked in.
+    """
+    context_digest = hashlib.sha256(f"{conversation_history!r}\0{document or ''}".encode("utf-8")).hexdigest()
+    return f"{chat_id}:{context_digest}"
+
+
 # --- Main Orchestrator Function ---
 async def ask_gemini_stream(
         current_question: str,
         conversation_history: List[Dict[str, Any]],
         system_prompt: str,
+        document: Optional[str] = None,
+        chat_id: Optional[int] = None,
+        priority: Priority = Priority.INTERACTIVE,
 ) -> AsyncGenerator[Union[str, Dict[str, Any]], None]:
     """
     Handles a conversation with Gemini, including tool calls and manual retries.
     This version uses 'auto' tool-calling mode, relying on a strong system
     prompt to guide the model, which can prevent tool-looping behavior.
+    `document` is reference text for the conversation, cached server-side once it is reused.
+    Every API call is admitted by `gemini_admission` at `priority`; while it is queued, a
+    {"queued": True, "eta": seconds} signal is yielded.
+    The model comes from `model_router`: a failed attempt is retried on the next tier, and
+    when every model's circuit is open the last answer to the same question is reused.
     """
-    # model_name = "gemini-1.5-flash-latest"
-    # model_name = "models/gemini-2.5-pro"
-    model_name = "models/gemini-2.5-flash"
-
-
     # --- The Final Change: Use 'auto' mode ---
     # This lets the model choose between calling a tool or generating text directly.
     # Our strong system prompt should guide it to make the correct choice.
     auto_tool_config = {"function_calling_config": {"mode": "auto"}}
 
-    model = genai.GenerativeModel(
-        model_name,
-        system_instruction=system_prompt,
-        generation_config=GenerationConfig(temperature=0.7),
-        tools=[web_search_tool],
-        tool_config=auto_tool_config
-    )
-
     max_retries = 3
     initial_delay = 1.5
+    request_tokens = _request_tokens(system_prompt, current_question, document, history=conversation_history)
+    answer_scope = _answer_cache_scope(chat_id, conversation_history, document)
+    failed_models, exhausted_models = set(), set()
+    last_error: Optional[Exception] = None
+    # Once text has reached the caller, a retry would stream the answer a second time.
+    yielded_text = False
 
     for attempt in range(max_retries):
+        model_name = await _next_model(attempt, failed_models, exhausted_models, initial_delay)
+        if model_name is None:
+            break
+        model, history, cache_key = get_context_model(
+            model_name,
+            system_prompt,
+            conversation_history,
+            generation_config=GenerationConfig(temperature=0.7),
+            tools=[web_search_tool],
+            tool_config=auto_tool_config,
+            document=document,
+            chat_id=chat_id,
+        )
+
+        async def send_first_message():
+            # Each attempt (and each hedged duplicate) starts with a clean session to prevent state corruption
+            session = model.start_chat(history=history)
+            # A streaming send returns once the first chunk has arrived.
+            return session, await session.send_message_async(current_question, stream=True)
+
         try:
-            # Each attempt starts with a clean session to prevent state corruption
-            chat_session = model.start_chat(history=conversation_history)
-            logger.debug(f"Attempt {attempt + 1}/{max_retries}: Sending prompt...")
+            async for signal in _admission(model_name, priority, request_tokens):
+                yield signal
+            logger.debug(f"Attempt {attempt + 1}/{max_retries}: Sending prompt to {model_name}...")
 
             # --- API Call #1 ---
-            response_stream_1 = await chat_session.send_message_async(current_question, stream=True)
+            sent_at = time.monotonic()
+            chat_session, response_stream_1 = await hedged_first_chunk(send_first_message, model_name,
+                                                                       request_tokens)
+            first_chunk_latency = time.monotonic() - sent_at
 
             function_call_to_execute = None
             text_from_stream_1 = ""
+            answer_text = ""
 
             # This loop correctly handles text and tool calls from the first response
             async for chunk in response_stream_1:
@@ -93,9 +371,11 @@ async def ask_gemini_stream(
                     function_call_to_execute = chunk.parts[0].function_call
                 elif chunk.text:
                     text_from_stream_1 += chunk.text
+                    yielded_text = True
                     yield chunk.text
 
             await response_stream_1.resolve()
+            answer_text = text_from_stream_1
 
             # --- Process the result of the first stream ---
             if function_call_to_execute:
@@ -105,6 +385,9 @@ async def ask_gemini_stream(
 
                 if tool_name in TOOL_REGISTRY:
                     tool_response_content = await TOOL_REGISTRY[tool_name](**tool_args)
+                    async for signal in _admission(model_name, priority,
+                                                   request_tokens + estimate_tokens(str(tool_response_content))):
+                        yield signal
 
                     # --- API Call #2 ---
                     response_stream_2 = await chat_session.send_message_async(
@@ -119,6 +402,8 @@ async def ask_gemini_stream(
                             logger.warning(
                                 f"Model requested a second function call: {final_chunk.parts[0].function_call.name}. Ignoring.")
                         elif final_chunk.text:
+                            answer_text += final_chunk.text
+                            yielded_text = True
                             yield final_chunk.text
 
                     await response_stream_2.resolve()
@@ -133,22 +418,41 @@ async def ask_gemini_stream(
                     logger.error("Model did not call a tool and did not return any text.")
                     yield "[AI ERROR: The AI did not generate a response.]"
 
+            model_router.record_success(model_name, first_chunk_latency)
+            if answer_text.strip():
+                model_router.remember_answer(answer_scope, system_prompt, current_question, answer_text)
             # If the 'try' block completed, we're done. Exit the retry loop.
             return
 
+        except GeminiOverloadedError as e:
+            # This model's quota is booked up; another tier has its own.
+            last_error = e
+            exhausted_models.add(model_name)
         except Exception as e:
-            from google.api_core import exceptions
-            if isinstance(e,
-                          (exceptions.ServiceUnavailable, exceptions.ResourceExhausted)) and attempt < max_retries - 1:
-                delay = initial_delay * (2 ** attempt)
-                logger.warning(f"Temporary API error: {e}. Retrying in {delay:.1f} seconds...")
-                await asyncio.sleep(delay)
-                continue
-            else:
-                logger.error(f"A final, non-retryable error occurred in ask_gemini_stream: {e}", exc_info=True)
-                yield f"\n\n[AI ERROR: An unexpected error occurred: {e}]"
+            last_error = e
+            outcome = _handle_failure(e, model_name, cache_key, initial_delay * (2 ** attempt))
+            if outcome == RETRY_LATER:
+                failed_models.add(model_name)
+            elif outcome == RETRY_NEVER:
+                exhausted_models.add(model_name)
+            if yielded_text:
+                logger.error(f"Gemini stream from {model_name} failed after partial output: {e}")
+                yield "\n\n[AI ERROR: The response was interrupted. Please ask again to get the rest.]"
                 return
 
+    # No model could answer: reuse a recent answer to the same question if there is one.
+    cached_answer = model_router.cached_answer(answer_scope, system_prompt, current_question)
+    if cached_answer is not None:
+        logger.warning("No Gemini model available; serving a cached answer.")
+        yield cached_answer
+    elif isinstance(last_error, GeminiOverloadedError):
+        yield _overloaded_message(last_error)
+    elif last_error is None:
+        yield "[AI ERROR: The AI service is temporarily unavailable. Please try again in a minute.]"
+    else:
+        logger.error(f"A final, non-retryable error occurred in ask_gemini_stream: {last_error}")
+        yield f"\n\n[AI ERROR: An unexpected error occurred: {last_error}]"
+
 # --- Vision Model Function ---
 async def ask_gemini_vision_stream(
         prompt_text: str,
@@ -156,51 +460,84 @@ async def ask_gemini_vision_stream(
         image_mime_type: str,
         conversation_history: List[Dict[str, Any]],
         system_prompt: str
-) -> AsyncGenerator[str, None]:
+) -> AsyncGenerator[Union[str, Dict[str, Any]], None]:
     """
     Generates content from Gemini based on a prompt and an image, with robust
     timeout handling to prevent getting stuck on slow connections.
+    While the call is queued for admission, a {"queued": True, "eta": seconds} signal is yielded.
+    A call that fails before any text arrived is retried on the next model tier.
     """
-    # model_name = "gemini-1.5-flash-latest"
-    # model_name = "models/gemini-2.5-pro"
-    model_name = "models/gemini-2.5-flash"
-
-    logger.info(f"Using vision model: {model_name}")
-    model = genai.GenerativeModel(model_name, system_instruction=system_prompt)
-
     image_part = PartDict(inline_data=PartDict(data=image_bytes, mime_type=image_mime_type))
     prompt_parts = [prompt_text, image_part]
+    # Images are billed at a fixed ~258 tokens each.
+    request_tokens = _request_tokens(system_prompt, prompt_text) + 258
+    failed_models, exhausted_models = set(), set()
+    last_error: Optional[Exception] = None
+    received_any_text = False
+
+    for attempt in range(2):
+        model_name = await _next_model(attempt, failed_models, exhausted_models, 1.5)
+        if model_name is None:
+            break
+        logger.info(f"Using vision model: {model_name}")
+        model, _, cache_key = get_context_model(model_name, system_prompt, [])
 
-    try:
-        # --- NEW: Define request options with a 60-second timeout ---
-        request_options = {"timeout": 60}
-
-        # --- MODIFIED: Pass the request_options to the API call ---
-        response = await model.generate_content_async(
-            prompt_parts,
-            stream=True,
-            request_options=request_options
-        )
+        try:
+            async for signal in _admission(model_name, Priority.VISION, request_tokens):
+                yield signal
+
+            # --- NEW: Define request options with a 60-second timeout ---
+            request_options = {"timeout": 60}
+
+            # --- MODIFIED: Pass the request_options to the API call ---
+            sent_at = time.monotonic()
+            response = await hedged_first_chunk(
+                lambda: model.generate_content_async(
+                    prompt_parts,
+                    stream=True,
+                    request_options=request_options
+                ),
+                model_name,
+                request_tokens,
+            )
+            first_chunk_latency = time.monotonic() - sent_at
+
+            async for chunk in response:
+                if chunk.text:
+                    received_any_text = True
+                    yield chunk.text
+            model_router.record_success(model_name, first_chunk_latency)
 
-        received_any_text = False
-        async for chunk in response:
-            if chunk.text:
-                received_any_text = True
-                yield chunk.text
-
-        # This handles the case where the stream finishes successfully but was empty.
-        if not received_any_text:
-            logger.warning("Gemini Vision stream completed but returned no text.")
-            yield "[AI could not generate a response for this image.]"
-
-    # --- NEW: Catch the specific timeout error ---
-    except asyncio.TimeoutError:
-        logger.error("Gemini Vision API call timed out after 60 seconds.",
-                     exc_info=False)  # No need for full traceback here
-        yield "\n\n[AI ERROR: The request to the AI service timed out. This may be due to a slow network connection or a very large image. Please try again.]"
+            # This handles the case where the stream finishes successfully but was empty.
+            if not received_any_text:
+                logger.warning("Gemini Vision stream completed but returned no text.")
+                yield "[AI could not generate a response for this image.]"
+            return
 
-    except Exception as e:
-        logger.error(f"Error during Gemini Vision API call: {e}", exc_info=True)
+        except GeminiOverloadedError as e:
+            last_error = e
+            exhausted_models.add(model_name)
+        except Exception as e:
+            last_error = e
+            outcome = _handle_failure(e, model_name, cache_key, 5.0)
+            if outcome == RETRY_LATER:
+                failed_models.add(model_name)
+            elif outcome == RETRY_NEVER:
+                exhausted_models.add(model_name)
+        if received_any_text:
+            break  # Part of the answer is already on screen; a retry would repeat it.
+
+    if isinstance(last_error, GeminiOverloadedError):
+        yield _overloaded_message(last_error)
+    elif last_error is None:
+        logger.warning("No Gemini model available for the vision request; every circuit is open.")
+        yield "[AI ERROR: The AI service is temporarily unavailable. Please try again in a minute.]"
+    # --- NEW: Report the specific timeout error ---
+    elif isinstance(last_error, asyncio.TimeoutError):
+        logger.error("Gemini Vision API call timed out after 60 seconds.")
+        yield "\n\n[AI ERROR: The request to the AI service timed out. This may be due to a slow network connection or a very large image. Please try again.]"
+    else:
+        logger.error(f"Error during Gemini Vision API call: {last_error}")
         # Your original error handling is good for other types of errors.
         yield f"\n\n[AI ERROR: Could not analyze the image. The AI service reported an error.]"
 
@@ -208,23 +545,61 @@ async def ask_gemini_vision_stream(
 async def ask_gemini_non_stream(
         prompt: str,
         system_prompt: str,
-        conversation_history: List[Dict[str, Any]]
+        conversation_history: List[Dict[str, Any]],
+        document: Optional[str] = None,
+        chat_id: Optional[int] = None,
+        priority: Priority = Priority.INTERACTIVE,
 ) -> str:
     """
     Sends a prompt to Gemini and gets the complete response back without streaming.
     This is necessary for the Creator-Critic pattern.
+    `document` is reference text, cached server-side once it is reused. The call waits for
+    admission at `priority` and falls back through the model tiers like `ask_gemini_stream`;
+    if nothing can answer, an "[AI ERROR: ...]" string is returned.
     """
-    try:
-        model_name = "models/gemini-2.5-flash"
-        # model_name = "gemini-1.5-flash-latest"  # Using Flash to keep it faster and cheaper
-        model = genai.GenerativeModel(model_name, system_instruction=system_prompt)
-
-        chat_session = model.start_chat(history=conversation_history)
-        response = await chat_session.send_message_async(prompt)
-
-        return response.text
-    except Exception as e:
-        logger.error(f"Error in ask_gemini_non_stream: {e}", exc_info=True)
-        return f"[AI ERROR: Could not generate a response. Details: {e}]"
-
-# --- END OF FINAL bot/gemini_utils.py ---
\ No newline at end of file
+    request_tokens = _request_tokens(system_prompt, prompt, document, history=conversation_history)
+    answer_scope = _answer_cache_scope(chat_id, conversation_history, document)
+    failed_models, exhausted_models = set(), set()
+    last_error: Optional[Exception] = None
+
+    for attempt in range(3):
+        model_name = await _next_model(attempt, failed_models, exhausted_models, 1.5)
+        if model_name is None:
+            break
+        model, history, cache_key = get_context_model(model_name, system_prompt, conversation_history,
+                                                      document=document, chat_id=chat_id)
+        try:
+            async for _ in _admission(model_name, priority, request_tokens):
+                pass
+            chat_session = model.start_chat(history=history)
+            sent_at = time.monotonic()
+            response = await chat_session.send_message_async(prompt)
+            model_router.record_success(model_name, time.monotonic() - sent_at)
+
+            if response.text.strip():
+                model_router.remember_answer(answer_scope, system_prompt, prompt, response.text)
+            return response.text
+        except GeminiOverloadedError as e:
+            last_error = e
+            exhausted_models.add(model_name)
+        except Exception as e:
+            last_error = e
+            outcome = _handle_failure(e, model_name, cache_key, 1.5 * (2 ** attempt))
+            if outcome == RETRY_LATER:
+                failed_models.add(model_name)
+            elif outcome == RETRY_NEVER:
+                exhausted_models.add(model_name)
+
+    cached_answer = model_router.cached_answer(answer_scope, system_prompt, prompt)
+    if cached_answer is not None:
+        logger.warning("No Gemini model available; serving a cached answer.")
+        return cached_answer
+    if isinstance(last_error, GeminiOverloadedError):
+        return _overloaded_message(last_error)
+    if last_error is None:
+        logger.warning("No Gemini model available for ask_gemini_non_stream; every circuit is open.")
+        return "[AI ERROR: Could not generate a response. Details: no Gemini model is available]"
+    logger.error(f"Error in ask_gemini_non_stream: {last_error}")
+    return f"[AI ERROR: Could not generate a response. Details: {last_error}]"
+
+# --- END OF FINAL bot/gemini_utils.py ---
@@ -0,0 +1,128 @@
+# --- START OF FILE bot/hedging.py ---
+
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, TypeVar
+
+from .config_utils import env_number
+from .gemini_admission import gemini_admission
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+# --- Hedging Configuration ---
+GEMINI_HEDGING = os.getenv("GEMINI_HEDGING", "on").lower() not in ("0", "off", "false", "no")
+# A duplicate request is sent when the first chunk is slower than this percentile of recent first chunks.
+GEMINI_HEDGE_PERCENTILE = env_number("GEMINI_HEDGE_PERCENTILE", 95.0, cast=float)
+GEMINI_HEDGE_MIN_DELAY_SECONDS = env_number("GEMINI_HEDGE_MIN_DELAY_SECONDS", 2.0, cast=float)
+# Used until a model has HEDGE_MIN_SAMPLES latencies to take the percentile from.
+GEMINI_HEDGE_DEFAULT_DELAY_SECONDS = env_number("GEMINI_HEDGE_DEFAULT_DELAY_SECONDS", 8.0, cast=float)
+HEDGE_MIN_SAMPLES = 20
+HEDGE_LATENCY_SAMPLES = 200
+
+
+class HedgePolicy:
+    """Tracks first-chunk latencies per model and decides when a call is slow enough to hedge."""
+
+    def __init__(self):
+        self._latencies: Dict[str, Deque[float]] = {}
+        self.stats = {"hedges_sent": 0, "hedge_wins": 0, "skipped_for_budget": 0}
+
+    def record(self, model_name: str, latency: float) -> None:
+        self._latencies.setdefault(model_name, deque(maxlen=HEDGE_LATENCY_SAMPLES)).append(latency)
+
+    def deadline(self, model_name: str) -> Optional[float]:
+        """Seconds to wait for the first chunk before hedging, or None when hedging is off."""
+        if not GEMINI_HEDGING:
+            return None
+        latencies = sorted(self._latencies.get(model_name, ()))
+        if len(latencies) < HEDGE_MIN_SAMPLES:
+            return GEMINI_HEDGE_DEFAULT_DELAY_SECONDS
+        index = min(int(len(latencies) * GEMINI_HEDGE_PERCENTILE / 100), len(latencies) - 1)
+        return max(latencies[index], GEMINI_HEDGE_MIN_DELAY_SECONDS)
+
+    def get_stats(self) -> Dict[str, Any]:
+        deadlines = {model_name: self.deadline(model_name) for model_name in self._latencies}
+        return {**self.stats, "deadlines": deadlines}
+
+
+hedge_policy = HedgePolicy()
+
+
+async def hedged_first_chunk(start: Callable[[], Awaitable[T]], model_name: str, tokens: int) -> T:
+    """
+    Runs `start()`, a coroutine factory that sends a streaming request and returns once its
+    first chunk is in. If that takes longer than the model's hedge deadline and the admission
+    budget has room right now, an identical second request is started; whichever delivers
+    its first chunk first is returned and the other is cancelled, or its stream closed if it
+    had answered too. A hedge is never queued, so it cannot take quota from waiting users.
+    """
+    started_at = time.monotonic()
+    primary = asyncio.ensure_future(start())
+    deadline = hedge_policy.deadline(model_name)
+    if deadline is None:
+        result = await primary
+        hedge_policy.record(model_name, time.monotonic() - started_at)
+        return result
+
+    hedge: Optional[asyncio.Future] = None
+    winner: Optional[asyncio.Future] = None
+    try:
+        done, _ = await asyncio.wait({primary}, timeout=deadline)
+        if not done:
+            if gemini_admission.try_admit(model_name, tokens):
+                logger.info(f"No first chunk from {model_name} after {deadline:.1f}s; sending a hedged request.")
+                hedge_policy.stats["hedges_sent"] += 1
+                hedge = asyncio.ensure_future(start())
+            else:
+                hedge_policy.stats["skipped_for_budget"] += 1
+
+        pending = {task for task in (primary, hedge) if task is not None}
+        while winner is None:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if not task.cancelled() and task.exception() is None:
+                    winner = task
+                    break
+            if winner is None and not pending:
+                # Both requests failed: report the original one's error.
+                errors = [task.exception() for task in (primary, hedge) if task is not None and not task.cancelled()]
+                raise errors[0] if errors else asyncio.CancelledError()
+        if winner is hedge:
+            hedge_policy.stats["hedge_wins"] += 1
+        return winner.result()
+    finally:
+        # A cancelled primary still tells us its first chunk took at least this long.
+        hedge_policy.record(model_name, time.monotonic() - started_at)
+        for task in (primary, hedge):
+            if task is None or task is winner:
+                continue
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled() and task.exception() is None:
+                # Both delivered a first chunk; the loser's stream must still be closed.
+                await _close_stream(task.result())
+
+
+async def _close_stream(result: Any) -> None:
+    """Closes the response stream of a request that lost the race (also inside a (session, stream) pair)."""
+    for value in result if isinstance(result, tuple) else (result,):
+        stream = getattr(value, "_iterator", value)
+        try:
+            if hasattr(stream, "aclose"):
+                await stream.aclose()
+            elif hasattr(stream, "cancel"):
+                stream.cancel()
+        except Exception as e:
+            logger.warning(f"Could not close the losing hedged stream: {e}")
+
+
+def get_hedging_stats() -> Dict[str, Any]:
+    return hedge_policy.get_stats()
+
+# --- END OF FILE bot/hedging.py ---
@@ -0,0 +1,86 @@
+# --- START OF FILE bot/http_client.py ---
+
+import os
+import logging
+from typing import Any, Dict, Optional
+
+import httpx
+
+from .config_utils import env_number
+
+logger = logging.getLogger(__name__)
+
+
+# --- Pool Configuration ---
+HTTP_MAX_CONNECTIONS = env_number("HTTP_MAX_CONNECTIONS", 100)
+HTTP_MAX_KEEPALIVE_CONNECTIONS = env_number("HTTP_MAX_KEEPALIVE_CONNECTIONS", 20)
+HTTP_KEEPALIVE_EXPIRY = env_number("HTTP_KEEPALIVE_EXPIRY", 30.0, cast=float)
+HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "true").lower() in ("1", "true", "yes")
+
+try:
+    import h2  # noqa: F401  (only needed so httpx can negotiate HTTP/2)
+    H2_AVAILABLE = True
+except ImportError:
+    H2_AVAILABLE = False
+    if HTTP2_ENABLED:
+        logger.warning("Package 'h2' not found. Outbound HTTP will use HTTP/1.1 only.")
+
+_client: Optional[httpx.AsyncClient] = None
+_http_stats = {"requests": 0, "new_connections": 0}
+
+
+async def _trace(event_name: str, info: Dict[str, Any]) -> None:
+    """httpcore trace callback; a TCP connect means the request could not reuse a pooled connection."""
+    if event_name == "connection.connect_tcp.complete":
+        _http_stats["new_connections"] += 1
+
+
+async def _attach_trace(request: httpx.Request) -> None:
+    _http_stats["requests"] += 1
+    request.extensions["trace"] = _trace
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """
+    Returns the process-wide AsyncClient used for all outbound web and search requests.
+
+    The client keeps connections alive (and multiplexes them over HTTP/2 when the server
+    supports it), so repeated requests to googleapis.com or the same site skip the TCP
+    and TLS handshakes. It is created on first use; `close_http_client` is called from
+    the Application's post_shutdown hook.
+    """
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            http2=HTTP2_ENABLED and H2_AVAILABLE,
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+            ),
+            event_hooks={"request": [_attach_trace]},
+        )
+        logger.info(
+            f"Created shared HTTP client (http2={HTTP2_ENABLED and H2_AVAILABLE}, "
+            f"max_connections={HTTP_MAX_CONNECTIONS}, keepalive={HTTP_MAX_KEEPALIVE_CONNECTIONS})."
+        )
+    return _client
+
+
+async def close_http_client() -> None:
+    """Closes the shared client and its pooled connections."""
+    global _client
+    if _client is not None and not _client.is_closed:
+        await _client.aclose()
+        logger.info("Shared HTTP client closed.")
+    _client = None
+
+
+def get_http_client_stats() -> Dict[str, Any]:
+    """Returns request and new-connection counters plus the resulting connection reuse rate."""
+    requests_sent = _http_stats["requests"]
+    new_connections = _http_stats["new_connections"]
+    reuse_rate = (1 - min(new_connections, requests_sent) / requests_sent) * 100 if requests_sent else 0.0
+    return {"requests": requests_sent, "new_connections": new_connections, "reuse_rate": reuse_rate}
+
+# --- END OF FILE bot/http_client.py ---
@@ -0,0 +1,155 @@
+# --- START OF FILE bot/image_preprocessing.py ---
+
+import io
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Deque, Dict, Optional
+
+from PIL import Image, ImageOps
+
+from .config_utils import env_number
+
+logger = logging.getLogger(__name__)
+
+
+# --- Image Preprocessing Configuration ---
+# Longest edge sent to Gemini Vision; larger images are downscaled (aspect ratio kept).
+IMAGE_MAX_EDGE = env_number("IMAGE_MAX_EDGE", 1536)
+IMAGE_OUTPUT_FORMAT = os.getenv("IMAGE_OUTPUT_FORMAT", "JPEG").upper()  # JPEG or WEBP
+IMAGE_QUALITY = env_number("IMAGE_QUALITY", 85)
+# JPEG/PNG/WebP images within IMAGE_MAX_EDGE and at most this size are sent untouched.
+IMAGE_SKIP_BYTES = env_number("IMAGE_SKIP_BYTES", 512 * 1024)
+IMAGE_WORKERS = env_number("IMAGE_WORKERS", 2)
+# Used to turn bytes saved into upload time saved for /stats.
+IMAGE_UPLOAD_BYTES_PER_SECOND = env_number("IMAGE_UPLOAD_BYTES_PER_SECOND", 2 * 1024 * 1024, cast=float)
+IMAGE_STATS_SAMPLES = 500
+
+PASSTHROUGH_FORMATS = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp"}
+
+
+@dataclass
+class PreparedImage:
+    data: bytes
+    mime_type: str
+    original_size: int
+    seconds: float  # Time spent preprocessing
+    skipped: bool = False
+
+
+def _encode(image: Image.Image) -> bytes:
+    """Re-encodes in IMAGE_OUTPUT_FORMAT without metadata (EXIF, GPS, comments)."""
+    has_alpha = image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info)
+    with io.BytesIO() as out:
+        if IMAGE_OUTPUT_FORMAT == "WEBP":
+            image = image.convert("RGBA" if has_alpha else "RGB")
+            image.save(out, format="WEBP", quality=IMAGE_QUALITY, method=4)
+        else:
+            if has_alpha:
+                # JPEG has no alpha channel: flatten onto white, as a viewer would show it.
+                rgba = image.convert("RGBA")
+                image = Image.new("RGB", rgba.size, (255, 255, 255))
+                image.paste(rgba, mask=rgba.getchannel("A"))
+            image = image.convert("RGB")
+            image.save(out, format="JPEG", quality=IMAGE_QUALITY, optimize=True, progressive=True)
+        return out.getvalue()
+
+
+def preprocess_image_sync(data: bytes) -> PreparedImage:
+    """
+    Downscales an image to IMAGE_MAX_EDGE and re-encodes it for Gemini Vision, applying
+    the EXIF orientation and dropping the metadata. Small JPEG/PNG/WebP images are
+    returned as-is, and the original is kept when re-encoding would not make it smaller.
+    Raises PIL.UnidentifiedImageError for data that is not an image.
+    """
+    started = time.perf_counter()
+    with Image.open(io.BytesIO(data)) as image:
+        original_format = image.format
+        if original_format in PASSTHROUGH_FORMATS and max(image.size) <= IMAGE_MAX_EDGE \
+                and len(data) <= IMAGE_SKIP_BYTES:
+            return PreparedImage(data, PASSTHROUGH_FORMATS[original_format], len(data),
+                                 time.perf_counter() - started, skipped=True)
+
+        resized = max(image.size) > IMAGE_MAX_EDGE
+        if resized and original_format == "JPEG":
+            # Let the JPEG decoder scale down by a power of two while decoding; much cheaper for photos.
+            image.draft("RGB", (IMAGE_MAX_EDGE, IMAGE_MAX_EDGE))
+        prepared = ImageOps.exif_transpose(image)
+        prepared.thumbnail((IMAGE_MAX_EDGE, IMAGE_MAX_EDGE), Image.Resampling.LANCZOS)
+        encoded = _encode(prepared)
+
+    if not resized and original_format in PASSTHROUGH_FORMATS and len(encoded) >= len(data):
+        return PreparedImage(data, PASSTHROUGH_FORMATS[original_format], len(data),
+                             time.perf_counter() - started, skipped=True)
+    return PreparedImage(encoded, f"image/{IMAGE_OUTPUT_FORMAT.lower()}", len(data), time.perf_counter() - started)
+
+
+class _PreprocessingStats:
+    """Distributions of bytes saved and net upload time saved per image, for /stats."""
+
+    def __init__(self):
+        self.images = 0
+        self.skipped = 0
+        self.bytes_saved: Deque[int] = deque(maxlen=IMAGE_STATS_SAMPLES)
+        self.seconds_saved: Deque[float] = deque(maxlen=IMAGE_STATS_SAMPLES)
+
+    def record(self, prepared: PreparedImage) -> None:
+        saved = prepared.original_size - len(prepared.data)
+        self.images += 1
+        self.skipped += prepared.skipped
+        self.bytes_saved.append(saved)
+        # Upload time saved minus the time spent preprocessing; negative when it did not pay off.
+        self.seconds_saved.append(saved / IMAGE_UPLOAD_BYTES_PER_SECOND - prepared.seconds)
+
+    @staticmethod
+    def _percentiles(samples) -> Dict[str, float]:
+        ordered = sorted(samples)
+        if not ordered:
+            return {"p50": 0, "p95": 0}
+        return {"p50": ordered[len(ordered) // 2], "p95": ordered[min(int(len(ordered) * 0.95), len(ordered) - 1)]}
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {"images": self.images, "skipped": self.skipped,
+                "total_bytes_saved": sum(self.bytes_saved),
+                "bytes_saved": self._percentiles(self.bytes_saved),
+                "seconds_saved": self._percentiles(self.seconds_saved)}
+
+
+_stats = _PreprocessingStats()
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        # Pillow releases the GIL while decoding, resizing and encoding, so threads run in parallel.
+        _executor = ThreadPoolExecutor(max_workers=max(IMAGE_WORKERS, 1), thread_name_prefix="image-prep")
+    return _executor
+
+
+async def preprocess_image(data: bytes) -> PreparedImage:
+    """Runs `preprocess_image_sync` in the image thread pool so decoding never blocks the event loop."""
+    prepared = await asyncio.get_running_loop().run_in_executor(_get_executor(), preprocess_image_sync, data)
+    _stats.record(prepared)
+    if not prepared.skipped:
+        logger.info(f"Image preprocessed in {prepared.seconds * 1000:.0f}ms: "
+                    f"{prepared.original_size} -> {len(prepared.data)} bytes ({prepared.mime_type}).")
+    return prepared
+
+
+def shutdown_image_pool() -> None:
+    """Stops the image thread pool (called from the Application's post_shutdown)."""
+    global _executor
+    if _executor is not None:
+        executor, _executor = _executor, None
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def get_image_preprocessing_stats() -> Dict[str, Any]:
+    return _stats.snapshot()
+
+# --- END OF FILE bot/image_preprocessing.py ---
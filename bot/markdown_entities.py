@@ -0,0 +1,256 @@
+# --- START OF FILE bot/markdown_entities.py ---
+
+import re
+from typing import List, Optional, Tuple
+
+from telegram import MessageEntity
+
+# Telegram limits messages to 4096 characters after entities are parsed out.
+TELEGRAM_MAX_ENTITY_TEXT_LENGTH = 4096
+
+_FENCE_PATTERN = re.compile(r'^[^\S\n]*```[^\S\n]*([\w.+#-]*)[^\S\n]*$')
+_HEADING_PATTERN = re.compile(r'^[^\S\n]{0,3}#{1,6}[^\S\n]+(.*?)(?:[^\S\n]+#+)?[^\S\n]*$')
+_BULLET_PATTERN = re.compile(r'^([^\S\n]*)[*+-][^\S\n]+(.*)$')
+_BLANK_LINES_PATTERN = re.compile(r'\n{3,}')
+_LINK_URL_PATTERN = re.compile(r'^(?:https?://|tg://)\S+$', re.IGNORECASE)
+_ESCAPABLE = set('\\`*_{}[]()#+-.!|~>=')
+
+# (delimiter, entity type), longest delimiters first so '**' is not read as two '*'.
+_EMPHASIS_DELIMITERS = (
+    ('**', MessageEntity.BOLD),
+    ('__', MessageEntity.UNDERLINE),
+    ('~~', MessageEntity.STRIKETHROUGH),
+    ('||', MessageEntity.SPOILER),
+    ('*', MessageEntity.BOLD),  # The system prompt asks for MarkdownV2-style *bold*.
+    ('_', MessageEntity.ITALIC),
+    ('~', MessageEntity.STRIKETHROUGH),
+)
+_DELIMITER_START_CHARS = frozenset(delimiter[0] for delimiter, _ in _EMPHASIS_DELIMITERS)
+
+
+def utf16_len(text: str) -> int:
+    """Length of `text` in UTF-16 code units, the unit Telegram uses for entity offsets."""
+    return len(text.encode('utf-16-le')) // 2
+
+
+class _Builder:
+    """Collects output text and entities, tracking the current UTF-16 offset."""
+
+    def __init__(self):
+        self.parts: List[str] = []
+        self.offset = 0
+        self.entities: List[MessageEntity] = []
+
+    def write(self, text: str) -> None:
+        if text:
+            self.parts.append(text)
+            self.offset += utf16_len(text)
+
+    def add_entity(self, entity_type: str, start: int, **kwargs) -> None:
+        # Telegram rejects empty entities, so text that rendered to nothing gets none.
+        if self.offset > start:
+            self.entities.append(MessageEntity(entity_type, start, self.offset - start, **kwargs))
+
+
+def _can_open(line: str, start: int, delimiter: str) -> bool:
+    after = start + len(delimiter)
+    if after >= len(line) or line[after].isspace():
+        return False
+    # snake_case identifiers are not emphasis.
+    return not (delimiter[0] == '_' and start > 0 and line[start - 1].isalnum())
+
+
+def _find_closing(line: str, start: int, delimiter: str) -> int:
+    """Index of the delimiter closing the one at `start`, or -1 (only on the same line)."""
+    position = line.find(delimiter, start + len(delimiter) + 1)
+    while position != -1:
+        # In a longer run ("***" after "*nested") the closing delimiter is the end of the run.
+        while position + len(delimiter) < len(line) and line[position + len(delimiter)] == delimiter[0]:
+            position += 1
+        before, after = line[position - 1], position + len(delimiter)
+        if not before.isspace() and before != '\\' and \
+                not (delimiter[0] == '_' and after < len(line) and line[after].isalnum()):
+            return position
+        position = line.find(delimiter, position + 1)
+    return -1
+
+
+def _find_code_span_end(line: str, start: int, ticks: int) -> int:
+    position = line.find('`' * ticks, start + ticks)
+    while position != -1:
+        end = position + ticks
+        if (end >= len(line) or line[end] != '`') and line[position - 1] != '`':
+            return position
+        position = line.find('`' * ticks, end)
+    return -1
+
+
+def _find_link(line: str, start: int) -> Optional[Tuple[int, int, int]]:
+    """For '[' at `start`, returns (text_end, url_start, url_end) of a [text](url) link, or None."""
+    text_end = line.find('](', start + 1)
+    if text_end == -1:
+        return None
+    depth = 0
+    for position in range(text_end + 2, len(line)):
+        char = line[position]
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            if depth == 0:
+                return text_end, text_end + 2, position
+            depth -= 1
+        elif char.isspace():
+            return None
+    return None
+
+
+def _render_inline(builder: _Builder, line: str, active: frozenset, allow_code: bool = True,
+                   allow_links: bool = True) -> None:
+    """
+    Renders one line of inline Markdown into `builder`. `active` holds the entity types
+    enclosing this text; Telegram does not allow code inside other entities, nor links in links.
+    """
+    plain_start = 0
+    position = 0
+    length = len(line)
+    while position < length:
+        char = line[position]
+        if char == '\\' and position + 1 < length and line[position + 1] in _ESCAPABLE:
+            builder.write(line[plain_start:position])
+            builder.write(line[position + 1])
+            position += 2
+            plain_start = position
+            continue
+
+        if char == '`':
+            ticks = 1
+            while position + ticks < length and line[position + ticks] == '`':
+                ticks += 1
+            end = _find_code_span_end(line, position, ticks)
+            if end == -1:
+                position += ticks
+                continue
+            content = line[position + ticks:end]
+            if len(content) > 2 and content[0] == ' ' and content[-1] == ' ':
+                content = content[1:-1]
+            builder.write(line[plain_start:position])
+            start = builder.offset
+            builder.write(content)
+            if allow_code:
+                builder.add_entity(MessageEntity.CODE, start)
+            position = plain_start = end + ticks
+            continue
+
+        if char == '[' and allow_links:
+            link = _find_link(line, position)
+            if link is not None:
+                text_end, url_start, url_end = link
+                url = line[url_start:url_end]
+                builder.write(line[plain_start:position])
+                start = builder.offset
+                _render_inline(builder, line[position + 1:text_end], active | {MessageEntity.TEXT_LINK},
+                               allow_code=False, allow_links=False)
+                if _LINK_URL_PATTERN.match(url) and builder.offset > start:
+                    builder.add_entity(MessageEntity.TEXT_LINK, start, url=url)
+                else:
+                    # Telegram rejects links it cannot open; show the target instead.
+                    builder.write(f" ({url})")
+                position = plain_start = url_end + 1
+                continue
+
+        if char in _DELIMITER_START_CHARS:
+            for delimiter, entity_type in _EMPHASIS_DELIMITERS:
+                if not line.startswith(delimiter, position) or not _can_open(line, position, delimiter):
+                    continue
+                end = _find_closing(line, position, delimiter)
+                if end == -1:
+                    continue
+                builder.write(line[plain_start:position])
+                start = builder.offset
+                _render_inline(builder, line[position + len(delimiter):end], active | {entity_type},
+                               allow_code=False, allow_links=allow_links)
+                if entity_type not in active:
+                    builder.add_entity(entity_type, start)
+                position = plain_start = end + len(delimiter)
+                break
+            else:
+                # Not emphasis: skip the whole run so '**' is not retried as '*'.
+                run_end = position + 1
+                while run_end < length and line[run_end] == char:
+                    run_end += 1
+                position = run_end
+            continue
+
+        position += 1
+    builder.write(line[plain_start:])
+
+
+def render_markdown(text: str) -> Tuple[str, List[MessageEntity]]:
+    """
+    Renders Gemini's Markdown into plain text plus Telegram `MessageEntity` objects.
+
+    Unlike a MarkdownV2 string, text with entities cannot fail to parse, so every edit is
+    a single API call. Supported: fenced code blocks (pre), inline code, *bold*/**bold**,
+    _italic_, __underline__, ~~strikethrough~~, ||spoiler||, [links](url) and
+    headings (rendered bold). Bullets become '•' as in `transform_markdown_fallback`.
+    An unclosed code fence runs to the end of the text, which keeps streamed code
+    blocks formatted while they arrive. Offsets are in UTF-16 code units.
+    """
+    if not isinstance(text, str):
+        text = str(text)
+    lines = _BLANK_LINES_PATTERN.sub('\n\n', text.replace('\r\n', '\n').strip()).split('\n')
+    builder = _Builder()
+    line_index = 0
+    while line_index < len(lines):
+        line = lines[line_index]
+        if line_index:
+            builder.write('\n')
+        line_index += 1
+
+        fence = _FENCE_PATTERN.match(line)
+        if fence:
+            code_lines = []
+            while line_index < len(lines) and not lines[line_index].lstrip().startswith('```'):
+                code_lines.append(lines[line_index])
+                line_index += 1
+            line_index += 1  # Skip the closing fence.
+            start = builder.offset
+            builder.write('\n'.join(code_lines))
+            builder.add_entity(MessageEntity.PRE, start, language=fence.group(1) or None)
+            continue
+
+        heading = _HEADING_PATTERN.match(line)
+        if heading:
+            start = builder.offset
+            _render_inline(builder, heading.group(1), frozenset({MessageEntity.BOLD}), allow_code=False)
+            builder.add_entity(MessageEntity.BOLD, start)
+            continue
+
+        bullet = _BULLET_PATTERN.match(line)
+        if bullet:
+            builder.write(' ' * len(bullet.group(1)) + '• ')
+            line = bullet.group(2)
+        _render_inline(builder, line, frozenset())
+
+    builder.entities.sort(key=lambda entity: (entity.offset, -entity.length))
+    return "".join(builder.parts), builder.entities
+
+
+def truncate_rendered(text: str, entities: List[MessageEntity],
+                      max_length: int = TELEGRAM_MAX_ENTITY_TEXT_LENGTH) -> Tuple[str, List[MessageEntity]]:
+    """Cuts rendered text to `max_length` UTF-16 units, clipping or dropping entities past the cut."""
+    if utf16_len(text) <= max_length:
+        return text, entities
+    encoded = text.encode('utf-16-le')[:max_length * 2]
+    truncated = encoded.decode('utf-16-le', errors='ignore')
+    cut = utf16_len(truncated)
+    clipped = []
+    for entity in entities:
+        if entity.offset >= cut:
+            continue
+        length = min(entity.length, cut - entity.offset)
+        clipped.append(MessageEntity(entity.type, entity.offset, length, url=entity.url,
+                                     language=entity.language))
+    return truncated, clipped
+
+# --- END OF FILE bot/markdown_entities.py ---
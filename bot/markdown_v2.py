@@ -0,0 +1,150 @@
+# --- START OF FILE bot/markdown_v2.py ---
+
+from typing import Any, Dict, List, Optional, Tuple
+
+# Characters Telegram reserves in MarkdownV2 text; inside code only '`' (and '\') are special.
+RESERVED_CHARACTERS = frozenset('_*[]()~`>#+-=|{}.!')
+CODE_RESERVED_CHARACTERS = frozenset('`')
+
+_ENTITY_NAMES = {"bold": "bold", "italic": "italic", "underline": "underline", "strikethrough": "strikethrough",
+                 "spoiler": "spoiler", "code": "code", "pre": "pre", "text_url": "text URL",
+                 "custom_emoji": "custom emoji"}
+
+_validation_stats = {"checked": 0, "predicted_failures": 0, "telegram_rejections": 0}
+
+
+def _is_end_of_entity(entity_type: str, text: str, i: int) -> bool:
+    char = text[i]
+    following = text[i + 1] if i + 1 < len(text) else ''
+    if entity_type == "bold":
+        return char == '*'
+    if entity_type == "italic":
+        return char == '_' and following != '_'
+    if entity_type == "underline":
+        return char == '_' and following == '_'
+    if entity_type == "strikethrough":
+        return char == '~'
+    if entity_type == "spoiler":
+        return char == '|' and following == '|'
+    if entity_type == "code":
+        return char == '`'
+    if entity_type == "pre":
+        return text.startswith('```', i)
+    return char == ']'  # text_url, custom_emoji
+
+
+def find_markdown_v2_error(text: str) -> Optional[str]:
+    """
+    Checks MarkdownV2 text the way Telegram's parser does and returns the error Telegram
+    would answer with (e.g. "Can't find end of bold entity at byte offset 3"), or None if
+    the text would be accepted.
+
+    Mirrors the rules of the server-side parser: '\\' escapes any ASCII character, reserved
+    characters outside entity syntax must be escaped, only the innermost open entity can
+    be closed, code and pre contain no other entities, and every entity must be closed.
+    Offsets are reported in UTF-8 bytes like Telegram's own messages.
+    """
+    nested: List[Tuple[str, int]] = []  # (entity type, byte offset of its opening marker)
+    length = len(text)
+    byte_offset = 0
+    has_content = False
+    i = 0
+    while i < length:
+        char = text[i]
+        start = i
+        if char == '\\' and i + 1 < length and 0 < ord(text[i + 1]) <= 126:
+            i += 2
+            has_content = True
+            byte_offset += 2
+            continue
+
+        reserved = CODE_RESERVED_CHARACTERS if nested and nested[-1][0] in ("code", "pre") else RESERVED_CHARACTERS
+        if char not in reserved:
+            has_content = has_content or not char.isspace()
+            byte_offset += len(char.encode('utf-8'))
+            i += 1
+            continue
+
+        if nested and _is_end_of_entity(nested[-1][0], text, i):
+            entity_type, _ = nested.pop()
+            if entity_type in ("underline", "spoiler"):
+                i += 1
+            elif entity_type == "pre":
+                i += 2
+            elif entity_type in ("text_url", "custom_emoji"):
+                if i + 1 < length and text[i + 1] == '(':
+                    url_start = i + 2
+                    url_end = url_start
+                    while url_end < length and text[url_end] != ')':
+                        url_end += 2 if text[url_end] == '\\' and url_end + 1 < length else 1
+                    if url_end >= length:
+                        return f"Can't find end of a URL at byte offset {len(text[:url_start].encode('utf-8'))}"
+                    i = url_end
+                elif entity_type == "custom_emoji":
+                    return "Custom emoji entity must contain a tg://emoji URL"
+        else:
+            following = text[i + 1] if i + 1 < length else ''
+            if char == '_':
+                entity_type = "underline" if following == '_' else "italic"
+                i += 1 if following == '_' else 0
+            elif char == '*':
+                entity_type = "bold"
+            elif char == '~':
+                entity_type = "strikethrough"
+            elif char == '|' and following == '|':
+                entity_type = "spoiler"
+                i += 1
+            elif char == '[':
+                entity_type = "text_url"
+            elif char == '!' and following == '[':
+                entity_type = "custom_emoji"
+                i += 1
+            elif char == '`':
+                if text.startswith('```', i):
+                    entity_type = "pre"
+                    i += 2
+                else:
+                    entity_type = "code"
+            elif char == '>' and (i == 0 or text[i - 1] == '\n'):
+                # A block quote marker at the start of a line.
+                byte_offset += 1
+                i += 1
+                continue
+            else:
+                return f"Character '{char}' is reserved and must be escaped with the preceding '\\'"
+            nested.append((entity_type, byte_offset))
+        byte_offset += len(text[start:i + 1].encode('utf-8'))
+        i += 1
+
+    if nested:
+        entity_type, entity_offset = nested[-1]
+        return f"Can't find end of {_ENTITY_NAMES[entity_type]} entity at byte offset {entity_offset}"
+    if not has_content:
+        return "Message text is empty"
+    return None
+
+
+def check_markdown_v2(text: str) -> Optional[str]:
+    """`find_markdown_v2_error` that also counts the check (and a predicted failure) for /stats."""
+    error = find_markdown_v2_error(text)
+    _validation_stats["checked"] += 1
+    if error:
+        _validation_stats["predicted_failures"] += 1
+    return error
+
+
+def record_markdown_v2_rejection() -> None:
+    """Counts a MarkdownV2 message Telegram rejected although the validator passed it."""
+    _validation_stats["telegram_rejections"] += 1
+
+
+def get_markdown_v2_stats() -> Dict[str, Any]:
+    """
+    Returns the validator's counters (process-local). `avoided_rate` is the percentage of
+    would-be failed API calls that were caught locally and sent as plain text instead.
+    """
+    failures = _validation_stats["predicted_failures"] + _validation_stats["telegram_rejections"]
+    avoided_rate = (_validation_stats["predicted_failures"] / failures * 100) if failures else 0.0
+    return {**_validation_stats, "avoided_rate": avoided_rate}
+
+# --- END OF FILE bot/markdown_v2.py ---
@@ -0,0 +1,63 @@
+# --- START OF FILE bot/media_cache.py ---
+
+import sys
+import logging
+from typing import Any, Awaitable, Callable, Dict, Optional, TypeVar
+
+from .cache_utils import TTLCache, SingleFlight
+from .config_utils import env_number
+from .image_preprocessing import PreparedImage
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+# --- Media Cache Configuration ---
+# Keyed by Telegram's file_unique_id, which is the same for every forward or re-send of a
+# file, so a repeated worksheet photo, PDF or voice note is neither downloaded nor processed again.
+MEDIA_CACHE_TTL_SECONDS = env_number("MEDIA_CACHE_TTL_SECONDS", 24 * 3600, cast=float)
+MEDIA_CACHE_MAX_ENTRIES = env_number("MEDIA_CACHE_MAX_ENTRIES", 512)
+MEDIA_CACHE_MAX_BYTES = env_number("MEDIA_CACHE_MAX_BYTES", 64 * 1024 * 1024)
+
+
+def _entry_size(value: Any) -> int:
+    if isinstance(value, PreparedImage):
+        return len(value.data) + 256
+    return sys.getsizeof(value)
+
+
+media_cache = TTLCache("media", ttl_seconds=MEDIA_CACHE_TTL_SECONDS, max_entries=MEDIA_CACHE_MAX_ENTRIES,
+                       max_bytes=MEDIA_CACHE_MAX_BYTES, size_func=_entry_size)
+_media_single_flight = SingleFlight()
+
+
+async def get_processed_media(kind: str, file_unique_id: Optional[str],
+                              process: Callable[[], Awaitable[T]]) -> T:
+    """
+    Returns the cached result of processing a file ('image' -> PreparedImage, 'document' ->
+    extracted text, 'voice' -> transcript), or runs `process()` (download + processing) and
+    caches what it returns. Concurrent requests for the same file share one `process()` call.
+    Empty results (None, "") are returned but not cached, so a failed download is retried.
+    """
+    if not file_unique_id:
+        return await process()
+    key = (kind, file_unique_id)
+    cached = media_cache.get(key)
+    if cached is not None:
+        logger.info(f"Media cache hit for {kind} {file_unique_id}; skipping download and processing.")
+        return cached
+
+    async def process_and_store():
+        result = await process()
+        if result:
+            media_cache.set(key, result)
+        return result
+
+    return await _media_single_flight.do(key, process_and_store)
+
+
+def get_media_cache_stats() -> Dict[str, Any]:
+    return {**media_cache.snapshot(), "collapsed": _media_single_flight.collapsed}
+
+# --- END OF FILE bot/media_cache.py ---
@@ -0,0 +1,113 @@
+# --- START OF FILE bot/media_download.py ---
+
+import io
+import os
+import tempfile
+import logging
+from typing import Any, BinaryIO, Dict, Optional, Union
+
+import telegram
+
+from .config_utils import env_number
+
+logger = logging.getLogger(__name__)
+
+
+# --- Media Download Configuration ---
+# Files up to this size are kept in memory; larger ones go to a temporary file that is
+# removed when the download is closed. The Bot API serves at most 20 MB per file.
+MEDIA_SPILL_THRESHOLD_BYTES = env_number("MEDIA_SPILL_THRESHOLD_BYTES", 8 * 1024 * 1024)
+MEDIA_SPILL_DIR = os.getenv("MEDIA_SPILL_DIR", "temp_downloads")
+
+_stats = {"downloads": 0, "bytes": 0, "spilled": 0, "failures": 0}
+
+
+class DownloadedMedia:
+    """
+    A downloaded Telegram file, held in a `BytesIO` or, above MEDIA_SPILL_THRESHOLD_BYTES,
+    in a named temporary file. Use it as a context manager (or call `close`) so a spilled
+    file is removed as soon as the handler is done with it.
+    """
+
+    def __init__(self, file: BinaryIO, spilled: bool):
+        self._file = file
+        self.spilled = spilled
+        self.size = file.seek(0, io.SEEK_END)
+        file.seek(0)
+
+    @property
+    def file(self) -> BinaryIO:
+        """The content as a binary file rewound to the start, for PIL, python-docx or the OpenAI client."""
+        self._file.seek(0)
+        return self._file
+
+    def getbuffer(self) -> memoryview:
+        """
+        A zero-copy view of in-memory content (the spilled file is read in). Release the view
+        (`with media.getbuffer() as view:`) before the media is closed.
+        """
+        if self.spilled:
+            return memoryview(self.file.read())
+        return self._file.getbuffer()
+
+    def getvalue(self) -> bytes:
+        """The content as `bytes`, for APIs that need an immutable copy (e.g. Gemini blobs)."""
+        if self.spilled:
+            return self.file.read()
+        return self._file.getvalue()
+
+    @property
+    def source(self) -> Union[bytes, str]:
+        """
+        What to hand the document extraction pool: the bytes of an in-memory file, or the
+        path of a spilled one so large documents are not pickled into every worker task.
+        """
+        if self.spilled:
+            self._file.flush()
+            return self._file.name
+        return self._file.getvalue()
+
+    def close(self) -> None:
+        try:
+            self._file.close()
+        except BufferError:
+            # A caller still holds a view of the buffer; it is freed with the last reference.
+            pass
+
+    def __enter__(self) -> "DownloadedMedia":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+async def download_media(bot_instance: telegram.Bot, file_id: str) -> DownloadedMedia:
+    """
+    Downloads a Telegram file into memory, or into a temporary file when the size the
+    Bot API reports is above MEDIA_SPILL_THRESHOLD_BYTES. Raises on failure.
+    """
+    file_obj = await bot_instance.get_file(file_id)
+    spilled = (file_obj.file_size or 0) > MEDIA_SPILL_THRESHOLD_BYTES
+    if spilled:
+        os.makedirs(MEDIA_SPILL_DIR, exist_ok=True)
+        out = tempfile.NamedTemporaryFile(dir=MEDIA_SPILL_DIR, prefix="media_")
+    else:
+        out = io.BytesIO()
+    try:
+        await file_obj.download_to_memory(out)
+    except Exception:
+        out.close()
+        _stats["failures"] += 1
+        raise
+    media = DownloadedMedia(out, spilled)
+    _stats["downloads"] += 1
+    _stats["bytes"] += media.size
+    _stats["spilled"] += spilled
+    logger.info(f"File {file_id} downloaded ({media.size} bytes, {'spilled to disk' if spilled else 'in memory'}).")
+    return media
+
+
+def get_media_download_stats() -> Dict[str, Any]:
+    return dict(_stats)
+
+# --- END OF FILE bot/media_download.py ---
@@ -0,0 +1,172 @@
+# --- START OF FILE bot/model_router.py ---
+
+import os
+import time
+import hashlib
+import logging
+from collections import Counter, OrderedDict, deque
+from typing import Any, Collection, Deque, Dict, List, Optional
+
+from .config_utils import env_number
+
+logger = logging.getLogger(__name__)
+
+
+# --- Model Tiers ---
+# Tried in order; when every tier is unavailable the last answer to the same question is reused.
+GEMINI_MODEL_TIERS = [name.strip() for name in
+                      os.getenv("GEMINI_MODEL_TIERS", "models/gemini-2.5-flash,models/gemini-2.5-flash-lite").split(",")
+                      if name.strip()]
+CACHED_ANSWER_TIER = "cached_answer"
+UNAVAILABLE_TIER = "unavailable"
+
+# --- Circuit Breaker Configuration ---
+# A model's breaker opens when at least BREAKER_ERROR_RATE of its last BREAKER_WINDOW calls
+# (and at least BREAKER_MIN_CALLS) failed or took longer than BREAKER_SLOW_CALL_SECONDS to
+# answer. After BREAKER_COOLDOWN_SECONDS one probe call is let through.
+BREAKER_WINDOW = env_number("GEMINI_BREAKER_WINDOW", 20)
+BREAKER_MIN_CALLS = env_number("GEMINI_BREAKER_MIN_CALLS", 5)
+BREAKER_ERROR_RATE = env_number("GEMINI_BREAKER_ERROR_RATE", 0.5, cast=float)
+BREAKER_SLOW_CALL_SECONDS = env_number("GEMINI_BREAKER_SLOW_CALL_SECONDS", 20.0, cast=float)
+BREAKER_COOLDOWN_SECONDS = env_number("GEMINI_BREAKER_COOLDOWN_SECONDS", 30.0, cast=float)
+GEMINI_ANSWER_CACHE_SIZE = env_number("GEMINI_ANSWER_CACHE_SIZE", 256)
+
+
+class CircuitBreaker:
+    """Closed / open / half-open breaker over the outcomes of one model's recent calls."""
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, name: str):
+        self.name = name
+        self.state = self.CLOSED
+        self.outcomes: Deque[bool] = deque(maxlen=max(BREAKER_WINDOW, 1))  # True = healthy call
+        self.latencies: Deque[float] = deque(maxlen=max(BREAKER_WINDOW, 1))
+        self.opened_at = 0.0
+        self.probe_started_at: Optional[float] = None
+        self.stats = {"calls": 0, "failures": 0, "slow_calls": 0, "times_opened": 0}
+
+    def allow(self, now: float) -> bool:
+        """True if a call may go to this model now; in half-open state only one probe at a time."""
+        if self.state == self.OPEN and now - self.opened_at >= BREAKER_COOLDOWN_SECONDS:
+            self.state = self.HALF_OPEN
+            self.probe_started_at = None
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.HALF_OPEN:
+            # A probe that never reported back (e.g. the user's request was cancelled) is given up on.
+            if self.probe_started_at is None or now - self.probe_started_at > BREAKER_COOLDOWN_SECONDS:
+                self.probe_started_at = now
+                return True
+        return False
+
+    def record(self, healthy: bool, now: float, latency: Optional[float] = None) -> None:
+        self.stats["calls"] += 1
+        if latency is not None:
+            self.latencies.append(latency)
+            if latency > BREAKER_SLOW_CALL_SECONDS:
+                self.stats["slow_calls"] += 1
+                healthy = False
+        if not healthy:
+            self.stats["failures"] += 1
+
+        if self.state == self.HALF_OPEN:
+            if healthy:
+                logger.info(f"Circuit for {self.name} closed again after a successful probe.")
+                self.state = self.CLOSED
+                self.outcomes.clear()
+            else:
+                self._open(now)
+            return
+        self.outcomes.append(healthy)
+        failures = self.outcomes.count(False)
+        if self.state == self.CLOSED and len(self.outcomes) >= BREAKER_MIN_CALLS and \
+                failures / len(self.outcomes) >= BREAKER_ERROR_RATE:
+            self._open(now)
+
+    def _open(self, now: float) -> None:
+        self.state = self.OPEN
+        self.opened_at = now
+        self.probe_started_at = None
+        self.stats["times_opened"] += 1
+        logger.warning(f"Circuit for {self.name} opened; routing to the next model tier "
+                       f"for {BREAKER_COOLDOWN_SECONDS:.0f}s.")
+
+    def snapshot(self) -> Dict[str, Any]:
+        latencies = sorted(self.latencies)
+        return {**self.stats, "state": self.state,
+                "error_rate": self.outcomes.count(False) / len(self.outcomes) if self.outcomes else 0.0,
+                "p50_latency": latencies[len(latencies) // 2] if latencies else 0.0}
+
+
+class ModelRouter:
+    """
+    Picks the Gemini model for each call from GEMINI_MODEL_TIERS, skipping models whose
+    circuit breaker is open, so a degraded model is routed around without every request
+    first waiting for it to time out. The last tier is a small cache of recent answers,
+    used only when no model can be called.
+    """
+
+    def __init__(self, tiers: Optional[List[str]] = None):
+        self.tiers = list(tiers or GEMINI_MODEL_TIERS)
+        self.breakers = {name: CircuitBreaker(name) for name in self.tiers}
+        self._answers: "OrderedDict[str, str]" = OrderedDict()
+        self.tier_usage: Counter = Counter()
+
+    def select(self, avoid: Collection[str] = ()) -> Optional[str]:
+        """
+        Returns the first tier whose breaker allows a call, preferring models not in `avoid`
+        (those that already failed this request). None when every breaker is open.
+        """
+        now = time.monotonic()
+        for name in self.tiers:
+            if name not in avoid and self.breakers[name].allow(now):
+                return name
+        for name in self.tiers:
+            if name in avoid and self.breakers[name].allow(now):
+                return name
+        return None
+
+    def record_success(self, model_name: str, latency: float) -> None:
+        """Records a completed call; `latency` is the time to the model's first response chunk."""
+        self.breakers[model_name].record(True, time.monotonic(), latency)
+        self.tier_usage[model_name] += 1
+
+    def record_failure(self, model_name: str) -> None:
+        self.breakers[model_name].record(False, time.monotonic())
+
+    @staticmethod
+    def _answer_key(scope: str, system_prompt: str, question: str) -> str:
+        normalized_question = ' '.join(question.lower().split())
+        return hashlib.sha256(f"{scope}\0{system_prompt}\0{normalized_question}".encode("utf-8")).hexdigest()
+
+    def remember_answer(self, scope: str, system_prompt: str, question: str, answer: str) -> None:
+        """
+        Stores an answer for the last-resort tier. `scope` identifies who may see it again
+        (the chat and the exact conversation it was asked in); answers never cross scopes.
+        """
+        key = self._answer_key(scope, system_prompt, question)
+        self._answers[key] = answer
+        self._answers.move_to_end(key)
+        while len(self._answers) > max(GEMINI_ANSWER_CACHE_SIZE, 0):
+            self._answers.popitem(last=False)
+
+    def cached_answer(self, scope: str, system_prompt: str, question: str) -> Optional[str]:
+        """The last-resort tier: a recent answer to the same question in the same scope, counted as served from cache."""
+        answer = self._answers.get(self._answer_key(scope, system_prompt, question))
+        self.tier_usage[CACHED_ANSWER_TIER if answer is not None else UNAVAILABLE_TIER] += 1
+        return answer
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Returns each model's breaker state and health, and how many calls each tier served."""
+        return {"models": {name: breaker.snapshot() for name, breaker in self.breakers.items()},
+                "tier_usage": {tier: self.tier_usage[tier] for tier in (*self.tiers, CACHED_ANSWER_TIER,
+                                                                         UNAVAILABLE_TIER)}}
+
+
+model_router = ModelRouter()
+
+
+def get_model_router_stats() -> Dict[str, Any]:
+    return model_router.get_stats()
+
+# --- END OF FILE bot/model_router.py ---
@@ -1,24 +1,45 @@
 # --- START OF FILE bot/persistence.py ---
 
 import os
+import asyncio
 import logging
-from telegram.ext import PicklePersistence
+from telegram.ext import BasePersistence, PicklePersistence
+
+from .sqlite_persistence import SQLitePersistence, import_pickle_file
 
 logger = logging.getLogger(__name__)
 
 
-def create_persistence_instance() -> PicklePersistence:
-    """Creates and returns a PicklePersistence instance based on environment variables."""
+def create_persistence_instance() -> BasePersistence:
+    """
+    Creates and returns the persistence instance based on environment variables.
+
+    PERSISTENCE_BACKEND selects between "sqlite" (default, writes only changed rows) and
+    "pickle" (the original single-file PicklePersistence). When the SQLite database does
+    not exist yet but the pickle file does, the pickle is imported once so no state is lost.
+    """
 
     try:
         persistence_dir = os.getenv("PERSISTENCE_DIR", "bot_data")
         persistence_filename = os.getenv("PERSISTENCE_FILENAME", "bot_persistence.pkl")
+        persistence_backend = os.getenv("PERSISTENCE_BACKEND", "sqlite").lower()
 
         # Ensure the directory exists
         os.makedirs(persistence_dir, exist_ok=True)
 
         persistence_filepath = os.path.join(persistence_dir, persistence_filename)
 
+        if persistence_backend == "sqlite":
+            sqlite_filename = os.getenv("PERSISTENCE_SQLITE_FILENAME", "bot_persistence.sqlite3")
+            sqlite_filepath = os.path.join(persistence_dir, sqlite_filename)
+
+            if not os.path.exists(sqlite_filepath) and os.path.exists(persistence_filepath):
+                logger.info(f"Importing existing pickle data from {persistence_filepath} into {sqlite_filepath}...")
+                asyncio.run(import_pickle_file(persistence_filepath, sqlite_filepath))
+
+            logger.info(f"Setting up SQLitePersistence at: {sqlite_filepath}")
+            return SQLitePersistence(filepath=sqlite_filepath)
+
         logger.info(f"Setting up PicklePersistence at: {persistence_filepath}")
 
         return PicklePersistence(filepath=persistence_filepath)
@@ -29,4 +50,4 @@ def create_persistence_instance() -> PicklePersistence:
         logger.warning("Falling back to in-memory persistence. Bot state will be lost on restart.")
         return PicklePersistence(store_data=False)  # Or just return None and handle it in main
 
-# --- END OF FILE bot/persistence.py ---
\ No newline at end of file
+# --- END OF FILE bot/persistence.py ---
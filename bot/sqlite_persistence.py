@@ -0,0 +1,393 @@
+# --- START OF FILE bot/sqlite_persistence.py ---
+
+import os
+import sys
+import pickle
+import sqlite3
+import asyncio
+import hashlib
+import logging
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from telegram.ext import BasePersistence, PersistenceInput, PicklePersistence
+
+from .state_janitor import LAST_ACTIVE_KEY
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS user_data (user_id INTEGER PRIMARY KEY, data BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS chat_data (chat_id INTEGER PRIMARY KEY, data BLOB NOT NULL, last_active REAL);
+CREATE TABLE IF NOT EXISTS bot_data (key BLOB PRIMARY KEY, data BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS conversations (name TEXT NOT NULL, key BLOB NOT NULL, state BLOB NOT NULL,
+                                          PRIMARY KEY (name, key));
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, data BLOB);
+"""
+
+
+# table -> (key column, value columns). chat_data rows also keep the chat's last activity,
+# so idle chats can be found without unpickling every row.
+_TABLE_COLUMNS = {"user_data": ("user_id", ("data",)), "chat_data": ("chat_id", ("data", "last_active")),
+                  "bot_data": ("key", ("data",))}
+
+
+def _dumps(obj: Any) -> bytes:
+    return pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _chat_row(data: Dict[Any, Any]) -> Tuple[bytes, Optional[float]]:
+    return _dumps(data), data.get(LAST_ACTIVE_KEY)
+
+
+class SQLitePersistence(BasePersistence):
+    """
+    A `BasePersistence` that keeps one SQLite row per user, per chat and per bot_data key.
+
+    Unlike `PicklePersistence`, a persistence run only writes the rows that actually
+    changed: `update_*` calls serialize the touched entry into a pending batch, and the
+    whole batch is upserted in a single transaction right after the Application's update
+    run. The database runs in WAL mode so writes never block the lazy reads.
+
+    User and chat data are loaded lazily: `get_user_data`/`get_chat_data` return an empty
+    dict at startup and each entry is read from disk the first time
+    `refresh_user_data`/`refresh_chat_data` is called for it (i.e. on the first update of
+    that user or chat after a restart). bot_data is small and always loaded eagerly.
+    """
+
+    def __init__(self, filepath: str, store_data: Optional[PersistenceInput] = None,
+                 update_interval: float = 60):
+        super().__init__(store_data=store_data, update_interval=update_interval)
+        self.filepath = filepath
+        self._db_lock = threading.Lock()
+        self._connection = self._connect()
+
+        # Pending rows: table -> {row key: pickled bytes ((bytes, last_active) for chats), or None to delete the row}
+        self._pending: Dict[str, Dict[Any, Optional[bytes]]] = {"user_data": {}, "chat_data": {}, "bot_data": {}}
+        self._pending_conversations: Dict[Tuple[str, bytes], Optional[bytes]] = {}
+        self._pending_callback_data: Optional[bytes] = None
+        self._write_task: Optional[asyncio.Task] = None
+        # Rows of the batch currently being written, so a delete is honoured before it is committed.
+        self._writing: Dict[str, Dict[Any, Optional[bytes]]] = {}
+
+        self._loaded_user_ids: set = set()
+        self._loaded_chat_ids: set = set()
+        # Digest of each bot_data value as last written, so unchanged keys are skipped.
+        self._bot_data_digests: Dict[bytes, bytes] = {}
+
+    def _connect(self) -> sqlite3.Connection:
+        directory = os.path.dirname(self.filepath)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        connection = sqlite3.connect(self.filepath, check_same_thread=False, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.executescript(_SCHEMA)
+        if "last_active" not in {column[1] for column in connection.execute("PRAGMA table_info(chat_data)")}:
+            # Databases from before the column existed; their rows are stamped by the first sweep.
+            connection.execute("ALTER TABLE chat_data ADD COLUMN last_active REAL")
+        connection.execute("CREATE INDEX IF NOT EXISTS chat_data_last_active ON chat_data (last_active)")
+        return connection
+
+    # --- Low-level helpers (run in a worker thread) ---
+    def _fetch_one(self, query: str, params: tuple) -> Optional[tuple]:
+        with self._db_lock:
+            return self._connection.execute(query, params).fetchone()
+
+    def _fetch_all(self, query: str, params: tuple = ()) -> List[tuple]:
+        with self._db_lock:
+            return self._connection.execute(query, params).fetchall()
+
+    def _write_batch(self, rows: Dict[str, Dict[Any, Optional[bytes]]],
+                     conversations: Dict[Tuple[str, bytes], Optional[bytes]],
+                     callback_data: Optional[bytes]) -> None:
+        """Writes one batch of dirty rows inside a single transaction."""
+        with self._db_lock:
+            cursor = self._connection.cursor()
+            cursor.execute("BEGIN")
+            try:
+                for table, (key_column, value_columns) in _TABLE_COLUMNS.items():
+                    upserts = [(key, *(data if isinstance(data, tuple) else (data,)))
+                               for key, data in rows[table].items() if data is not None]
+                    deletes = [(key,) for key, data in rows[table].items() if data is None]
+                    if upserts:
+                        placeholders = ", ".join("?" * (len(value_columns) + 1))
+                        assignments = ", ".join(f"{column} = excluded.{column}" for column in value_columns)
+                        cursor.executemany(
+                            f"INSERT INTO {table} ({key_column}, {', '.join(value_columns)}) VALUES ({placeholders}) "
+                            f"ON CONFLICT({key_column}) DO UPDATE SET {assignments}", upserts)
+                    if deletes:
+                        cursor.executemany(f"DELETE FROM {table} WHERE {key_column} = ?", deletes)
+                for (name, key), state in conversations.items():
+                    if state is None:
+                        cursor.execute("DELETE FROM conversations WHERE name = ? AND key = ?", (name, key))
+                    else:
+                        cursor.execute(
+                            "INSERT INTO conversations (name, key, state) VALUES (?, ?, ?) "
+                            "ON CONFLICT(name, key) DO UPDATE SET state = excluded.state", (name, key, state))
+                if callback_data is not None:
+                    cursor.execute(
+                        "INSERT INTO meta (key, data) VALUES ('callback_data', ?) "
+                        "ON CONFLICT(key) DO UPDATE SET data = excluded.data", (callback_data,))
+                cursor.execute("COMMIT")
+            except Exception:
+                cursor.execute("ROLLBACK")
+                raise
+
+    def _take_pending(self) -> tuple:
+        rows = self._pending
+        conversations = self._pending_conversations
+        callback_data = self._pending_callback_data
+        self._pending = {"user_data": {}, "chat_data": {}, "bot_data": {}}
+        self._pending_conversations = {}
+        self._pending_callback_data = None
+        return rows, conversations, callback_data
+
+    def _has_pending(self) -> bool:
+        return any(self._pending.values()) or bool(self._pending_conversations) or \
+            self._pending_callback_data is not None
+
+    async def _write_pending(self) -> None:
+        """
+        Writes pending rows batch by batch until none are left. Only one of these tasks runs
+        at a time and `_write_task` stays set until the last batch is committed, so batches
+        are written in order and `flush` can wait for the one in flight.
+        """
+        try:
+            # Yield once so every update_* call of the current persistence run lands in this batch.
+            await asyncio.sleep(0)
+            while self._has_pending():
+                batch = self._take_pending()
+                self._writing = batch[0]
+                try:
+                    await asyncio.to_thread(self._write_batch, *batch)
+                    logger.debug(f"SQLite persistence wrote {sum(len(r) for r in batch[0].values())} dirty rows.")
+                except Exception as e:
+                    logger.error(f"Failed to write persistence batch to {self.filepath}: {e}", exc_info=True)
+                finally:
+                    self._writing = {}
+        finally:
+            self._write_task = None
+
+    def _schedule_write(self) -> None:
+        if self._write_task is None:
+            self._write_task = asyncio.get_running_loop().create_task(self._write_pending())
+
+    # --- BasePersistence API: loading ---
+    async def get_user_data(self) -> Dict[int, Dict[Any, Any]]:
+        """Returns an empty dict; entries are loaded lazily in `refresh_user_data`."""
+        return {}
+
+    async def get_chat_data(self) -> Dict[int, Dict[Any, Any]]:
+        """Returns an empty dict; entries are loaded lazily in `refresh_chat_data`."""
+        return {}
+
+    async def get_bot_data(self) -> Dict[Any, Any]:
+        rows = await asyncio.to_thread(self._fetch_all, "SELECT key, data FROM bot_data")
+        bot_data = {}
+        for key_blob, data in rows:
+            bot_data[pickle.loads(key_blob)] = pickle.loads(data)
+            self._bot_data_digests[key_blob] = hashlib.sha1(data).digest()
+        return bot_data
+
+    async def get_callback_data(self) -> Optional[Any]:
+        row = await asyncio.to_thread(self._fetch_one, "SELECT data FROM meta WHERE key = 'callback_data'", ())
+        return pickle.loads(row[0]) if row and row[0] is not None else None
+
+    async def get_conversations(self, name: str) -> Dict[tuple, object]:
+        rows = await asyncio.to_thread(self._fetch_all, "SELECT key, state FROM conversations WHERE name = ?",
+                                       (name,))
+        return {pickle.loads(key): pickle.loads(state) for key, state in rows}
+
+    async def _load_entry(self, table: str, key_column: str, entry_id: int, loaded_ids: set,
+                          data: Dict[Any, Any]) -> None:
+        """Merges the stored row of a user or chat into `data` the first time it is seen."""
+        if entry_id in loaded_ids:
+            return
+        row = None
+        if not self._is_dropped(table, entry_id):
+            row = await asyncio.to_thread(self._fetch_one, f"SELECT data FROM {table} WHERE {key_column} = ?",
+                                          (entry_id,))
+        if entry_id in loaded_ids:
+            return
+        loaded_ids.add(entry_id)
+        if self._is_dropped(table, entry_id):
+            # The row is still on disk until the delete is written; it must not come back.
+            return
+        if row:
+            # Values written in memory before the row was loaded win over the stored ones.
+            stored = pickle.loads(row[0])
+            stored.update(data)
+            data.update(stored)
+
+    def _is_dropped(self, table: str, entry_id: int) -> bool:
+        """Whether the latest change to the entry's row, not yet committed, is a delete."""
+        for rows in (self._pending[table], self._writing.get(table, {})):
+            if entry_id in rows:
+                return rows[entry_id] is None
+        return False
+
+    async def refresh_user_data(self, user_id: int, user_data: Dict[Any, Any]) -> None:
+        await self._load_entry("user_data", "user_id", user_id, self._loaded_user_ids, user_data)
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: Dict[Any, Any]) -> None:
+        await self._load_entry("chat_data", "chat_id", chat_id, self._loaded_chat_ids, chat_data)
+
+    async def refresh_bot_data(self, bot_data: Dict[Any, Any]) -> None:
+        """bot_data is loaded once at startup and only changed by this process."""
+
+    # --- BasePersistence API: storing ---
+    async def update_user_data(self, user_id: int, data: Dict[Any, Any]) -> None:
+        # An entry touched only by a job was never refreshed; merge it so the stored row is not lost.
+        await self._load_entry("user_data", "user_id", user_id, self._loaded_user_ids, data)
+        self._pending["user_data"][user_id] = _dumps(data)
+        self._schedule_write()
+
+    async def update_chat_data(self, chat_id: int, data: Dict[Any, Any]) -> None:
+        await self._load_entry("chat_data", "chat_id", chat_id, self._loaded_chat_ids, data)
+        self._pending["chat_data"][chat_id] = _chat_row(data)
+        self._schedule_write()
+
+    async def update_bot_data(self, data: Dict[Any, Any]) -> None:
+        seen_keys = set()
+        for key, value in data.items():
+            key_blob = _dumps(key)
+            seen_keys.add(key_blob)
+            value_blob = _dumps(value)
+            digest = hashlib.sha1(value_blob).digest()
+            if self._bot_data_digests.get(key_blob) != digest:
+                self._bot_data_digests[key_blob] = digest
+                self._pending["bot_data"][key_blob] = value_blob
+        for key_blob in list(self._bot_data_digests):
+            if key_blob not in seen_keys:
+                del self._bot_data_digests[key_blob]
+                self._pending["bot_data"][key_blob] = None
+        if self._pending["bot_data"]:
+            self._schedule_write()
+
+    async def update_callback_data(self, data: Any) -> None:
+        self._pending_callback_data = _dumps(data)
+        self._schedule_write()
+
+    async def update_conversation(self, name: str, key: tuple, new_state: Optional[object]) -> None:
+        self._pending_conversations[(name, _dumps(key))] = None if new_state is None else _dumps(new_state)
+        self._schedule_write()
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._loaded_user_ids.discard(user_id)
+        self._pending["user_data"][user_id] = None
+        self._schedule_write()
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        self._loaded_chat_ids.discard(chat_id)
+        self._pending["chat_data"][chat_id] = None
+        self._schedule_write()
+
+    async def flush(self) -> None:
+        """Writes any rows that are still pending. Called by the Application on shutdown."""
+        if self._has_pending():
+            self._schedule_write()
+        while self._write_task is not None:
+            await self._write_task
+        logger.info(f"SQLite persistence flushed: {self.filepath}")
+
+    def _sweep_chat_rows(self, idle_since: Optional[float], idle_before: float,
+                         trim: Callable[[Dict[Any, Any]], bool]) -> List[int]:
+        query = "SELECT chat_id, data, last_active FROM chat_data WHERE last_active < ?"
+        if idle_since is None:
+            query += " OR last_active IS NULL"
+        else:
+            query += " AND last_active >= ?"
+        rows = self._fetch_all(query, (idle_before,) if idle_since is None else (idle_before, idle_since))
+        updates = []
+        for chat_id, blob, last_active in rows:
+            if chat_id in self._loaded_chat_ids:
+                continue  # In memory: swept there, and written back by the next persistence run.
+            data = pickle.loads(blob)
+            if trim(data) or last_active is None:
+                updates.append((chat_id, *_chat_row(data)))
+        with self._db_lock:
+            cursor = self._connection.cursor()
+            cursor.execute("BEGIN")
+            try:
+                for chat_id, blob, last_active in updates:
+                    if chat_id not in self._loaded_chat_ids and chat_id not in self._pending["chat_data"]:
+                        cursor.execute("UPDATE chat_data SET data = ?, last_active = ? WHERE chat_id = ?",
+                                       (blob, last_active, chat_id))
+                cursor.execute("COMMIT")
+            except Exception:
+                cursor.execute("ROLLBACK")
+                raise
+        return [chat_id for chat_id, _, _ in updates]
+
+    async def sweep_chat_rows(self, idle_since: Optional[float], idle_before: float,
+                              trim: Callable[[Dict[Any, Any]], bool]) -> List[int]:
+        """
+        Trims stored chats that are not loaded in memory, e.g. chats idle since a restart.
+        Each row whose last activity is in [`idle_since`, `idle_before`) is unpickled and passed
+        to `trim`, which removes fields in place and returns True if it changed anything; the
+        changed rows are rewritten. With `idle_since` None, rows written before the
+        last_active column existed are included and stamped. Returns the rewritten chat ids.
+        Runs in a worker thread, so `trim` must not touch event-loop state.
+        """
+        return await asyncio.to_thread(self._sweep_chat_rows, idle_since, idle_before, trim)
+
+    def close(self) -> None:
+        """Closes the database connection. Pending rows are not written; call `flush` first."""
+        with self._db_lock:
+            self._connection.close()
+
+    # --- Introspection helpers ---
+    def count_rows(self, table: str) -> int:
+        """Returns the number of stored rows in 'user_data', 'chat_data' or 'bot_data'."""
+        if table not in self._pending:
+            raise ValueError(f"Unknown persistence table: {table}")
+        return self._fetch_one(f"SELECT COUNT(*) FROM {table}", ())[0]
+
+
+async def import_pickle_file(pickle_filepath: str, sqlite_filepath: str) -> Dict[str, int]:
+    """
+    Imports a single-file `PicklePersistence` store into a SQLite persistence database.
+
+    Existing rows with the same keys are overwritten. Returns the number of imported
+    users, chats and bot_data keys.
+    """
+    source = PicklePersistence(filepath=pickle_filepath)
+    user_data = await source.get_user_data()
+    chat_data = await source.get_chat_data()
+    bot_data = await source.get_bot_data()
+    callback_data = await source.get_callback_data()
+    conversations = source.conversations or {}
+
+    target = SQLitePersistence(sqlite_filepath)
+    try:
+        rows = {
+            "user_data": {user_id: _dumps(data) for user_id, data in user_data.items()},
+            "chat_data": {chat_id: _chat_row(data) for chat_id, data in chat_data.items()},
+            "bot_data": {_dumps(key): _dumps(value) for key, value in bot_data.items()},
+        }
+        conversation_rows = {
+            (name, _dumps(key)): _dumps(state)
+            for name, states in conversations.items()
+            for key, state in states.items()
+        }
+        await asyncio.to_thread(target._write_batch, rows, conversation_rows,
+                                _dumps(callback_data) if callback_data is not None else None)
+    finally:
+        await target.flush()
+        target.close()
+
+    counts = {"users": len(user_data), "chats": len(chat_data), "bot_data_keys": len(bot_data)}
+    logger.info(f"Imported {pickle_filepath} into {sqlite_filepath}: {counts}")
+    return counts
+
+
+if __name__ == '__main__':
+    # Migration tool: python -m bot.sqlite_persistence <pickle file> <sqlite file>
+    logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) != 3:
+        print("Usage: python -m bot.sqlite_persistence bot_data/bot_persistence.pkl bot_data/bot_persistence.sqlite3")
+        sys.exit(1)
+    print(asyncio.run(import_pickle_file(sys.argv[1], sys.argv[2])))
+
+# --- END OF FILE bot/sqlite_persistence.py ---
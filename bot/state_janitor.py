@@ -0,0 +1,206 @@
+# --- START OF FILE bot/state_janitor.py ---
+
+import time
+import pickle
+import asyncio
+import logging
+from typing import Any, Dict, List, Optional
+
+from telegram import Update
+from telegram.ext import Application, ContextTypes
+
+from .config_utils import env_number
+
+logger = logging.getLogger(__name__)
+
+
+# --- Janitor Configuration ---
+STATE_JANITOR_INTERVAL_SECONDS = env_number("STATE_JANITOR_INTERVAL_SECONDS", 600)
+# Heavy per-chat fields (page text, document index) are dropped after this much inactivity;
+# the conversation itself is kept longer.
+CHAT_STATE_IDLE_TTL_SECONDS = env_number("CHAT_STATE_IDLE_TTL_SECONDS", 24 * 3600)
+CONVERSATION_IDLE_TTL_SECONDS = env_number("CONVERSATION_IDLE_TTL_SECONDS", 7 * 24 * 3600)
+
+LAST_ACTIVE_KEY = "last_active"
+
+# field -> (idle TTL, global byte budget across all chats, companion keys evicted with it)
+EVICTABLE_FIELDS = {
+    "document_index": (CHAT_STATE_IDLE_TTL_SECONDS,
+                       env_number("STATE_BUDGET_DOCUMENT_INDEX_BYTES", 64 * 1024 * 1024), ()),
+    "last_url_content": (CHAT_STATE_IDLE_TTL_SECONDS,
+                         env_number("STATE_BUDGET_LAST_URL_CONTENT_BYTES", 32 * 1024 * 1024), ("last_url_source", "last_url_at")),
+    "conversation_history": (CONVERSATION_IDLE_TTL_SECONDS,
+                             env_number("STATE_BUDGET_CONVERSATION_HISTORY_BYTES", 32 * 1024 * 1024),
+                             ("history_summary", "history_unsummarized")),
+}
+
+_janitor_stats: Dict[str, Any] = {
+    "runs": 0, "chats": 0, "last_run_ms": 0.0,
+    "field_bytes": {field: 0 for field in EVICTABLE_FIELDS},
+    "evicted_idle": {field: 0 for field in EVICTABLE_FIELDS},
+    "evicted_budget": {field: 0 for field in EVICTABLE_FIELDS},
+    "stored_chats_trimmed": 0,
+}
+_fallback_task: Optional[asyncio.Task] = None
+# (chat_id, field) -> (value, size) as of the last sweep. Handlers replace these values rather
+# than mutate them, so a value that is still the same object is not pickled again to measure it.
+_size_cache: Dict[tuple, tuple] = {}
+# Idle TTL -> the `idle_before` bound the stored rows were last swept up to, so each stored
+# chat is only read back when its idle time crosses a TTL, not on every run.
+_stored_swept_until: Dict[int, float] = {}
+
+
+def _size_of(value: Any) -> int:
+    """Serialized size of a chat_data value, i.e. what it costs in memory and in the persistence file."""
+    try:
+        return len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+    except Exception:
+        return 0
+
+
+def _evict_idle_fields(data: Dict[Any, Any], now: float) -> bool:
+    """Drops the fields (and companions) whose idle TTL has passed for one chat; True if any were dropped."""
+    last_active = data.setdefault(LAST_ACTIVE_KEY, now)
+    evicted = False
+    for field, (ttl, _, companions) in EVICTABLE_FIELDS.items():
+        if field in data and now - last_active > ttl:
+            for key in (field, *companions):
+                data.pop(key, None)
+            _janitor_stats["evicted_idle"][field] += 1
+            evicted = True
+    return evicted
+
+
+async def record_chat_activity(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Stamps the chat's last activity; registered in an early handler group for every update."""
+    if update.effective_chat is not None and context.chat_data is not None:
+        context.chat_data[LAST_ACTIVE_KEY] = time.time()
+
+
+def sweep_chat_state(chat_data: Dict[int, Dict[Any, Any]], now: Optional[float] = None) -> List[int]:
+    """
+    Evicts heavy fields from `chat_data` (chat_id -> chat's data) and returns the chat ids
+    that changed.
+
+    A field is dropped from every chat idle for longer than its TTL. If the field's total
+    size across the remaining chats is still over its byte budget, it is dropped from the
+    least recently active chats until the total fits. Chats never stamped by
+    `record_chat_activity` (state from before the janitor existed) count as active now.
+    """
+    now = time.time() if now is None else now
+    changed = set()
+    sizes: Dict[tuple, tuple] = {}
+    field_sizes: Dict[str, List[tuple]] = {field: [] for field in EVICTABLE_FIELDS}
+    for chat_id, data in chat_data.items():
+        if _evict_idle_fields(data, now):
+            changed.add(chat_id)
+        for field in EVICTABLE_FIELDS:
+            if field not in data:
+                continue
+            value = data[field]
+            cached = _size_cache.get((chat_id, field))
+            size = cached[1] if cached is not None and cached[0] is value else _size_of(value)
+            sizes[(chat_id, field)] = (value, size)
+            field_sizes[field].append((data[LAST_ACTIVE_KEY], chat_id, size))
+
+    for field, (_, budget, companions) in EVICTABLE_FIELDS.items():
+        entries = field_sizes[field]
+        total = sum(size for _, _, size in entries)
+        # Oldest activity first.
+        for _, chat_id, size in sorted(entries):
+            if total <= budget:
+                break
+            for key in (field, *companions):
+                chat_data[chat_id].pop(key, None)
+            sizes.pop((chat_id, field), None)
+            total -= size
+            _janitor_stats["evicted_budget"][field] += 1
+            changed.add(chat_id)
+        _janitor_stats["field_bytes"][field] = total
+
+    _janitor_stats["chats"] = len(chat_data)
+    _size_cache.clear()
+    _size_cache.update(sizes)
+    return sorted(changed)
+
+
+async def sweep_stored_chats(persistence: Any, now: Optional[float] = None) -> List[int]:
+    """
+    Applies the idle TTLs to chats that exist only in the persistence store (not loaded
+    since the last restart), through the store's `sweep_chat_rows`. Returns the chat ids
+    whose rows were rewritten.
+    """
+    now = time.time() if now is None else now
+    trimmed = set()
+    for ttl in sorted({ttl for ttl, _, _ in EVICTABLE_FIELDS.values()}):
+        idle_before = now - ttl
+        trimmed.update(await persistence.sweep_chat_rows(_stored_swept_until.get(ttl), idle_before,
+                                                         lambda data: _evict_idle_fields(data, now)))
+        _stored_swept_until[ttl] = idle_before
+    _janitor_stats["stored_chats_trimmed"] += len(trimmed)
+    return sorted(trimmed)
+
+
+async def state_janitor_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    JobQueue callback: sweeps the application's chat_data and persists the chats it changed,
+    then the chats only found in the persistence store, if it supports that (SQLitePersistence).
+    """
+    application = context.application
+    start = time.perf_counter()
+    changed = sweep_chat_state(application.chat_data)
+    _janitor_stats["runs"] += 1
+    _janitor_stats["last_run_ms"] = (time.perf_counter() - start) * 1000
+    if changed:
+        application.mark_data_for_update_persistence(chat_ids=changed)
+        logger.info(f"State janitor trimmed {len(changed)} chats in {_janitor_stats['last_run_ms']:.1f}ms.")
+    if hasattr(application.persistence, "sweep_chat_rows"):
+        stored = await sweep_stored_chats(application.persistence)
+        if stored:
+            logger.info(f"State janitor trimmed {len(stored)} stored chats that are not loaded.")
+
+
+def schedule_state_janitor(application: Application) -> None:
+    """
+    Runs `state_janitor_job` every STATE_JANITOR_INTERVAL_SECONDS on the JobQueue. Without
+    the optional JobQueue (python-telegram-bot[job-queue]), falls back to a plain asyncio loop,
+    which `stop_state_janitor` cancels on shutdown.
+    """
+    global _fallback_task
+    if STATE_JANITOR_INTERVAL_SECONDS <= 0:
+        logger.info("State janitor disabled (STATE_JANITOR_INTERVAL_SECONDS <= 0).")
+        return
+    if application.job_queue is not None:
+        application.job_queue.run_repeating(state_janitor_job, interval=STATE_JANITOR_INTERVAL_SECONDS,
+                                            first=STATE_JANITOR_INTERVAL_SECONDS, name="state_janitor")
+        return
+
+    logger.warning("JobQueue not available (install python-telegram-bot[job-queue]); "
+                   "running the state janitor on a plain asyncio loop.")
+    context = ContextTypes.DEFAULT_TYPE(application=application)
+
+    async def janitor_loop():
+        while True:
+            await asyncio.sleep(STATE_JANITOR_INTERVAL_SECONDS)
+            try:
+                await state_janitor_job(context)
+            except Exception as e:
+                logger.error(f"State janitor run failed: {e}", exc_info=True)
+
+    _fallback_task = asyncio.get_running_loop().create_task(janitor_loop())
+
+
+async def stop_state_janitor() -> None:
+    """Cancels the fallback janitor loop, if one was started (called from post_shutdown)."""
+    global _fallback_task
+    if _fallback_task is not None:
+        _fallback_task.cancel()
+        await asyncio.gather(_fallback_task, return_exceptions=True)
+        _fallback_task = None
+
+
+def get_state_janitor_stats() -> Dict[str, Any]:
+    """Returns resident chat state size per field (as of the last run) and eviction counters for /stats."""
+    return _janitor_stats
+
+# --- END OF FILE bot/state_janitor.py ---
@@ -3,20 +3,18 @@
 import re
 import time
 from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
 import os
 import logging
 import asyncio
 from functools import wraps
 
 import httpx
-from bs4 import BeautifulSoup
-from openai import OpenAI, RateLimitError, APIConnectionError
+from openai import RateLimitError, APIConnectionError
 
 from localization import COMMANDS
 from telegram import Update, constants, Message
-import fitz
 import telegram
-from docx import Document as DocxDocument
 
 from telegram import Update, constants, InlineKeyboardButton, InlineKeyboardMarkup, BotCommand
 from telegram.ext import (
@@ -26,31 +24,40 @@ from telegram.ext import (
     filters,
     ContextTypes,
     BasePersistence,
-    CallbackQueryHandler
+    CallbackQueryHandler,
+    TypeHandler
 )
-from telegram.error import BadRequest, RetryAfter
+from telegram.error import BadRequest
 
 from localization import get_template, DEFAULT_LOC_LANG
 # from telegram.request import HTTPXRequest # Temporarily commented out for diagnostics
 
 # Assuming gemini_utils.py is in the same directory or a correctly configured package
-from .gemini_utils import ask_gemini_stream, ask_gemini_vision_stream, ask_gemini_non_stream
+from .gemini_utils import ask_gemini_stream, ask_gemini_vision_stream, ask_gemini_non_stream, get_model_cache_stats
+from .http_client import get_http_client_stats
+from .web_search import fetch_page_text, get_search_cache_stats, get_page_cache_stats
+from .document_extraction import detect_document_kind, extract_document_text, TRUNCATION_NOTICE
+from .edit_scheduler import edit_scheduler, get_edit_scheduler_stats
+from .markdown_entities import render_markdown, truncate_rendered, utf16_len
+from .markdown_v2 import check_markdown_v2, record_markdown_v2_rejection, get_markdown_v2_stats
+from .state_janitor import record_chat_activity, get_state_janitor_stats
+from .context_cache import context_cache, get_context_cache_stats, GEMINI_DOCUMENT_CACHE_TTL_SECONDS
+from .gemini_admission import Priority, get_gemini_admission_stats
+from .model_router import get_model_router_stats
+from .hedging import get_hedging_stats
+from .media_download import DownloadedMedia, download_media, get_media_download_stats
+from .image_preprocessing import preprocess_image, get_image_preprocessing_stats
+from .media_cache import get_processed_media, get_media_cache_stats
+from .transcription import transcribe_audio, transcription_available, get_transcription_stats
+from .conversation_memory import append_turn, get_history_for_prompt, clear_conversation, get_conversation_memory_stats
+from .document_index import (DocumentIndex, chunk_text, group_chunks, DOC_MAP_SECTION_CHARS,
+                             DOC_MAP_CONCURRENCY, DOC_FOLLOW_UP_MIN_SCORE)
 
 logger = logging.getLogger(__name__)  # This will be 'bot.telegram_bot'
 
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-openai_client = None
-if not OPENAI_API_KEY:
-    logger.warning("OPENAI_API_KEY not found in .env. Voice message transcription will be disabled.")
-else:
-    # Initialize the OpenAI client
-    openai_client = OpenAI(api_key=OPENAI_API_KEY)
-    logger.info("OpenAI client initialized successfully for voice transcriptions.")
-
 try:
     import pytesseract
-    from PIL import Image, UnidentifiedImageError
-    import io  # For BytesIO if converting images
+    from PIL import UnidentifiedImageError
 
     TESSERACT_AVAILABLE = True
 
@@ -74,8 +81,6 @@ except ImportError:
     logger.warning("Pytesseract or Pillow not found. OCR for images will not be available via Tesseract.")
     TESSERACT_AVAILABLE = False
 
-TEMP_DIR = "temp_downloads"
-
 ADMIN_ID_STR = os.getenv("TELEGRAM_ADMIN_ID")
 ADMIN_ID = int(ADMIN_ID_STR) if ADMIN_ID_STR and ADMIN_ID_STR.isdigit() else None
 
@@ -158,7 +163,6 @@ DEFAULT_SYSTEM_PROMPT_BASE = os.getenv(
 )
 
 TELEGRAM_MAX_MESSAGE_LENGTH = 4096
-STREAM_UPDATE_INTERVAL = 0.75
 
 SUPPORTED_LANGUAGES = OrderedDict([
     ("en", "English"),
@@ -320,22 +324,21 @@ def rate_limit(cooldown: int = USER_REQUEST_COOLDOWN):
     return decorator
 
 # --- Helper to Download File ---
-async def download_telegram_file(bot_instance: telegram.Bot, file_id: str, local_filename: str) -> bool:
+async def download_telegram_file(bot_instance: telegram.Bot, file_id: str) -> Optional[DownloadedMedia]:
+    """Downloads a file into memory (or a self-deleting temp file if large); None on failure."""
     try:
-        file_obj = await bot_instance.get_file(file_id)
-        await file_obj.download_to_drive(local_filename)
-        logger.info(f"File {file_id} downloaded to {local_filename}")
-        return True
+        return await download_media(bot_instance, file_id)
     except Exception as e:
         logger.error(f"Failed to download file {file_id}: {e}")
-        return False
+        return None
 
 
 async def _core_ai_handler(
         update: Update,
         context: ContextTypes.DEFAULT_TYPE,
         prompt_text: str,
-        conversation_history: list
+        conversation_history: list,
+        document: Optional[str] = None
 ):
     """
     The core logic for interacting with Gemini, streaming the response, and handling fallbacks.
@@ -346,7 +349,7 @@ async def _core_ai_handler(
     1. Sending an initial "Thinking..." placeholder.
     2. Calling the `ask_gemini_stream` function with the provided prompt.
     3. Streaming the response back to the user by editing the placeholder message.
-    4. Handling MarkdownV2 parsing errors and falling back to plain text.
+    4. Rendering the Markdown to text + entities (`render_markdown`), so no edit can fail to parse.
     5. Handling messages that are too long by delegating to `send_long_message_fallback`.
     6. Adding the 👍/👎 feedback keyboard to the final successful message.
     7. Saving the interaction to the conversation history.
@@ -357,9 +360,12 @@ async def _core_ai_handler(
         prompt_text: The actual prompt to be sent to the Gemini API. This might be the user's
                      raw text or a specially constructed prompt (e.g., for a URL follow-up).
         conversation_history: The current list of conversation turns.
+        document: Optional reference text (e.g. an article) the question is about; it is sent
+                  ahead of the history and cached by Gemini when it is reused.
     """
     chat_id = update.effective_chat.id
     user_lang_code = context.user_data.get('selected_language', DEFAULT_LANGUAGE_CODE)
+    record_first_visible = _first_visible_recorder("text", time.monotonic())
 
     # Check if a study subject is set for the user
     study_subject = context.user_data.get('study_subject')
@@ -378,16 +384,12 @@ async def _core_ai_handler(
     lang_name_prompt = SUPPORTED_LANGUAGES.get(user_lang_code, "English").split(" (")[0]
     system_prompt = f"{DEFAULT_SYSTEM_PROMPT_BASE}\n\nImportant: Please provide your entire response in {lang_name_prompt}."
 
-    if 'mdv2_failed_for_msg_id' not in context.chat_data:
-        context.chat_data['mdv2_failed_for_msg_id'] = {}
-
     placeholder_message: Message | None = None
+    thinking_raw = get_template("thinking", user_lang_code, default_val="🧠 Thinking...")
     try:
-        thinking_raw = get_template("thinking", user_lang_code, default_val="🧠 Thinking...")
-        placeholder_message = await update.message.reply_text(escape_markdown_v2(thinking_raw),
-                                                              parse_mode=constants.ParseMode.MARKDOWN_V2)
+        placeholder_message = await update.message.reply_text(*prepare_markdown_v2(thinking_raw))
     except BadRequest:
-        thinking_raw = get_template("thinking", user_lang_code, default_val="🧠 Thinking...")
+        record_markdown_v2_rejection()
         placeholder_message = await update.message.reply_text(thinking_raw, parse_mode=None)
     except Exception as e:
         logger.error(f"Chat {chat_id}: Failed to send initial placeholder in _core_ai_handler: {e}", exc_info=True)
@@ -397,157 +399,104 @@ async def _core_ai_handler(
         logger.error(f"Chat {chat_id}: placeholder_message is None in _core_ai_handler. Cannot proceed.")
         return
 
-    initial_placeholder_text = placeholder_message.text
-    current_message_text_on_telegram = placeholder_message.text
-    accumulated_raw_text_for_current_segment = ""
+    # The raw Markdown of the current message; every update renders it to text + entities,
+    # which Telegram cannot fail to parse, so each update is exactly one API call.
+    segment_raw = ""
+    # Rendering drops Markdown markers and never adds text, so the segment's rendered length
+    # is at most its raw UTF-16 length; it is only rendered to check once this passes the limit.
+    segment_utf16 = 0
     full_raw_response_for_history = ""
-    last_edit_time = asyncio.get_event_loop().time()
 
     try:
         logger.debug(
             f"Chat {chat_id}: Calling ask_gemini_stream with tool support for prompt: '{prompt_text[:100]}...'")
 
-        async for chunk in ask_gemini_stream(final_prompt, conversation_history, system_prompt):
+        async for chunk in ask_gemini_stream(final_prompt, conversation_history, system_prompt,
+                                             document=document, chat_id=chat_id):
             if isinstance(chunk, dict) and chunk.get("tool_call_start"):
                 tool_name = chunk.get("tool_name", "unknown_tool")
                 logger.info(f"Chat {chat_id}: Received tool call signal for '{tool_name}'.")
                 if tool_name == "perform_web_search":
                     increment_stat(context, "web_searches")
                     searching_raw = get_template("searching_web", user_lang_code, default_val="Searching the web... 🌐")
-                    try:
-                        await placeholder_message.edit_text(escape_markdown_v2(searching_raw),
-                                                            parse_mode=constants.ParseMode.MARKDOWN_V2)
-                    except BadRequest:
-                        await placeholder_message.edit_text(searching_raw, parse_mode=None)
-                    initial_placeholder_text = placeholder_message.text
-                    current_message_text_on_telegram = placeholder_message.text
-                    accumulated_raw_text_for_current_segment = ""
+                    await _show_status(chat_id, placeholder_message, searching_raw)
+                    segment_raw = ""
+                    segment_utf16 = 0
+                continue
+            if isinstance(chunk, dict) and chunk.get("queued"):
+                logger.info(f"Chat {chat_id}: Gemini request queued for admission, ETA {chunk['eta']:.1f}s.")
+                await _show_status(chat_id, placeholder_message, _queued_status(user_lang_code, chunk["eta"]))
                 continue
 
             if not isinstance(chunk, str): continue
 
             chunk_raw = chunk
             full_raw_response_for_history += chunk_raw
-            accumulated_raw_text_for_current_segment += chunk_raw
-            current_time = asyncio.get_event_loop().time()
-            current_placeholder_mdv2_has_failed_parsing = context.chat_data['mdv2_failed_for_msg_id'].get(
-                placeholder_message.message_id, False)
-            should_edit_now = (
-                        current_message_text_on_telegram == initial_placeholder_text or current_time - last_edit_time >= STREAM_UPDATE_INTERVAL or len(
-                    chunk_raw) > 70)
-
-            if accumulated_raw_text_for_current_segment.strip() and should_edit_now:
-                raw_text_to_process = accumulated_raw_text_for_current_segment
-                text_to_send_this_edit, parse_mode_for_this_edit_attempt = "", None
-                if current_placeholder_mdv2_has_failed_parsing:
-                    text_to_send_this_edit = transform_markdown_fallback(raw_text_to_process)
-                    parse_mode_for_this_edit_attempt = None
-                else:
-                    text_to_send_this_edit = escape_markdown_v2(raw_text_to_process)
-                    parse_mode_for_this_edit_attempt = constants.ParseMode.MARKDOWN_V2
-                if len(text_to_send_this_edit) > TELEGRAM_MAX_MESSAGE_LENGTH:
-                    logger.info(f"Chat {chat_id} (Text Stream): Text for chosen format too long. Offloading.")
+            segment_raw += chunk_raw
+            segment_utf16 += utf16_len(chunk_raw)
+
+            if segment_raw.strip():
+                if segment_utf16 > TELEGRAM_MAX_MESSAGE_LENGTH and \
+                        utf16_len(render_markdown(segment_raw)[0]) > TELEGRAM_MAX_MESSAGE_LENGTH:
+                    logger.info(f"Chat {chat_id} (Text Stream): Rendered text too long. Offloading.")
+                    await edit_scheduler.finish(chat_id, placeholder_message.message_id)
                     continue_message_raw = get_template("response_continued_below", user_lang_code,
                                                         default_val="...(see new messages below)...")
                     try:
                         if placeholder_message.text != escape_markdown_v2(continue_message_raw):
-                            await placeholder_message.edit_text(escape_markdown_v2(continue_message_raw),
-                                                                parse_mode=constants.ParseMode.MARKDOWN_V2)
+                            await edit_scheduler.run(chat_id, lambda: placeholder_message.edit_text(
+                                escape_markdown_v2(continue_message_raw), parse_mode=constants.ParseMode.MARKDOWN_V2))
                     except BadRequest:
                         if placeholder_message.text != continue_message_raw:
-                            await placeholder_message.edit_text(continue_message_raw, parse_mode=None)
-                    await send_long_message_fallback(update, context, raw_text_to_process)
-                    accumulated_raw_text_for_current_segment = ""
-                    if placeholder_message.message_id in context.chat_data['mdv2_failed_for_msg_id']:
-                        del context.chat_data['mdv2_failed_for_msg_id'][placeholder_message.message_id]
+                            await edit_scheduler.run(chat_id, lambda: placeholder_message.edit_text(
+                                continue_message_raw, parse_mode=None))
+                    await send_long_message_fallback(update, context, segment_raw)
+                    record_first_visible()
+                    segment_raw = ""
+                    segment_utf16 = 0
                     continuing_raw = get_template("continuing_response", user_lang_code,
                                                   default_val="...continuing response...")
                     try:
-                        placeholder_message = await update.message.reply_text(escape_markdown_v2(continuing_raw),
-                                                                              parse_mode=constants.ParseMode.MARKDOWN_V2)
-                        current_placeholder_parse_mode = constants.ParseMode.MARKDOWN_V2
+                        placeholder_message = await update.message.reply_text(*prepare_markdown_v2(continuing_raw))
                     except BadRequest:
+                        record_markdown_v2_rejection()
                         placeholder_message = await update.message.reply_text(continuing_raw, parse_mode=None)
-                        current_placeholder_parse_mode = None
-                    initial_placeholder_text = placeholder_message.text
-                    current_message_text_on_telegram = placeholder_message.text
                 else:
-                    try:
-                        if text_to_send_this_edit != current_message_text_on_telegram:
-                            await context.bot.edit_message_text(
-                                text_to_send_this_edit, chat_id, placeholder_message.message_id,
-                                parse_mode=parse_mode_for_this_edit_attempt
-                            )
-                            current_placeholder_parse_mode = parse_mode_for_this_edit_attempt
-                            current_message_text_on_telegram = text_to_send_this_edit
-                            if parse_mode_for_this_edit_attempt == constants.ParseMode.MARKDOWN_V2:
-                                context.chat_data['mdv2_failed_for_msg_id'][placeholder_message.message_id] = False
-                        logger.debug(
-                            f"Chat {chat_id} (Text Stream): Edit with {'MDV2' if parse_mode_for_this_edit_attempt else 'PLAIN'} successful.")
-                    except BadRequest as e_edit_stream:
-                        if "message is not modified" in str(e_edit_stream).lower():
-                            pass
-                        elif parse_mode_for_this_edit_attempt == constants.ParseMode.MARKDOWN_V2 and any(
-                                err_str in str(e_edit_stream).lower() for err_str in
-                                ["can't parse entities", "unescaped", "can't find end of", "nested entities"]):
-                            logger.warning(
-                                f"Chat {chat_id} (Text Stream): MDV2 FAILED PARSING: {e_edit_stream}. Sticking to plain for msg_id {placeholder_message.message_id}.")
-                            context.chat_data['mdv2_failed_for_msg_id'][placeholder_message.message_id] = True
-                            context.chat_data['mdv2_failed_for_msg_id'][placeholder_message.message_id] = True
-                            transformed_retry = transform_markdown_fallback(raw_text_to_process)
-                            if len(transformed_retry) > TELEGRAM_MAX_MESSAGE_LENGTH:
-                                transformed_retry = transformed_retry[:TELEGRAM_MAX_MESSAGE_LENGTH]
-                            try:
-                                if transformed_retry != current_message_text_on_telegram:
-                                    await context.bot.edit_message_text(transformed_retry, chat_id,
-                                                                        placeholder_message.message_id, parse_mode=None)
-                                    current_placeholder_parse_mode = None
-                                    current_message_text_on_telegram = transformed_retry
-                                logger.info(
-                                    f"Chat {chat_id} (Text Stream): Retry edit with TRANSFORMED PLAIN successful.")
-                            except BadRequest as e_plain_retry_stream:
-                                if "message is not modified" not in str(e_plain_retry_stream).lower():
-                                    logger.error(
-                                        f"Chat {chat_id} (Text Stream): TRANSFORMED PLAIN retry FAILED: {e_plain_retry_stream}")
-                        else:
-                            logger.error(
-                                f"Chat {chat_id} (Text Stream): Unhandled BadRequest during stream edit: {e_edit_stream}")
-                last_edit_time = current_time
-                await asyncio.sleep(0.05)
+                    # The scheduler coalesces these edits and renders only the latest text, when the chat's next slot opens.
+                    edit_scheduler.schedule_edit(
+                        context.bot, chat_id, placeholder_message.message_id,
+                        render=lambda raw=segment_raw: render_markdown(raw),
+                        fallback=lambda raw=segment_raw: render_markdown(raw)[0],
+                        on_sent=record_first_visible,
+                    )
 
         # --- Final Edit & History Saving ---
-        final_segment_raw = accumulated_raw_text_for_current_segment.strip()
+        await edit_scheduler.finish(chat_id, placeholder_message.message_id)
+        final_segment_raw = segment_raw.strip()
         if final_segment_raw:
-            final_placeholder_mdv2_has_failed_parsing = context.chat_data['mdv2_failed_for_msg_id'].get(
-                placeholder_message.message_id, False)
-            text_for_final_edit, parse_mode_for_final_edit = "", None
-            if final_placeholder_mdv2_has_failed_parsing:
-                text_for_final_edit = transform_markdown_fallback(final_segment_raw)
-            else:
-                text_for_final_edit = escape_markdown_v2(final_segment_raw)
-                parse_mode_for_final_edit = constants.ParseMode.MARKDOWN_V2
+            text_for_final_edit, entities_for_final_edit = render_markdown(final_segment_raw)
 
-            if len(text_for_final_edit) > TELEGRAM_MAX_MESSAGE_LENGTH:
+            if utf16_len(text_for_final_edit) > TELEGRAM_MAX_MESSAGE_LENGTH:
                 await send_long_message_fallback(update, context, final_segment_raw)
             else:
                 feedback_keyboard = build_feedback_keyboard(placeholder_message.message_id)
                 try:
-                    await placeholder_message.edit_text(text_for_final_edit, parse_mode=parse_mode_for_final_edit,
-                                                        reply_markup=feedback_keyboard)
+                    await edit_scheduler.run(chat_id, lambda: placeholder_message.edit_text(
+                        text_for_final_edit, entities=entities_for_final_edit, reply_markup=feedback_keyboard))
                 except BadRequest as e_f_edit:
                     if "message is not modified" in str(e_f_edit).lower():
                         pass
-                    elif parse_mode_for_final_edit == constants.ParseMode.MARKDOWN_V2:
-                        transformed_final_fallback = transform_markdown_fallback(final_segment_raw)
-                        if len(transformed_final_fallback) > TELEGRAM_MAX_MESSAGE_LENGTH:
-                            transformed_final_fallback = transformed_final_fallback[:TELEGRAM_MAX_MESSAGE_LENGTH]
-                        await placeholder_message.edit_text(transformed_final_fallback, parse_mode=None,
-                                                            reply_markup=feedback_keyboard)
+                    else:
+                        # Should not happen with entities; keep the text and drop the formatting.
+                        logger.warning(f"Chat {chat_id}: Final edit with entities failed ({e_f_edit}). Sending plain text.")
+                        await edit_scheduler.run(chat_id, lambda: placeholder_message.edit_text(
+                            text_for_final_edit, parse_mode=None, reply_markup=feedback_keyboard))
+            record_first_visible()
         elif not full_raw_response_for_history.strip():
             # Handle empty response from AI
             no_response_raw = get_template("gemini_no_response_text", user_lang_code,
                                            default_val="🤷 No response generated.")
-            await placeholder_message.edit_text(no_response_raw, parse_mode=None)
+            await edit_scheduler.run(chat_id, lambda: placeholder_message.edit_text(no_response_raw, parse_mode=None))
 
         # --- Save to Conversation History ---
         if full_raw_response_for_history.strip() and not any(kw in full_raw_response_for_history.lower() for kw in
@@ -560,9 +509,8 @@ async def _core_ai_handler(
 
                 # Now, save the interaction with the guaranteed non-empty user text.
             if user_text_for_history:
-                conversation_history.append({'role': 'user', 'parts': [{'text': user_text_for_history}]})
-                conversation_history.append({'role': 'model', 'parts': [{'text': full_raw_response_for_history}]})
-                context.chat_data['conversation_history'] = conversation_history[-(MAX_CONVERSATION_TURNS * 2):]
+                append_turn(context.chat_data, user_text_for_history, full_raw_response_for_history,
+                            MAX_CONVERSATION_TURNS, chat_id, context.application)
                 logger.debug(f"History saved. User part: '{user_text_for_history[:50]}...'")
             else:
                 logger.warning("Could not save to history because user text was empty.")
@@ -578,39 +526,26 @@ async def _core_ai_handler(
         except Exception:
             pass
     finally:
-        if placeholder_message and placeholder_message.message_id in context.chat_data.get('mdv2_failed_for_msg_id',
-                                                                                           {}):
-            del context.chat_data['mdv2_failed_for_msg_id'][placeholder_message.message_id]
         logger.info(f"--- _core_ai_handler finished for chat {chat_id} ---")
 
 
-async def _process_image(update: Update, context: ContextTypes.DEFAULT_TYPE, file_id: str, prompt_text: str):
+async def _process_image(update: Update, context: ContextTypes.DEFAULT_TYPE, file_id: str, prompt_text: str,
+                         file_unique_id: Optional[str] = None):
     """
     A generic helper function to download, analyze, and stream a response for a given image file_id and prompt.
     This contains the core logic for all image-related interactions, including a watchdog timer on the stream.
+    With `file_unique_id`, an image seen before is taken from the media cache without downloading it again.
     """
     increment_stat(context, "images_received")
 
-    user = update.effective_user
     chat_id = update.effective_chat.id
-    message_id_for_uniqueness = update.message.message_id if update.message else 'reply'
     user_lang_code = context.user_data.get('selected_language', DEFAULT_LANGUAGE_CODE)
+    # Measured from the moment the image is picked up, so download and preprocessing count too.
+    record_first_visible = _first_visible_recorder("image", time.monotonic())
 
     logger.info(f"Processing image {file_id} for chat {chat_id} with prompt: '{prompt_text[:100]}...'")
 
     # --- Setup and Placeholder ---
-    if 'mdv2_failed_for_msg_id' not in context.chat_data:
-        context.chat_data['mdv2_failed_for_msg_id'] = {}
-    if not os.path.exists(TEMP_DIR):
-        try:
-            os.makedirs(TEMP_DIR)
-        except OSError as e:
-            logger.error(f"Could not create TEMP_DIR '{TEMP_DIR}': {e}")
-            err_msg_raw = get_template("error_temp_storage", user_lang_code,
-                                       default_val="⚠️ Server error: Cannot create temporary storage.")
-            await update.message.reply_text(escape_markdown_v2(err_msg_raw), parse_mode=constants.ParseMode.MARKDOWN_V2)
-            return
-
     placeholder_message: Message | None = None
     current_placeholder_parse_mode: constants.ParseMode | None = constants.ParseMode.MARKDOWN_V2
     try:
@@ -626,60 +561,77 @@ async def _process_image(update: Update, context: ContextTypes.DEFAULT_TYPE, fil
         return
 
     # --- File Download and Processing ---
-    temp_file_name = f"{chat_id}_{user.id}_{file_id}_{message_id_for_uniqueness}.jpg"
-    temp_file_path = os.path.join(TEMP_DIR, temp_file_name)
+    async def download_and_prepare():
+        # The image stays in memory instead of going through a temp file.
+        media = await download_telegram_file(context.bot, file_id)
+        if media is None:
+            return None
+        with media:
+            # Downscaled and re-encoded (without EXIF) in the image thread pool; small images pass through.
+            return await preprocess_image(media.getvalue())
 
-    if await download_telegram_file(context.bot, file_id, temp_file_path):
-        try:
-            image_bytes_content = None
-            actual_mime_type = "image/jpeg"
-            with open(temp_file_path, "rb") as image_file_bytes_io:
-                image_bytes_content = image_file_bytes_io.read()
-            try:
-                with Image.open(io.BytesIO(image_bytes_content)) as pil_image:
-                    image_format = pil_image.format
-                    if image_format == "JPEG":
-                        actual_mime_type = "image/jpeg"
-                    elif image_format == "PNG":
-                        actual_mime_type = "image/png"
-                    elif image_format == "WEBP":
-                        actual_mime_type = "image/webp"
-                    else:
-                        pil_image.seek(0)
-                        with io.BytesIO() as img_byte_arr_converted:
-                            pil_image.save(img_byte_arr_converted, format="PNG")
-                            image_bytes_content = img_byte_arr_converted.getvalue()
-                        actual_mime_type = "image/png"
-            except UnidentifiedImageError:
-                err_raw = get_template("unidentified_image_error", user_lang_code,
-                                       default_val="⚠️ Could not identify image format.")
-                await placeholder_message.edit_text(escape_markdown_v2(err_raw),
-                                                    parse_mode=constants.ParseMode.MARKDOWN_V2)
-                if os.path.exists(temp_file_path): os.remove(temp_file_path)
-                return
+    try:
+        prepared_image = await get_processed_media("image", file_unique_id, download_and_prepare)
+    except UnidentifiedImageError:
+        err_raw = get_template("unidentified_image_error", user_lang_code,
+                               default_val="⚠️ Could not identify image format.")
+        await placeholder_message.edit_text(escape_markdown_v2(err_raw),
+                                            parse_mode=constants.ParseMode.MARKDOWN_V2)
+        return
 
+    if prepared_image is not None:
+        try:
             # --- Gemini Vision Call and Streaming ---
             language_name_for_prompt = \
             SUPPORTED_LANGUAGES.get(user_lang_code, SUPPORTED_LANGUAGES[DEFAULT_LANGUAGE_CODE]).split(" (")[0]
             system_prompt_for_vision = DEFAULT_SYSTEM_PROMPT_BASE + f"\n\nImportant: Please provide your entire response in {language_name_for_prompt}."
 
-            initial_placeholder_text = placeholder_message.text
-            current_message_text_on_telegram = placeholder_message.text
             full_raw_response_for_history = ""
+            response_utf16 = 0  # Upper bound of the rendered length, see _core_ai_handler.
+            # Set once the rendered answer outgrows one message: the placeholder keeps `visible_raw`,
+            # the part shown so far, and the rest is sent as new messages at the end.
+            stream_overflowed = False
+            visible_raw = ""
             stream_timed_out = False
 
             try:
                 response_generator = ask_gemini_vision_stream(
-                    prompt_text=prompt_text, image_bytes=image_bytes_content, image_mime_type=actual_mime_type,
-                    conversation_history=context.chat_data.get('conversation_history', []),
+                    prompt_text=prompt_text, image_bytes=prepared_image.data, image_mime_type=prepared_image.mime_type,
+                    conversation_history=get_history_for_prompt(context.chat_data),
                     system_prompt=system_prompt_for_vision
                 )
 
                 # Watchdog loop to process the stream with a timeout
+                chunk_timeout = 15.0
                 while True:
                     try:
-                        chunk_raw = await asyncio.wait_for(anext(response_generator), timeout=15.0)
+                        chunk_raw = await asyncio.wait_for(anext(response_generator), timeout=chunk_timeout)
+                        chunk_timeout = 15.0
+                        if isinstance(chunk_raw, dict):
+                            # Queued for admission: show the ETA and let the watchdog wait it out.
+                            chunk_timeout += chunk_raw["eta"]
+                            await _show_status(chat_id, placeholder_message,
+                                               _queued_status(user_lang_code, chunk_raw["eta"]))
+                            continue
+                        shown_raw = full_raw_response_for_history
                         full_raw_response_for_history += chunk_raw
+                        response_utf16 += utf16_len(chunk_raw)
+                        if stream_overflowed or not full_raw_response_for_history.strip():
+                            continue
+                        if response_utf16 > TELEGRAM_MAX_MESSAGE_LENGTH and utf16_len(
+                                render_markdown(full_raw_response_for_history)[0]) > TELEGRAM_MAX_MESSAGE_LENGTH:
+                            # Keep the visible part and finish the answer in new messages below.
+                            logger.info(f"Chat {chat_id} (Vision Stream): Rendered text too long. Offloading at the end.")
+                            stream_overflowed = True
+                            visible_raw = shown_raw
+                            continue
+                        # Same path as text answers: coalesced edits, rendered when the chat's next slot opens.
+                        edit_scheduler.schedule_edit(
+                            context.bot, chat_id, placeholder_message.message_id,
+                            render=lambda raw=full_raw_response_for_history: render_markdown(raw),
+                            fallback=lambda raw=full_raw_response_for_history: render_markdown(raw)[0],
+                            on_sent=record_first_visible,
+                        )
                     except asyncio.TimeoutError:
                         logger.warning(f"Stream for image {file_id} timed out after 15s of inactivity.")
                         stream_timed_out = True
@@ -691,26 +643,46 @@ async def _process_image(update: Update, context: ContextTypes.DEFAULT_TYPE, fil
             except Exception as e_stream_init:
                 logger.error(f"Could not start or process the Gemini stream: {e_stream_init}")
                 full_raw_response_for_history = f"[AI ERROR: Failed to process response stream: {e_stream_init}]"
+                stream_overflowed = False
 
             # --- Final Edit and History Saving ---
+            await edit_scheduler.finish(chat_id, placeholder_message.message_id)
             if stream_timed_out:
                 timeout_warning = get_template("stream_timeout_warning", user_lang_code,
                                                default_val="\n\n[Warning: The response may be incomplete as the connection timed out.]")
                 full_raw_response_for_history += timeout_warning
 
             if full_raw_response_for_history.strip():
-                # Perform one final edit with the complete (or timed-out) text
-                if full_raw_response_for_history != current_message_text_on_telegram:
+                text_for_final_edit, entities_for_final_edit = render_markdown(full_raw_response_for_history.strip())
+                if stream_overflowed and visible_raw.strip():
+                    # The placeholder keeps what the user has been reading; the rest follows below it.
+                    visible_text, visible_entities = render_markdown(visible_raw)
                     try:
-                        feedback_keyboard = build_feedback_keyboard(placeholder_message.message_id)
-                        await placeholder_message.edit_text(escape_markdown_v2(full_raw_response_for_history),
-                                                            parse_mode=constants.ParseMode.MARKDOWN_V2,
-                                                            reply_markup=feedback_keyboard)
-                    except BadRequest:
-                        afeedback_keyboard = build_feedback_keyboard(placeholder_message.message_id)
-                        await placeholder_message.edit_text(transform_markdown_fallback(full_raw_response_for_history),
-                                                            parse_mode=None,
-                                                            reply_markup=feedback_keyboard)
+                        await edit_scheduler.run(chat_id, lambda: placeholder_message.edit_text(
+                            visible_text, entities=visible_entities))
+                    except BadRequest as e_f_edit:
+                        if "message is not modified" not in str(e_f_edit).lower():
+                            logger.warning(f"Chat {chat_id}: Vision edit with entities failed ({e_f_edit}).")
+                    await send_long_message_fallback(update, context,
+                                                     full_raw_response_for_history[len(visible_raw):].strip())
+                elif utf16_len(text_for_final_edit) > TELEGRAM_MAX_MESSAGE_LENGTH:
+                    continue_message_raw = get_template("response_continued_below", user_lang_code,
+                                                        default_val="...(see new messages below)...")
+                    await edit_scheduler.run(chat_id, lambda: placeholder_message.edit_text(
+                        continue_message_raw, parse_mode=None))
+                    await send_long_message_fallback(update, context, full_raw_response_for_history.strip())
+                else:
+                    feedback_keyboard = build_feedback_keyboard(placeholder_message.message_id)
+                    try:
+                        await edit_scheduler.run(chat_id, lambda: placeholder_message.edit_text(
+                            text_for_final_edit, entities=entities_for_final_edit, reply_markup=feedback_keyboard))
+                    except BadRequest as e_f_edit:
+                        if "message is not modified" not in str(e_f_edit).lower():
+                            logger.warning(f"Chat {chat_id}: Final vision edit with entities failed ({e_f_edit}). "
+                                           f"Sending plain text.")
+                            await edit_scheduler.run(chat_id, lambda: placeholder_message.edit_text(
+                                text_for_final_edit, parse_mode=None, reply_markup=feedback_keyboard))
+                record_first_visible()
             else:
                 no_response_text_raw = get_template("gemini_no_vision_response", user_lang_code,
                                                     default_val="🤷 I couldn't get a specific analysis for this image.")
@@ -719,31 +691,36 @@ async def _process_image(update: Update, context: ContextTypes.DEFAULT_TYPE, fil
 
             if full_raw_response_for_history.strip() and not stream_timed_out:
                 history_user_prompt = f"The user asked '{prompt_text[:50]}...' about an image."
-                conversation_history = context.chat_data.get('conversation_history', [])
-                conversation_history.append({'role': 'user', 'parts': [{'text': history_user_prompt}]})
-                conversation_history.append({'role': 'model', 'parts': [{'text': full_raw_response_for_history}]})
-                context.chat_data['conversation_history'] = conversation_history[-MAX_CONVERSATION_TURNS * 2:]
+                append_turn(context.chat_data, history_user_prompt, full_raw_response_for_history,
+                            MAX_CONVERSATION_TURNS, chat_id, context.application)
                 logger.debug(f"Chat {chat_id} (Photo): Vision analysis saved to conversation history.")
 
         except Exception as e:
             logger.error(f"Error processing image {file_id} with Vision: {e}", exc_info=True)
             err_raw = get_template("unexpected_image_error", user_lang_code, default_val="⚠️ Error analyzing image.")
             await placeholder_message.edit_text(escape_markdown_v2(err_raw), parse_mode=constants.ParseMode.MARKDOWN_V2)
-        finally:
-            if placeholder_message and placeholder_message.message_id in context.chat_data.get('mdv2_failed_for_msg_id',
-                                                                                               {}):
-                del context.chat_data['mdv2_failed_for_msg_id'][placeholder_message.message_id]
-            if os.path.exists(temp_file_path):
-                try:
-                    os.remove(temp_file_path)
-                    logger.debug(f"Cleaned up temp image: {temp_file_path}")
-                except Exception as e_remove:
-                    logger.error(f"Error removing temp image {temp_file_path}: {e_remove}")
     else:  # Download failed
         err_raw = get_template("download_failed_error", user_lang_code, file_name="the image")
         await placeholder_message.edit_text(escape_markdown_v2(err_raw), parse_mode=constants.ParseMode.MARKDOWN_V2)
 
 
+# Replies to the bot are answered from the last link's text for this long after it was sent,
+# the same time its Gemini document cache is kept.
+URL_FOLLOW_UP_WINDOW_SECONDS = GEMINI_DOCUMENT_CACHE_TTL_SECONDS
+URL_STATE_KEYS = ('last_url_content', 'last_url_source', 'last_url_at')
+
+
+def _url_follow_up_pending(chat_data: Dict[Any, Any]) -> bool:
+    """True while replies should be answered from the last link; drops the link's text once the window is over."""
+    if 'last_url_content' not in chat_data:
+        return False
+    if time.time() - chat_data.get('last_url_at', 0) <= URL_FOLLOW_UP_WINDOW_SECONDS:
+        return True
+    for key in URL_STATE_KEYS:
+        chat_data.pop(key, None)
+    return False
+
+
 async def _process_url(update: Update, context: ContextTypes.DEFAULT_TYPE, url: str):
     """
     Fetches, parses, and provides a HIGH-QUALITY summary of a URL by using the
@@ -766,29 +743,18 @@ async def _process_url(update: Update, context: ContextTypes.DEFAULT_TYPE, url:
     except BadRequest:
         placeholder_message = await update.message.reply_text(placeholder_text)
 
-    # 2. Fetch and parse URL content (this logic is unchanged as it works well).
+    # 2. Fetch and parse URL content through the shared page cache (same one the web search scraper uses).
     extracted_text = ""
     try:
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-        }
-        # Use httpx for async requests to not block the bot
-        async with httpx.AsyncClient() as client:
-            response = await client.get(url, headers=headers, timeout=15, follow_redirects=True)
-        response.raise_for_status()
-
-        if 'text/html' not in response.headers.get('Content-Type', ''):
+        extracted_text = await fetch_page_text(url, timeout=15)
+
+        if extracted_text is None:
             error_text = get_template("url_not_html", user_lang_code,
                                       default_val="⚠️ The link does not point to an HTML page.")
             await placeholder_message.edit_text(escape_markdown_v2(error_text),
                                                 parse_mode=constants.ParseMode.MARKDOWN_V2)
             return
 
-        soup = BeautifulSoup(response.content, 'html.parser')
-        for element in soup(['script', 'style', 'header', 'footer', 'nav', 'aside']):
-            element.decompose()  # A better way to remove junk tags
-        extracted_text = ' '.join(p.get_text(strip=True) for p in soup.find_all('p'))
-
         if not extracted_text:
             error_text = get_template("url_no_text", user_lang_code,
                                       default_val="🤷 I couldn't find any readable text at that URL.")
@@ -831,27 +797,30 @@ async def _process_url(update: Update, context: ContextTypes.DEFAULT_TYPE, url:
 
     max_chars_for_prompt = 25000
     truncated_text = extracted_text[:max_chars_for_prompt]
-    context.chat_data['last_url_content'] = extracted_text
+    # Follow-ups send exactly the text the summary was made from, so Gemini can cache it once it is reused.
+    context.chat_data['last_url_content'] = truncated_text
     context.chat_data['last_url_source'] = url
-    logger.info(f"Chat {chat_id}: Stored {len(extracted_text)} chars from {url} for follow-up questions.")
+    context.chat_data['last_url_at'] = time.time()
+    logger.info(f"Chat {chat_id}: Stored {len(truncated_text)} chars from {url} for follow-up questions.")
 
     # Create a much more explicit prompt that emphasizes the output language
     summary_prompt = (
         f"CRITICAL INSTRUCTION: Your entire response MUST be in the following language: **{language_name}**. "
-        f"The following text is from an article. Provide a detailed, well-structured summary of it in **{language_name}**. "
+        f"The reference document above is an article. Provide a detailed, well-structured summary of it in **{language_name}**. "
         f"Begin with a 'Key Takeaways' section, then provide the more comprehensive summary.\n\n"
-        f"--- ARTICLE TEXT ---\n"
-        f"{truncated_text}\n"
-        f"--- END OF TEXT ---\n\n"
         f"Reminder: All output, including headings and content, must be in **{language_name}**."
     )
 
     # Call our high-quality, multi-call function.
     # We pass an empty conversation history so the summary focuses ONLY on the article content.
+    # The article goes in as a reference document, so links shared in many chats are cached by Gemini.
     refined_summary = await get_refined_response(
         initial_prompt=summary_prompt,
         base_system_prompt=DEFAULT_SYSTEM_PROMPT_BASE,
-        conversation_history=[]
+        conversation_history=[],
+        document=truncated_text,
+        chat_id=chat_id,
+        priority=Priority.URL
     )
 
     # 4. Send the final, perfected response to the user.
@@ -872,6 +841,8 @@ async def _process_url(update: Update, context: ContextTypes.DEFAULT_TYPE, url:
 async def _process_url_follow_up(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Handles a follow-up question by building a new prompt and calling the core AI handler.
+    The article stays available for further replies until URL_FOLLOW_UP_WINDOW_SECONDS
+    after it was sent, /new, or the next link or document.
     """
     user_question = update.message.text
     stored_text = context.chat_data.get('last_url_content')
@@ -884,20 +855,46 @@ async def _process_url_follow_up(update: Update, context: ContextTypes.DEFAULT_T
     # Build the new, detailed prompt for the AI
     follow_up_prompt = (
         f"The user is asking a follow-up question in {language_name} about an article from {url_source}. "
-        f"Please answer their question in {language_name}, based *only* on the provided article content.\n\n"
-        f"User's question: '{user_question}'.\n\n"
-        f"FULL original text of the article for context: \n\n---\n\n{stored_text}\n---"
+        f"Please answer their question in {language_name}, based *only* on the article in the reference document.\n\n"
+        f"User's question: '{user_question}'."
     )
 
-    # Clear the context so the *next* message isn't treated as a follow-up
-    context.chat_data.pop('last_url_content', None)
-    context.chat_data.pop('last_url_source', None)
-
     # Get the existing conversation history to maintain context
-    conversation_history = context.chat_data.get('conversation_history', [])
+    conversation_history = get_history_for_prompt(context.chat_data)
 
     # Call the core handler with the special follow-up prompt
+    await _core_ai_handler(update, context, follow_up_prompt, conversation_history, document=stored_text)
+
+async def _process_document_follow_up(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    """
+    Answers a reply about the last uploaded document using only the chunks most relevant
+    to the question. Returns False when the document does not match the question well
+    enough (see DOC_FOLLOW_UP_MIN_SCORE), so the message is handled as a normal question instead.
+    """
+    user_question = update.message.text
+    document_index = context.chat_data['document_index']
+    relevant_chunks = document_index.top_chunks(user_question, fallback_to_start=False,
+                                                 min_score=DOC_FOLLOW_UP_MIN_SCORE)
+    if not relevant_chunks:
+        return False
+
+    user_lang_code = context.user_data.get('selected_language', DEFAULT_LANGUAGE_CODE)
+    language_name = SUPPORTED_LANGUAGES.get(user_lang_code, "English").split(" (")[0]
+    logger.info(f"Handling follow-up question for document '{document_index.name}' with "
+                f"{len(relevant_chunks)} of {len(document_index)} chunks.")
+
+    follow_up_prompt = (
+        f"The user is asking a follow-up question in {language_name} about the document '{document_index.name}'. "
+        f"Please answer their question in {language_name}, based on the excerpts of the document below. "
+        f"If the excerpts do not contain the answer, say so.\n\n"
+        f"User's question: '{user_question}'.\n\n"
+        f"Relevant excerpts from the document (in document order):\n\n---\n"
+        + "\n---\n".join(relevant_chunks)
+        + "\n---"
+    )
+    conversation_history = get_history_for_prompt(context.chat_data)
     await _core_ai_handler(update, context, follow_up_prompt, conversation_history)
+    return True
 
 @rate_limit()
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -922,22 +919,27 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # ROUTE 2: Check for a reply to one of the bot's own messages
     if update.message.reply_to_message and update.message.reply_to_message.from_user.is_bot:
         # Sub-route 2a: Is it a follow-up to a URL summary?
-        if 'last_url_content' in context.chat_data:
+        if _url_follow_up_pending(context.chat_data):
             await _process_url_follow_up(update, context)
             return
 
-        # Sub-route 2b: Is it a reply to a photo?
+        # Sub-route 2b: Is it a question about the last uploaded document?
+        if 'document_index' in context.chat_data and not update.message.reply_to_message.photo:
+            if await _process_document_follow_up(update, context):
+                return
+
+        # Sub-route 2c: Is it a reply to a photo?
         if update.message.reply_to_message.photo:
             logger.info("User is replying to a photo. Routing to image processor.")
-            file_id = update.message.reply_to_message.photo[-1].file_id
-            await _process_image(update, context, file_id, update.message.text)
+            photo = update.message.reply_to_message.photo[-1]
+            await _process_image(update, context, photo.file_id, update.message.text, photo.file_unique_id)
             return
 
     # --- DEFAULT ACTION: If no special routes were taken, handle as a standard text query ---
     increment_stat(context, "messages_received")
     logger.info(f"Handling standard text message: '{update.message.text[:100]}...'")
 
-    conversation_history = context.chat_data.get('conversation_history', [])
+    conversation_history = get_history_for_prompt(context.chat_data)
 
     # Call the core handler with the user's direct message text
     await _core_ai_handler(update, context, update.message.text, conversation_history)
@@ -950,8 +952,8 @@ async def handle_voice_message(update: Update, context: ContextTypes.DEFAULT_TYP
     and then routing the resulting text to the core AI handler for a response.
     Includes robust error handling for API and file operations.
     """
-    # First, check if the OpenAI client was successfully initialized at startup
-    if not openai_client:
+    # First, check that transcription is configured (OPENAI_API_KEY is set)
+    if not transcription_available():
         logger.error("Received a voice message, but OpenAI client is not available (API key likely missing).")
         # Optionally, send a message to the user that the feature is disabled
         # await update.message.reply_text("Sorry, the voice message feature is currently disabled.")
@@ -968,27 +970,18 @@ async def handle_voice_message(update: Update, context: ContextTypes.DEFAULT_TYP
     placeholder_message = await update.message.reply_text(escape_markdown_v2(placeholder_text),
                                                           parse_mode=constants.ParseMode.MARKDOWN_V2)
 
-    temp_file_path = None
-    try:
-        # 2. Download the voice file from Telegram
-        voice = update.message.voice
-        voice_file = await context.bot.get_file(voice.file_id)
-
-        # Define a unique path for the temporary audio file
-        temp_file_path = os.path.join(TEMP_DIR, f"{voice.file_unique_id}.oga")
-        await voice_file.download_to_drive(temp_file_path)
-
-        # 3. Send the audio file to the Whisper API for transcription
-        # This is a blocking I/O operation, so we run it in a separate thread
-        # to avoid blocking the bot's main event loop.
-        with open(temp_file_path, "rb") as audio_file:
-            transcription = await asyncio.to_thread(
-                openai_client.audio.transcriptions.create,
-                model="whisper-1",
-                file=audio_file
-            )
+    voice = update.message.voice
 
-        transcribed_text = transcription.text
+    async def download_and_transcribe():
+        # 2. Download the voice file from Telegram into memory
+        with await download_media(context.bot, voice.file_id) as media:
+            # 3. Send the audio file to the Whisper API for transcription with the async client,
+            # within Whisper's own concurrency limit. The file name tells Whisper the format.
+            return await transcribe_audio(f"{voice.file_unique_id}.oga", media.file)
+
+    try:
+        # A forwarded voice note that was transcribed before is answered from the media cache.
+        transcribed_text = await get_processed_media("voice", voice.file_unique_id, download_and_transcribe)
         if not transcribed_text.strip():
             raise ValueError("Transcription resulted in empty text.")
 
@@ -1006,7 +999,7 @@ async def handle_voice_message(update: Update, context: ContextTypes.DEFAULT_TYP
 
         # 5. Route the transcribed text to our core AI handler.
         # The core handler will create its OWN placeholder and manage the final response.
-        conversation_history = context.chat_data.get('conversation_history', [])
+        conversation_history = get_history_for_prompt(context.chat_data)
         await _core_ai_handler(update, context, transcribed_text, conversation_history)
 
         # 6. Delete our now-redundant placeholder message for a cleaner UI.
@@ -1034,15 +1027,6 @@ async def handle_voice_message(update: Update, context: ContextTypes.DEFAULT_TYP
             await placeholder_message.edit_text(escape_markdown_v2(error_text),
                                                 parse_mode=constants.ParseMode.MARKDOWN_V2)
 
-    finally:
-        # 7. CRITICAL: Clean up the temporary audio file in all cases (success or failure).
-        if temp_file_path and os.path.exists(temp_file_path):
-            try:
-                os.remove(temp_file_path)
-                logger.debug(f"Cleaned up temp voice file: {temp_file_path}")
-            except Exception as e_remove:
-                logger.error(f"Error removing temp voice file {temp_file_path}: {e_remove}")
-
 @rate_limit()
 async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
@@ -1053,10 +1037,7 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         logger.warning("handle_photo called without a message or photo.")
         return
 
-    if 'mdv2_failed_for_msg_id' not in context.chat_data:
-        context.chat_data['mdv2_failed_for_msg_id'] = {}
-
-    file_id = update.message.photo[-1].file_id
+    photo = update.message.photo[-1]
     user_lang_code = context.user_data.get('selected_language', DEFAULT_LANGUAGE_CODE)
 
     # Use the user's caption as the prompt. If there's no caption, create a default general prompt.
@@ -1067,7 +1048,7 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     )
 
     # Call the new helper function with the file_id and the determined prompt
-    await _process_image(update, context, file_id, prompt)
+    await _process_image(update, context, photo.file_id, prompt, photo.file_unique_id)
 
 # --- Make sure handle_document still uses OCR or text extraction and ask_gemini_stream ---
 # async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -1081,6 +1062,72 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 # application.add_handler(MessageHandler(filters.Document.ALL, handle_document))
 # Or more specific document filters if you prefer.
 
+# --- Map-reduce summaries for long documents ---
+DOC_MAP_FALLBACK_CHARS = 2000  # Raw text kept for a section whose summary failed.
+
+
+class _DocumentSectionMapper:
+    """
+    Summarizes a long document section by section (the "map" step). Pages are fed in as
+    they are extracted; every time a section's worth of text has arrived its summary is
+    started, so the Gemini calls overlap with parsing the rest of the document.
+    """
+
+    def __init__(self, file_name: str, language_name: str):
+        self.file_name = file_name
+        self.language_name = language_name
+        self.covered_chars = 0
+        self._pending_pages = []
+        self._pending_chars = 0
+        self._tasks = []
+        self._semaphore = asyncio.Semaphore(DOC_MAP_CONCURRENCY)
+
+    @property
+    def started(self) -> bool:
+        return bool(self._tasks)
+
+    def add_page(self, page_text: str) -> None:
+        self._pending_pages.append(page_text)
+        self._pending_chars += len(page_text)
+        if self._pending_chars >= DOC_MAP_SECTION_CHARS:
+            self._start_section("".join(self._pending_pages))
+            self.covered_chars += self._pending_chars
+            self._pending_pages, self._pending_chars = [], 0
+
+    def add_remainder(self, full_text: str) -> None:
+        """Queues everything after the sections already started (all of it for DOCX/TXT)."""
+        for section in group_chunks(chunk_text(full_text[self.covered_chars:])):
+            self._start_section(section)
+        self.covered_chars = len(full_text)
+        self._pending_pages, self._pending_chars = [], 0
+
+    async def gather(self) -> list:
+        return list(await asyncio.gather(*self._tasks))
+
+    def cancel(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+
+    def _start_section(self, section_text: str) -> None:
+        section_number = len(self._tasks) + 1
+        self._tasks.append(asyncio.create_task(self._summarize(section_text, section_number)))
+
+    async def _summarize(self, section_text: str, section_number: int) -> str:
+        section_prompt = (
+            f"Below is section {section_number} of the document '{self.file_name}'. "
+            f"Summarize it in {self.language_name} for a student: keep the key ideas, definitions, "
+            f"formulas, names, dates and numbers. Do not add an introduction.\n\n"
+            f"---\n{section_text}\n---"
+        )
+        async with self._semaphore:
+            summary = await ask_gemini_non_stream(section_prompt, DEFAULT_SYSTEM_PROMPT_BASE, [],
+                                                  priority=Priority.DOCUMENT)
+        if not summary or summary.startswith("[AI ERROR"):
+            logger.warning(f"Summary of section {section_number} of '{self.file_name}' failed; using its opening text.")
+            return section_text[:DOC_MAP_FALLBACK_CHARS]
+        return summary
+
+
 # --- Handler for Documents (PDF, DOCX, etc.) ---
 @rate_limit(cooldown=10)
 async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -1090,10 +1137,6 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
     increment_stat(context, "documents_received")
 
-    if 'mdv2_failed_for_msg_id' not in context.chat_data:
-        context.chat_data['mdv2_failed_for_msg_id'] = {}
-
-    user = update.effective_user
     doc = update.message.document
     chat_id = update.effective_chat.id
     user_lang_code = context.user_data.get('selected_language', DEFAULT_LANGUAGE_CODE)
@@ -1112,51 +1155,43 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         logger.error(f"Chat {chat_id}: placeholder_message is None. Cannot proceed with document processing.")
         return
 
-    # --- Setup temporary file path ---
-    if not os.path.exists(TEMP_DIR):
-        os.makedirs(TEMP_DIR)
-    base_name, ext = os.path.splitext(doc.file_name or f"file_{doc.file_id}")
-    temp_file_path = os.path.join(TEMP_DIR, f"{chat_id}_{user.id}_{doc.file_id}{ext}")
-
-    if not await download_telegram_file(context.bot, doc.file_id, temp_file_path):
-        download_fail_raw = get_template("download_failed_error", user_lang_code,
-                                         file_name=(doc.file_name or "the document"))
-        await placeholder_message.edit_text(escape_markdown_v2(download_fail_raw),
-                                            parse_mode=constants.ParseMode.MARKDOWN_V2)
-        return
-
     # --- Main processing block with guaranteed cleanup ---
+    section_mapper = None
     try:
         # --- Document Type Specific Extraction ---
-        extracted_text = ""
-        extraction_successful = False
-        if doc.mime_type == "application/pdf" or doc.file_name.lower().endswith(".pdf"):
-            with fitz.open(temp_file_path) as pdf_doc:
-                for page in pdf_doc:
-                    extracted_text += page.get_text("text")
-                    if len(extracted_text) > 300000:
-                        logger.warning(f"PDF {doc.file_name} text extraction stopped at 300k chars.")
-                        extracted_text += "\n[...Content truncated due to length...]"
-                        break
-            extraction_successful = True
-        elif doc.mime_type in ["application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-                               "application/msword"] or \
-                doc.file_name.lower().endswith((".docx", ".doc")):
-            docx_doc = DocxDocument(temp_file_path)
-            for para in docx_doc.paragraphs:
-                extracted_text += para.text + "\n"
-            extraction_successful = True
-        elif doc.mime_type == "text/plain" or doc.file_name.lower().endswith(".txt"):
-            with open(temp_file_path, 'r', encoding='utf-8', errors='ignore') as txt_file:
-                extracted_text = txt_file.read()
-            extraction_successful = True
-        else:
+        # Parsing runs in the extraction process pool so a large PDF never blocks other chats.
+        document_kind = detect_document_kind(doc.mime_type, doc.file_name)
+        if document_kind is None:
             unsupported_msg_raw = get_template("unsupported_document_type", user_lang_code,
                                                file_type=(doc.mime_type or doc.file_name))
             await placeholder_message.edit_text(escape_markdown_v2(unsupported_msg_raw),
                                                 parse_mode=constants.ParseMode.MARKDOWN_V2)
             return
 
+        language_name_for_prompt = SUPPORTED_LANGUAGES.get(user_lang_code, "English").split(" (")[0]
+        # Long PDFs start their section summaries while later pages are still being parsed.
+        section_mapper = _DocumentSectionMapper(doc.file_name or "untitled", language_name_for_prompt)
+
+        async def download_and_extract():
+            # In memory unless the file is large.
+            media = await download_telegram_file(context.bot, doc.file_id)
+            if media is None:
+                return None
+            with media:
+                return await extract_document_text(media.source, document_kind, on_page=section_mapper.add_page)
+
+        # A re-sent or forwarded document reuses its earlier extraction instead of downloading it again.
+        extracted_text = await get_processed_media("document", doc.file_unique_id, download_and_extract)
+        if extracted_text is None:
+            download_fail_raw = get_template("download_failed_error", user_lang_code,
+                                             file_name=(doc.file_name or "the document"))
+            await placeholder_message.edit_text(escape_markdown_v2(download_fail_raw),
+                                                parse_mode=constants.ParseMode.MARKDOWN_V2)
+            return
+        extraction_successful = True
+        if extracted_text.endswith(TRUNCATION_NOTICE):
+            logger.warning(f"Document {doc.file_name} text extraction stopped at the page/char/time budget.")
+
         if not extracted_text.strip() and extraction_successful:
             no_text_msg_raw = get_template("no_text_in_document", user_lang_code,
                                            file_name=(doc.file_name or "the document"))
@@ -1164,52 +1199,62 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                                                 parse_mode=constants.ParseMode.MARKDOWN_V2)
             return
 
+        # Keep a retrieval index so replies about the document only send the relevant chunks.
+        context.chat_data['document_index'] = DocumentIndex.from_text(doc.file_name or "untitled", extracted_text)
+        # Replies now refer to this document, not to a link sent before it.
+        for key in URL_STATE_KEYS:
+            context.chat_data.pop(key, None)
+
         # --- AI Analysis with Flood-Control-Proof Streaming ---
         asking_ai_raw = get_template('asking_ai_analysis', user_lang_code, default_val="Analyzing document...")
         await placeholder_message.edit_text(escape_markdown_v2(asking_ai_raw),
                                             parse_mode=constants.ParseMode.MARKDOWN_V2)
 
         # Prepare for Gemini Call
-        conversation_history = context.chat_data.get('conversation_history', [])
-        language_name_for_prompt = SUPPORTED_LANGUAGES.get(user_lang_code, "English").split(" (")[0]
+        conversation_history = get_history_for_prompt(context.chat_data)
         system_prompt = f"{DEFAULT_SYSTEM_PROMPT_BASE}\n\nImportant: Please provide your entire response in {language_name_for_prompt}."
-        gemini_question = (
-            f"The user has uploaded a document named '{(doc.file_name or "untitled")}'. "
-            f"Please act as an AI Study Helper and provide a comprehensive analysis of the following text extracted from it:\n\n"
-            f"---\n{extracted_text}\n---"
-        )
+        if not section_mapper.started and len(extracted_text) <= DOC_MAP_SECTION_CHARS:
+            gemini_question = (
+                f"The user has uploaded a document named '{(doc.file_name or "untitled")}'. "
+                f"Please act as an AI Study Helper and provide a comprehensive analysis of the following text extracted from it:\n\n"
+                f"---\n{extracted_text}\n---"
+            )
+        else:
+            # Map-reduce: summarize each section, then analyse the document from the section summaries.
+            section_mapper.add_remainder(extracted_text)
+            section_summaries = await section_mapper.gather()
+            logger.info(f"Document {doc.file_name}: {len(extracted_text)} chars reduced to "
+                        f"{sum(len(summary) for summary in section_summaries)} chars of section summaries.")
+            gemini_question = (
+                f"The user has uploaded a document named '{(doc.file_name or "untitled")}'. "
+                f"It is too long to read at once, so below are summaries of its {len(section_summaries)} consecutive sections. "
+                f"Please act as an AI Study Helper and provide a comprehensive analysis of the whole document based on them:\n\n"
+                + "\n\n".join(f"--- Section {number} ---\n{summary}"
+                               for number, summary in enumerate(section_summaries, start=1))
+            )
 
         full_raw_response = ""
-        last_edit_time = 0
-        update_interval = 1.5  # A safe interval of 1.5 seconds to prevent flood errors
-
-        async for chunk_raw in ask_gemini_stream(gemini_question, conversation_history, system_prompt):
-            full_raw_response += chunk_raw
-            current_time = asyncio.get_event_loop().time()
-
-            # The time-based gatekeeper is the primary flood control mechanism
-            if current_time - last_edit_time < update_interval:
+        async for chunk_raw in ask_gemini_stream(gemini_question, conversation_history, system_prompt,
+                                                 chat_id=chat_id, priority=Priority.DOCUMENT):
+            if isinstance(chunk_raw, dict):
+                if chunk_raw.get("queued"):
+                    await _show_status(chat_id, placeholder_message, _queued_status(user_lang_code, chunk_raw["eta"]))
                 continue
-
-            try:
-                # Stream updates using safe, plain text to avoid parsing errors mid-stream
-                plain_text_stream = transform_markdown_fallback(full_raw_response)
-
-                # Only edit if the text has actually changed to avoid "not modified" errors
-                if plain_text_stream.strip() and plain_text_stream != placeholder_message.text:
-                    await placeholder_message.edit_text(plain_text_stream, parse_mode=None)
-
-                last_edit_time = current_time  # Reset timer after a successful attempt
-            except RetryAfter as e:
-                # Specifically catch the flood control error and wait
-                logger.warning(f"Flood control exceeded during document stream. Waiting for {e.retry_after} seconds.")
-                await asyncio.sleep(e.retry_after)
-            except BadRequest as e:
-                logger.warning(f"BadRequest during plain text stream edit: {e}")
-                last_edit_time = current_time  # Reset timer even on fail to avoid loop
+            full_raw_response += chunk_raw
+            # The streamed preview is rendered like the chat answers, cut to Telegram's limit in
+            # UTF-16 units; the scheduler coalesces the edits and renders only the ones it sends.
+            if full_raw_response.strip():
+                edit_scheduler.schedule_edit(
+                    context.bot, chat_id, placeholder_message.message_id,
+                    render=lambda raw=full_raw_response: truncate_rendered(*render_markdown(raw),
+                                                                           TELEGRAM_MAX_MESSAGE_LENGTH),
+                    fallback=lambda raw=full_raw_response: truncate_rendered(*render_markdown(raw),
+                                                                             TELEGRAM_MAX_MESSAGE_LENGTH)[0],
+                )
 
         # --- Final Message Handling ---
         logger.info(f"Document stream finished. Final length: {len(full_raw_response)} chars.")
+        await edit_scheduler.finish(chat_id, placeholder_message.message_id)
         if full_raw_response.strip():
             # Delete the plain-text streaming message for a clean UI
             await placeholder_message.delete()
@@ -1225,9 +1270,8 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         if full_raw_response.strip() and not any(
                 err_msg in full_raw_response.lower() for err_msg in ["sorry", "i can't", "unable to", "blocked"]):
             history_user_prompt = f"User uploaded document '{(doc.file_name or "untitled")}' for analysis."
-            conversation_history.append({'role': 'user', 'parts': [{'text': history_user_prompt}]})
-            conversation_history.append({'role': 'model', 'parts': [{'text': full_raw_response}]})
-            context.chat_data['conversation_history'] = conversation_history[-MAX_CONVERSATION_TURNS * 2:]
+            append_turn(context.chat_data, history_user_prompt, full_raw_response,
+                        MAX_CONVERSATION_TURNS, chat_id, context.application)
 
     except Exception as e_process_doc:
         logger.error(f"Error processing document '{(doc.file_name or 'N/A')}': {e_process_doc}", exc_info=True)
@@ -1239,12 +1283,8 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
     finally:
         # --- Cleanup ---
-        if os.path.exists(temp_file_path):
-            try:
-                os.remove(temp_file_path)
-                logger.debug(f"Cleaned up temporary document: {temp_file_path}")
-            except Exception as e_remove:
-                logger.error(f"Error removing temporary document {temp_file_path}: {e_remove}")
+        if section_mapper is not None:
+            section_mapper.cancel()
 
 
 def escape_markdown_v2(text: str) -> str:
@@ -1309,6 +1349,47 @@ def escape_markdown_v2_strict(text: str) -> str:
 
     return escaped_text
 
+
+def prepare_markdown_v2(text_raw: str) -> Tuple[str, Optional[str]]:
+    """
+    Escapes `text_raw` for MarkdownV2 and checks it locally with `check_markdown_v2`.
+
+    Returns the escaped text and ParseMode.MARKDOWN_V2 when Telegram will accept it, or
+    the `transform_markdown_fallback` plain text and None when it would be rejected, so
+    a malformed message costs no failed API call. Unpack it into reply_text/edit_text.
+    """
+    escaped_text = escape_markdown_v2(text_raw)
+    if check_markdown_v2(escaped_text):
+        return transform_markdown_fallback(text_raw), None
+    return escaped_text, constants.ParseMode.MARKDOWN_V2
+
+
+async def _show_status(chat_id: int, message: Message, text_raw: str) -> None:
+    """Replaces a placeholder's text with a status line (searching, queued), within the chat's edit rate."""
+    await edit_scheduler.finish(chat_id, message.message_id)
+    try:
+        await edit_scheduler.run(chat_id, lambda: message.edit_text(*prepare_markdown_v2(text_raw)))
+    except BadRequest:
+        record_markdown_v2_rejection()
+        await edit_scheduler.run(chat_id, lambda: message.edit_text(text_raw, parse_mode=None))
+
+
+def _first_visible_recorder(kind: str, started_at: float):
+    """Returns a callback that records, on its first call, how long the user waited for answer text."""
+    pending = [True]
+
+    def record() -> None:
+        if pending:
+            pending.clear()
+            edit_scheduler.record_first_visible(kind, time.monotonic() - started_at)
+
+    return record
+
+
+def _queued_status(user_lang_code: str, eta: float) -> str:
+    return get_template("gemini_queued", user_lang_code, seconds=max(1, round(eta)),
+                        default_val=f"⏳ Many people are asking right now. You're in line, about {max(1, round(eta))} s...")
+
 # --- Command Handlers ---
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
@@ -1437,6 +1518,34 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     if total_feedback > 0:
         satisfaction_rate = (positive_feedback / total_feedback) * 100
 
+    # --- Gemini model registry counters (process-local, reset on restart) ---
+    model_cache = get_model_cache_stats()
+    model_cache_lookups = model_cache["hits"] + model_cache["misses"]
+    model_cache_hit_rate = (model_cache["hits"] / model_cache_lookups * 100) if model_cache_lookups else 0.0
+    http_stats = get_http_client_stats()
+    search_cache = get_search_cache_stats()
+    page_cache = get_page_cache_stats()
+    edit_stats = get_edit_scheduler_stats()
+    markdown_stats = get_markdown_v2_stats()
+    janitor_stats = get_state_janitor_stats()
+    memory_stats = get_conversation_memory_stats()
+    gemini_cache_stats = get_context_cache_stats()
+    admission_stats = get_gemini_admission_stats()
+    router_stats = get_model_router_stats()
+    hedging_stats = get_hedging_stats()
+    media_stats = get_media_download_stats()
+    image_stats = get_image_preprocessing_stats()
+    media_cache_stats = get_media_cache_stats()
+    whisper_stats = get_transcription_stats()
+    model_health = ", ".join(
+        f"{name.split('/')[-1]} `{health['state']}` (err `{health['error_rate'] * 100:.0f}%`, "
+        f"p50 `{health['p50_latency']:.1f}s`)" for name, health in router_stats['models'].items())
+    tier_usage = ", ".join(f"{tier.split('/')[-1]} `{count}`" for tier, count in router_stats['tier_usage'].items())
+    first_visible = ", ".join(
+        f"{kind} p50 `{latency['p50']:.1f}s` / p95 `{latency['p95']:.1f}s` (`{latency['count']}`)"
+        for kind, latency in edit_stats['first_visible'].items()) or "`n/a`"
+    state_kib = ", ".join(f"{field} `{size / 1024:.0f}`" for field, size in janitor_stats['field_bytes'].items())
+
     # --- MODIFIED: Format the stats message with the new section ---
     stats_text = (
         f"*📊 Bot Usage Statistics*\n\n"
@@ -1445,7 +1554,50 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         f"  - Images Received: `{images}`\n"
         f"  - Documents Received: `{documents}`\n\n"
         f"⚙️ *API Usage:*\n"
-        f"  - Web Searches Performed: `{searches}`\n\n"
+        f"  - Web Searches Performed: `{searches}`\n"
+        f"  - Search Cache Hit Rate: `{search_cache['hit_rate']:.1f}%` "
+        f"(`{search_cache['entries']}` cached, `{search_cache['collapsed']}` duplicates collapsed)\n"
+        f"  - Page Cache: `{page_cache['fresh_hits']}` fresh hits, `{page_cache['revalidated']}` not modified, "
+        f"`{page_cache['downloads']}` downloads\n"
+        f"  - Model Cache Hits/Misses: `{model_cache['hits']}` / `{model_cache['misses']}` "
+        f"(`{model_cache_hit_rate:.1f}%`)\n"
+        f"  - Model Setup Time Saved: `{model_cache['saved_seconds_estimate']:.2f}s` "
+        f"(avg build `{model_cache['avg_build_ms']:.1f}ms`)\n"
+        f"  - Outbound HTTP Requests: `{http_stats['requests']}` "
+        f"(new connections `{http_stats['new_connections']}`, reuse `{http_stats['reuse_rate']:.1f}%`)\n"
+        f"  - Stream Edits Sent/Coalesced: `{edit_stats['edits_sent']}` / `{edit_stats['edits_coalesced']}` "
+        f"(flood waits `{edit_stats['retry_after']}`)\n"
+        f"  - Time to First Answer Text: {first_visible}\n"
+        f"  - Media Downloads: `{media_stats['downloads']}` (`{media_stats['bytes'] / 1048576:.1f}` MiB, "
+        f"`{media_stats['spilled']}` spilled to disk, `{media_stats['failures']}` failed)\n"
+        f"  - Media Cache Hits/Misses: `{media_cache_stats['hits']}` / `{media_cache_stats['misses']}` "
+        f"(`{media_cache_stats['entries']}` files, `{media_cache_stats['bytes'] / 1048576:.1f}` MiB, "
+        f"`{media_cache_stats['collapsed']}` duplicates collapsed)\n"
+        f"  - Whisper Transcriptions: `{whisper_stats['transcriptions']}` (avg `{whisper_stats['avg_seconds']:.1f}s`, "
+        f"queued `{whisper_stats['queued']}`, failed `{whisper_stats['failures']}`)\n"
+        f"  - Image Preprocessing: `{image_stats['images']}` images (`{image_stats['skipped']}` sent as-is), "
+        f"saved p50 `{image_stats['bytes_saved']['p50'] / 1024:.0f}` / p95 `{image_stats['bytes_saved']['p95'] / 1024:.0f}` KiB, "
+        f"upload time saved p50 `{image_stats['seconds_saved']['p50']:.2f}s` / p95 `{image_stats['seconds_saved']['p95']:.2f}s`\n"
+        f"  - MarkdownV2 Failures Avoided: `{markdown_stats['avoided_rate']:.1f}%` "
+        f"(`{markdown_stats['predicted_failures']}` caught locally, "
+        f"`{markdown_stats['telegram_rejections']}` rejected by Telegram)\n"
+        f"  - Chat State (KiB, `{janitor_stats['chats']}` chats): {state_kib}\n"
+        f"  - State Evictions Idle/Budget: `{sum(janitor_stats['evicted_idle'].values())}` / "
+        f"`{sum(janitor_stats['evicted_budget'].values())}`\n"
+        f"  - History Turns Summarized: `{memory_stats['turns_folded']}` "
+        f"(`{memory_stats['summaries']}` summaries, `{memory_stats['summary_failures']}` failed, "
+        f"`{memory_stats['turns_clipped']}` turns clipped)\n"
+        f"  - Gemini Context Caches: `{gemini_cache_stats['entries']}` "
+        f"(hits `{gemini_cache_stats['hits']}`, created `{gemini_cache_stats['created']}`, "
+        f"failed `{gemini_cache_stats['create_failures']}`, "
+        f"`{gemini_cache_stats['cached_tokens_served']}` input tokens served from cache)\n"
+        f"  - Gemini Admission: queued `{admission_stats['queued']}` "
+        f"(avg wait `{admission_stats['avg_wait_seconds']:.1f}s`, now `{admission_stats['queue_depth']}`), "
+        f"shed `{admission_stats['shed']}`, quota pauses `{admission_stats['quota_pauses']}`\n"
+        f"  - Gemini Models: {model_health}\n"
+        f"  - Answers by Tier: {tier_usage}\n"
+        f"  - Hedged Requests: `{hedging_stats['hedges_sent']}` (won `{hedging_stats['hedge_wins']}`, "
+        f"skipped for quota `{hedging_stats['skipped_for_budget']}`)\n\n"
         f"👤 *User Metrics:*\n"
         f"  - New Users Started: `{new_users}`\n\n"  # Added a newline for spacing
         # --- NEW SECTION FOR FEEDBACK ---
@@ -1502,11 +1654,14 @@ async def new_chat_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     logger.info(f"Chat {chat_id}: User {user.id} initiated a new chat with /new command.")
 
     # Pop the conversation history from chat_data
-    if 'conversation_history' in context.chat_data:
-        context.chat_data.pop('conversation_history')
+    if clear_conversation(context.chat_data, chat_id):
         logger.info(f"Chat {chat_id}: Conversation history cleared.")
     else:
         logger.info(f"Chat {chat_id}: No conversation history found to clear.")
+    context.chat_data.pop('document_index', None)
+    for key in URL_STATE_KEYS:
+        context.chat_data.pop(key, None)
+    await context_cache.release_chat(chat_id)
 
     # Get user's language for the confirmation message
     user_lang_code = context.user_data.get('selected_language', DEFAULT_LANGUAGE_CODE)
@@ -1576,10 +1731,7 @@ async def clear_subject_command(update: Update, context: ContextTypes.DEFAULT_TY
         del context.user_data['study_subject']
         subject_was_cleared = True
 
-    history_was_cleared = False
-    if 'conversation_history' in context.chat_data:
-        context.chat_data.pop('conversation_history')
-        history_was_cleared = True
+    history_was_cleared = clear_conversation(context.chat_data, update.effective_chat.id)
 
     if subject_was_cleared or history_was_cleared:
         logger.info(f"User {update.effective_user.id} cleared subject and conversation history.")
@@ -1791,7 +1943,7 @@ async def button_callback_handler(update: Update, context: ContextTypes.DEFAULT_
     response_lang_display_name = SUPPORTED_LANGUAGES.get(response_lang_code, "English").split(" (")[0]
 
     if callback_data == "confirm_start_reset_actions":
-        context.chat_data.pop('conversation_history', None)
+        clear_conversation(context.chat_data, chat_id)
         logger.info(
             f"Chat {chat_id}: History reset by user {user_id}. Language remains '{response_lang_display_name}'.")
         text_to_send_raw = get_template(
@@ -1858,64 +2010,97 @@ def transform_markdown_fallback(text: str) -> str:
     if not isinstance(text, str):
         return ""
 
-    # Assuming 'logger' is available from the global scope of telegram_bot.py
-    logger.debug(f"Transforming text for 'smarter' fallback. Original starts: '{text[:100].replace(chr(10), ' ')}...'")
+    debug_enabled = logger.isEnabledFor(logging.DEBUG)
+    if debug_enabled:
+        logger.debug(f"Transforming text for 'smarter' fallback. Original starts: '{text[:100].replace(chr(10), ' ')}...'")
+
+    transformed_text_final = _fallback_line_stages(_fallback_code_stages(_fallback_fenced_blocks(text)))
+
+    # --- Final Cleanup ---
+    # Collapse more than two consecutive newlines into just two to maintain paragraph spacing.
+    transformed_text_final = _collapse_blank_lines(transformed_text_final)
+
+    if debug_enabled:
+        logger.debug(f"Smarter fallback result starts: '{transformed_text_final[:100].replace(chr(10), ' ')}...'")
+    return transformed_text_final.strip()
+
+
+# --- Stages of transform_markdown_fallback ---
+# Each pass is skipped when its marker does not occur in the current text, so plain
+# prose costs a handful of substring checks instead of a dozen full regex scans.
+_FENCED_BLOCK_PATTERN = re.compile(r'```(?:[a-zA-Z0-9_.-]*)?\n(.*?)\n```', flags=re.DOTALL | re.MULTILINE)
+_TRIPLE_TICK_PATTERN = re.compile(r'```(.*?)```', flags=re.DOTALL)
+_INLINE_CODE_PATTERN = re.compile(r'`(.*?)`')
+_HEADING_PATTERN = re.compile(r'^\s*#{1,6}\s*(.*?)\s*$', flags=re.MULTILINE)
+_LINK_PATTERN = re.compile(r'\[(.*?)\]\((.*?)\)')
+# (marker that must be present, pattern) in the order the passes must run:
+# multi-character markers before single ones.
+_EMPHASIS_PASSES = (
+    ('**', re.compile(r'\*\*(.*?)\*\*')),  # **bold** -> bold
+    ('__', re.compile(r'__(.*?)__')),  # __underline__ -> underline
+    ('*', re.compile(r'\*(.*?)\*')),  # *italic* -> italic
+    ('_', re.compile(r'_(.*?)_')),  # _italic_ -> italic
+    ('~', re.compile(r'~(.*?)~')),  # ~strikethrough~ -> strikethrough
+    ('||', re.compile(r'\|\|(.*?)\|\|')),  # ||spoiler|| -> spoiler
+)
+# A bulleted list marker (*, -, +) after the line's leading whitespace (any whitespace but '\n').
+_BULLET_PATTERN = re.compile(r'^([^\S\n]*)[*+-] ', flags=re.MULTILINE)
+_BLANK_LINES_PATTERN = re.compile(r'\n{3,}')
+
+
+def _bullet_replacement(match: re.Match) -> str:
+    # Leading whitespace becomes the same number of spaces, the marker a safe bullet character.
+    return ' ' * len(match.group(1)) + '• '
 
+
+def _fallback_fenced_blocks(text: str) -> str:
     # --- Initial Cleanup ---
     # Normalize line endings to prevent regex issues.
-    transformed_text = text.replace('\r\n', '\n')
+    transformed_text = text.replace('\r\n', '\n') if '\r' in text else text
 
-    # --- Code Blocks and Inline Code (Keep Content, Remove Ticks) ---
+    # --- Code Blocks (Keep Content, Remove Ticks) ---
     # Process multi-line blocks first to avoid conflicts with inline code.
-    transformed_text = re.sub(r'```(?:[a-zA-Z0-9_.-]*)?\n(.*?)\n```', r'\1', transformed_text,
-                              flags=re.DOTALL | re.MULTILINE)
-    transformed_text = re.sub(r'```(.*?)```', r'\1', transformed_text, flags=re.DOTALL)
+    if '```' in transformed_text:
+        transformed_text = _FENCED_BLOCK_PATTERN.sub(r'\1', transformed_text)
+    return transformed_text
+
+
+def _fallback_code_stages(transformed_text: str) -> str:
+    if '`' not in transformed_text:
+        return transformed_text
+    if '```' in transformed_text:
+        transformed_text = _TRIPLE_TICK_PATTERN.sub(r'\1', transformed_text)
     # Just remove the backticks from inline code.
-    transformed_text = re.sub(r'`(.*?)`', r'\1', transformed_text)
+    return _INLINE_CODE_PATTERN.sub(r'\1', transformed_text)
+
 
+def _fallback_line_stages(transformed_text: str) -> str:
     # --- Headings (Remove Hashtags, Keep Text) ---
     # Let the surrounding newlines provide the visual separation for headings.
-    transformed_text = re.sub(r'^\s*#{1,6}\s*(.*?)\s*$', r'\1', transformed_text, flags=re.MULTILINE)
+    if '#' in transformed_text:
+        transformed_text = _HEADING_PATTERN.sub(r'\1', transformed_text)
 
     # --- Links (Extract URL) ---
     # Convert [Link Text](http://example.com) to "Link Text (http://example.com)"
     # This preserves all information in a readable, non-Markdown format.
-    transformed_text = re.sub(r'\[(.*?)\]\((.*?)\)', r'\1 (\2)', transformed_text)
+    if '](' in transformed_text:
+        transformed_text = _LINK_PATTERN.sub(r'\1 (\2)', transformed_text)
 
     # --- Bold, Italics, Strikethrough (Remove Formatting, Keep Text) ---
-    # The order is important: process multi-character markers before single ones.
-    transformed_text = re.sub(r'\*\*(.*?)\*\*', r'\1', transformed_text)  # **bold** -> bold
-    transformed_text = re.sub(r'__(.*?)__', r'\1', transformed_text)  # __underline__ -> underline
-    transformed_text = re.sub(r'\*(.*?)\*', r'\1', transformed_text)  # *italic* -> italic
-    transformed_text = re.sub(r'_(.*?)_', r'\1', transformed_text)  # _italic_ -> italic
-    transformed_text = re.sub(r'~(.*?)~', r'\1', transformed_text)  # ~strikethrough~ -> strikethrough
-    transformed_text = re.sub(r'\|\|(.*?)\|\|', r'\1', transformed_text)  # ||spoiler|| -> spoiler
+    for marker, pattern in _EMPHASIS_PASSES:
+        if marker in transformed_text:
+            transformed_text = pattern.sub(r'\1', transformed_text)
 
     # --- Lists (Preserve Structure with Safe Characters) ---
-    # This approach is simpler and more robust than re-numbering.
-    lines = transformed_text.split('\n')
-    processed_lines = []
-    for line in lines:
-        # Match and replace bulleted list markers (*, -, +)
-        stripped_line = line.lstrip()
-        indentation_str = ' ' * (len(line) - len(stripped_line))
-
-        if stripped_line.startswith(('* ', '- ', '+ ')):
-            # Replace the Markdown marker with a safe, visually appealing bullet character.
-            processed_lines.append(indentation_str + '• ' + stripped_line[2:])
-        else:
-            # Keep numbered lists and all other lines as they are.
-            # Numbered lists are generally safe and readable in plain text.
-            processed_lines.append(line)
+    # Keep numbered lists and all other lines as they are; they are readable in plain text.
+    if '* ' in transformed_text or '- ' in transformed_text or '+ ' in transformed_text:
+        transformed_text = _BULLET_PATTERN.sub(_bullet_replacement, transformed_text)
+    return transformed_text
 
-    transformed_text_final = "\n".join(processed_lines)
 
-    # --- Final Cleanup ---
-    # Collapse more than two consecutive newlines into just two to maintain paragraph spacing.
-    transformed_text_final = re.sub(r'\n{3,}', '\n\n', transformed_text_final)
+def _collapse_blank_lines(text: str) -> str:
+    return _BLANK_LINES_PATTERN.sub('\n\n', text) if '\n\n\n' in text else text
 
-    logger.debug(f"Smarter fallback result starts: '{transformed_text_final[:100].replace(chr(10), ' ')}...'")
-    return transformed_text_final.strip()
 
 # Your existing send_long_message_fallback from the provided context
 # (Make sure it has the `context: ContextTypes.DEFAULT_TYPE` parameter if it needs to send messages via context.bot
@@ -1931,8 +2116,8 @@ async def send_long_message_fallback(update: Update,
     This function first splits the raw text into chunks that respect the max length, trying to
     break at natural points like newlines. It then attempts to send each chunk using a prioritized
     list of formats for best readability:
-    1. Transformed Plain Text (for good list/structure rendering).
-    2. Escaped MarkdownV2 (if plain text fails).
+    1. Rendered text with entities (`render_markdown`), keeping the formatting.
+    2. Transformed Plain Text (if the entities are rejected).
     3. Truncated Raw Text (as a last resort).
 
     After the final chunk is successfully sent, it edits that message to add 👍/👎 feedback buttons.
@@ -1995,35 +2180,26 @@ async def send_long_message_fallback(update: Update,
         sent_successfully = False
         current_segment_message: Message | None = None
 
-        # --- Priority 1: Attempt Transformed Plain Text ---
+        # --- Priority 1: Attempt Rendered Text with Entities ---
         try:
-            transformed_segment = transform_markdown_fallback(segment_raw)
-            if len(transformed_segment) > max_length:
-                logger.warning(f"Fallback: Transformed segment {i + 1} too long. Sending truncated raw.")
-                text_to_send = segment_raw[:max_length]
-            else:
-                text_to_send = transformed_segment
-
-            current_segment_message = await update.message.reply_text(text_to_send, parse_mode=None)
-            logger.info(f"Fallback: Sent segment {i + 1}/{total_parts} as TRANSFORMED PLAIN.")
+            rendered_segment, segment_entities = truncate_rendered(*render_markdown(segment_raw), max_length)
+            current_segment_message = await update.message.reply_text(rendered_segment, entities=segment_entities)
+            logger.info(f"Fallback: Sent segment {i + 1}/{total_parts} as RENDERED ENTITIES.")
             sent_successfully = True
-        except Exception as e_plain:
-            logger.error(f"Fallback: TRANSFORMED PLAIN send FAILED: {e_plain}. Trying Escaped MDV2.")
+        except Exception as e_entities:
+            logger.error(f"Fallback: RENDERED ENTITIES send FAILED: {e_entities}. Trying Transformed Plain.")
 
-            # --- Priority 2: Fallback to Escaped MarkdownV2 ---
+            # --- Priority 2: Fallback to Transformed Plain Text ---
             try:
-                escaped_segment = escape_markdown_v2(segment_raw)
-                if len(escaped_segment) > max_length:
-                    logger.warning(f"Fallback: Escaped MDV2 for segment {i + 1} also too long. Sending truncated raw.")
-                    current_segment_message = await update.message.reply_text(segment_raw[:max_length], parse_mode=None)
-                else:
-                    current_segment_message = await update.message.reply_text(escaped_segment,
-                                                                              parse_mode=constants.ParseMode.MARKDOWN_V2)
-
-                logger.info(f"Fallback: Sent segment {i + 1}/{total_parts} as ESCAPED MDV2 (or truncated raw).")
+                transformed_segment = transform_markdown_fallback(segment_raw)
+                if len(transformed_segment) > max_length:
+                    logger.warning(f"Fallback: Transformed segment {i + 1} too long. Sending truncated raw.")
+                    transformed_segment = segment_raw[:max_length]
+                current_segment_message = await update.message.reply_text(transformed_segment, parse_mode=None)
+                logger.info(f"Fallback: Sent segment {i + 1}/{total_parts} as TRANSFORMED PLAIN (or truncated raw).")
                 sent_successfully = True
-            except Exception as e_md:
-                logger.error(f"Fallback: ESCAPED MDV2 send ALSO FAILED: {e_md}.")
+            except Exception as e_plain:
+                logger.error(f"Fallback: TRANSFORMED PLAIN send ALSO FAILED: {e_plain}.")
 
         # --- Post-Send Processing ---
         if current_segment_message:
@@ -2068,7 +2244,10 @@ async def send_long_message_fallback(update: Update,
 async def get_refined_response(
         initial_prompt: str,
         base_system_prompt: str,
-        conversation_history: list
+        conversation_history: list,
+        document: Optional[str] = None,
+        chat_id: Optional[int] = None,
+        priority: Priority = Priority.INTERACTIVE
 ) -> str:
     """
     Implements the Creator-Critic-Corrector pattern for high-quality responses.
@@ -2081,6 +2260,9 @@ async def get_refined_response(
         initial_prompt: The user's original question or the first prompt for the AI.
         base_system_prompt: The main system prompt for your bot.
         conversation_history: The chat history to provide context.
+        document: Optional reference text for the draft (e.g. an article), cached by Gemini when reused.
+        chat_id: The chat the request is for, used to release cached documents on /new.
+        priority: Admission priority of both Gemini calls.
 
     Returns:
         A string containing the final, corrected response.
@@ -2092,7 +2274,10 @@ async def get_refined_response(
     first_draft = await ask_gemini_non_stream(
         prompt=initial_prompt,
         system_prompt=base_system_prompt,
-        conversation_history=conversation_history
+        conversation_history=conversation_history,
+        document=document,
+        chat_id=chat_id,
+        priority=priority
     )
 
     if not first_draft or "[AI ERROR:" in first_draft:
@@ -2128,7 +2313,8 @@ async def get_refined_response(
     final_response = await ask_gemini_non_stream(
         prompt=correction_prompt,
         system_prompt=critic_system_prompt,
-        conversation_history=[]
+        conversation_history=[],
+        priority=priority
     )
 
     if not final_response or "[AI ERROR:" in final_response:
@@ -2205,10 +2391,8 @@ def add_all_handlers(application: "Application"):
     """
     logger.info("Registering all application handlers...")
 
-    # --- THE FIX IS HERE ---
-    # Use `setdefault` to initialize the dictionary if it doesn't exist.
-    # This is the correct way to modify the chat_data proxy.
-    # application.chat_data.setdefault('mdv2_failed_for_msg_id', {})
+    # Stamps chat_data['last_active'] so the state janitor can evict idle chats' heavy fields.
+    application.add_handler(TypeHandler(Update, record_chat_activity), group=-2)
 
     # The rest of the function is correct.
     application.add_handler(MessageHandler(filters.ALL, all_updates_logger), group=-1)
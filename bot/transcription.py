@@ -0,0 +1,88 @@
+# --- START OF FILE bot/transcription.py ---
+
+import os
+import time
+import asyncio
+import logging
+from typing import Any, BinaryIO, Dict, Optional
+
+import httpx
+from openai import AsyncOpenAI
+
+from .config_utils import env_number
+from .http_client import get_http_client
+
+logger = logging.getLogger(__name__)
+
+
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+WHISPER_MODEL = os.getenv("WHISPER_MODEL", "whisper-1")
+# How many voice notes are uploaded/transcribed at once, independent of the Gemini admission limits.
+WHISPER_MAX_CONCURRENCY = env_number("WHISPER_MAX_CONCURRENCY", 4)
+WHISPER_CONNECT_TIMEOUT_SECONDS = env_number("WHISPER_CONNECT_TIMEOUT_SECONDS", 10.0, cast=float)
+# Covers the upload and the transcription itself, which for a long voice note can take a while.
+WHISPER_TIMEOUT_SECONDS = env_number("WHISPER_TIMEOUT_SECONDS", 60.0, cast=float)
+WHISPER_MAX_RETRIES = env_number("WHISPER_MAX_RETRIES", 2)
+
+if not OPENAI_API_KEY:
+    logger.warning("OPENAI_API_KEY not found in .env. Voice message transcription will be disabled.")
+
+_client: Optional[AsyncOpenAI] = None
+_client_http: Optional[httpx.AsyncClient] = None
+_semaphore: Optional[asyncio.Semaphore] = None
+_stats = {"transcriptions": 0, "failures": 0, "queued": 0, "in_flight": 0, "seconds": 0.0}
+
+
+def transcription_available() -> bool:
+    return bool(OPENAI_API_KEY)
+
+
+def get_openai_client() -> AsyncOpenAI:
+    """
+    Returns the AsyncOpenAI client. It sends its requests over the shared HTTP client's
+    connection pool, and is rebuilt if that pool was closed and recreated.
+    """
+    global _client, _client_http
+    http_client = get_http_client()
+    if _client is None or _client_http is not http_client:
+        _client = AsyncOpenAI(api_key=OPENAI_API_KEY, http_client=http_client, max_retries=WHISPER_MAX_RETRIES)
+        _client_http = http_client
+        logger.info("AsyncOpenAI client initialized on the shared HTTP pool for voice transcriptions.")
+    return _client
+
+
+async def transcribe_audio(file_name: str, audio: BinaryIO) -> str:
+    """
+    Transcribes an audio file with Whisper. At most WHISPER_MAX_CONCURRENCY transcriptions
+    run at once; the rest wait their turn without holding a thread. Raises the OpenAI
+    client's errors (RateLimitError, APIConnectionError / APITimeoutError, ...).
+    """
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(max(WHISPER_MAX_CONCURRENCY, 1))
+    if _semaphore.locked():
+        _stats["queued"] += 1
+    async with _semaphore:
+        _stats["in_flight"] += 1
+        started = time.monotonic()
+        try:
+            transcription = await get_openai_client().audio.transcriptions.create(
+                model=WHISPER_MODEL,
+                file=(file_name, audio),
+                timeout=httpx.Timeout(WHISPER_TIMEOUT_SECONDS, connect=WHISPER_CONNECT_TIMEOUT_SECONDS),
+            )
+        except Exception:
+            _stats["failures"] += 1
+            raise
+        finally:
+            _stats["in_flight"] -= 1
+        _stats["transcriptions"] += 1
+        _stats["seconds"] += time.monotonic() - started
+    return transcription.text
+
+
+def get_transcription_stats() -> Dict[str, Any]:
+    done = _stats["transcriptions"]
+    return {**_stats, "avg_seconds": _stats["seconds"] / done if done else 0.0}
+
+# --- END OF FILE bot/transcription.py ---
@@ -0,0 +1,87 @@
+# --- START OF FILE bot/update_processor.py ---
+
+import asyncio
+import logging
+from typing import Any, Awaitable, Dict, Optional
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+from .config_utils import env_number
+
+logger = logging.getLogger(__name__)
+
+MAX_CONCURRENT_UPDATES = env_number("MAX_CONCURRENT_UPDATES", 32)
+# Updates admitted at once, counting those still waiting for their chat's previous updates.
+MAX_QUEUED_UPDATES = env_number("MAX_QUEUED_UPDATES", 1024)
+
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """
+    Processes updates from different chats concurrently while keeping updates from
+    the same chat strictly sequential and in arrival order.
+
+    A slow Gemini stream or PDF extraction in one chat no longer blocks everyone else,
+    but two handlers of the same chat can never write `conversation_history` in
+    `chat_data` at the same time.
+
+    PTB's `process_update` admits up to `max_queued_updates` updates. Each one then waits
+    for its chat's turn and only then takes one of the `max_running_updates` running
+    slots, so a chat with a backlog of queued updates never holds slots that other chats
+    could use.
+    """
+
+    def __init__(self, max_concurrent_updates: int = MAX_CONCURRENT_UPDATES,
+                 max_queued_updates: int = MAX_QUEUED_UPDATES):
+        super().__init__(max(max_queued_updates, max_concurrent_updates))
+        self.max_running_updates = max_concurrent_updates
+        self._running_slots = asyncio.BoundedSemaphore(max_concurrent_updates)
+        # chat key -> [lock, number of updates holding or waiting for the lock]
+        self._chat_locks: Dict[int, list] = {}
+
+    @staticmethod
+    def _chat_key(update: object) -> Optional[int]:
+        """Returns the key updates are serialized on: the chat id, else the user id."""
+        if not isinstance(update, Update):
+            return None
+        if update.effective_chat:
+            return update.effective_chat.id
+        if update.effective_user:
+            return update.effective_user.id
+        return None
+
+    @property
+    def active_chats(self) -> int:
+        """The number of chats that currently have an update running or queued."""
+        return len(self._chat_locks)
+
+    async def do_process_update(self, update: object, coroutine: "Awaitable[Any]") -> None:
+        """Waits for the chat's previous updates to finish, then runs the update in a running slot."""
+        chat_key = self._chat_key(update)
+        if chat_key is None:
+            async with self._running_slots:
+                await coroutine
+            return
+
+        entry = self._chat_locks.setdefault(chat_key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            # asyncio.Lock wakes waiters in FIFO order, so updates keep their arrival order.
+            async with entry[0]:
+                async with self._running_slots:
+                    await coroutine
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                self._chat_locks.pop(chat_key, None)
+
+    async def initialize(self) -> None:
+        """Logs the configured limit; no resources need to be allocated."""
+        logger.info(f"Per-chat update processor ready with a global limit of {self.max_running_updates} "
+                    f"running and {self.max_concurrent_updates} admitted updates.")
+
+    async def shutdown(self) -> None:
+        """Forgets any per-chat locks left over from a previous run."""
+        self._chat_locks.clear()
+
+# --- END OF FILE bot/update_processor.py ---
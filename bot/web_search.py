@@ -1,11 +1,19 @@
 # --- bot/web_search.py ---
 
 import os
+import json
+import time
 import asyncio
 import logging
+import unicodedata
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
 import httpx
 from bs4 import BeautifulSoup
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Tuple, Optional
+
+from .cache_utils import TTLCache, SingleFlight
+from .config_utils import env_number
+from .http_client import get_http_client
 
 logger = logging.getLogger(__name__)
 
@@ -13,6 +21,172 @@ logger = logging.getLogger(__name__)
 GOOGLE_SEARCH_API_KEY = os.getenv("GOOGLE_SEARCH_API_KEY")
 GOOGLE_SEARCH_ENGINE_ID = os.getenv("GOOGLE_SEARCH_ENGINE_ID")
 
+# --- Search Result Cache ---
+# Many students ask the same current-events questions; each miss costs a paid Custom
+# Search call plus page scrapes, so finished reports are cached for a while.
+WEB_SEARCH_CACHE_TTL = env_number("WEB_SEARCH_CACHE_TTL", 1800.0, cast=float)
+WEB_SEARCH_CACHE_MAX_ENTRIES = env_number("WEB_SEARCH_CACHE_MAX_ENTRIES", 500)
+WEB_SEARCH_CACHE_MAX_BYTES = env_number("WEB_SEARCH_CACHE_MAX_BYTES", 16 * 1024 * 1024)
+# Optional JSON file so hot queries survive restarts (empty = memory only).
+WEB_SEARCH_CACHE_FILE = os.getenv("WEB_SEARCH_CACHE_FILE", "")
+
+search_cache = TTLCache("web_search", ttl_seconds=WEB_SEARCH_CACHE_TTL,
+                        max_entries=WEB_SEARCH_CACHE_MAX_ENTRIES, max_bytes=WEB_SEARCH_CACHE_MAX_BYTES)
+_search_single_flight = SingleFlight()
+
+
+def normalize_search_query(search_query: str) -> str:
+    """Folds case, punctuation and whitespace so trivially different phrasings share a cache entry."""
+    folded = unicodedata.normalize("NFKC", search_query).casefold()
+    without_punctuation = "".join(
+        " " if unicodedata.category(char).startswith("P") else char for char in folded
+    )
+    return " ".join(without_punctuation.split())
+
+
+def load_search_cache(filepath: Optional[str] = None) -> int:
+    """Loads still-valid cached reports from disk. Returns the number of restored entries."""
+    filepath = filepath or WEB_SEARCH_CACHE_FILE
+    if not filepath or not os.path.exists(filepath):
+        return 0
+    try:
+        with open(filepath, "r", encoding="utf-8") as cache_file:
+            stored_entries = json.load(cache_file)
+        for query_key, num_results, expires_at, report in stored_entries:
+            search_cache.set((query_key, num_results), report, expires_at=expires_at)
+        search_cache.purge_expired()
+        logger.info(f"Restored {len(search_cache)} web search results from {filepath}.")
+        return len(search_cache)
+    except Exception as e:
+        logger.error(f"Could not load web search cache from {filepath}: {e}")
+        return 0
+
+
+def save_search_cache(filepath: Optional[str] = None) -> int:
+    """Writes the live cache entries to disk. Returns the number of saved entries."""
+    filepath = filepath or WEB_SEARCH_CACHE_FILE
+    if not filepath:
+        return 0
+    try:
+        entries = [[key[0], key[1], expires_at, report] for key, expires_at, report in search_cache.items()]
+        temp_path = f"{filepath}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as cache_file:
+            json.dump(entries, cache_file, ensure_ascii=False)
+        os.replace(temp_path, filepath)
+        logger.info(f"Saved {len(entries)} web search results to {filepath}.")
+        return len(entries)
+    except Exception as e:
+        logger.error(f"Could not save web search cache to {filepath}: {e}")
+        return 0
+
+
+def get_search_cache_stats() -> Dict[str, Any]:
+    """Returns hit/miss counters for the search cache and the number of collapsed duplicate requests."""
+    return {**search_cache.snapshot(), "collapsed": _search_single_flight.collapsed}
+
+
+# --- Scraped Page Cache ---
+# Pages are cached by canonical URL together with their ETag/Last-Modified validators.
+# A fresh entry is served without any request; a stale one is revalidated with a
+# conditional GET, and a 304 reuses the stored text without downloading or parsing.
+PAGE_CACHE_TTL = env_number("PAGE_CACHE_TTL", 86400.0, cast=float)
+PAGE_CACHE_FRESH_SECONDS = env_number("PAGE_CACHE_FRESH_SECONDS", 300.0, cast=float)
+PAGE_CACHE_MAX_ENTRIES = env_number("PAGE_CACHE_MAX_ENTRIES", 1000)
+PAGE_CACHE_MAX_BYTES = env_number("PAGE_CACHE_MAX_BYTES", 64 * 1024 * 1024)
+
+SCRAPER_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+}
+TRACKING_QUERY_PARAMS = {"fbclid", "gclid", "dclid", "gbraid", "wbraid", "yclid", "msclkid", "mc_cid", "mc_eid",
+                         "igshid", "ref_src", "_ga", "_gl", "spm", "si"}
+
+page_cache = TTLCache("pages", ttl_seconds=PAGE_CACHE_TTL, max_entries=PAGE_CACHE_MAX_ENTRIES,
+                      max_bytes=PAGE_CACHE_MAX_BYTES,
+                      size_func=lambda entry: len(entry["text"] or "") * 2 + 256)
+_page_single_flight = SingleFlight()
+_page_cache_stats = {"fresh_hits": 0, "revalidated": 0, "downloads": 0}
+
+
+def canonicalize_url(url: str) -> str:
+    """
+    Returns a canonical form of a URL for cache keys: lower-case scheme and host, no
+    default port, no fragment, no tracking parameters (utm_*, fbclid, ...) and sorted
+    query parameters.
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+    if parts.port and not ((scheme == "http" and parts.port == 80) or (scheme == "https" and parts.port == 443)):
+        host = f"{host}:{parts.port}"
+    query_params = [
+        (key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+        if not key.lower().startswith("utm_") and key.lower() not in TRACKING_QUERY_PARAMS
+    ]
+    return urlunsplit((scheme, host, parts.path or "/", urlencode(sorted(query_params)), ""))
+
+
+def extract_page_text(html_content: bytes) -> str:
+    """Extracts the paragraph text of an HTML page, ignoring scripts and page chrome."""
+    soup = BeautifulSoup(html_content, 'html.parser')
+
+    # A more robust text extraction strategy
+    for element in soup(['script', 'style', 'header', 'footer', 'nav', 'aside']):
+        element.decompose()  # Remove irrelevant tags
+
+    return ' '.join(p.get_text(strip=True) for p in soup.find_all('p'))
+
+
+async def fetch_page_text(url: str, timeout: float = 10, client: Optional[httpx.AsyncClient] = None) -> Optional[str]:
+    """
+    Returns the extracted paragraph text of a web page, using the page cache.
+
+    Returns None if the URL does not point to an HTML page and "" if the page has no
+    paragraph text. HTTP and network failures raise `httpx.HTTPError`.
+    """
+    cache_key = canonicalize_url(url)
+    cached_entry = page_cache.get(cache_key)
+    if cached_entry is not None and time.time() - cached_entry["validated_at"] < PAGE_CACHE_FRESH_SECONDS:
+        _page_cache_stats["fresh_hits"] += 1
+        return cached_entry["text"]
+
+    async def fetch() -> Optional[str]:
+        headers = dict(SCRAPER_HEADERS)
+        if cached_entry is not None:
+            if cached_entry["etag"]:
+                headers["If-None-Match"] = cached_entry["etag"]
+            if cached_entry["last_modified"]:
+                headers["If-Modified-Since"] = cached_entry["last_modified"]
+
+        response = await (client or get_http_client()).get(url, headers=headers, timeout=timeout,
+                                                           follow_redirects=True)
+        if response.status_code == 304 and cached_entry is not None:
+            logger.debug(f"Page not modified, reusing cached text: {cache_key}")
+            _page_cache_stats["revalidated"] += 1
+            page_cache.set(cache_key, {**cached_entry, "validated_at": time.time()})
+            return cached_entry["text"]
+        response.raise_for_status()
+        _page_cache_stats["downloads"] += 1
+
+        if 'text/html' not in response.headers.get('Content-Type', ''):
+            text = None
+        else:
+            text = extract_page_text(response.content)
+
+        page_cache.set(cache_key, {
+            "text": text,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "validated_at": time.time(),
+        })
+        return text
+
+    return await _page_single_flight.do(cache_key, fetch)
+
+
+def get_page_cache_stats() -> Dict[str, Any]:
+    """Returns page cache counters: fresh hits, 304 revalidations and full downloads."""
+    return {**page_cache.snapshot(), **_page_cache_stats}
+
 
 # --- NEW: Helper function to scrape a single URL ---
 async def scrape_url_content(url: str, client: httpx.AsyncClient) -> str:
@@ -22,23 +196,12 @@ async def scrape_url_content(url: str, client: httpx.AsyncClient) -> str:
     """
     try:
         logger.info(f"Scraping content from: {url}")
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'}
-        response = await client.get(url, headers=headers, timeout=10, follow_redirects=True)
-        response.raise_for_status()
+        text = await fetch_page_text(url, timeout=10, client=client)
 
-        if 'text/html' not in response.headers.get('Content-Type', ''):
+        if text is None:
             logger.warning(f"Skipping non-HTML content at {url}")
             return "[Content is not a webpage]"
 
-        soup = BeautifulSoup(response.content, 'html.parser')
-
-        # A more robust text extraction strategy
-        for element in soup(['script', 'style', 'header', 'footer', 'nav', 'aside']):
-            element.decompose()  # Remove irrelevant tags
-
-        text = ' '.join(p.get_text(strip=True) for p in soup.find_all('p'))
-
         if not text:
             return "[No meaningful paragraph text found on this page]"
 
@@ -54,6 +217,9 @@ async def perform_web_search(search_query: str, num_results_to_scrape: int = 2)
     """
     Performs a web search, then scrapes the top results to provide a rich context.
 
+    Successful reports are cached by normalized query, and concurrent identical
+    queries share a single in-flight search.
+
     Args:
         search_query: The string to search for.
         num_results_to_scrape: The number of top search results to visit and scrape.
@@ -61,12 +227,34 @@ async def perform_web_search(search_query: str, num_results_to_scrape: int = 2)
     Returns:
         A detailed, formatted string containing search snippets and scraped page content.
     """
+    cache_key = (normalize_search_query(search_query), num_results_to_scrape)
+    cached_report = search_cache.get(cache_key)
+    if cached_report is not None:
+        logger.info(f"Web search cache hit for: '{search_query}'")
+        return cached_report
+
+    async def search_and_cache() -> str:
+        report, cacheable = await _run_web_search(search_query, num_results_to_scrape)
+        if cacheable:
+            search_cache.set(cache_key, report)
+        return report
+
+    return await _search_single_flight.do(cache_key, search_and_cache)
+
+
+async def _run_web_search(search_query: str, num_results_to_scrape: int) -> Tuple[str, bool]:
+    """
+    Runs the actual Google search and scraping for `perform_web_search`.
+
+    Returns:
+        The report text and whether it is a successful result that may be cached.
+    """
     logger.info(f"Performing deep web search for: '{search_query}'")
 
     if not GOOGLE_SEARCH_API_KEY or not GOOGLE_SEARCH_ENGINE_ID:
         error_message = "Google Search API Key or Search Engine ID is not configured."
         logger.error(error_message)
-        return f"[Search Configuration Error]: {error_message}"
+        return f"[Search Configuration Error]: {error_message}", False
 
     url = "https://www.googleapis.com/customsearch/v1"
     params = {
@@ -77,48 +265,49 @@ async def perform_web_search(search_query: str, num_results_to_scrape: int = 2)
     }
 
     try:
-        async with httpx.AsyncClient() as client:
-            # 1. Perform the initial Google Search
-            google_response = await client.get(url, params=params)
-            google_response.raise_for_status()
-            search_data = google_response.json()
-            search_items: List[Dict[str, Any]] = search_data.get("items", [])
-
-            if not search_items:
-                logger.warning(f"Google Search for '{search_query}' returned no results.")
-                return "Web search returned no results."
-
-            # 2. Asynchronously scrape the top N results
-            tasks = []
-            for item in search_items[:num_results_to_scrape]:
-                link = item.get('link')
-                if link:
-                    tasks.append(scrape_url_content(link, client))
-
-            scraped_contents = await asyncio.gather(*tasks)
-
-            # 3. Format all the collected information for the AI
-            final_report = f"Research report for the query: '{search_query}'\n\n"
-            final_report += "--- Search Snippets ---\n"
-            for i, item in enumerate(search_items[:num_results_to_scrape]):
-                title = item.get('title', 'No Title')
-                snippet = item.get('snippet', 'No snippet.').replace("\n", " ")
-                final_report += f"{i + 1}. {title}: {snippet}\n"
-
-            final_report += "\n--- Detailed Content from Top Pages ---\n"
-            for i, content in enumerate(scraped_contents):
-                final_report += f"\n\n>> Content from Result {i + 1}:\n"
-                final_report += content + "\n"
-
-            final_report += "\n--- End of Report ---\nBased on the comprehensive information above, please provide a direct answer to the user's original query."
-
-            logger.debug(f"Generated research report for Gemini. Length: {len(final_report)} chars.")
-            return final_report
+        client = get_http_client()
+
+        # 1. Perform the initial Google Search
+        google_response = await client.get(url, params=params)
+        google_response.raise_for_status()
+        search_data = google_response.json()
+        search_items: List[Dict[str, Any]] = search_data.get("items", [])
+
+        if not search_items:
+            logger.warning(f"Google Search for '{search_query}' returned no results.")
+            return "Web search returned no results.", False
+
+        # 2. Asynchronously scrape the top N results
+        tasks = []
+        for item in search_items[:num_results_to_scrape]:
+            link = item.get('link')
+            if link:
+                tasks.append(scrape_url_content(link, client))
+
+        scraped_contents = await asyncio.gather(*tasks)
+
+        # 3. Format all the collected information for the AI
+        final_report = f"Research report for the query: '{search_query}'\n\n"
+        final_report += "--- Search Snippets ---\n"
+        for i, item in enumerate(search_items[:num_results_to_scrape]):
+            title = item.get('title', 'No Title')
+            snippet = item.get('snippet', 'No snippet.').replace("\n", " ")
+            final_report += f"{i + 1}. {title}: {snippet}\n"
+
+        final_report += "\n--- Detailed Content from Top Pages ---\n"
+        for i, content in enumerate(scraped_contents):
+            final_report += f"\n\n>> Content from Result {i + 1}:\n"
+            final_report += content + "\n"
+
+        final_report += "\n--- End of Report ---\nBased on the comprehensive information above, please provide a direct answer to the user's original query."
+
+        logger.debug(f"Generated research report for Gemini. Length: {len(final_report)} chars.")
+        return final_report, True
 
     except httpx.HTTPStatusError as e:
         error_body = e.response.text
         logger.error(f"HTTP error during Google Search for '{search_query}': {e}\nResponse: {error_body}")
-        return f"An error occurred while contacting the search service: {e}"
+        return f"An error occurred while contacting the search service: {e}", False
     except Exception as e:
         logger.error(f"An unexpected error occurred during Google Search for '{search_query}': {e}", exc_info=True)
-        return f"An unexpected error occurred during the web search: {e}"
\ No newline at end of file
+        return f"An unexpected error occurred during the web search: {e}", False
\ No newline at end of file
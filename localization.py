@@ -959,6 +959,41 @@ TEMPLATES = {
         "zh-TW": "...繼續回應中...",
         "pt-PT": "...a continuar a resposta..."
     },
+    "gemini_queued": {
+        "en": "⏳ Many people are asking right now. You're in line, about {seconds} s...",
+        "es": "⏳ Mucha gente está preguntando ahora. Estás en la cola, unos {seconds} s...",
+        "fr": "⏳ Beaucoup de demandes en ce moment. Vous êtes dans la file, environ {seconds} s...",
+        "kk": "⏳ Қазір сұраныс көп. Сіз кезектесіз, шамамен {seconds} с...",
+        "de": "⏳ Gerade fragen sehr viele. Du bist in der Warteschlange, etwa {seconds} s...",
+        "ru": "⏳ Сейчас много запросов. Вы в очереди, примерно {seconds} с...",
+        "zh-CN": "⏳ 现在提问的人很多。您正在排队，大约 {seconds} 秒...",
+        "ja": "⏳ ただいま多くの質問が届いています。順番待ちです。約 {seconds} 秒...",
+        "ko": "⏳ 지금 요청이 많습니다. 대기 중이며, 약 {seconds}초...",
+        "pt-BR": "⏳ Muitas pessoas estão perguntando agora. Você está na fila, cerca de {seconds} s...",
+        "it": "⏳ Molte richieste in questo momento. Sei in coda, circa {seconds} s...",
+        "ar": "⏳ هناك الكثير من الطلبات الآن. أنت في قائمة الانتظار، حوالي {seconds} ث...",
+        "hi": "⏳ अभी बहुत से लोग पूछ रहे हैं। आप कतार में हैं, लगभग {seconds} सेकंड...",
+        "tr": "⏳ Şu anda çok fazla istek var. Sıradasınız, yaklaşık {seconds} sn...",
+        "nl": "⏳ Er worden nu veel vragen gesteld. Je staat in de wachtrij, ongeveer {seconds} s...",
+        "pl": "⏳ Teraz pyta bardzo wiele osób. Jesteś w kolejce, około {seconds} s...",
+        "sv": "⏳ Många frågar just nu. Du står i kö, ungefär {seconds} s...",
+        "fi": "⏳ Juuri nyt kysytään paljon. Olet jonossa, noin {seconds} s...",
+        "no": "⏳ Mange spør akkurat nå. Du står i kø, omtrent {seconds} s...",
+        "da": "⏳ Mange spørger lige nu. Du er i kø, cirka {seconds} s...",
+        "cs": "⏳ Právě se ptá mnoho lidí. Jste ve frontě, asi {seconds} s...",
+        "hu": "⏳ Most sokan kérdeznek. Sorban állsz, körülbelül {seconds} mp...",
+        "ro": "⏳ Multe persoane întreabă acum. Ești la coadă, aproximativ {seconds} s...",
+        "el": "⏳ Πολλοί ρωτούν αυτή τη στιγμή. Είστε στην ουρά, περίπου {seconds} δ...",
+        "he": "⏳ הרבה אנשים שואלים כרגע. אתה בתור, בערך {seconds} שניות...",
+        "th": "⏳ ขณะนี้มีผู้ถามจำนวนมาก คุณอยู่ในคิว ประมาณ {seconds} วินาที...",
+        "vi": "⏳ Hiện có rất nhiều người đang hỏi. Bạn đang trong hàng chờ, khoảng {seconds} giây...",
+        "id": "⏳ Banyak orang sedang bertanya saat ini. Anda dalam antrean, sekitar {seconds} detik...",
+        "ms": "⏳ Ramai orang sedang bertanya sekarang. Anda dalam giliran, kira-kira {seconds} saat...",
+        "uk": "⏳ Зараз багато запитів. Ви в черзі, приблизно {seconds} с...",
+        "uz": "⏳ Hozir so'rovlar ko'p. Siz navbatdasiz, taxminan {seconds} soniya...",
+        "zh-TW": "⏳ 現在提問的人很多。您正在排隊，大約 {seconds} 秒...",
+        "pt-PT": "⏳ Muitas pessoas estão a perguntar neste momento. Está na fila, cerca de {seconds} s..."
+    },
     "response_continued_below": {
         "en": "...(response continues in new messages below)...",
         "es": "...(la respuesta continúa en los mensajes siguientes)...",
@@ -1694,41 +1729,6 @@ TEMPLATES = {
         "zh-TW": "...繼續分析...",
         "pt-PT": "...a continuar a análise..."
     },
-    "error_temp_storage": {
-        "en": "⚠️ Server error: Cannot create temporary storage.",
-        "es": "⚠️ Error del servidor: no se puede crear almacenamiento temporal.",
-        "fr": "⚠️ Erreur du serveur : impossible de créer un stockage temporaire.",
-        "kk": "⚠️ Сервер қатесі: уақытша сақтау орнын жасау мүмкін емес.",
-        "de": "⚠️ Serverfehler: Temporärer Speicher kann nicht erstellt werden.",
-        "ru": "⚠️ Ошибка сервера: не удалось создать временное хранилище.",
-        "zh-CN": "⚠️ 服务器错误：无法创建临时存储。",
-        "ja": "⚠️ サーバーエラー：一時ストレージを作成できません。",
-        "ko": "⚠️ 서버 오류: 임시 저장소를 만들 수 없습니다.",
-        "pt-BR": "⚠️ Erro do servidor: não foi possível criar armazenamento temporário.",
-        "it": "⚠️ Errore del server: impossibile creare lo storage temporaneo.",
-        "ar": "⚠️ خطأ في الخادم: لا يمكن إنشاء وحدة تخزين مؤقتة.",
-        "hi": "⚠️ सर्वर त्रुटि: अस्थायी स्टोरेज नहीं बना सका।",
-        "tr": "⚠️ Sunucu hatası: Geçici depolama oluşturulamadı.",
-        "nl": "⚠️ Serverfout: kan tijdelijke opslag niet maken.",
-        "pl": "⚠️ Błąd serwera: nie można utworzyć tymczasowego magazynu.",
-        "sv": "⚠️ Serverfel: kan inte skapa tillfällig lagring.",
-        "fi": "⚠️ Palvelinvirhe: tilapäistä tallennustilaa ei voi luoda.",
-        "no": "⚠️ Serverfeil: kan ikke opprette midlertidig lagring.",
-        "da": "⚠️ Serverfejl: Kan ikke oprette midlertidig lager.",
-        "cs": "⚠️ Chyba serveru: Nelze vytvořit dočasné úložiště.",
-        "hu": "⚠️ Szerverhiba: nem hozható létre ideiglenes tároló.",
-        "ro": "⚠️ Eroare server: Nu se poate crea stocare temporară.",
-        "el": "⚠️ Σφάλμα διακομιστή: Δεν είναι δυνατή η δημιουργία προσωρινής αποθήκευσης.",
-        "he": "⚠️ שגיאת שרת: לא ניתן ליצור אחסון זמני.",
-        "th": "⚠️ ข้อผิดพลาดของเซิร์ฟเวอร์: ไม่สามารถสร้างที่จัดเก็บชั่วคราวได้",
-        "vi": "⚠️ Lỗi máy chủ: Không thể tạo bộ nhớ tạm thời.",
-        "id": "⚠️ Kesalahan server: Tidak dapat membuat penyimpanan sementara.",
-        "ms": "⚠️ Ralat pelayan: Tidak dapat mencipta storan sementara.",
-        "uk": "⚠️ Помилка сервера: не вдалося створити тимчасове сховище.",
-        "uz": "⚠️ Server xatosi: vaqtinchalik saqlashni yaratib bo‘lmadi.",
-        "zh-TW": "⚠️ 伺服器錯誤：無法建立暫存空間。",
-        "pt-PT": "⚠️ Erro do servidor: não foi possível criar armazenamento temporário."
-    },
     "searching_web": {
         "en": "Searching the web... 🌐",
         "es": "Buscando en la web... 🌐",
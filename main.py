@@ -33,6 +33,14 @@ try:
     from telegram.ext import ContextTypes, ApplicationBuilder, PicklePersistence
     from bot.telegram_bot import add_all_handlers, set_bot_commands
     from bot.persistence import create_persistence_instance
+    from bot.update_processor import PerChatUpdateProcessor
+    from bot.http_client import get_http_client, close_http_client
+    from bot.web_search import load_search_cache, save_search_cache
+    from bot.document_extraction import shutdown_extraction_pool
+    from bot.image_preprocessing import shutdown_image_pool
+    from bot.edit_scheduler import edit_scheduler
+    from bot.state_janitor import schedule_state_janitor, stop_state_janitor
+    from bot.context_cache import context_cache
 except (ImportError, EnvironmentError) as e:
     logger.critical(f"Failed to initialize bot components. Please check imports and .env file. Error: {e}",
                     exc_info=True)
@@ -60,12 +68,32 @@ async def post_init_tasks(application: "Application"):
 
     await set_bot_commands(application)
 
+    # Create the shared outbound HTTP client inside the running event loop
+    get_http_client()
+    # Restore hot web search results from the previous run (no-op unless WEB_SEARCH_CACHE_FILE is set)
+    load_search_cache()
+    # Periodically evict idle chats' heavy chat_data fields and enforce the state byte budgets
+    schedule_state_janitor(application)
+
     logger.info("Deleting any existing webhook to ensure a clean polling start...")
     await application.bot.delete_webhook(drop_pending_updates=True)
 
     logger.info("Post-initialization tasks complete. Bot is now ready and will start polling.")
 
 
+# --- Post-Shutdown Function for Cleanup Tasks ---
+async def post_shutdown_tasks(application: "Application"):
+    """Runs after the application has shut down; saves caches and releases shared network resources."""
+    save_search_cache()
+    await edit_scheduler.shutdown()
+    await stop_state_janitor()
+    # Delete this run's Gemini context caches instead of paying for their storage until they expire
+    await context_cache.close()
+    await close_http_client()
+    shutdown_extraction_pool()
+    shutdown_image_pool()
+
+
 def main() -> None:
     """The main function that sets up and runs the bot."""
 
@@ -85,7 +113,11 @@ def main() -> None:
         .token(os.getenv("TELEGRAM_BOT_TOKEN"))
         .persistence(persistence)
         .request(request)  # ## MODIFIED: Pass the custom request object ##
+        # Different chats are handled in parallel (up to MAX_CONCURRENT_UPDATES),
+        # while updates of the same chat still run one at a time, in order.
+        .concurrent_updates(PerChatUpdateProcessor())
         .post_init(post_init_tasks)
+        .post_shutdown(post_shutdown_tasks)
         .build()
     )
 
@@ -0,0 +1,73 @@
+import asyncio
+
+import pytest
+
+from bot.cache_utils import TTLCache, SingleFlight
+
+
+def test_ttl_cache_evicts_least_recently_used_over_byte_budget():
+    cache = TTLCache("test", ttl_seconds=60, max_entries=10, max_bytes=30, size_func=len)
+    cache.set("a", "x" * 10)
+    cache.set("b", "y" * 10)
+    cache.get("a")  # 'b' is now the least recently used entry
+    cache.set("c", "z" * 15)
+
+    assert "b" not in cache
+    assert cache.get("a") == "x" * 10
+    assert cache.total_bytes == 25
+    assert cache.snapshot()["evictions"] == 1
+
+
+def test_ttl_cache_expires_entries():
+    cache = TTLCache("test", ttl_seconds=60)
+    cache.set("gone", 1, ttl_seconds=-1)
+    assert cache.get("gone") is None
+    assert len(cache) == 0
+
+
+@pytest.mark.asyncio
+async def test_single_flight_shares_result_and_exception():
+    single_flight = SingleFlight()
+    runs = []
+
+    async def work():
+        runs.append(1)
+        await asyncio.sleep(0.01)
+        return "done"
+
+    assert await asyncio.gather(*(single_flight.do("k", work) for _ in range(3))) == ["done"] * 3
+    assert len(runs) == 1
+    assert single_flight.collapsed == 2
+
+    async def broken():
+        await asyncio.sleep(0.01)
+        raise ValueError("boom")
+
+    results = await asyncio.gather(single_flight.do("k", broken), single_flight.do("k", broken),
+                                   return_exceptions=True)
+    assert all(isinstance(r, ValueError) for r in results)
+
+
+@pytest.mark.asyncio
+async def test_cancelling_the_first_caller_does_not_cancel_the_others():
+    """
+    Tests that when the caller that started the shared work is cancelled, the work keeps
+    running and the callers still waiting on it get its result.
+    """
+    single_flight = SingleFlight()
+    release = asyncio.Event()
+
+    async def work():
+        await release.wait()
+        return "done"
+
+    owner = asyncio.create_task(single_flight.do("k", work))
+    waiter = asyncio.create_task(single_flight.do("k", work))
+    await asyncio.sleep(0)
+    owner.cancel()
+    await asyncio.sleep(0)
+    release.set()
+
+    assert await asyncio.wait_for(waiter, timeout=1) == "done"
+    assert owner.cancelled()
+    assert single_flight.collapsed == 1
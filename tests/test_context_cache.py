@@ -0,0 +1,107 @@
+import asyncio
+
+import pytest
+from unittest.mock import MagicMock, patch
+
+from bot import context_cache as context_cache_module
+from bot import gemini_utils
+from bot.context_cache import ContextCache, LocalCachedContent, DOCUMENT_ACKNOWLEDGEMENT
+
+LONG_PROMPT = "You are a helpful study assistant. " * 200  # ~1700 tokens, above the caching minimum
+
+
+async def _settle(cache: ContextCache):
+    while cache._tasks:
+        await asyncio.gather(*cache._tasks.values(), return_exceptions=True)
+
+
+@pytest.mark.asyncio
+async def test_system_prompt_cache_is_created_in_background_and_refreshed_on_use():
+    """
+    Tests that a miss goes out uncached while the cache is created, that later lookups
+    hit it, that an entry close to expiry is extended, and that small prompts are not cached.
+    """
+    cache = ContextCache(backend=LocalCachedContent)
+    kwargs = {"model": "models/gemini-2.5-flash", "system_instruction": LONG_PROMPT}
+
+    assert cache.lookup(("en",), kwargs, tokens=1700) is None
+    await _settle(cache)
+    handle = cache.lookup(("en",), kwargs, tokens=1700)
+    assert handle is not None and handle.name in LocalCachedContent.store
+    assert handle.system_instruction == LONG_PROMPT
+
+    entry = cache._entries[("en",)]
+    entry.expires_at -= entry.ttl * 0.8
+    first_expiry = handle.expire_time
+    assert cache.lookup(("en",), kwargs, tokens=1700) is handle
+    await _settle(cache)
+    assert handle.expire_time > first_expiry
+    assert entry.expires_at > entry.ttl * 0.9
+
+    assert cache.lookup(("short",), {"model": "m", "system_instruction": "Be brief."}, tokens=3) is None
+    await _settle(cache)
+
+    stats = cache.get_stats()
+    assert (stats["hits"], stats["created"], stats["refreshed"], stats["skipped_small"]) == (2, 1, 1, 1)
+    await cache.close()
+    assert handle.name not in LocalCachedContent.store
+
+
+@pytest.mark.asyncio
+async def test_documents_are_cached_on_reuse_and_released_with_the_chat():
+    """
+    Tests that a document is only cached from its second use, that the cache is deleted
+    when the last chat using it starts over, and that failed creates back off.
+    """
+    cache = ContextCache(backend=LocalCachedContent)
+    contents = [{'role': 'user', 'parts': [{'text': "article " * 1000}]}]
+    kwargs = {"model": "m", "system_instruction": LONG_PROMPT, "contents": contents}
+
+    assert cache.lookup(("doc",), kwargs, tokens=3700, document_id="article", chat_id=1) is None
+    await _settle(cache)
+    assert not cache._entries
+    assert cache.lookup(("doc",), kwargs, tokens=3700, document_id="article", chat_id=2) is None
+    await _settle(cache)
+    handle = cache.lookup(("doc",), kwargs, tokens=3700, document_id="article", chat_id=1)
+    assert handle is not None
+
+    await cache.release_chat(1)
+    assert handle.name in LocalCachedContent.store  # chat 2 still uses it
+    await cache.release_chat(2)
+    assert handle.name not in LocalCachedContent.store
+
+    failing = MagicMock()
+    failing.create.side_effect = RuntimeError("quota")
+    broken = ContextCache(backend=failing)
+    broken.lookup(("en",), {"model": "m"}, tokens=2000)
+    await _settle(broken)
+    broken.lookup(("en",), {"model": "m"}, tokens=2000)
+    await _settle(broken)
+    assert failing.create.call_count == 1
+    assert broken.get_stats()["create_failures"] == 1
+
+
+@pytest.mark.asyncio
+async def test_uncached_requests_send_the_document_as_leading_history():
+    """
+    Tests that get_context_model sends the document inline until a cache is ready and then
+    switches to a model bound to the cached content with the plain history.
+    """
+    cache = ContextCache(backend=LocalCachedContent)
+    history = [{'role': 'user', 'parts': [{'text': "hi"}]}, {'role': 'model', 'parts': [{'text': "hello"}]}]
+    with patch.object(gemini_utils, "context_cache", cache), \
+            patch.object(context_cache_module, "GEMINI_DOCUMENT_CACHE_MIN_USES", 1), \
+            patch("bot.gemini_utils.genai.GenerativeModel", side_effect=lambda *a, **k: MagicMock()), \
+            patch("bot.gemini_utils.genai.GenerativeModel.from_cached_content",
+                  side_effect=lambda content, **k: MagicMock(cached_content=content.name)):
+        _, uncached_history, key = gemini_utils.get_context_model("m", LONG_PROMPT, history, document="article")
+        assert key is None
+        assert uncached_history[1]['parts'][0]['text'] == DOCUMENT_ACKNOWLEDGEMENT
+        assert uncached_history[2:] == history
+        await _settle(cache)
+
+        model, cached_history, key = gemini_utils.get_context_model("m", LONG_PROMPT, history, document="article")
+    assert key is not None
+    assert cached_history == history
+    assert LocalCachedContent.store[model.cached_content].contents[0]['parts'][0]['text'].endswith("article")
+    await cache.close()
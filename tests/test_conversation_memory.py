@@ -0,0 +1,108 @@
+import asyncio
+
+import pytest
+from unittest.mock import AsyncMock, MagicMock, patch
+
+from bot import conversation_memory
+from bot.conversation_memory import (append_turn, get_history_for_prompt, clear_conversation, history_tokens,
+                                     HISTORY_KEY, SUMMARY_KEY, UNSUMMARIZED_KEY, CONVERSATION_ID_KEY)
+
+
+async def _wait_for_summaries():
+    while conversation_memory._summary_tasks:
+        await asyncio.gather(*conversation_memory._summary_tasks.values(), return_exceptions=True)
+
+
+@pytest.mark.asyncio
+async def test_old_turns_are_folded_into_a_summary_within_the_token_budget(monkeypatch):
+    """
+    Tests that exchanges over the token budget move out of the history oldest first, that a
+    background summary replaces them, and that the prompt history starts with that summary.
+    """
+    monkeypatch.setattr(conversation_memory, "HISTORY_TOKEN_BUDGET", 300)
+    chat_data = {}
+    application = MagicMock()
+    summarizer = AsyncMock(return_value="Talked about photosynthesis.")
+
+    with patch("bot.conversation_memory.ask_gemini_non_stream", summarizer):
+        for turn in range(5):
+            append_turn(chat_data, f"question {turn} " + "q" * 200, f"answer {turn} " + "a" * 200, 10,
+                        chat_id=7, application=application)
+            assert history_tokens(chat_data[HISTORY_KEY]) <= 300
+        await _wait_for_summaries()
+
+    assert [message['parts'][0]['text'][:10] for message in chat_data[HISTORY_KEY]] == [
+        "question 3", "answer 3 a", "question 4", "answer 4 a"]
+    assert chat_data[SUMMARY_KEY] == "Talked about photosynthesis."
+    assert chat_data[UNSUMMARIZED_KEY] == []
+    assert "question 0" in summarizer.await_args_list[0].kwargs["prompt"]
+    application.mark_data_for_update_persistence.assert_called_with(chat_ids=7)
+
+    history = get_history_for_prompt(chat_data)
+    assert [message['role'] for message in history] == ["user", "model"] * 3
+    assert "Talked about photosynthesis." in history[0]['parts'][0]['text']
+
+
+@pytest.mark.asyncio
+async def test_failed_summary_keeps_turns_queued_and_oversized_turns_are_clipped(monkeypatch):
+    """
+    Tests that a failed summary call leaves the folded turns queued for the next attempt,
+    that a single exchange larger than the budget is stored clipped, and that clearing
+    the conversation removes the summary state too.
+    """
+    monkeypatch.setattr(conversation_memory, "HISTORY_TOKEN_BUDGET", 300)
+    chat_data = {}
+
+    with patch("bot.conversation_memory.ask_gemini_non_stream",
+               AsyncMock(return_value="[AI ERROR: quota exceeded]")):
+        append_turn(chat_data, "short question", "short answer", 10, chat_id=8)
+        append_turn(chat_data, "summarize this document", "x" * 5000, 10, chat_id=8)
+        await _wait_for_summaries()
+
+    assert SUMMARY_KEY not in chat_data
+    queued = [message['parts'][0]['text'] for message in chat_data[UNSUMMARIZED_KEY]]
+    assert queued[:2] == ["short question", "short answer"]
+    assert queued[-1] == "x" * 5000
+    assert history_tokens(chat_data[HISTORY_KEY]) <= 300
+    assert chat_data[HISTORY_KEY][1]['parts'][0]['text'].endswith("[...]")
+
+    assert clear_conversation(chat_data) is True
+    assert chat_data == {CONVERSATION_ID_KEY: 1}
+
+
+@pytest.mark.asyncio
+async def test_summary_started_before_new_never_touches_the_new_conversation(monkeypatch):
+    """
+    Tests that /new cancels the chat's summary run, and that a run which still finishes
+    (e.g. it was not found to cancel) sees the new conversation id and writes nothing.
+    """
+    monkeypatch.setattr(conversation_memory, "HISTORY_TOKEN_BUDGET", 300)
+    release = asyncio.Event()
+
+    async def slow_summary(**kwargs):
+        await release.wait()
+        return "Summary of the old conversation."
+
+    with patch("bot.conversation_memory.ask_gemini_non_stream", AsyncMock(side_effect=slow_summary)):
+        chat_data = {}
+        for turn in range(3):
+            append_turn(chat_data, f"old question {turn} " + "q" * 200, "a" * 200, 10, chat_id=9)
+        await asyncio.sleep(0)  # Let the summary run start on the old turns.
+        task = conversation_memory._summary_tasks[9]
+        clear_conversation(chat_data, chat_id=9)
+        await asyncio.gather(task, return_exceptions=True)
+        assert task.cancelled()
+
+        other_chat = {}
+        for turn in range(3):
+            append_turn(other_chat, f"old question {turn} " + "q" * 200, "a" * 200, 10, chat_id=10)
+        await asyncio.sleep(0)
+        clear_conversation(other_chat)  # No chat id: the run is not cancelled and has to notice itself.
+        for turn in range(3):
+            append_turn(other_chat, f"new question {turn} " + "q" * 200, "a" * 200, 10, chat_id=10)
+        release.set()
+        await _wait_for_summaries()
+
+    assert SUMMARY_KEY not in other_chat
+    # The new conversation's folded turns are still queued for its own summary.
+    assert other_chat[UNSUMMARIZED_KEY][0]['parts'][0]['text'].startswith("new question 0")
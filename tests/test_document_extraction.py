@@ -0,0 +1,180 @@
+import os
+import asyncio
+import threading
+from contextlib import aclosing
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import fitz
+import pytest
+
+from bot import document_extraction
+from bot.document_extraction import (DocumentExtractionError, detect_document_kind, extract_document_text,
+                                     extract_text_sync, iter_pdf_pages, shutdown_extraction_pool,
+                                     TRUNCATION_NOTICE)
+
+
+def make_pdf(num_pages: int) -> bytes:
+    pdf_doc = fitz.open()
+    for page_number in range(num_pages):
+        page = pdf_doc.new_page()
+        page.insert_text((72, 72), f"Page {page_number} text")
+    data = pdf_doc.tobytes()
+    pdf_doc.close()
+    return data
+
+
+def test_detect_document_kind():
+    assert detect_document_kind("application/pdf", None) == "pdf"
+    assert detect_document_kind(None, "Notes.DOCX") == "docx"
+    assert detect_document_kind("text/plain", "notes") == "txt"
+    assert detect_document_kind("image/png", "photo.png") is None
+
+
+def test_page_and_char_budgets_truncate_text():
+    pdf_bytes = make_pdf(5)
+    text = extract_text_sync("pdf", pdf_bytes, max_pages=2)
+    assert "Page 1 text" in text and "Page 2 text" not in text
+    assert text.endswith(TRUNCATION_NOTICE)
+
+    assert extract_text_sync("txt", b"abcdefghij", max_chars=4) == "abcd" + TRUNCATION_NOTICE
+
+
+@pytest.mark.asyncio
+async def test_extraction_runs_in_process_pool(tmp_path):
+    """
+    Tests extraction from both a file path and raw bytes through the worker pool.
+    """
+    pdf_path = tmp_path / "doc.pdf"
+    pdf_path.write_bytes(make_pdf(3))
+    try:
+        from_path = await extract_document_text(str(pdf_path), "pdf")
+        from_bytes = await extract_document_text(pdf_path.read_bytes(), "pdf")
+    finally:
+        shutdown_extraction_pool()
+
+    assert from_path == from_bytes
+    assert "Page 0 text" in from_path and "Page 2 text" in from_path
+
+
+@pytest.mark.asyncio
+async def test_parallel_pdf_pages_stream_in_order(monkeypatch):
+    """
+    Tests that a PDF split across several page ranges streams its pages in order and
+    joins to the same text as the serial extraction.
+    """
+    monkeypatch.setattr(document_extraction, "PDF_MIN_PAGES_PER_TASK", 2)
+    pdf_bytes = make_pdf(9)
+    try:
+        pages = [(page_number, page_count) async for page_number, page_count, _ in iter_pdf_pages(pdf_bytes)]
+        parallel_text = await extract_document_text(pdf_bytes, "pdf")
+        truncated_text = await extract_document_text(pdf_bytes, "pdf", max_pages=4)
+    finally:
+        shutdown_extraction_pool()
+
+    assert pages == [(page_number, 9) for page_number in range(9)]
+    assert parallel_text == extract_text_sync("pdf", pdf_bytes)
+    assert "Page 3 text" in truncated_text and "Page 4 text" not in truncated_text
+    assert truncated_text.endswith(TRUNCATION_NOTICE)
+
+
+@pytest.mark.asyncio
+async def test_pdf_bytes_are_written_once_and_tasks_get_the_path(monkeypatch):
+    """
+    Tests that the page-range tasks receive the path of one temporary copy of the PDF
+    instead of its bytes, and that the copy is removed, also when the reader stops early.
+    """
+    monkeypatch.setattr(document_extraction, "PDF_MIN_PAGES_PER_TASK", 2)
+    sources = []
+
+    class RecordingPool(ThreadPoolExecutor):
+        def submit(self, fn, *args, **kwargs):
+            sources.append(args[0])
+            return super().submit(fn, *args, **kwargs)
+
+    pool = RecordingPool(max_workers=2)
+    monkeypatch.setattr(document_extraction, "get_extraction_pool", lambda: pool)
+    pdf_bytes = make_pdf(9)
+    try:
+        pages = [page_number async for page_number, _, _ in iter_pdf_pages(pdf_bytes)]
+        async with aclosing(iter_pdf_pages(pdf_bytes)) as reader:
+            async for _ in reader:
+                break
+    finally:
+        pool.shutdown()
+
+    assert pages == list(range(9))
+    assert all(isinstance(source, str) for source in sources)
+    assert len(set(sources)) == 2 and not any(os.path.exists(source) for source in sources)
+
+
+@pytest.mark.asyncio
+async def test_overrun_kills_the_pool_but_other_documents_are_retried(monkeypatch):
+    """
+    Tests that when one extraction overruns and the pool is killed to stop it, a PDF whose
+    pages were being extracted on the same pool is finished on a fresh pool instead of
+    failing, while the overrunning extraction still times out.
+    """
+    monkeypatch.setattr(document_extraction, "PDF_MIN_PAGES_PER_TASK", 2)
+    monkeypatch.setattr(document_extraction, "WORKER_GRACE_SECONDS", 0)
+
+    class StuckPool:
+        """Only page counts finish; killing the pool breaks every job still on it."""
+
+        def __init__(self):
+            self.held = []
+
+        def submit(self, fn, *args):
+            future = Future()
+            if fn is document_extraction._count_pdf_pages:
+                future.set_result(fn(*args))
+            else:
+                self.held.append(future)
+            return future
+
+        def shutdown(self, wait=True, cancel_futures=False):
+            for future in self.held:
+                if not future.done():
+                    future.set_exception(BrokenProcessPool("worker terminated"))
+
+    stuck = StuckPool()
+    monkeypatch.setattr(document_extraction, "_pool", stuck)
+    monkeypatch.setattr(document_extraction, "ProcessPoolExecutor", lambda **kwargs: ThreadPoolExecutor(2))
+    pdf_bytes = make_pdf(9)
+    try:
+        pdf_task = asyncio.create_task(extract_document_text(pdf_bytes, "pdf", timeout=5))
+        while not stuck.held:  # All page ranges are submitted at once.
+            await asyncio.sleep(0.01)
+        with pytest.raises(DocumentExtractionError):
+            await extract_document_text(b"stuck", "txt", timeout=0.01)
+        pdf_text = await asyncio.wait_for(pdf_task, timeout=5)
+    finally:
+        shutdown_extraction_pool()
+
+    assert pdf_text == extract_text_sync("pdf", pdf_bytes)
+
+
+@pytest.mark.asyncio
+async def test_cancelled_extraction_is_dropped_from_the_queue(monkeypatch):
+    """
+    Tests that cancelling an extraction that is still waiting for a worker removes its
+    job from the pool's queue, so an abandoned upload never takes a worker.
+    """
+    pool = ThreadPoolExecutor(max_workers=1)
+    monkeypatch.setattr(document_extraction, "get_extraction_pool", lambda: pool)
+    ran = []
+    monkeypatch.setattr(document_extraction, "extract_text_sync", lambda *args: ran.append(args) or "text")
+    release = threading.Event()
+    try:
+        pool.submit(release.wait)  # Keeps the only worker busy.
+        task = asyncio.create_task(extract_document_text(b"queued", "txt"))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        release.set()
+    finally:
+        release.set()
+        pool.shutdown(wait=True)
+
+    assert ran == []
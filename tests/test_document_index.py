@@ -0,0 +1,38 @@
+import pickle
+
+from bot.document_index import DocumentIndex, chunk_text, group_chunks
+
+
+def test_chunk_text_packs_paragraphs_and_splits_long_ones():
+    text = "First paragraph.\n\nSecond paragraph.\n\n" + "x" * 250
+    chunks = chunk_text(text, chunk_chars=100, overlap=20)
+
+    assert chunks[0] == "First paragraph.\n\nSecond paragraph."
+    assert all(len(chunk) <= 100 for chunk in chunks)
+    # The long paragraph is cut with overlap, so nothing is lost.
+    assert sum(len(chunk) for chunk in chunks[1:]) >= 250
+    assert group_chunks(["a" * 40, "b" * 40, "c" * 40], max_chars=90) == ["a" * 40 + "\n\n" + "b" * 40, "c" * 40]
+
+
+def test_bm25_ranks_relevant_chunks_and_survives_pickling():
+    """
+    Tests that retrieval returns the matching chunks in document order, and that a
+    pickled index (as stored in chat_data) only keeps its chunks and still works.
+    """
+    chunks = [
+        "Photosynthesis converts light energy into chemical energy in chloroplasts.",
+        "The French Revolution began in 1789.",
+        "Mitochondria produce ATP through cellular respiration.",
+        "Chloroplasts contain chlorophyll, which absorbs light.",
+    ]
+    index = DocumentIndex("biology.pdf", chunks)
+
+    hits = index.search("How do chloroplasts use light?", k=2)
+    assert {chunk_index for chunk_index, _ in hits} == {0, 3}
+    assert index.top_chunks("How do chloroplasts use light?", k=2) == [chunks[0], chunks[3]]
+    assert index.top_chunks("zzz", k=1) == [chunks[0]]
+    assert index.top_chunks("zzz", k=1, fallback_to_start=False) == []
+
+    restored = pickle.loads(pickle.dumps(index))
+    assert restored.__dict__["_term_freqs"] == []
+    assert restored.top_chunks("When did the revolution begin?", k=1) == [chunks[1]]
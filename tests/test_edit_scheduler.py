@@ -0,0 +1,209 @@
+import time
+import asyncio
+
+import pytest
+from unittest.mock import AsyncMock, MagicMock
+from telegram.error import BadRequest, RetryAfter
+
+from bot.edit_scheduler import EditScheduler
+
+
+def make_bot():
+    bot = MagicMock()
+    bot.sent = []
+
+    async def edit_message_text(text, chat_id, message_id, parse_mode=None, entities=None):
+        bot.sent.append((chat_id, text, parse_mode, time.monotonic()))
+
+    bot.edit_message_text = AsyncMock(side_effect=edit_message_text)
+    return bot
+
+
+@pytest.mark.asyncio
+async def test_edits_are_coalesced_to_the_latest_text():
+    """
+    Tests that a burst of stream chunks becomes a few edits that always end on the
+    newest text, and that the per-chat rate is respected after the initial burst.
+    """
+    scheduler = EditScheduler(global_rate=30, chat_rate=10, chat_burst=1)
+    bot = make_bot()
+
+    for i in range(50):
+        scheduler.schedule_edit(bot, 1, 100, f"text {i}")
+        await asyncio.sleep(0.005)
+    await asyncio.sleep(0.2)
+    await scheduler.finish(1, 100)
+
+    texts = [text for _, text, _, _ in bot.sent]
+    assert texts[-1] == "text 49"
+    assert len(texts) <= 5
+    assert scheduler.stats["edits_coalesced"] >= 40
+    gaps = [later[3] - earlier[3] for earlier, later in zip(bot.sent, bot.sent[1:])]
+    assert all(gap >= 0.09 for gap in gaps)
+
+
+@pytest.mark.asyncio
+async def test_rendered_edits_are_only_rendered_when_sent():
+    """
+    Tests that a stream passing a render callable pays for rendering once per edit sent,
+    not once per chunk, and that the latest text is the one rendered.
+    """
+    scheduler = EditScheduler(global_rate=30, chat_rate=10, chat_burst=1)
+    bot = make_bot()
+    rendered = []
+
+    def render(raw):
+        rendered.append(raw)
+        return raw.upper(), []
+
+    for i in range(50):
+        scheduler.schedule_edit(bot, 1, 100, render=lambda raw=f"text {i}": render(raw))
+        await asyncio.sleep(0.005)
+    await asyncio.sleep(0.2)
+    await scheduler.finish(1, 100)
+
+    assert [text for _, text, _, _ in bot.sent][-1] == "TEXT 49"
+    assert len(rendered) == len(bot.sent) <= 5
+
+
+@pytest.mark.asyncio
+async def test_skipped_and_failed_edits_do_not_stall_the_stream():
+    """
+    Tests that an edit whose text is unchanged does not spend the chat's token, and that a
+    render callback that raises is counted while later edits of the message are still sent.
+    """
+    scheduler = EditScheduler(global_rate=30, chat_rate=10, chat_burst=1)
+    bot = make_bot()
+
+    def broken_render():
+        raise ValueError("bad chunk")
+
+    scheduler.schedule_edit(bot, 1, 100, "same")
+    await asyncio.sleep(0.01)
+    scheduler.schedule_edit(bot, 1, 100, "same")
+    await asyncio.sleep(0.15)
+    assert scheduler.stats["edits_skipped_unchanged"] == 1
+    scheduler.schedule_edit(bot, 1, 100, "next")
+    scheduled_at = time.monotonic()
+    await asyncio.sleep(0.01)
+    assert bot.sent[-1][1] == "next"
+    assert bot.sent[-1][3] - scheduled_at < 0.05
+
+    scheduler.schedule_edit(bot, 1, 100, render=broken_render)
+    await asyncio.sleep(0.15)
+    scheduler.schedule_edit(bot, 1, 100, "after the error")
+    await asyncio.sleep(0.15)
+    await scheduler.finish(1, 100)
+
+    assert scheduler.stats["edit_errors"] == 1
+    assert [text for _, text, _, _ in bot.sent] == ["same", "next", "after the error"]
+
+
+@pytest.mark.asyncio
+async def test_retry_after_pauses_every_chat():
+    """
+    Tests that a flood-control error in one chat holds back edits in other chats and
+    that the interrupted edit is resent after the pause.
+    """
+    scheduler = EditScheduler(global_rate=30, chat_rate=10, chat_burst=2)
+    bot = make_bot()
+    real_edit = bot.edit_message_text.side_effect
+    calls = {"count": 0}
+
+    async def flood_once(text, chat_id, message_id, parse_mode=None, entities=None):
+        calls["count"] += 1
+        if calls["count"] == 1:
+            raise RetryAfter(1)
+        await real_edit(text, chat_id, message_id, parse_mode)
+
+    bot.edit_message_text.side_effect = flood_once
+    start = time.monotonic()
+    scheduler.schedule_edit(bot, 1, 100, "chat one")
+    await asyncio.sleep(0.05)
+    scheduler.schedule_edit(bot, 2, 200, "chat two")
+    await asyncio.sleep(1.2)
+
+    assert sorted(text for _, text, _, _ in bot.sent) == ["chat one", "chat two"]
+    assert all(sent_at - start >= 0.95 for _, _, _, sent_at in bot.sent)
+    assert scheduler.stats["retry_after"] == 1
+
+
+@pytest.mark.asyncio
+async def test_markdown_parse_error_falls_back_to_plain_text():
+    scheduler = EditScheduler(global_rate=30, chat_rate=10, chat_burst=2)
+    bot = make_bot()
+    real_edit = bot.edit_message_text.side_effect
+
+    async def reject_markdown(text, chat_id, message_id, parse_mode=None, entities=None):
+        if parse_mode:
+            raise BadRequest("Can't parse entities: can't find end of bold entity")
+        await real_edit(text, chat_id, message_id, parse_mode)
+
+    bot.edit_message_text.side_effect = reject_markdown
+    on_parse_error = MagicMock()
+    scheduler.schedule_edit(bot, 1, 100, "*bold*", parse_mode="MarkdownV2",
+                            fallback=lambda: "bold", on_parse_error=on_parse_error)
+    await asyncio.sleep(0.3)
+    await scheduler.finish(1, 100)
+
+    assert [(text, parse_mode) for _, text, parse_mode, _ in bot.sent] == [("bold", None)]
+    on_parse_error.assert_called_once()
+    assert scheduler.stats["parse_fallbacks"] == 1
+
+
+@pytest.mark.asyncio
+async def test_many_streaming_chats_stay_under_the_flood_limit():
+    """
+    Load test: 20 chats stream at once against a fake Telegram that answers RetryAfter
+    when a chat edits faster than its limit. The scheduler should never trigger it,
+    while still giving every chat close to its full edit rate.
+    """
+    chat_rate = 20
+    scheduler = EditScheduler(global_rate=1000, chat_rate=chat_rate, chat_burst=1)
+    last_edit = {}
+    edits = {}
+
+    async def telegram(text, chat_id, message_id, parse_mode=None, entities=None):
+        now = time.monotonic()
+        # Only edits clearly above the chat's rate count: the scheduler spaces its sends on
+        # its own clock, and timer jitter can bring two of them a few milliseconds closer here.
+        if now - last_edit.get(chat_id, 0) < 0.5 / chat_rate:
+            raise RetryAfter(1)
+        last_edit[chat_id] = now
+        edits[chat_id] = edits.get(chat_id, 0) + 1
+
+    bot = MagicMock()
+    bot.edit_message_text = AsyncMock(side_effect=telegram)
+
+    async def stream(chat_id):
+        for i in range(100):
+            scheduler.schedule_edit(bot, chat_id, 1, f"chunk {i}")
+            await asyncio.sleep(0.01)
+        await scheduler.finish(chat_id, 1)
+
+    await asyncio.gather(*(stream(chat_id) for chat_id in range(1, 21)))
+
+    assert scheduler.stats["retry_after"] == 0
+    # ~1 s of streaming at 20 edits/s per chat.
+    assert all(count >= 12 for count in edits.values())
+    assert len(edits) == 20
+
+
+@pytest.mark.asyncio
+async def test_invalid_markdown_is_sent_as_plain_text_without_a_failed_call():
+    """
+    Tests that an edit the local MarkdownV2 validator predicts Telegram would reject
+    goes out as its plain-text fallback in a single API call.
+    """
+    scheduler = EditScheduler(global_rate=30, chat_rate=10, chat_burst=2)
+    bot = make_bot()
+    on_parse_error = MagicMock()
+    scheduler.schedule_edit(bot, 1, 100, "2 * 3 \\= 6", parse_mode="MarkdownV2",
+                            fallback=lambda: "2 * 3 = 6", on_parse_error=on_parse_error)
+    await asyncio.sleep(0.1)
+    await scheduler.finish(1, 100)
+
+    assert [(text, parse_mode) for _, text, parse_mode, _ in bot.sent] == [("2 * 3 = 6", None)]
+    assert bot.edit_message_text.await_count == 1
+    on_parse_error.assert_called_once()
+    assert scheduler.stats["parse_failures_avoided"] == 1
@@ -0,0 +1,65 @@
+import asyncio
+
+import pytest
+
+from bot import gemini_admission as admission_module
+from bot.gemini_admission import GeminiAdmissionController, GeminiOverloadedError, Priority
+
+
+@pytest.mark.asyncio
+async def test_queued_requests_are_admitted_by_priority_when_the_window_frees(monkeypatch):
+    """
+    Tests that requests beyond the RPM budget queue with an ETA and that, once the window
+    frees up, interactive work is admitted before earlier-queued URL work.
+    """
+    monkeypatch.setattr(admission_module, "QUOTA_WINDOW_SECONDS", 0.2)
+    controller = GeminiAdmissionController(rpm=2, tpm=1_000_000)
+
+    assert not controller.request("m", Priority.URL, 100).queued
+    assert not controller.request("m", Priority.URL, 100).queued
+    url_ticket = controller.request("m", Priority.URL, 100)
+    chat_ticket = controller.request("m", Priority.INTERACTIVE, 100)
+    assert url_ticket.queued and chat_ticket.queued
+    assert 0 < chat_ticket.eta <= 0.2
+
+    admitted = []
+
+    async def wait(name, ticket):
+        await ticket.wait()
+        admitted.append(name)
+
+    await asyncio.wait_for(asyncio.gather(wait("url", url_ticket), wait("chat", chat_ticket)), timeout=2)
+    assert admitted == ["chat", "url"]
+    stats = controller.get_stats()
+    assert (stats["admitted"], stats["queued"], stats["queue_depth"]) == (4, 2, 0)
+
+
+@pytest.mark.asyncio
+async def test_low_priority_work_is_shed_first_and_quota_errors_pause_the_model(monkeypatch):
+    """
+    Tests that a request whose ETA exceeds its priority's max wait is rejected, that urgent
+    work sheds the queued background work it delays past its deadline, and that a reported
+    quota error holds back new requests.
+    """
+    monkeypatch.setitem(admission_module.MAX_QUEUE_WAIT_SECONDS, Priority.INTERACTIVE, 200.0)
+    monkeypatch.setitem(admission_module.MAX_QUEUE_WAIT_SECONDS, Priority.BACKGROUND, 90.0)
+    monkeypatch.setitem(admission_module.MAX_QUEUE_WAIT_SECONDS, Priority.URL, 10.0)
+    controller = GeminiAdmissionController(rpm=1, tpm=1_000_000)
+
+    controller.request("m", Priority.INTERACTIVE, 100)
+    background = controller.request("m", Priority.BACKGROUND, 100)  # ETA ~60s, within its 90s
+    chat = controller.request("m", Priority.INTERACTIVE, 100)  # Goes first, pushing background to ~120s
+    with pytest.raises(GeminiOverloadedError):
+        await background.wait()
+    with pytest.raises(GeminiOverloadedError):
+        controller.request("m", Priority.URL, 100)
+    chat.cancel()
+    assert controller.get_stats()["shed"] == 2
+    assert controller.get_stats()["queue_depth"] == 0
+
+    paused = GeminiAdmissionController(rpm=100, tpm=1_000_000)
+    paused.report_quota_exceeded("m", 30.0)
+    ticket = paused.request("m", Priority.INTERACTIVE, 100)
+    assert ticket.queued and 29 < ticket.eta <= 30
+    ticket.cancel()
+    assert paused.request("other-model", Priority.INTERACTIVE, 100).queued is False
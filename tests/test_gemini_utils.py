@@ -0,0 +1,47 @@
+from unittest.mock import MagicMock, patch
+
+from bot import gemini_utils
+from bot.gemini_utils import get_cached_model, get_model_cache_stats, clear_model_cache, web_search_tool
+
+
+def test_model_registry_reuses_models_for_same_settings():
+    """
+    Tests that identical model settings hit the cache and that a different
+    system prompt builds a new model.
+    """
+    clear_model_cache()
+    with patch("bot.gemini_utils.genai.GenerativeModel", side_effect=lambda *a, **k: MagicMock()) as mock_model:
+        first = get_cached_model("models/gemini-2.5-flash", system_prompt="Answer in English.",
+                                 tools=[web_search_tool], tool_config={"function_calling_config": {"mode": "auto"}})
+        second = get_cached_model("models/gemini-2.5-flash", system_prompt="Answer in English.",
+                                  tools=[web_search_tool], tool_config={"function_calling_config": {"mode": "auto"}})
+        third = get_cached_model("models/gemini-2.5-flash", system_prompt="Answer in German.")
+
+    assert first is second
+    assert third is not first
+    assert mock_model.call_count == 2
+
+    stats = get_model_cache_stats()
+    assert stats["hits"] == 1
+    assert stats["misses"] == 2
+    assert stats["size"] == 2
+
+
+def test_model_registry_evicts_least_recently_used():
+    """
+    Tests that the registry never grows past its size limit and evicts the
+    least recently used model first.
+    """
+    clear_model_cache()
+    with patch.object(gemini_utils, "GEMINI_MODEL_CACHE_SIZE", 2), \
+            patch("bot.gemini_utils.genai.GenerativeModel", side_effect=lambda *a, **k: MagicMock()):
+        model_a = get_cached_model("model-a", system_prompt="prompt")
+        get_cached_model("model-b", system_prompt="prompt")
+        assert get_cached_model("model-a", system_prompt="prompt") is model_a  # 'a' is now most recent
+        get_cached_model("model-c", system_prompt="prompt")  # evicts 'b'
+        assert get_cached_model("model-a", system_prompt="prompt") is model_a
+
+    stats = get_model_cache_stats()
+    assert stats["size"] == 2
+    assert stats["evictions"] == 1
+    clear_model_cache()
@@ -1,7 +1,20 @@
+import io
+import asyncio
+from types import SimpleNamespace
+
 import pytest
 from unittest.mock import MagicMock, patch, AsyncMock
+from PIL import Image
 
-from bot.telegram_bot import set_subject_command, _core_ai_handler
+from bot import gemini_utils
+from bot.context_cache import ContextCache, LocalCachedContent
+from bot.document_index import DocumentIndex
+from bot.edit_scheduler import EditScheduler
+from bot.markdown_entities import utf16_len
+from bot.media_download import DownloadedMedia
+from bot.telegram_bot import (set_subject_command, handle_document, _core_ai_handler, _process_document_follow_up,
+                              _process_image, _process_url, _process_url_follow_up, _url_follow_up_pending,
+                              _DocumentSectionMapper, DOC_MAP_SECTION_CHARS)
 
 @pytest.mark.asyncio
 async def test_set_subject_modifies_prompt():
@@ -51,4 +64,257 @@ async def test_set_subject_modifies_prompt():
         expected_end = "Tell me about the uncertainty principle."
 
         assert prompt_sent_to_ai.startswith(expected_start)
-        assert prompt_sent_to_ai.endswith(expected_end)
\ No newline at end of file
+        assert prompt_sent_to_ai.endswith(expected_end)
+
+@pytest.mark.asyncio
+async def test_document_follow_up_sends_only_relevant_chunks():
+    """
+    Verifies that a question about an uploaded document sends the matching chunks,
+    not the whole document, and that unrelated questions fall through.
+    """
+    chunks = [f"Chapter {number}: filler text about topic {number}." for number in range(50)]
+    chunks[37] = "Chapter 37: the Krebs cycle takes place in the mitochondrial matrix."
+
+    update = MagicMock()
+    context = MagicMock()
+    context.user_data = {}
+    context.chat_data = {'document_index': DocumentIndex("notes.pdf", chunks)}
+
+    with patch("bot.telegram_bot._core_ai_handler", new_callable=AsyncMock) as mock_core:
+        update.message.text = "Where does the Krebs cycle happen?"
+        assert await _process_document_follow_up(update, context) is True
+        prompt_sent_to_ai = mock_core.call_args[0][2]
+
+        update.message.text = "Thanks!"
+        assert await _process_document_follow_up(update, context) is False
+
+    assert "mitochondrial matrix" in prompt_sent_to_ai
+    assert "topic 3." not in prompt_sent_to_ai
+    mock_core.assert_called_once()
+
+@pytest.mark.asyncio
+async def test_unrelated_reply_is_not_routed_to_the_document():
+    """
+    Verifies that a question sharing only function words ("is", "a", "in") or a word found
+    all over the document is not answered from the document.
+    """
+    chunks = [f"Section {number}: photosynthesis in plants, part {number}." for number in range(20)]
+    chunks[5] = "Section 5: photosynthesis is a process in chloroplasts that turns light into sugar."
+
+    update = MagicMock()
+    context = MagicMock()
+    context.user_data = {}
+    context.chat_data = {'document_index': DocumentIndex("biology.pdf", chunks)}
+
+    with patch("bot.telegram_bot._core_ai_handler", new_callable=AsyncMock) as mock_core:
+        for question in ("What is a derivative in calculus?", "Can you explain derivatives of plants in economics?"):
+            update.message.text = question
+            assert await _process_document_follow_up(update, context) is False
+
+        update.message.text = "What do chloroplasts turn light into?"
+        assert await _process_document_follow_up(update, context) is True
+
+    mock_core.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_document_sections_are_summarized_while_pages_arrive():
+    """
+    Verifies the map step starts a section summary as soon as enough pages arrived,
+    summarizes the rest after extraction, and keeps raw text for a failed section.
+    """
+    page = "word " * (DOC_MAP_SECTION_CHARS // 5)
+    summaries = iter(["Summary one.", "[AI ERROR: Could not generate a response. Details: quota]"])
+
+    with patch("bot.telegram_bot.ask_gemini_non_stream", new_callable=AsyncMock) as mock_ask:
+        mock_ask.side_effect = lambda *args, **kwargs: next(summaries)
+        mapper = _DocumentSectionMapper("notes.pdf", "English")
+        mapper.add_page(page)
+        assert mapper.started
+
+        mapper.add_remainder(page + "Tail paragraph.")
+        section_summaries = await mapper.gather()
+
+    assert mock_ask.call_count == 2
+    assert section_summaries[0] == "Summary one."
+    assert section_summaries[1].startswith("Tail paragraph.")
+
+
+@pytest.mark.asyncio
+async def test_vision_answer_is_visible_before_the_stream_ends():
+    """
+    Verifies that image answers are streamed through the edit scheduler, so the first
+    part is on screen while Gemini is still writing, and that the wait is recorded.
+    """
+    scheduler = EditScheduler(global_rate=100, chat_rate=100, chat_burst=5)
+    visible_mid_stream = []
+
+    png = io.BytesIO()
+    Image.new("RGB", (4, 4)).save(png, format="PNG")
+
+    async def vision_stream(**kwargs):
+        yield "Part one. "
+        await asyncio.sleep(0.1)
+        visible_mid_stream.extend(call.args[0] for call in context.bot.edit_message_text.call_args_list)
+        yield "Part two."
+
+    update = MagicMock()
+    context = MagicMock()
+    context.user_data = {}
+    context.chat_data = {}
+    update.effective_chat.id = 42
+    context.bot.edit_message_text = AsyncMock()
+    placeholder = MagicMock(message_id=7)
+    placeholder.edit_text = AsyncMock()
+    update.message.reply_text = AsyncMock(return_value=placeholder)
+
+    with patch("bot.telegram_bot.edit_scheduler", scheduler), \
+            patch("bot.telegram_bot.download_telegram_file", return_value=DownloadedMedia(png, spilled=False)), \
+            patch("bot.telegram_bot.ask_gemini_vision_stream", side_effect=vision_stream):
+        await _process_image(update, context, "file-1", "What is this?")
+
+    assert visible_mid_stream == ["Part one."]
+    assert placeholder.edit_text.call_args.args[0] == "Part one. Part two."
+    assert scheduler.snapshot()["first_visible"]["image"]["count"] == 1
+
+
+@pytest.mark.asyncio
+async def test_long_vision_answer_keeps_the_visible_part_and_continues_below():
+    """
+    Verifies that once an image answer outgrows one message, the placeholder keeps the
+    part already shown and only the rest is sent as new messages.
+    """
+    scheduler = EditScheduler(global_rate=100, chat_rate=100, chat_burst=5)
+    first_part, second_part = "First paragraph. " * 150, "Second paragraph. " * 150
+
+    png = io.BytesIO()
+    Image.new("RGB", (4, 4)).save(png, format="PNG")
+
+    async def vision_stream(**kwargs):
+        yield first_part
+        yield second_part
+
+    update = MagicMock()
+    context = MagicMock()
+    context.user_data = {}
+    context.chat_data = {}
+    update.effective_chat.id = 42
+    context.bot.edit_message_text = AsyncMock()
+    placeholder = MagicMock(message_id=7)
+    placeholder.edit_text = AsyncMock()
+    update.message.reply_text = AsyncMock(return_value=placeholder)
+
+    with patch("bot.telegram_bot.edit_scheduler", scheduler), \
+            patch("bot.telegram_bot.download_telegram_file", return_value=DownloadedMedia(png, spilled=False)), \
+            patch("bot.telegram_bot.ask_gemini_vision_stream", side_effect=vision_stream), \
+            patch("bot.telegram_bot.send_long_message_fallback", AsyncMock()) as send_rest:
+        await _process_image(update, context, "file-1", "What is this?")
+
+    assert placeholder.edit_text.call_args.args[0] == first_part.strip()
+    send_rest.assert_awaited_once()
+    assert send_rest.call_args.args[2] == second_part.strip()
+
+
+@pytest.mark.asyncio
+async def test_document_analysis_streams_formatted_and_within_the_utf16_limit():
+    """
+    Verifies that a document analysis is streamed through the entity renderer like chat
+    answers, and that the preview is cut at Telegram's limit counted in UTF-16 units, so
+    emoji-heavy text is never sent too long.
+    """
+    scheduler = EditScheduler(global_rate=100, chat_rate=100, chat_burst=5)
+
+    async def analysis_stream(*args, **kwargs):
+        yield "*Summary*\n" + "😀" * 3000
+        await asyncio.sleep(0.05)
+
+    update = MagicMock()
+    context = MagicMock()
+    context.user_data = {}
+    context.chat_data = {}
+    update.effective_chat.id = 42
+    update.message.document = MagicMock(file_name="notes.txt", mime_type="text/plain", file_unique_id="u1")
+    context.bot.edit_message_text = AsyncMock()
+    placeholder = MagicMock(message_id=7)
+    placeholder.edit_text = AsyncMock()
+    placeholder.delete = AsyncMock()
+    update.message.reply_text = AsyncMock(return_value=placeholder)
+
+    with patch("bot.telegram_bot.edit_scheduler", scheduler), \
+            patch("bot.telegram_bot.get_processed_media", AsyncMock(return_value="Cell biology notes.")), \
+            patch("bot.telegram_bot.ask_gemini_stream", side_effect=analysis_stream), \
+            patch("bot.telegram_bot.send_long_message_fallback", AsyncMock()), \
+            patch("bot.telegram_bot.append_turn"):
+        await handle_document(update, context)
+
+    edit = context.bot.edit_message_text.call_args
+    assert edit.args[0].startswith("Summary\n😀")
+    assert utf16_len(edit.args[0]) <= 4096 < len(edit.args[0]) * 2
+    assert [(entity.type, entity.offset, entity.length) for entity in edit.kwargs["entities"]] == [("bold", 0, 7)]
+
+
+@pytest.mark.asyncio
+async def test_link_is_cached_by_gemini_once_a_follow_up_reuses_it():
+    """
+    Runs a link summary and two follow-up questions through the real Gemini call paths and
+    verifies that the article counts as reused across the two, so the second follow-up is
+    served from a context cache holding the same text the summary was made from.
+    """
+    article = "Cells turn glucose into ATP during cellular respiration. " * 200
+    cache = ContextCache(backend=LocalCachedContent)
+    calls = []
+
+    class FakeStream:
+        def __init__(self, text):
+            self.chunks = [SimpleNamespace(parts=[], text=text)]
+
+        def __aiter__(self):
+            return self._iterate()
+
+        async def _iterate(self):
+            for chunk in self.chunks:
+                yield chunk
+
+        async def resolve(self):
+            pass
+
+    def fake_model(cached_content=None):
+        async def send_message_async(content, stream=False):
+            calls.append(cached_content)
+            return FakeStream("Answer.") if stream else SimpleNamespace(text="Summary.")
+        session = MagicMock(send_message_async=send_message_async)
+        return MagicMock(start_chat=MagicMock(return_value=session))
+
+    update = MagicMock()
+    context = MagicMock()
+    context.user_data = {}
+    context.chat_data = {}
+    update.effective_chat.id = 42
+    placeholder = MagicMock(message_id=7, text="")
+    placeholder.edit_text = AsyncMock()
+    placeholder.delete = AsyncMock()
+    update.message.reply_text = AsyncMock(return_value=placeholder)
+
+    gemini_utils.clear_model_cache()
+    with patch.object(gemini_utils, "context_cache", cache), \
+            patch("bot.gemini_utils.genai.GenerativeModel", side_effect=lambda *a, **k: fake_model()), \
+            patch("bot.gemini_utils.genai.GenerativeModel.from_cached_content",
+                  side_effect=lambda content, **k: fake_model(content.name)), \
+            patch("bot.telegram_bot.edit_scheduler", EditScheduler(global_rate=100, chat_rate=100, chat_burst=5)), \
+            patch("bot.telegram_bot.fetch_page_text", AsyncMock(return_value=article)), \
+            patch("bot.telegram_bot.send_long_message_fallback", AsyncMock()):
+        await _process_url(update, context, "https://example.com/respiration")
+        for question in ("Where is ATP made?", "What does glucose turn into?"):
+            update.message.text = question
+            assert _url_follow_up_pending(context.chat_data)
+            await _process_url_follow_up(update, context)
+            await asyncio.gather(*cache._tasks.values())
+    gemini_utils.clear_model_cache()
+
+    # Summary draft, critic, first follow-up (uncached, starts the cache), second follow-up (cached).
+    assert calls[:3] == [None, None, None]
+    cached_name = calls[3]
+    assert cached_name is not None
+    cached = LocalCachedContent.store[cached_name]
+    assert cached.contents[0]['parts'][0]['text'] == f"Reference document:\n\n{article}"
+    await cache.close()
@@ -0,0 +1,112 @@
+import asyncio
+
+import pytest
+
+from bot import hedging
+from bot.gemini_admission import GeminiAdmissionController, Priority
+from bot.hedging import HedgePolicy, hedged_first_chunk
+
+
+def test_hedge_deadline_follows_the_latency_percentile(monkeypatch):
+    """
+    Tests that the default delay is used until enough first-chunk latencies are known, and
+    that the deadline then tracks the configured percentile, floored at the minimum delay.
+    """
+    monkeypatch.setattr(hedging, "HEDGE_MIN_SAMPLES", 10)
+    monkeypatch.setattr(hedging, "GEMINI_HEDGE_PERCENTILE", 90.0)
+    monkeypatch.setattr(hedging, "GEMINI_HEDGE_MIN_DELAY_SECONDS", 2.0)
+    policy = HedgePolicy()
+
+    for latency in range(1, 10):
+        policy.record("m", float(latency))
+    assert policy.deadline("m") == hedging.GEMINI_HEDGE_DEFAULT_DELAY_SECONDS
+
+    policy.record("m", 10.0)
+    assert policy.deadline("m") == 10.0
+    for _ in range(90):
+        policy.record("m", 0.5)
+    assert policy.deadline("m") == 2.0
+
+    monkeypatch.setattr(hedging, "GEMINI_HEDGING", False)
+    assert policy.deadline("m") is None
+
+
+@pytest.mark.asyncio
+async def test_slow_first_chunk_is_hedged_only_when_the_quota_has_room(monkeypatch):
+    """
+    Tests that a duplicate request is sent once the deadline passes, that the faster one
+    wins and the slower one is cancelled, and that no hedge is sent when it would need quota
+    other callers are waiting for.
+    """
+    monkeypatch.setattr(hedging, "GEMINI_HEDGE_DEFAULT_DELAY_SECONDS", 0.05)
+    monkeypatch.setattr(hedging, "hedge_policy", HedgePolicy())
+    delays = [1.0, 0.01]
+    cancelled = []
+
+    async def start():
+        delay = delays.pop(0)
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            cancelled.append(delay)
+            raise
+        return delay
+
+    monkeypatch.setattr(hedging, "gemini_admission", GeminiAdmissionController(rpm=10, tpm=1_000_000))
+    assert await asyncio.wait_for(hedged_first_chunk(start, "m", 100), timeout=2) == 0.01
+    await asyncio.sleep(0)
+    assert cancelled == [1.0]
+
+    busy = GeminiAdmissionController(rpm=1, tpm=1_000_000)
+    busy.request("m", Priority.INTERACTIVE, 100)
+    monkeypatch.setattr(hedging, "gemini_admission", busy)
+    delays[:] = [0.2, 0.01]
+    assert await asyncio.wait_for(hedged_first_chunk(start, "m", 100), timeout=2) == 0.2
+
+    stats = hedging.hedge_policy.get_stats()
+    assert (stats["hedges_sent"], stats["hedge_wins"], stats["skipped_for_budget"]) == (1, 1, 1)
+
+
+@pytest.mark.asyncio
+async def test_losing_stream_is_closed_and_a_cancelled_request_is_not_fatal(monkeypatch):
+    """
+    Tests that when both requests deliver their first chunk together, the one not returned
+    has its stream closed, and that a request that ends up cancelled on its own does not
+    hide the other one's answer.
+    """
+    monkeypatch.setattr(hedging, "GEMINI_HEDGE_DEFAULT_DELAY_SECONDS", 0.02)
+    monkeypatch.setattr(hedging, "hedge_policy", HedgePolicy())
+    monkeypatch.setattr(hedging, "gemini_admission", GeminiAdmissionController(rpm=10, tpm=1_000_000))
+
+    class Stream:
+        def __init__(self):
+            self.closed = False
+
+        async def aclose(self):
+            self.closed = True
+
+    answered = asyncio.Event()
+    streams = []
+
+    async def start():
+        stream = Stream()
+        streams.append(stream)
+        await answered.wait()
+        return ("session", stream)
+
+    asyncio.get_running_loop().call_later(0.1, answered.set)
+    _, winner = await asyncio.wait_for(hedged_first_chunk(start, "m", 100), timeout=2)
+    assert len(streams) == 2
+    assert [stream.closed for stream in streams if stream is not winner] == [True]
+    assert not winner.closed
+
+    outcomes = [asyncio.CancelledError(), None]
+
+    async def start_cancelled_primary():
+        outcome = outcomes.pop(0)
+        await asyncio.sleep(0.05)
+        if outcome is not None:
+            raise outcome
+        return "hedge answer"
+
+    assert await asyncio.wait_for(hedged_first_chunk(start_cancelled_primary, "m", 100), timeout=2) == "hedge answer"
@@ -0,0 +1,38 @@
+import pytest
+
+from bot import http_client
+from bot.http_client import get_http_client, close_http_client, get_http_client_stats
+
+
+@pytest.mark.asyncio
+async def test_shared_client_is_reused_until_closed():
+    """
+    Tests that every caller gets the same pooled client and that a new one is
+    created after the shutdown hook closed it.
+    """
+    first = get_http_client()
+    assert get_http_client() is first
+
+    await close_http_client()
+    assert first.is_closed
+
+    second = get_http_client()
+    assert second is not first
+    await close_http_client()
+
+
+@pytest.mark.asyncio
+async def test_connection_reuse_rate(monkeypatch):
+    """
+    Tests that the reuse rate counts requests that did not need a new TCP connection.
+    """
+    monkeypatch.setattr(http_client, "_http_stats", {"requests": 0, "new_connections": 0})
+    client = get_http_client()
+    for _ in range(4):
+        request = client.build_request("GET", "https://example.com")
+        await http_client._attach_trace(request)
+    await http_client._trace("connection.connect_tcp.complete", {})
+
+    stats = get_http_client_stats()
+    assert stats == {"requests": 4, "new_connections": 1, "reuse_rate": 75.0}
+    await close_http_client()
@@ -0,0 +1,54 @@
+import io
+
+import pytest
+from PIL import Image
+
+from bot import image_preprocessing
+from bot.image_preprocessing import preprocess_image, preprocess_image_sync, get_image_preprocessing_stats
+
+
+def encode(image: Image.Image, image_format: str, **kwargs) -> bytes:
+    with io.BytesIO() as out:
+        image.save(out, format=image_format, **kwargs)
+        return out.getvalue()
+
+
+def test_large_photo_is_downscaled_reoriented_and_stripped_of_exif(monkeypatch):
+    """
+    Tests that a photo over the size limit is scaled to the max edge as it would be
+    displayed (EXIF orientation applied), re-encoded smaller, and has no EXIF left.
+    """
+    monkeypatch.setattr(image_preprocessing, "IMAGE_MAX_EDGE", 400)
+    exif = Image.Exif()
+    exif[0x0112] = 6  # Orientation: rotate 90° clockwise
+    exif[0x010F] = "Phone Maker"
+    photo = Image.effect_noise((1200, 800), 60).convert("RGB")
+    original = encode(photo, "JPEG", quality=95, exif=exif)
+
+    prepared = preprocess_image_sync(original)
+
+    assert not prepared.skipped and prepared.mime_type == "image/jpeg"
+    assert len(prepared.data) < len(original)
+    with Image.open(io.BytesIO(prepared.data)) as result:
+        assert result.size == (267, 400)  # Portrait after applying the orientation
+        assert not result.getexif()
+
+
+@pytest.mark.asyncio
+async def test_small_images_pass_through_and_unknown_formats_are_not_made_bigger(monkeypatch):
+    """
+    Tests that a small PNG is sent untouched, that a BMP is re-encoded to a compact JPEG
+    instead of a larger PNG, and that the pool path records the savings.
+    """
+    monkeypatch.setattr(image_preprocessing, "_stats", image_preprocessing._PreprocessingStats())
+    small_png = encode(Image.new("RGB", (64, 64), (200, 30, 30)), "PNG")
+    bmp = encode(Image.new("RGB", (300, 200), (10, 120, 200)), "BMP")
+
+    passed = await preprocess_image(small_png)
+    converted = await preprocess_image(bmp)
+
+    assert passed.skipped and passed.data == small_png and passed.mime_type == "image/png"
+    assert converted.mime_type == "image/jpeg" and len(converted.data) < len(bmp) / 10
+    stats = get_image_preprocessing_stats()
+    assert (stats["images"], stats["skipped"]) == (2, 1)
+    assert stats["bytes_saved"]["p95"] == len(bmp) - len(converted.data)
@@ -0,0 +1,73 @@
+import random
+
+from telegram import MessageEntity
+
+from bot.markdown_entities import render_markdown, truncate_rendered, utf16_len
+
+
+def entity_text(text, entity):
+    encoded = text.encode('utf-16-le')
+    return encoded[entity.offset * 2:(entity.offset + entity.length) * 2].decode('utf-16-le')
+
+
+def test_render_markdown_entities_and_utf16_offsets():
+    """
+    Tests the common Gemini constructs, with offsets counted in UTF-16 code units
+    (the emoji before the bold text takes two).
+    """
+    text, entities = render_markdown("## Result 🎉\n\n😀 **Bold _nested_** and `x = 1`\n"
+                                     "* [docs](https://example.com/a_(b)) my_var_name\n"
+                                     "```python\nprint('hi')\n```")
+
+    assert text == "Result 🎉\n\n😀 Bold nested and x = 1\n• docs my_var_name\nprint('hi')"
+    rendered = [(entity.type, entity_text(text, entity)) for entity in entities]
+    assert rendered == [(MessageEntity.BOLD, "Result 🎉"), (MessageEntity.BOLD, "Bold nested"),
+                        (MessageEntity.ITALIC, "nested"), (MessageEntity.CODE, "x = 1"),
+                        (MessageEntity.TEXT_LINK, "docs"), (MessageEntity.PRE, "print('hi')")]
+    assert entities[4].url == "https://example.com/a_(b)"
+    assert entities[5].language == "python"
+
+
+def test_render_markdown_never_produces_invalid_entities():
+    """
+    Property test: for random Markdown-heavy input the entities are non-empty, inside
+    the text, never partially overlap, and code never sits inside another entity.
+    """
+    tokens = ["word", "😀", " ", "\n", "\n\n", "**", "*", "_", "__", "~", "~~", "||", "`", "```", "```py\n",
+              "\n```", "# ", "[", "](", "https://t.me/x", "javascript:x", ")", "- ", "\\*"]
+    rng = random.Random(99)
+    for _ in range(2000):
+        source = "".join(rng.choice(tokens) for _ in range(rng.randint(0, 60)))
+        text, entities = render_markdown(source)
+        total = utf16_len(text)
+        for entity in entities:
+            assert entity.length > 0 and entity.offset + entity.length <= total, repr(source)
+        for outer in entities:
+            for inner in entities:
+                if inner is outer or inner.offset >= outer.offset + outer.length \
+                        or outer.offset >= inner.offset + inner.length:
+                    continue
+                inside = outer.offset <= inner.offset and inner.offset + inner.length <= outer.offset + outer.length
+                contains = inner.offset <= outer.offset and outer.offset + outer.length <= inner.offset + inner.length
+                assert inside or contains, repr(source)
+                if inside and (inner.offset, inner.length) != (outer.offset, outer.length):
+                    assert inner.type not in (MessageEntity.CODE, MessageEntity.PRE), repr(source)
+
+
+def test_single_asterisks_are_bold_as_in_markdown_v2():
+    """Tests that `*x*`, which the system prompt asks Gemini to use for bold, renders bold."""
+    text, entities = render_markdown("This is *bold* and _italic_.")
+
+    assert text == "This is bold and italic."
+    assert [(entity.type, entity_text(text, entity)) for entity in entities] == \
+        [(MessageEntity.BOLD, "bold"), (MessageEntity.ITALIC, "italic")]
+
+
+def test_unsupported_links_and_truncation():
+    text, entities = render_markdown("[click](javascript:alert) " + "😀" * 10 + " **end**")
+    assert text.startswith("click (javascript:alert) ")
+    assert [entity.type for entity in entities] == [MessageEntity.BOLD]
+
+    truncated, clipped = truncate_rendered(text, entities, max_length=utf16_len(text) - 2)
+    assert truncated.endswith(" e")
+    assert clipped[0].length == 1
@@ -0,0 +1,34 @@
+import pytest
+
+from bot.markdown_v2 import find_markdown_v2_error
+from bot.telegram_bot import escape_markdown_v2, prepare_markdown_v2
+
+
+@pytest.mark.parametrize("text", [
+    r"Hello *bold* and _italic_ \.",
+    r"__underline__ ||spoiler|| ~strike~ *bold _nested_*",
+    "`code with * and _ inside`",
+    "```python\nx = 1 * 2\n```",
+    r"[link](http://example.com/a\)b)",
+    "> a quote\nnext line",
+])
+def test_valid_markdown_v2_is_accepted(text):
+    assert find_markdown_v2_error(text) is None
+
+
+def test_invalid_markdown_v2_reports_telegram_errors():
+    """
+    Tests the errors Telegram answers with, including byte offsets that count the
+    UTF-8 length of the emoji before the unclosed entity.
+    """
+    assert find_markdown_v2_error("😀 *x") == "Can't find end of bold entity at byte offset 5"
+    assert find_markdown_v2_error("*a _b* c_") == "Can't find end of italic entity at byte offset 8"
+    assert find_markdown_v2_error("a.b") == "Character '.' is reserved and must be escaped with the preceding '\\'"
+    assert find_markdown_v2_error("[link](http://a") == "Can't find end of a URL at byte offset 7"
+    assert find_markdown_v2_error("  ") == "Message text is empty"
+
+
+def test_prepare_markdown_v2_picks_the_parse_mode_up_front():
+    assert prepare_markdown_v2("Use **bold** here.") == (escape_markdown_v2("Use **bold** here."), "MarkdownV2")
+    # An unbalanced '*' (e.g. "2 * 3") would be rejected, so plain text is chosen without an API call.
+    assert prepare_markdown_v2("2 * 3 = 6, see my_var.") == ("2 * 3 = 6, see my_var.", None)
@@ -0,0 +1,46 @@
+import asyncio
+
+import pytest
+
+from bot import media_cache as media_cache_module
+from bot.cache_utils import TTLCache, SingleFlight
+from bot.image_preprocessing import PreparedImage
+from bot.media_cache import get_processed_media
+
+
+@pytest.mark.asyncio
+async def test_repeated_media_is_processed_once_per_file_unique_id(monkeypatch):
+    """
+    Tests that forwarding the same file again is served from the cache, that concurrent
+    requests share one download, and that failed downloads (None) are retried.
+    """
+    monkeypatch.setattr(media_cache_module, "media_cache", TTLCache("media", ttl_seconds=60, max_bytes=10_000,
+                                                                    size_func=media_cache_module._entry_size))
+    monkeypatch.setattr(media_cache_module, "_media_single_flight", SingleFlight())
+    calls = []
+
+    async def extract():
+        calls.append("document")
+        await asyncio.sleep(0.01)
+        return "Worksheet 3: quadratic equations"
+
+    first, second = await asyncio.gather(get_processed_media("document", "AgADx1", extract),
+                                         get_processed_media("document", "AgADx1", extract))
+    again = await get_processed_media("document", "AgADx1", extract)
+    assert first == second == again == "Worksheet 3: quadratic equations"
+    assert calls == ["document"]
+
+    async def failed_download():
+        calls.append("failed")
+        return None
+
+    assert await get_processed_media("image", "AgADy2", failed_download) is None
+    assert await get_processed_media("image", "AgADy2", failed_download) is None
+    assert calls.count("failed") == 2
+
+    async def prepare():
+        return PreparedImage(b"\xff" * 20_000, "image/jpeg", 40_000, 0.01)
+
+    await get_processed_media("image", "AgADz3", prepare)  # Over the byte budget, so not kept
+    stats = media_cache_module.get_media_cache_stats()
+    assert (stats["entries"], stats["collapsed"]) == (1, 1)
@@ -0,0 +1,43 @@
+import os
+
+import pytest
+from unittest.mock import AsyncMock, MagicMock
+
+from bot import media_download
+from bot.document_extraction import extract_text_sync
+from bot.media_download import download_media
+
+
+def make_bot(content: bytes):
+    async def download_to_memory(out):
+        out.write(content)
+
+    file_obj = MagicMock(file_size=len(content))
+    file_obj.download_to_memory = AsyncMock(side_effect=download_to_memory)
+    bot = MagicMock()
+    bot.get_file = AsyncMock(return_value=file_obj)
+    return bot
+
+
+@pytest.mark.asyncio
+async def test_small_files_stay_in_memory_and_large_ones_spill_to_a_self_deleting_file(tmp_path, monkeypatch):
+    """
+    Tests that a file under the threshold never touches the disk and is exposed as a
+    zero-copy view, while a larger one is written to a temp file that close() removes.
+    """
+    monkeypatch.setattr(media_download, "MEDIA_SPILL_THRESHOLD_BYTES", 16)
+    monkeypatch.setattr(media_download, "MEDIA_SPILL_DIR", str(tmp_path))
+
+    with await download_media(make_bot(b"short notes"), "small") as media:
+        assert not media.spilled and media.size == 11
+        with media.getbuffer() as view:
+            assert view.readonly is False and bytes(view) == b"short notes"
+        assert media.source == b"short notes"
+    assert os.listdir(tmp_path) == []
+
+    with await download_media(make_bot(b"a much longer set of lecture notes"), "large") as media:
+        assert media.spilled
+        assert os.path.dirname(media.source) == str(tmp_path)
+        assert extract_text_sync("txt", media.source) == "a much longer set of lecture notes"
+        assert media.file.read(6) == b"a much"
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,191 @@
+import pytest
+from unittest.mock import AsyncMock, MagicMock, patch
+
+from google.api_core import exceptions
+
+from bot import gemini_utils
+from bot import model_router as router_module
+from bot.gemini_admission import GeminiAdmissionController
+from bot.model_router import ModelRouter, CircuitBreaker
+
+
+def test_breaker_opens_on_errors_and_slow_calls_and_recovers_through_a_probe(monkeypatch):
+    """
+    Tests that a model's circuit opens once enough recent calls failed or were slow, that
+    traffic then goes to the next tier, and that one successful probe closes it again.
+    """
+    monkeypatch.setattr(router_module, "BREAKER_MIN_CALLS", 4)
+    monkeypatch.setattr(router_module, "BREAKER_COOLDOWN_SECONDS", 0.0)
+    router = ModelRouter(["flash", "lite"])
+
+    router.record_success("flash", 0.5)
+    router.record_success("flash", 0.5)
+    router.record_failure("flash")
+    assert router.select() == "flash"
+    router.record_success("flash", router_module.BREAKER_SLOW_CALL_SECONDS + 1)  # Too slow to count as healthy
+    assert router.breakers["flash"].state == CircuitBreaker.OPEN
+
+    monkeypatch.setattr(router_module, "BREAKER_COOLDOWN_SECONDS", 60.0)
+    assert router.select() == "lite"
+    assert router.select(avoid={"lite"}) == "lite"  # Nothing else is available
+
+    monkeypatch.setattr(router_module, "BREAKER_COOLDOWN_SECONDS", 0.0)
+    assert router.select() == "flash"  # The half-open probe
+    router.record_success("flash", 0.4)
+    assert router.breakers["flash"].state == CircuitBreaker.CLOSED
+
+    stats = router.get_stats()
+    assert stats["models"]["flash"]["times_opened"] == 1
+    assert stats["tier_usage"]["flash"] == 4
+
+
+@pytest.mark.asyncio
+async def test_non_stream_call_falls_back_to_the_next_tier_and_then_to_a_cached_answer():
+    """
+    Tests that a server error on the first tier is answered by the second tier, and that
+    the same question is answered from the answer cache once no model can be called.
+    """
+    router = ModelRouter(["flash", "lite"])
+
+    def context_model(model_name, system_prompt, history, **kwargs):
+        session = MagicMock()
+        if model_name == "flash":
+            session.send_message_async = AsyncMock(side_effect=exceptions.ServiceUnavailable("overloaded"))
+        else:
+            session.send_message_async = AsyncMock(return_value=MagicMock(text="Mitochondria make ATP."))
+        model = MagicMock()
+        model.start_chat.return_value = session
+        return model, history, None
+
+    with patch.object(gemini_utils, "model_router", router), \
+            patch.object(gemini_utils, "gemini_admission", GeminiAdmissionController()), \
+            patch("bot.gemini_utils.get_context_model", side_effect=context_model):
+        answer = await gemini_utils.ask_gemini_non_stream("What do mitochondria do?", "Be a tutor.", [])
+        assert answer == "Mitochondria make ATP."
+        assert router.breakers["flash"].stats["failures"] == 1
+
+        for breaker in router.breakers.values():
+            breaker._open(0.0)
+            breaker.opened_at = float("inf")
+        cached = await gemini_utils.ask_gemini_non_stream("what do  Mitochondria do?", "Be a tutor.", [])
+        missing = await gemini_utils.ask_gemini_non_stream("Something new?", "Be a tutor.", [])
+
+    assert cached == "Mitochondria make ATP."
+    assert missing.startswith("[AI ERROR")
+    usage = router.get_stats()["tier_usage"]
+    assert (usage["lite"], usage["cached_answer"], usage["unavailable"]) == (1, 1, 1)
+
+
+@pytest.mark.asyncio
+async def test_client_errors_do_not_count_against_the_breaker(monkeypatch):
+    """
+    Tests that rejected requests (a bad prompt, an oversized upload) never open a model's
+    circuit, while server errors still do.
+    """
+    monkeypatch.setattr(router_module, "BREAKER_MIN_CALLS", 2)
+    router = ModelRouter(["flash"])
+    errors = [exceptions.InvalidArgument("request too large")] * 3
+
+    def context_model(model_name, system_prompt, history, **kwargs):
+        session = MagicMock()
+        session.send_message_async = AsyncMock(side_effect=errors.pop(0))
+        model = MagicMock()
+        model.start_chat.return_value = session
+        return model, history, None
+
+    with patch.object(gemini_utils, "model_router", router), \
+            patch.object(gemini_utils, "gemini_admission", GeminiAdmissionController()), \
+            patch("bot.gemini_utils.get_context_model", side_effect=context_model):
+        for _ in range(3):
+            await gemini_utils.ask_gemini_non_stream("A huge prompt", "Be a tutor.", [])
+        assert router.breakers["flash"].stats["failures"] == 0
+        assert router.breakers["flash"].state == CircuitBreaker.CLOSED
+
+        for _ in range(2):
+            assert gemini_utils._handle_failure(exceptions.ServiceUnavailable("down"), "flash", None, 0.0) \
+                == gemini_utils.RETRY_LATER
+
+    assert router.breakers["flash"].stats["failures"] == 2
+    assert router.breakers["flash"].state == CircuitBreaker.OPEN
+
+
+@pytest.mark.asyncio
+async def test_cached_answers_never_cross_chats_or_conversations():
+    """
+    Tests that the cached-answer tier only answers the chat and conversation that produced
+    the answer, so a follow-up like "tell me more" cannot leak another user's answer.
+    """
+    router = ModelRouter(["flash"])
+    history = [{"role": "user", "parts": ["What is osmosis?"]}, {"role": "model", "parts": ["Water moving..."]}]
+
+    def context_model(model_name, system_prompt, history, **kwargs):
+        session = MagicMock()
+        session.send_message_async = AsyncMock(return_value=MagicMock(text="Private follow-up answer."))
+        model = MagicMock()
+        model.start_chat.return_value = session
+        return model, history, None
+
+    with patch.object(gemini_utils, "model_router", router), \
+            patch.object(gemini_utils, "gemini_admission", GeminiAdmissionController()), \
+            patch("bot.gemini_utils.get_context_model", side_effect=context_model):
+        await gemini_utils.ask_gemini_non_stream("Tell me more", "Be a tutor.", history, chat_id=1)
+
+        router.breakers["flash"]._open(0.0)
+        router.breakers["flash"].opened_at = float("inf")
+        same_chat = await gemini_utils.ask_gemini_non_stream("tell me  more", "Be a tutor.", history, chat_id=1)
+        other_chat = await gemini_utils.ask_gemini_non_stream("Tell me more", "Be a tutor.", history, chat_id=2)
+        new_conversation = await gemini_utils.ask_gemini_non_stream("Tell me more", "Be a tutor.", [], chat_id=1)
+
+    assert same_chat == "Private follow-up answer."
+    assert other_chat.startswith("[AI ERROR") and new_conversation.startswith("[AI ERROR")
+
+
+@pytest.mark.asyncio
+async def test_stream_failing_after_partial_output_is_not_replayed_on_another_tier():
+    """
+    Tests that a stream which breaks after text was already shown ends with an error
+    instead of retrying on the next tier and streaming the answer a second time.
+    """
+    router = ModelRouter(["flash", "lite"])
+    started = []
+
+    class BrokenStream:
+        async def __aiter__(self):
+            yield MagicMock(parts=[], text="Photosynthesis turns light ")
+            raise exceptions.ServiceUnavailable("connection reset")
+
+    def context_model(model_name, system_prompt, history, **kwargs):
+        started.append(model_name)
+        session = MagicMock()
+        session.send_message_async = AsyncMock(return_value=BrokenStream())
+        model = MagicMock()
+        model.start_chat.return_value = session
+        return model, history, None
+
+    with patch.object(gemini_utils, "model_router", router), \
+            patch.object(gemini_utils, "gemini_admission", GeminiAdmissionController()), \
+            patch("bot.gemini_utils.get_context_model", side_effect=context_model):
+        chunks = [chunk async for chunk in gemini_utils.ask_gemini_stream("Explain photosynthesis", [], "Tutor")]
+
+    assert started == ["flash"]
+    assert chunks[0] == "Photosynthesis turns light "
+    assert len(chunks) == 2 and "[AI ERROR" in chunks[1]
+
+
+@pytest.mark.asyncio
+async def test_vision_request_with_every_circuit_open_says_the_service_is_unavailable():
+    """
+    Tests that a vision request that finds no model to call reports the service as
+    unavailable instead of an error with no details.
+    """
+    router = ModelRouter(["flash"])
+    router.breakers["flash"]._open(0.0)
+    router.breakers["flash"].opened_at = float("inf")
+
+    with patch.object(gemini_utils, "model_router", router), \
+            patch("bot.gemini_utils.get_context_model") as context_model:
+        chunks = [chunk async for chunk in
+                  gemini_utils.ask_gemini_vision_stream("What is this?", b"img", "image/jpeg", [], "Tutor")]
+
+    context_model.assert_not_called()
+    assert chunks == ["[AI ERROR: The AI service is temporarily unavailable. Please try again in a minute.]"]
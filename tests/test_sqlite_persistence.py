@@ -0,0 +1,161 @@
+import time
+import asyncio
+
+import pytest
+from telegram.ext import PicklePersistence
+
+from bot.sqlite_persistence import SQLitePersistence, import_pickle_file
+
+
+async def run_persistence_round(persistence: SQLitePersistence) -> None:
+    """Lets the batched write task scheduled by the update_* calls finish."""
+    await asyncio.sleep(0)
+    await persistence.flush()
+
+
+@pytest.mark.asyncio
+async def test_chat_data_is_loaded_lazily_after_restart(tmp_path):
+    """
+    Tests that chat data survives a restart, is not loaded at startup and is
+    merged into the live dict on the first refresh.
+    """
+    db_path = str(tmp_path / "state.sqlite3")
+    persistence = SQLitePersistence(db_path)
+    await persistence.update_chat_data(1, {"conversation_history": ["hi"]})
+    await persistence.update_user_data(7, {"selected_language": "de"})
+    await persistence.update_bot_data({"stats": {"messages_received": 3}})
+    await run_persistence_round(persistence)
+    persistence.close()
+
+    restarted = SQLitePersistence(db_path)
+    assert await restarted.get_chat_data() == {}
+    assert await restarted.get_bot_data() == {"stats": {"messages_received": 3}}
+
+    live_chat_data = {"scratch": {}}
+    await restarted.refresh_chat_data(1, live_chat_data)
+    assert live_chat_data == {"conversation_history": ["hi"], "scratch": {}}
+
+    live_user_data = {}
+    await restarted.refresh_user_data(7, live_user_data)
+    assert live_user_data == {"selected_language": "de"}
+    restarted.close()
+
+
+@pytest.mark.asyncio
+async def test_only_changed_bot_data_keys_are_written(tmp_path):
+    """
+    Tests that an unchanged bot_data key is not rewritten and that removed keys
+    are deleted from the database.
+    """
+    persistence = SQLitePersistence(str(tmp_path / "state.sqlite3"))
+    await persistence.update_bot_data({"stats": {"a": 1}, "feedback_log": []})
+    assert len(persistence._pending["bot_data"]) == 2
+    await run_persistence_round(persistence)
+
+    await persistence.update_bot_data({"stats": {"a": 2}})
+    # 'stats' changed and 'feedback_log' was removed; nothing else is pending.
+    assert len(persistence._pending["bot_data"]) == 2
+    assert list(persistence._pending["bot_data"].values()).count(None) == 1
+    await run_persistence_round(persistence)
+
+    assert persistence.count_rows("bot_data") == 1
+    assert await persistence.get_bot_data() == {"stats": {"a": 2}}
+    persistence.close()
+
+
+@pytest.mark.asyncio
+async def test_dropped_chat_is_deleted(tmp_path):
+    persistence = SQLitePersistence(str(tmp_path / "state.sqlite3"))
+    await persistence.update_chat_data(1, {"x": 1})
+    await persistence.update_chat_data(2, {"x": 2})
+    await run_persistence_round(persistence)
+    await persistence.drop_chat_data(1)
+    await run_persistence_round(persistence)
+    assert persistence.count_rows("chat_data") == 1
+    persistence.close()
+
+
+@pytest.mark.asyncio
+async def test_refresh_before_the_delete_is_written_does_not_revive_a_dropped_chat(tmp_path):
+    """
+    Tests that a chat refreshed after `drop_chat_data` stays empty, both while the delete
+    is still queued and while its batch is being written.
+    """
+    persistence = SQLitePersistence(str(tmp_path / "state.sqlite3"))
+    for chat_id in (1, 2):
+        await persistence.update_chat_data(chat_id, {"x": chat_id})
+    await persistence.flush()
+
+    await persistence.drop_chat_data(1)
+    queued = {}
+    await persistence.refresh_chat_data(1, queued)
+    await persistence.drop_chat_data(2)
+    # Let the write task take the batch, then refresh while it is being written.
+    await asyncio.sleep(0)
+    in_flight = {}
+    await persistence.refresh_chat_data(2, in_flight)
+    await persistence.flush()
+
+    assert queued == {} and in_flight == {}
+    assert persistence.count_rows("chat_data") == 0
+    persistence.close()
+
+
+@pytest.mark.asyncio
+async def test_import_pickle_file(tmp_path):
+    """
+    Tests that the migration tool copies users, chats and bot_data from a
+    PicklePersistence file into the SQLite database.
+    """
+    pickle_path = tmp_path / "bot_persistence.pkl"
+    source = PicklePersistence(filepath=pickle_path)
+    await source.update_chat_data(10, {"conversation_history": [{"role": "user"}]})
+    await source.update_user_data(20, {"study_subject": "Physics"})
+    await source.update_bot_data({"stats": {"new_users": 4}})
+    await source.flush()
+
+    db_path = str(tmp_path / "state.sqlite3")
+    counts = await import_pickle_file(str(pickle_path), db_path)
+    assert counts == {"users": 1, "chats": 1, "bot_data_keys": 1}
+
+    persistence = SQLitePersistence(db_path)
+    chat_data = {}
+    await persistence.refresh_chat_data(10, chat_data)
+    assert chat_data == {"conversation_history": [{"role": "user"}]}
+    assert await persistence.get_bot_data() == {"stats": {"new_users": 4}}
+    persistence.close()
+
+
+@pytest.mark.asyncio
+async def test_flush_waits_for_the_batch_in_flight_and_batches_never_overlap(tmp_path):
+    """
+    Tests that flush() returns only after a slow batch has been committed, and that rows
+    changed during that write go into a later batch instead of a concurrent one, so the
+    newest data is what ends up on disk.
+    """
+    persistence = SQLitePersistence(str(tmp_path / "state.sqlite3"))
+    write_batch = persistence._write_batch
+    writing, overlaps = [], []
+
+    def slow_write_batch(*batch):
+        if writing:
+            overlaps.append(True)
+        writing.append(True)
+        time.sleep(0.1)
+        write_batch(*batch)
+        writing.pop()
+
+    persistence._write_batch = slow_write_batch
+    await persistence.update_chat_data(1, {"x": "old"})
+    await asyncio.sleep(0.02)  # The first batch is now being written
+    await persistence.update_chat_data(1, {"x": "new"})
+    await persistence.update_chat_data(2, {"x": 2})
+    await persistence.flush()
+
+    assert not overlaps
+    assert persistence.count_rows("chat_data") == 2
+    restarted_chat_data = {}
+    persistence._loaded_chat_ids.clear()
+    await persistence.refresh_chat_data(1, restarted_chat_data)
+    assert restarted_chat_data == {"x": "new"}
+    persistence.close()
@@ -0,0 +1,117 @@
+import time
+
+import pytest
+from unittest.mock import MagicMock
+
+from bot import state_janitor
+from bot.sqlite_persistence import SQLitePersistence
+from bot.state_janitor import sweep_chat_state, sweep_stored_chats, state_janitor_job, LAST_ACTIVE_KEY
+
+
+def test_idle_chats_lose_heavy_fields_after_their_ttl():
+    """
+    Tests that heavy fields expire on their own TTL while light settings stay, and that
+    state from before the janitor existed is stamped instead of evicted.
+    """
+    now = 1_000_000.0
+    day = 24 * 3600
+    chat_data = {
+        1: {LAST_ACTIVE_KEY: now - 2 * day, "last_url_content": "page", "last_url_source": "https://a.b",
+            "conversation_history": [{"role": "user"}], "selected_language": "en"},
+        2: {LAST_ACTIVE_KEY: now - 8 * day, "conversation_history": [{"role": "user"}]},
+        3: {LAST_ACTIVE_KEY: now - 60, "last_url_content": "page"},
+        4: {"document_index": "legacy"},
+    }
+
+    changed = sweep_chat_state(chat_data, now=now)
+
+    assert changed == [1, 2]
+    assert chat_data[1] == {LAST_ACTIVE_KEY: now - 2 * day, "conversation_history": [{"role": "user"}],
+                            "selected_language": "en"}
+    assert "conversation_history" not in chat_data[2]
+    assert chat_data[3]["last_url_content"] == "page"
+    assert chat_data[4] == {"document_index": "legacy", LAST_ACTIVE_KEY: now}
+
+
+@pytest.mark.asyncio
+async def test_byte_budget_evicts_least_recently_active_chats(monkeypatch):
+    """
+    Tests that a field over its global budget is dropped from the oldest chats first,
+    that resident size is reported, and that the job marks changed chats for persistence.
+    """
+    ttl, _, companions = state_janitor.EVICTABLE_FIELDS["last_url_content"]
+    monkeypatch.setitem(state_janitor.EVICTABLE_FIELDS, "last_url_content", (ttl, 25_000, companions))
+    now = time.time()
+    chat_data = {chat_id: {LAST_ACTIVE_KEY: now - chat_id, "last_url_content": "x" * 10_000}
+                 for chat_id in range(1, 6)}
+    application = MagicMock()
+    application.chat_data = chat_data
+    application.persistence = None
+    context = MagicMock()
+    context.application = application
+
+    await state_janitor_job(context)
+
+    assert sorted(chat_id for chat_id, data in chat_data.items() if "last_url_content" in data) == [1, 2]
+    assert 20_000 <= state_janitor.get_state_janitor_stats()["field_bytes"]["last_url_content"] <= 25_000
+    application.mark_data_for_update_persistence.assert_called_once_with(chat_ids=[3, 4, 5])
+
+
+def test_unchanged_values_are_not_measured_again(monkeypatch):
+    """Tests that a sweep only pickles values that were replaced since the previous sweep."""
+    measured = []
+    size_of = state_janitor._size_of
+    monkeypatch.setattr(state_janitor, "_size_of", lambda value: measured.append(value) or size_of(value))
+    now = time.time()
+    chat_data = {1: {LAST_ACTIVE_KEY: now, "last_url_content": "page", "conversation_history": [{"role": "user"}]}}
+
+    sweep_chat_state(chat_data, now=now)
+    sweep_chat_state(chat_data, now=now)
+    assert len(measured) == 2
+
+    chat_data[1]["last_url_content"] = "another page"
+    sweep_chat_state(chat_data, now=now)
+    assert measured[-1] == "another page" and len(measured) == 3
+
+
+@pytest.mark.asyncio
+async def test_stored_chats_idle_across_a_restart_are_trimmed(tmp_path, monkeypatch):
+    """
+    Tests that chats only present in SQLite (never loaded after a restart) lose their idle
+    fields, that rows from before the last_active column are stamped, and that a later run
+    does not read the same rows back again.
+    """
+    monkeypatch.setattr(state_janitor, "_stored_swept_until", {})
+    now = time.time()
+    day = 24 * 3600
+    path = str(tmp_path / "state.sqlite3")
+    persistence = SQLitePersistence(path)
+    await persistence.update_chat_data(1, {LAST_ACTIVE_KEY: now - 2 * day, "last_url_content": "page",
+                                           "conversation_history": ["hi"]})
+    await persistence.update_chat_data(2, {LAST_ACTIVE_KEY: now - 60, "last_url_content": "page"})
+    await persistence.update_chat_data(3, {"document_index": "legacy"})
+    await persistence.flush()
+    persistence._connection.execute("UPDATE chat_data SET last_active = NULL WHERE chat_id = 3")
+    persistence.close()
+
+    restarted = SQLitePersistence(path)
+    seen = []
+    sweep_chat_rows = restarted.sweep_chat_rows
+
+    async def counting_sweep(idle_since, idle_before, trim):
+        return await sweep_chat_rows(idle_since, idle_before, lambda data: seen.append(data) or trim(data))
+
+    monkeypatch.setattr(restarted, "sweep_chat_rows", counting_sweep)
+    assert await sweep_stored_chats(restarted, now=now) == [1, 3]
+    seen_first_run = len(seen)
+    assert await sweep_stored_chats(restarted, now=now + 60) == []
+    assert len(seen) == seen_first_run
+
+    chats = {}
+    for chat_id in (1, 2, 3):
+        chats[chat_id] = {}
+        await restarted.refresh_chat_data(chat_id, chats[chat_id])
+    assert chats[1] == {LAST_ACTIVE_KEY: now - 2 * day, "conversation_history": ["hi"]}
+    assert chats[2]["last_url_content"] == "page"
+    assert chats[3] == {"document_index": "legacy", LAST_ACTIVE_KEY: now}
+    restarted.close()
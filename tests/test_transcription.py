@@ -0,0 +1,40 @@
+import io
+import asyncio
+
+import pytest
+from unittest.mock import MagicMock
+
+from bot import transcription
+from bot.transcription import transcribe_audio
+
+
+@pytest.mark.asyncio
+async def test_whisper_calls_are_limited_and_carry_a_timeout(monkeypatch):
+    """
+    Tests that voice notes beyond WHISPER_MAX_CONCURRENCY wait for a slot instead of all
+    uploading at once, and that each request gets its own timeout.
+    """
+    monkeypatch.setattr(transcription, "WHISPER_MAX_CONCURRENCY", 2)
+    monkeypatch.setattr(transcription, "_semaphore", None)
+    running, peak, timeouts = 0, 0, []
+
+    async def create(model, file, timeout):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        timeouts.append(timeout.read)
+        await asyncio.sleep(0.02)
+        running -= 1
+        return MagicMock(text=f"transcript of {file[0]}")
+
+    client = MagicMock()
+    client.audio.transcriptions.create = create
+    monkeypatch.setattr(transcription, "get_openai_client", lambda: client)
+
+    texts = await asyncio.gather(*(transcribe_audio(f"voice{number}.oga", io.BytesIO(b"OggS"))
+                                   for number in range(5)))
+
+    assert texts == [f"transcript of voice{number}.oga" for number in range(5)]
+    assert peak == 2
+    assert timeouts == [transcription.WHISPER_TIMEOUT_SECONDS] * 5
+    assert transcription.get_transcription_stats()["queued"] >= 3
@@ -0,0 +1,128 @@
+import gc
+import time
+import asyncio
+from unittest.mock import MagicMock
+
+import pytest
+from telegram import Update
+
+from bot.update_processor import PerChatUpdateProcessor
+
+
+def make_update(chat_id: int) -> MagicMock:
+    update = MagicMock(spec=Update)
+    update.effective_chat.id = chat_id
+    return update
+
+
+@pytest.mark.asyncio
+async def test_updates_from_same_chat_run_in_order_and_one_at_a_time():
+    """
+    Tests that updates of one chat never overlap and finish in arrival order,
+    even though other chats are processed alongside them.
+    """
+    processor = PerChatUpdateProcessor(max_concurrent_updates=8)
+    running = {1: 0, 2: 0}
+    max_running = {1: 0, 2: 0}
+    finished = {1: [], 2: []}
+
+    async def handler(chat_id: int, seq: int):
+        running[chat_id] += 1
+        max_running[chat_id] = max(max_running[chat_id], running[chat_id])
+        await asyncio.sleep(0.01 * (5 - seq))  # earlier updates are slower
+        finished[chat_id].append(seq)
+        running[chat_id] -= 1
+
+    tasks = [
+        asyncio.create_task(processor.process_update(make_update(chat_id), handler(chat_id, seq)))
+        for seq in range(5)
+        for chat_id in (1, 2)
+    ]
+    await asyncio.gather(*tasks)
+
+    assert finished == {1: [0, 1, 2, 3, 4], 2: [0, 1, 2, 3, 4]}
+    assert max_running == {1: 1, 2: 1}
+    assert processor.active_chats == 0
+
+
+@pytest.mark.asyncio
+async def test_running_updates_reach_but_never_exceed_the_limit():
+    """
+    Load test: 40 chats with 2 updates each. Tests that as many handlers overlap as the
+    running limit allows, never more, however many updates are admitted and waiting.
+    """
+    for limit in (1, 4, 16):
+        processor = PerChatUpdateProcessor(max_concurrent_updates=limit)
+        running = 0
+        peak = 0
+
+        async def handler():
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.005)
+            running -= 1
+
+        updates = [make_update(chat_id) for _ in range(2) for chat_id in range(40)]
+        await asyncio.gather(*(processor.process_update(update, handler()) for update in updates))
+
+        assert peak == limit
+        assert processor.active_chats == 0
+
+
+@pytest.mark.asyncio
+async def test_throughput_scales_with_the_concurrency_limit():
+    """
+    Load test: 16 chats with 2 updates each, every handler taking 20ms. With a limit of K
+    the load takes about 32/K handler latencies, but never less than the 2 a chat needs
+    for its own updates, which stay one at a time.
+    """
+    latency = 0.02
+    for limit in (1, 4, 16):
+        processor = PerChatUpdateProcessor(max_concurrent_updates=limit)
+        running = {}
+
+        async def handler(chat_id):
+            running[chat_id] = running.get(chat_id, 0) + 1
+            assert running[chat_id] == 1
+            await asyncio.sleep(latency)
+            running[chat_id] -= 1
+
+        updates = [make_update(chat_id) for _ in range(2) for chat_id in range(16)]
+        # Keep full collections of the large test-process heap out of the timing.
+        gc.collect()
+        gc.freeze()
+        try:
+            started = time.perf_counter()
+            await asyncio.gather(*(processor.process_update(update, handler(update.effective_chat.id))
+                                   for update in updates))
+            elapsed = time.perf_counter() - started
+        finally:
+            gc.unfreeze()
+
+        expected = max(32 / limit, 2) * latency
+        print(f"Limit {limit}: {elapsed * 1000:.0f}ms (expected {expected * 1000:.0f}ms)")
+        assert expected * 0.9 <= elapsed <= expected * 2 + 0.05
+
+
+@pytest.mark.asyncio
+async def test_busy_chat_does_not_starve_other_chats():
+    """
+    Tests that a backlog in one chat does not occupy the global slots, so a
+    different chat is served right away.
+    """
+    processor = PerChatUpdateProcessor(max_concurrent_updates=2)
+    other_chat_done = asyncio.Event()
+
+    async def slow_handler():
+        await asyncio.sleep(0.05)
+
+    async def quick_handler():
+        other_chat_done.set()
+
+    busy = [asyncio.create_task(processor.process_update(make_update(1), slow_handler())) for _ in range(5)]
+    await asyncio.sleep(0)
+    quick = asyncio.create_task(processor.process_update(make_update(2), quick_handler()))
+
+    await asyncio.wait_for(other_chat_done.wait(), timeout=0.04)
+    await asyncio.gather(*busy, quick)
@@ -22,4 +22,39 @@ def test_escape_strict_handles_clean_text():
     Tests that text with no special characters remains unchanged.
     """
     raw_text = "This is a clean sentence"
-    assert escape_markdown_v2_strict(raw_text) == raw_text
\ No newline at end of file
+    assert escape_markdown_v2_strict(raw_text) == raw_text
+
+def _reference_transform_markdown_fallback(text):
+    """The original regex cascade of transform_markdown_fallback, frozen for comparison."""
+    import re
+    text = text.replace('\r\n', '\n')
+    text = re.sub(r'```(?:[a-zA-Z0-9_.-]*)?\n(.*?)\n```', r'\1', text, flags=re.DOTALL | re.MULTILINE)
+    text = re.sub(r'```(.*?)```', r'\1', text, flags=re.DOTALL)
+    text = re.sub(r'`(.*?)`', r'\1', text)
+    text = re.sub(r'^\s*#{1,6}\s*(.*?)\s*$', r'\1', text, flags=re.MULTILINE)
+    text = re.sub(r'\[(.*?)\]\((.*?)\)', r'\1 (\2)', text)
+    for pattern in (r'\*\*(.*?)\*\*', r'__(.*?)__', r'\*(.*?)\*', r'_(.*?)_', r'~(.*?)~', r'\|\|(.*?)\|\|'):
+        text = re.sub(pattern, r'\1', text)
+    lines = []
+    for line in text.split('\n'):
+        stripped_line = line.lstrip()
+        if stripped_line.startswith(('* ', '- ', '+ ')):
+            line = ' ' * (len(line) - len(stripped_line)) + '• ' + stripped_line[2:]
+        lines.append(line)
+    return re.sub(r'\n{3,}', '\n\n', "\n".join(lines)).strip()
+
+def test_fallback_transform_matches_reference_cascade():
+    """
+    Property test: the precompiled, fast-pathed fallback transform must produce exactly
+    the output of the original regex cascade, including on inputs without any markers.
+    """
+    import random
+    from bot.telegram_bot import transform_markdown_fallback
+
+    tokens = ["word", "Ünï", " ", "\t", " ", "\x0b", "\n", "\n\n\n", "\r\n", "\r", "**", "*", "_", "__",
+              "~", "||", "`", "```", "```py\n", "\n```", "# ", "#", "[", "](", ")", "- ", "* ", "+ ", "1. "]
+    rng = random.Random(4321)
+    for _ in range(3000):
+        text = "".join(rng.choice(tokens) for _ in range(rng.randint(0, 80)))
+        assert transform_markdown_fallback(text) == _reference_transform_markdown_fallback(text), repr(text)
+    assert transform_markdown_fallback("Plain prose.\nNo markers here.") == "Plain prose.\nNo markers here."
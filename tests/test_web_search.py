@@ -0,0 +1,111 @@
+import asyncio
+from unittest.mock import patch
+
+import pytest
+
+from bot import web_search
+from bot.web_search import (normalize_search_query, perform_web_search, search_cache,
+                            load_search_cache, save_search_cache)
+
+
+def test_normalize_search_query_folds_case_punctuation_and_whitespace():
+    assert normalize_search_query("  Who won the  F1 race?? ") == "who won the f1 race"
+    assert normalize_search_query("who won the F1 race") == normalize_search_query("Who won, the F1 race!")
+
+
+@pytest.mark.asyncio
+async def test_repeated_and_concurrent_queries_run_one_search():
+    """
+    Tests that concurrent identical queries share one in-flight search and that a
+    later, differently formatted query is served from the cache.
+    """
+    search_cache.clear()
+    calls = []
+
+    async def fake_search(query, num_results):
+        calls.append(query)
+        await asyncio.sleep(0.01)
+        return f"report for {query}", True
+
+    with patch("bot.web_search._run_web_search", side_effect=fake_search):
+        results = await asyncio.gather(*(perform_web_search("Oscar winner 2024") for _ in range(5)))
+        cached = await perform_web_search("oscar   WINNER 2024?")
+
+    assert len(calls) == 1
+    assert set(results) == {"report for Oscar winner 2024"}
+    assert cached == "report for Oscar winner 2024"
+    search_cache.clear()
+
+
+@pytest.mark.asyncio
+async def test_failed_searches_are_not_cached():
+    search_cache.clear()
+
+    async def failing_search(query, num_results):
+        return "An error occurred while contacting the search service: 500", False
+
+    with patch("bot.web_search._run_web_search", side_effect=failing_search) as mock_search:
+        await perform_web_search("weather in Almaty")
+        await perform_web_search("weather in Almaty")
+
+    assert mock_search.call_count == 2
+    assert len(search_cache) == 0
+
+
+def test_search_cache_survives_restart(tmp_path):
+    """
+    Tests that saved results are restored from disk and expired ones are dropped.
+    """
+    cache_file = str(tmp_path / "search_cache.json")
+    search_cache.clear()
+    search_cache.set(("latest iphone", 2), "fresh report")
+    search_cache.set(("old news", 2), "stale report", ttl_seconds=-1)
+    assert save_search_cache(cache_file) == 1
+
+    search_cache.clear()
+    assert load_search_cache(cache_file) == 1
+    assert search_cache.get(("latest iphone", 2)) == "fresh report"
+    search_cache.clear()
+
+
+def test_canonicalize_url_strips_tracking_and_fragment():
+    assert web_search.canonicalize_url("HTTPS://Example.com:443/news?utm_source=tg&b=2&a=1&fbclid=x#top") == \
+        "https://example.com/news?a=1&b=2"
+    assert web_search.canonicalize_url("http://example.com") == "http://example.com/"
+
+
+@pytest.mark.asyncio
+async def test_page_cache_revalidates_with_conditional_get(monkeypatch):
+    """
+    Tests that a stale page is revalidated with If-None-Match and that a 304
+    reuses the cached text without parsing the page again.
+    """
+    import httpx
+
+    web_search.page_cache.clear()
+    seen_headers = []
+
+    def handler(request):
+        seen_headers.append(dict(request.headers))
+        if request.headers.get("if-none-match") == '"v1"':
+            return httpx.Response(304)
+        return httpx.Response(200, headers={"Content-Type": "text/html", "ETag": '"v1"'},
+                              content=b"<html><p>Hello</p><p>world</p></html>")
+
+    client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    monkeypatch.setattr(web_search, "PAGE_CACHE_FRESH_SECONDS", 0)
+
+    with patch("bot.web_search.extract_page_text", wraps=web_search.extract_page_text) as mock_extract:
+        first = await web_search.fetch_page_text("https://example.com/a?utm_medium=x", client=client)
+        second = await web_search.fetch_page_text("https://example.com/a#section", client=client)
+
+    assert first == second == "Hello world"
+    assert mock_extract.call_count == 1
+    assert len(seen_headers) == 2
+    assert seen_headers[1]["if-none-match"] == '"v1"'
+
+    monkeypatch.setattr(web_search, "PAGE_CACHE_FRESH_SECONDS", 300)
+    assert await web_search.fetch_page_text("https://example.com/a", client=client) == "Hello world"
+    assert len(seen_headers) == 2  # served from cache without a request
+    await client.aclose()
+    web_search.page_cache.clear()